@@ -1,14 +1,59 @@
 """
 API调用基类，用于封装公共的大模型API调用逻辑
 """
+import time
+import asyncio
 import requests
+import httpx
 import json
 import logging
 from django.conf import settings
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterator, AsyncIterator
+from .utils.http_pool import get_session, get_async_client
+from .utils.circuit_breaker import get_circuit, ProviderCircuit
+from .utils.concurrency_limiter import get_limiter, estimate_request_tokens, usage_tokens, Lease
+from .utils import response_cache
+from .utils.semantic_cache import semantic_cache
+from .utils import single_flight
+from .utils.context_builder import pack_context, prompt_layout
+from .utils import prompt_cache
 
 logger = logging.getLogger(__name__)
 
+
+class ProviderAPIError(Exception):
+    """上游返回错误状态码"""
+    
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ProviderCall:
+    """一次上游调用占用的熔断器探测名额和并发名额，结束时统一记录结果"""
+    
+    def __init__(self, circuit: ProviderCircuit, lease: Lease):
+        self.circuit = circuit
+        self.lease = lease
+        self.start = time.monotonic()
+    
+    def finish(self, error: Optional[BaseException] = None, cancelled: bool = False, latency: Optional[float] = None,
+               usage: Optional[Dict] = None):
+        """
+        :param error: 请求抛出的异常，按状态码决定是否计入熔断器（见circuit_breaker.failure_scope）
+        :param cancelled: 请求被取消（对冲落后、客户端断开），不计入统计
+        :param latency: 流式请求传入首token耗时，默认为总耗时
+        :param usage: 上游返回的usage，其中的总token数替换并发限制器按请求估算的token数
+        """
+        if latency is None:
+            latency = time.monotonic() - self.start
+        if cancelled or error is None:
+            self.circuit.record(None if cancelled else True, latency)
+        else:
+            self.circuit.record_error(error, latency)
+        self.lease.release(error=error, cancelled=cancelled, latency=latency, tokens_used=usage_tokens(usage))
+
+
 class BaseAIApi:
     """大模型API调用基类"""
     
@@ -16,6 +61,8 @@ class BaseAIApi:
         self.base_url = ""
         self.headers = {}
         self.name = "BaseAI"
+        # 流式请求是否传入stream_options.include_usage以在最后一个数据块中返回usage
+        self.stream_usage = False
     
     def _prepare_headers(self, api_key: str) -> Dict[str, str]:
         """准备请求头"""
@@ -27,7 +74,7 @@ class BaseAIApi:
     def _prepare_payload(self, message: str, history: List[Dict], config: Dict) -> Dict:
         """准备请求载荷"""
         # 构建消息历史，最多保留8条
-        messages = self._build_messages(message, history)
+        messages = self._build_messages(message, history, config.get('system_prompt'), config)
         
         payload = {
             'messages': messages,
@@ -43,13 +90,26 @@ class BaseAIApi:
             
         return payload
     
-    def _build_messages(self, user_message: str, history: List[Dict]) -> List[Dict]:
-        """构建消息历史"""
+    def _build_messages(self, user_message: str, history: List[Dict], system_prompt: Optional[str] = None,
+                        config: Optional[Dict] = None) -> List[Dict]:
+        """
+        构建消息历史，按模型的上下文窗口和token预算保留最新的历史
+        prefix_cache布局下知识库上下文放在当前消息之前，会话摘要和历史消息组成跨轮次不变的前缀
+        """
         messages = []
+        system_prompt, history = pack_context(history, system_prompt, user_message, self.name, config or {})
+        system_message = {'role': 'system', 'content': system_prompt} if system_prompt else None
+        prefix_cache = prompt_layout(self.name) == 'prefix_cache'
         
-        # 添加历史消息，最多保留8条
-        if history:
-            messages.extend(history[-8:])
+        # 系统提示（如知识库上下文）优先保留，超出上下文窗口时才截断
+        if system_message and not prefix_cache:
+            messages.append(system_message)
+        
+        # 添加预算内的历史消息
+        messages.extend(history)
+        
+        if system_message and prefix_cache:
+            messages.append(system_message)
         
         # 添加当前用户消息
         messages.append({
@@ -60,9 +120,9 @@ class BaseAIApi:
         return messages
     
     def _make_request(self, url: str, headers: Dict, payload: Dict, timeout: int = 30) -> Dict:
-        """执行HTTP请求"""
+        """执行HTTP请求（复用提供商的连接池）"""
         try:
-            response = requests.post(
+            response = get_session(self.name).post(
                 url=url,
                 headers=headers,
                 json=payload,
@@ -71,7 +131,7 @@ class BaseAIApi:
             
             if not response.ok:
                 logger.error(f"{self.name} API请求失败: {response.status_code} - {response.text}")
-                raise Exception(f"{self.name} API错误: {response.status_code}")
+                raise ProviderAPIError(f"{self.name} API错误: {response.status_code}", response.status_code)
             
             return response.json()
             
@@ -100,38 +160,388 @@ class BaseAIApi:
         if not isinstance(max_tokens, int) or max_tokens < 1 or max_tokens > 4000:
             raise ValueError("最大token数必须在1-4000之间")
 
+    @staticmethod
+    def _report(config: Dict, **info):
+        """写入调用方通过config['call_info']传入的字典，流式调用以此返回用量和是否命中缓存"""
+        if isinstance(config.get('call_info'), dict):
+            config['call_info'].update(info)
+    
     def _extract_response_content(self, response_data: Dict) -> Dict:
         """从API响应中提取内容，子类需要实现具体的提取逻辑"""
         raise NotImplementedError("子类必须实现_extract_response_content方法")
     
-    def send_message(self, message: str, config: Dict) -> Dict:
-        """发送消息到AI模型"""
+    def _request_api_key(self, config: Dict) -> Optional[str]:
+        """本次请求使用的API密钥，调用方传入的用户密钥优先"""
+        return config.get('api_key') or self._get_api_key(config.get('model'))
+    
+    def _get_circuit(self, config: Dict) -> ProviderCircuit:
+        """获取提供商及API密钥的熔断器，熔断期间抛出CircuitOpenError"""
+        circuit = get_circuit(self.name, self._request_api_key(config))
+        circuit.before_request()
+        return circuit
+    
+    def _begin_call(self, config: Dict, request_params: Dict) -> ProviderCall:
+        """
+        检查熔断器并获取并发名额，名额不足时排队
+        排队超过截止时间抛出QueueTimeoutError
+        """
+        circuit = self._get_circuit(config)
+        limiter = get_limiter(self.name, self._request_api_key(config))
+        try:
+            lease = limiter.acquire(estimate_request_tokens(request_params['payload']), config.get('queue_timeout'))
+        except BaseException:
+            circuit.record(None, 0)
+            raise
+        return ProviderCall(circuit, lease)
+    
+    async def _abegin_call(self, config: Dict, request_params: Dict) -> ProviderCall:
+        """异步检查熔断器并获取并发名额，排队期间不阻塞事件循环"""
+        circuit = self._get_circuit(config)
+        limiter = get_limiter(self.name, self._request_api_key(config))
+        try:
+            lease = await limiter.aacquire(estimate_request_tokens(request_params['payload']), config.get('queue_timeout'))
+        except BaseException:
+            circuit.record(None, 0)
+            raise
+        return ProviderCall(circuit, lease)
+    
+    def _build_request(self, message: str, config: Dict) -> Dict:
+        """构建请求参数，同步和异步调用共用"""
         # 验证配置
         self._validate_config(config)
         
-        # 获取API密钥
-        api_key = self._get_api_key(config.get('model'))
+        # 获取API密钥，调用方传入的用户密钥优先
+        api_key = self._request_api_key(config)
         if not api_key:
             raise Exception(f"未配置{self.name} API密钥")
         
         # 准备请求参数
-        headers = self._prepare_headers(api_key)
-        payload = self._prepare_payload(
-            message=message,
-            history=config.get('history', []),
-            config=config
-        )
+        return {
+            'url': self.base_url,
+            'headers': self._prepare_headers(api_key),
+            'payload': self._prepare_payload(
+                message=message,
+                history=config.get('history', []),
+                config=config
+            ),
+            'timeout': config.get('timeout', 30),
+        }
+    
+    def send_message(self, message: str, config: Dict) -> Dict:
+        """
+        发送消息到AI模型
+        config中传入cache=True时使用响应缓存，传入semantic_cache时对独立问题使用语义缓存，
+        这两类请求同时有相同请求进行中时合并为一次上游调用
+        """
+        request_params = self._build_request(message, config)
+        cache_key = response_cache.lookup_key(self.name, config, request_params['payload'])
+        if cache_key:
+            cached = response_cache.get_cached(cache_key, config.get('model'))
+            if cached is not None:
+                return cached
+        answer = semantic_cache.lookup_for(config)
+        if answer is not None:
+            return {'content': answer, 'cached': True, 'semantic': True}
+        
+        key = single_flight.flight_key(self.name, config, request_params['payload'])
+        return single_flight.run(key, lambda: self._call_upstream(config, request_params, cache_key))
+    
+    def _call_upstream(self, config: Dict, request_params: Dict, cache_key: Optional[str]) -> Dict:
+        """调用上游并写入缓存"""
+        call = self._begin_call(config, request_params)
         
         # 发送请求
-        response_data = self._make_request(
-            url=self.base_url,
-            headers=headers,
-            payload=payload,
-            timeout=config.get('timeout', 30)
-        )
+        try:
+            response_data = self._make_request(**request_params)
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        
+        # 提取响应内容
+        result = {}
+        try:
+            result = self._extract_response_content(response_data)
+        finally:
+            call.finish(usage=result.get('usage'))
+        prompt_cache.record_usage(config.get('model'), result.get('usage'))
+        if cache_key:
+            response_cache.set_cached(cache_key, result, request_params['payload'])
+        semantic_cache.store_for(config, result.get('content'))
+        return result
+    
+    async def _make_request_async(self, url: str, headers: Dict, payload: Dict, timeout: int = 30) -> Dict:
+        """异步执行HTTP请求（复用提供商的异步连接池）"""
+        try:
+            client = get_async_client(self.name)
+            response = await client.post(
+                url,
+                headers=headers,
+                json=payload,
+                timeout=timeout
+            )
+            
+            if response.status_code >= 400:
+                logger.error(f"{self.name} API请求失败: {response.status_code} - {response.text}")
+                raise ProviderAPIError(f"{self.name} API错误: {response.status_code}", response.status_code)
+            
+            return response.json()
+            
+        except httpx.TimeoutException:
+            logger.error(f"{self.name} API请求超时")
+            raise Exception(f"{self.name} API请求超时")
+        except httpx.HTTPError as e:
+            logger.error(f"{self.name} API请求异常: {str(e)}")
+            raise Exception(f"{self.name} API请求异常: {str(e)}")
+        except json.JSONDecodeError:
+            logger.error(f"{self.name} API响应JSON解析失败")
+            raise Exception(f"{self.name} API响应解析失败")
+    
+    async def send_message_async(self, message: str, config: Dict) -> Dict:
+        """异步发送消息到AI模型，等待响应期间不占用工作线程"""
+        request_params = self._build_request(message, config)
+        cache_key = None
+        if config.get('cache'):
+            cache_key = await response_cache.alookup_key(self.name, config, request_params['payload'])
+        if cache_key:
+            cached = await response_cache.aget_cached(cache_key, config.get('model'))
+            if cached is not None:
+                return cached
+        answer = await semantic_cache.alookup_for(config)
+        if answer is not None:
+            return {'content': answer, 'cached': True, 'semantic': True}
+        
+        key = single_flight.flight_key(self.name, config, request_params['payload'])
+        return await single_flight.arun(key, lambda: self._acall_upstream(config, request_params, cache_key))
+    
+    async def _acall_upstream(self, config: Dict, request_params: Dict, cache_key: Optional[str]) -> Dict:
+        """异步调用上游并写入缓存"""
+        call = await self._abegin_call(config, request_params)
+        
+        # 发送请求
+        try:
+            response_data = await self._make_request_async(**request_params)
+        except asyncio.CancelledError:
+            # 对冲请求落后时被取消，不计入统计
+            call.finish(cancelled=True)
+            raise
+        except Exception as e:
+            call.finish(error=e)
+            raise
         
         # 提取响应内容
-        return self._extract_response_content(response_data)
+        result = {}
+        try:
+            result = self._extract_response_content(response_data)
+        finally:
+            call.finish(usage=result.get('usage'))
+        await prompt_cache.arecord_usage(config.get('model'), result.get('usage'))
+        if cache_key:
+            await response_cache.aset_cached(cache_key, result, request_params['payload'])
+        await semantic_cache.astore_for(config, result.get('content'))
+        return result
+    
+    def _build_stream_request(self, message: str, config: Dict) -> Dict:
+        """构建流式请求参数，默认使用OpenAI兼容的stream参数"""
+        request_params = self._build_request(message, config)
+        request_params['payload']['stream'] = True
+        if self.stream_usage:
+            request_params['payload']['stream_options'] = {'include_usage': True}
+        return request_params
+    
+    def _extract_stream_delta(self, chunk_data: Dict) -> str:
+        """从OpenAI兼容的流式数据块中提取增量文本"""
+        choices = chunk_data.get('choices') or []
+        if not choices:
+            return ''
+        delta = choices[0].get('delta') or {}
+        return delta.get('content') or ''
+    
+    def _extract_stream_usage(self, chunk_data: Dict) -> Optional[Dict]:
+        """从流式数据块中提取usage，OpenAI兼容接口在最后一个数据块中返回"""
+        return chunk_data.get('usage')
+    
+    def _iter_sse_data(self, lines: Iterator[str]) -> Iterator[Dict]:
+        """解析SSE数据行，逐个返回JSON数据块"""
+        for line in lines:
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                return
+            try:
+                yield json.loads(data)
+            except json.JSONDecodeError:
+                logger.warning(f"{self.name} 流式响应数据解析失败: {data[:100]}")
+    
+    def stream_message(self, message: str, config: Dict) -> Iterator[str]:
+        """
+        流式发送消息到AI模型，逐个返回增量文本
+        生成器被关闭时会同时关闭上游连接；语义缓存命中时一次性返回缓存的回答，
+        相同的独立问题同时进行时共享同一个上游流
+        """
+        answer = semantic_cache.lookup_for(config)
+        if answer is not None:
+            self._report(config, cached=True)
+            yield answer
+            return
+        
+        request_params = self._build_stream_request(message, config)
+        key = single_flight.flight_key(self.name, config, request_params['payload'])
+        yield from single_flight.stream(key, lambda: self._stream_upstream(config, request_params))
+    
+    def _stream_upstream(self, config: Dict, request_params: Dict) -> Iterator[str]:
+        """调用上游流式接口，完整结束后写入语义缓存"""
+        call = self._begin_call(config, request_params)
+        
+        first_token_latency = None
+        completed = False
+        error = None
+        deltas = []
+        usage = {}
+        stream = self._iter_stream(request_params, usage)
+        try:
+            for delta in stream:
+                if first_token_latency is None:
+                    first_token_latency = time.monotonic() - call.start
+                deltas.append(delta)
+                yield delta
+            completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            stream.close()
+            # 已收到token后被客户端关闭视为成功，慢请求按首token耗时判断
+            cancelled = not completed and error is None and first_token_latency is None
+            call.finish(error=error, cancelled=cancelled, latency=first_token_latency, usage=usage)
+        prompt_cache.record_usage(config.get('model'), usage)
+        self._report(config, usage=usage)
+        # 只缓存完整的回答
+        semantic_cache.store_for(config, ''.join(deltas))
+    
+    def _iter_stream(self, request_params: Dict, usage: Optional[Dict] = None) -> Iterator[str]:
+        """
+        发送流式请求并逐个返回增量文本
+        :param usage: 传入时写入数据块中返回的usage
+        """
+        try:
+            response = get_session(self.name).post(
+                url=request_params['url'],
+                headers=request_params['headers'],
+                json=request_params['payload'],
+                timeout=request_params['timeout'],
+                stream=True
+            )
+        except requests.exceptions.Timeout:
+            logger.error(f"{self.name} API请求超时")
+            raise Exception(f"{self.name} API请求超时")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"{self.name} API请求异常: {str(e)}")
+            raise Exception(f"{self.name} API请求异常: {str(e)}")
+        
+        try:
+            if not response.ok:
+                logger.error(f"{self.name} API请求失败: {response.status_code} - {response.text}")
+                raise ProviderAPIError(f"{self.name} API错误: {response.status_code}", response.status_code)
+            
+            # SSE规范默认使用UTF-8编码，避免requests按ISO-8859-1解码中文
+            response.encoding = 'utf-8'
+            for chunk_data in self._iter_sse_data(response.iter_lines(decode_unicode=True)):
+                if usage is not None:
+                    usage.update(self._extract_stream_usage(chunk_data) or {})
+                delta = self._extract_stream_delta(chunk_data)
+                if delta:
+                    yield delta
+        except requests.exceptions.RequestException as e:
+            logger.error(f"{self.name} API流式响应中断: {str(e)}")
+            raise Exception(f"{self.name} API流式响应中断: {str(e)}")
+        finally:
+            response.close()
+    
+    async def stream_message_async(self, message: str, config: Dict) -> AsyncIterator[str]:
+        """
+        异步流式发送消息到AI模型，逐个返回增量文本
+        生成器被关闭或任务被取消时会同时关闭上游连接；语义缓存命中时一次性返回缓存的回答，
+        相同的独立问题同时进行时共享同一个上游流
+        """
+        answer = await semantic_cache.alookup_for(config)
+        if answer is not None:
+            self._report(config, cached=True)
+            yield answer
+            return
+        
+        request_params = self._build_stream_request(message, config)
+        key = single_flight.flight_key(self.name, config, request_params['payload'])
+        stream = single_flight.astream(key, lambda: self._stream_upstream_async(config, request_params))
+        try:
+            async for delta in stream:
+                yield delta
+        finally:
+            await stream.aclose()
+    
+    async def _stream_upstream_async(self, config: Dict, request_params: Dict) -> AsyncIterator[str]:
+        """异步调用上游流式接口，完整结束后写入语义缓存"""
+        call = await self._abegin_call(config, request_params)
+        
+        first_token_latency = None
+        completed = False
+        error = None
+        deltas = []
+        usage = {}
+        stream = self._iter_stream_async(request_params, usage)
+        try:
+            async for delta in stream:
+                if first_token_latency is None:
+                    first_token_latency = time.monotonic() - call.start
+                deltas.append(delta)
+                yield delta
+            completed = True
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await stream.aclose()
+            cancelled = not completed and error is None and first_token_latency is None
+            call.finish(error=error, cancelled=cancelled, latency=first_token_latency, usage=usage)
+        await prompt_cache.arecord_usage(config.get('model'), usage)
+        self._report(config, usage=usage)
+        await semantic_cache.astore_for(config, ''.join(deltas))
+    
+    async def _iter_stream_async(self, request_params: Dict, usage: Optional[Dict] = None) -> AsyncIterator[str]:
+        """
+        异步发送流式请求并逐个返回增量文本
+        :param usage: 传入时写入数据块中返回的usage
+        """
+        client = get_async_client(self.name)
+        
+        try:
+            async with client.stream(
+                'POST',
+                request_params['url'],
+                headers=request_params['headers'],
+                json=request_params['payload'],
+                timeout=request_params['timeout']
+            ) as response:
+                if response.status_code >= 400:
+                    body = await response.aread()
+                    logger.error(f"{self.name} API请求失败: {response.status_code} - {body.decode('utf-8', errors='ignore')}")
+                    raise ProviderAPIError(f"{self.name} API错误: {response.status_code}", response.status_code)
+                
+                async for line in response.aiter_lines():
+                    for chunk_data in self._iter_sse_data([line]):
+                        if usage is not None:
+                            usage.update(self._extract_stream_usage(chunk_data) or {})
+                        delta = self._extract_stream_delta(chunk_data)
+                        if delta:
+                            yield delta
+                    if line.strip() == 'data: [DONE]':
+                        break
+        except httpx.TimeoutException:
+            logger.error(f"{self.name} API请求超时")
+            raise Exception(f"{self.name} API请求超时")
+        except httpx.HTTPError as e:
+            logger.error(f"{self.name} API请求异常: {str(e)}")
+            raise Exception(f"{self.name} API请求异常: {str(e)}")
     
     def _get_api_key(self, model: str) -> Optional[str]:
         """获取对应的API密钥，子类需要实现"""
@@ -145,6 +555,7 @@ class OpenAIApi(BaseAIApi):
         super().__init__()
         self.base_url = getattr(settings, 'OPENAI_API_BASE_URL', 'https://api.openai.com/v1/chat/completions')
         self.name = "OpenAI"
+        self.stream_usage = True
     
     def _get_api_key(self, model: str) -> Optional[str]:
         return getattr(settings, 'OPENAI_API_KEY', None)
@@ -159,7 +570,7 @@ class OpenAIApi(BaseAIApi):
     def _prepare_payload(self, message: str, history: List[Dict], config: Dict) -> Dict:
         """准备OpenAI API请求载荷"""
         # 构建消息历史
-        messages = self._build_messages(message, history)
+        messages = self._build_messages(message, history, config.get('system_prompt'), config)
         
         payload = {
             'model': config.get('model', 'gpt-3.5-turbo'),
@@ -191,26 +602,27 @@ class GoogleGeminiApi(BaseAIApi):
     
     def __init__(self):
         super().__init__()
+        self.base_url = getattr(settings, 'GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com/v1beta/models')
         self.name = "Google Gemini"
     
     def _get_api_key(self, model: str) -> Optional[str]:
         return getattr(settings, 'GEMINI_API_KEY', None)
     
-    def send_message(self, message: str, config: Dict) -> Dict:
-        """重写发送消息方法以适配Gemini API格式"""
+    def _build_request(self, message: str, config: Dict) -> Dict:
+        """重写请求构建方法以适配Gemini API格式"""
         # 验证配置
         self._validate_config(config)
         
-        # 获取API密钥
-        api_key = self._get_api_key(config.get('model'))
+        # 获取API密钥，调用方传入的用户密钥优先
+        api_key = self._request_api_key(config)
         if not api_key:
             raise Exception(f"未配置{self.name} API密钥")
         
         # 构建Gemini API格式的消息
-        messages = self._build_gemini_messages(message, config.get('history', []))
+        messages = self._build_gemini_messages(message, config.get('history', []), config)
         
         # 准备请求参数
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{config.get('model')}:generateContent?key={api_key}"
+        url = f"{self.base_url}/{config.get('model')}:generateContent?key={api_key}"
         
         payload = {
             'contents': messages,
@@ -221,38 +633,72 @@ class GoogleGeminiApi(BaseAIApi):
             }
         }
         
-        # 发送请求
-        response_data = self._make_request(
-            url=url,
-            headers={'Content-Type': 'application/json'},
-            payload=payload,
-            timeout=config.get('timeout', 30)
-        )
+        if config.get('system_prompt'):
+            if prompt_layout(self.name) == 'prefix_cache':
+                # 知识库上下文随当前消息传入，systemInstruction之后的历史保持不变
+                messages[-1]['parts'].insert(0, {'text': config['system_prompt']})
+            else:
+                payload['systemInstruction'] = {'parts': [{'text': config['system_prompt']}]}
         
-        # 提取响应内容
-        return self._extract_response_content(response_data)
+        return {
+            'url': url,
+            'headers': {'Content-Type': 'application/json'},
+            'payload': payload,
+            'timeout': config.get('timeout', 30),
+        }
+    
+    def _build_stream_request(self, message: str, config: Dict) -> Dict:
+        """Gemini使用streamGenerateContent接口，alt=sse返回SSE格式"""
+        request_params = self._build_request(message, config)
+        request_params['url'] = request_params['url'].replace(
+            ':generateContent?', ':streamGenerateContent?alt=sse&', 1
+        )
+        return request_params
+    
+    def _extract_stream_delta(self, chunk_data: Dict) -> str:
+        """从Gemini流式数据块中提取增量文本"""
+        candidates = chunk_data.get('candidates') or []
+        if not candidates:
+            return ''
+        parts = (candidates[0].get('content') or {}).get('parts') or []
+        return ''.join(part.get('text', '') for part in parts)
+    
+    def _extract_stream_usage(self, chunk_data: Dict) -> Optional[Dict]:
+        """Gemini每个数据块返回截至当前的usageMetadata"""
+        return chunk_data.get('usageMetadata')
     
-    def _build_gemini_messages(self, user_message: str, history: List[Dict]) -> List[Dict]:
+    def _build_gemini_messages(self, user_message: str, history: List[Dict], config: Optional[Dict] = None) -> List[Dict]:
         """构建Gemini API格式的消息"""
         messages = []
+        _, history = pack_context(history, None, user_message, self.name, config or {})
         
-        # 处理历史消息
+        # 处理预算内的历史消息
         if history:
-            for msg in history[-8:]:  # 最多保留8条历史
-                role = 'user' if msg['role'] in ['user', 'human'] else 'model'
+            for msg in history:
+                # Gemini没有系统角色，会话摘要作为用户消息传入
+                role = 'user' if msg['role'] in ['user', 'human', 'system'] else 'model'
                 messages.append({
                     'role': role,
-                    'parts': [{'text': msg['content']}]
+                    'parts': self._to_gemini_parts(msg['content'])
                 })
         
         # 添加当前用户消息
         messages.append({
             'role': 'user',
-            'parts': [{'text': user_message}]
+            'parts': self._to_gemini_parts(user_message)
         })
         
         return messages
     
+    def _to_gemini_parts(self, content) -> List[Dict]:
+        """转换消息内容，多模态内容中的图片URL暂不直接传给Gemini，以文字说明代替"""
+        if isinstance(content, list):
+            return [
+                {'text': item['text']} if item.get('type') == 'text' else {'text': '用户发送了一张图片'}
+                for item in content
+            ]
+        return [{'text': content}]
+    
     def _extract_response_content(self, response_data: Dict) -> Dict:
         """从Gemini API响应中提取内容"""
         if 'candidates' not in response_data or len(response_data['candidates']) == 0:
@@ -275,7 +721,7 @@ class MoonshotKimiApi(BaseAIApi):
     
     def __init__(self):
         super().__init__()
-        self.base_url = getattr(settings, 'MOONSHOT_API_BASE_URL', 'https://api.moonshot.cn/v1')
+        self.base_url = getattr(settings, 'MOONSHOT_API_BASE_URL', 'https://api.moonshot.cn/v1/chat/completions')
         self.name = "Moonshot Kimi"
     
     def _get_api_key(self, model: str) -> Optional[str]:
@@ -284,7 +730,7 @@ class MoonshotKimiApi(BaseAIApi):
     def _prepare_payload(self, message: str, history: List[Dict], config: Dict) -> Dict:
         """准备OpenAI兼容的请求载荷"""
         # 构建消息历史
-        messages = self._build_messages(message, history)
+        messages = self._build_messages(message, history, config.get('system_prompt'), config)
         
         payload = {
             'model': config.get('model', 'moonshot-v1-8k'),
@@ -312,21 +758,29 @@ class MoonshotKimiApi(BaseAIApi):
 
 
 class DoubaoApi(BaseAIApi):
-    """字节跳动豆包API实现"""
+    """字节跳动豆包API实现 - 火山方舟OpenAI兼容接口"""
     
     def __init__(self):
         super().__init__()
+        self.base_url = getattr(settings, 'DOUBAO_API_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3/chat/completions')
         self.name = "Doubao"
     
     def _get_api_key(self, model: str) -> Optional[str]:
-        # 豆包API通常使用不同的认证方式，这里简化处理
         return getattr(settings, 'DOUBAO_API_KEY', None)
     
-    def send_message(self, message: str, config: Dict) -> Dict:
-        """重写发送消息方法以适配豆包API格式"""
-        # 豆包API的具体实现会根据实际API文档调整
-        # 这里提供一个通用模板
-        raise NotImplementedError("豆包API的具体实现需要根据官方文档调整")
+    def _extract_response_content(self, response_data: Dict) -> Dict:
+        """从OpenAI兼容响应中提取内容"""
+        if 'choices' not in response_data or len(response_data['choices']) == 0:
+            raise Exception("豆包API响应格式错误")
+        
+        content = response_data['choices'][0]['message']['content']
+        
+        usage = response_data.get('usage', {})
+        
+        return {
+            'content': content,
+            'usage': usage
+        }
 
 
 class QwenApi(BaseAIApi):
@@ -334,7 +788,7 @@ class QwenApi(BaseAIApi):
     
     def __init__(self):
         super().__init__()
-        self.base_url = getattr(settings, 'QWEN_API_BASE_URL', 'https://dashscope.aliyuncs.com/compatible-mode/v1')
+        self.base_url = getattr(settings, 'QWEN_API_BASE_URL', 'https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions')
         self.name = "Qwen"
     
     def _get_api_key(self, model: str) -> Optional[str]:
@@ -350,7 +804,7 @@ class QwenApi(BaseAIApi):
     def _prepare_payload(self, message: str, history: List[Dict], config: Dict) -> Dict:
         """准备OpenAI兼容的请求载荷"""
         # 构建消息历史
-        messages = self._build_messages(message, history)
+        messages = self._build_messages(message, history, config.get('system_prompt'), config)
         
         payload = {
             'model': config.get('model', 'qwen-turbo'),
@@ -382,8 +836,9 @@ class DeepSeekApi(BaseAIApi):
     
     def __init__(self):
         super().__init__()
-        self.base_url = getattr(settings, 'DEEPSEEK_API_BASE_URL', 'https://api.deepseek.com/v1')
+        self.base_url = getattr(settings, 'DEEPSEEK_API_BASE_URL', 'https://api.deepseek.com/v1/chat/completions')
         self.name = "DeepSeek"
+        self.stream_usage = True
     
     def _get_api_key(self, model: str) -> Optional[str]:
         return getattr(settings, 'DEEPSEEK_API_KEY', None)
@@ -391,7 +846,7 @@ class DeepSeekApi(BaseAIApi):
     def _prepare_payload(self, message: str, history: List[Dict], config: Dict) -> Dict:
         """准备OpenAI兼容的请求载荷"""
         # 构建消息历史
-        messages = self._build_messages(message, history)
+        messages = self._build_messages(message, history, config.get('system_prompt'), config)
         
         payload = {
             'model': config.get('model', 'deepseek-chat'),
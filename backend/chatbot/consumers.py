@@ -1,10 +1,14 @@
 import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils import timezone
 import logging
 
+from .streaming import stream_chat_events
+
 logger = logging.getLogger(__name__)
 
 class VoiceCallConsumer(AsyncWebsocketConsumer):
@@ -215,4 +219,140 @@ class VoiceCallConsumer(AsyncWebsocketConsumer):
         try:
             return User.objects.get(id=user_id)
         except User.DoesNotExist:
-            return None
\ No newline at end of file
+            return None
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    聊天WebSocket
+    每个标签页保持一个已认证的连接，多个生成请求通过request_id复用同一连接
+
+    客户端消息：
+        {"type": "chat", "request_id": "...", "message": "...", "model": "...", "conversation_id": 1}
+        {"type": "cancel", "request_id": "..."}
+        {"type": "ping"}
+    服务端事件与SSE接口一致（user_message/token/complete/error），并附带request_id，
+    另有 cancelled 和 pong 事件
+    """
+
+    async def connect(self):
+        """建立WebSocket连接，仅允许已认证用户"""
+        self.user = self.scope["user"]
+        self.generations = {}
+
+        if self.user.is_authenticated:
+            await self.accept()
+            logger.info(f"User {self.user.username} connected to chat WebSocket")
+        else:
+            await self.close(code=4001)
+
+    async def disconnect(self, close_code):
+        """断开连接时取消所有进行中的生成"""
+        for task in list(self.generations.values()):
+            task.cancel()
+        if self.generations:
+            await asyncio.gather(*self.generations.values(), return_exceptions=True)
+        if self.user.is_authenticated:
+            logger.info(f"User {self.user.username} disconnected from chat WebSocket")
+
+    async def receive(self, text_data):
+        """接收客户端消息"""
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            await self.send_event({'type': 'error', 'message': '消息必须是JSON格式'})
+            return
+
+        message_type = data.get('type')
+        if message_type == 'chat':
+            await self.start_generation(data)
+        elif message_type == 'cancel':
+            await self.cancel_generation(data.get('request_id'))
+        elif message_type == 'ping':
+            await self.send_event({'type': 'pong'})
+        else:
+            await self.send_event({
+                'type': 'error',
+                'request_id': data.get('request_id'),
+                'message': f'不支持的消息类型: {message_type}'
+            })
+
+    async def send_event(self, event):
+        """发送事件"""
+        await self.send(text_data=json.dumps(event))
+
+    async def start_generation(self, data):
+        """校验请求并在后台任务中开始生成"""
+        from .views import validate_input_data, validate_conversation_id
+
+        request_id = data.get('request_id')
+        if not request_id or not isinstance(request_id, str):
+            await self.send_event({'type': 'error', 'message': 'request_id 不能为空'})
+            return
+        if request_id in self.generations:
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': 'request_id 正在使用中'})
+            return
+
+        max_concurrent = getattr(settings, 'CHAT_WS_MAX_CONCURRENT_GENERATIONS', 4)
+        if len(self.generations) >= max_concurrent:
+            await self.send_event({
+                'type': 'error',
+                'request_id': request_id,
+                'message': f'同时进行的生成请求不能超过 {max_concurrent} 个'
+            })
+            return
+
+        is_valid, message = validate_input_data(data.get('message'), '消息', max_length=5000)
+        if not is_valid:
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': message})
+            return
+
+        is_valid, model = validate_input_data(data.get('model', 'gpt-3.5-turbo'), '模型', max_length=100)
+        if not is_valid:
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': model})
+            return
+
+        image_url = data.get('image_url')
+        if image_url:
+            is_valid, image_url = validate_input_data(image_url, '图片URL', max_length=2000)
+            if not is_valid:
+                await self.send_event({'type': 'error', 'request_id': request_id, 'message': image_url})
+                return
+
+        is_valid, conversation_id = validate_conversation_id(data.get('conversation_id'))
+        if not is_valid:
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': conversation_id})
+            return
+
+        task = asyncio.ensure_future(self.run_generation(
+            request_id, message, model, conversation_id, image_url
+        ))
+        self.generations[request_id] = task
+        task.add_done_callback(lambda _: self.generations.pop(request_id, None))
+
+    async def run_generation(self, request_id, message, model, conversation_id, image_url):
+        """执行一次生成，将事件转发给客户端"""
+        events = stream_chat_events(self.user, message, model, conversation_id, image_url, request_id)
+        try:
+            async for event in events:
+                event['request_id'] = request_id
+                await self.send_event(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating chat response over WebSocket: {e}")
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': str(e)})
+        finally:
+            # 取消时关闭生成器，中断上游请求并保存已生成的部分
+            await events.aclose()
+
+    async def cancel_generation(self, request_id):
+        """取消指定的生成请求"""
+        task = self.generations.get(request_id)
+        if task is None:
+            await self.send_event({'type': 'error', 'request_id': request_id, 'message': '生成请求不存在或已结束'})
+            return
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await self.send_event({'type': 'cancelled', 'request_id': request_id})
@@ -5,7 +5,7 @@ import random
 import re
 from datetime import datetime
 from typing import Dict, List, Optional
-from .api_base import OpenAIApi, GoogleGeminiApi, MoonshotKimiApi, QwenApi, DeepSeekApi
+from .provider_registry import provider_registry
 
 
 class FunctionRouter:
@@ -95,25 +95,12 @@ class FunctionRouter:
         默认聊天处理
         """
         # 根据模型类型选择对应的API实现
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            # 默认使用OpenAI API
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.6,
                 'max_tokens': 2000,
                 'top_p': 0.7,
@@ -165,24 +152,12 @@ class FunctionRouter:
                 prompt = f"请讲一个笑话：{user_input}"
         
         # 使用AI API生成笑话
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.8,  # 更高的温度产生更有趣的回答
                 'max_tokens': 300,
                 'top_p': 0.9,
@@ -220,24 +195,12 @@ class FunctionRouter:
             prompt = f"请讲一个有趣的故事：{user_input}"
         
         # 使用AI API生成故事
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.7,
                 'max_tokens': 800,
                 'top_p': 0.8,
@@ -259,18 +222,9 @@ class FunctionRouter:
         """
         # 使用AI进行高级中文语义理解
         if model.startswith('qwen'):  # 优先使用通义千问进行中文处理
-            api_instance = QwenApi()
             model = 'qwen-max'  # 使用更强的中文模型
-        elif model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        else:
-            api_instance = QwenApi()  # 默认使用通义千问处理中文
+        # 未知模型默认使用通义千问处理中文
+        api_instance, api_key = provider_registry.resolve(model, default='qwen')
         
         prompt = f"""
         请对以下中文文本进行深入的语义理解和分析，准确率达到90%以上：
@@ -288,6 +242,7 @@ class FunctionRouter:
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.3,  # 较低温度以获得更准确的分析
                 'max_tokens': 600,
                 'top_p': 0.7,
@@ -336,24 +291,12 @@ class FunctionRouter:
         if any(word in user_input for word in ['详细', '预报', '明天', '后天', '一周', '趋势']):
             prompt = f"请提供关于{city}的详细天气预报信息：{user_input}"
             
-            if model.startswith('gpt'):
-                api_instance = OpenAIApi()
-            elif model.startswith('gemini'):
-                api_instance = GoogleGeminiApi()
-            elif model.startswith('kimi'):
-                api_instance = MoonshotKimiApi()
-            elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-                api_instance = QwenApi()
-            elif model.startswith('deepseek'):
-                api_instance = DeepSeekApi()
-            elif model.startswith('qwen'):
-                api_instance = QwenApi()
-            else:
-                api_instance = OpenAIApi()
+            api_instance, api_key = provider_registry.resolve(model)
             
             try:
                 config = {
                     'model': model,
+                    'api_key': api_key,
                     'temperature': 0.4,
                     'max_tokens': 400,
                     'top_p': 0.7,
@@ -401,24 +344,12 @@ class FunctionRouter:
         # 使用AI处理复杂的数学问题
         prompt = f"请帮我计算：{user_input}。请给出详细的解题步骤和最终答案。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.1,  # 低温度确保计算准确性
                 'max_tokens': 400,
                 'top_p': 0.7,
@@ -440,24 +371,15 @@ class FunctionRouter:
         """
         prompt = f"请作为百科全书回答以下问题，提供全面、准确的信息：{user_input}"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
+                'cache': True,
+                'cache_allow_sampling': True,
+                'semantic_cache': {'question': user_input, 'intent': 'encyclopedia'},
                 'temperature': 0.3,  # 较低温度确保信息准确性
                 'max_tokens': 800,
                 'top_p': 0.8,
@@ -486,24 +408,12 @@ class FunctionRouter:
         else:
             prompt = f"请创作一首诗：{user_input}"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.7,
                 'max_tokens': 500,
                 'top_p': 0.8,
@@ -535,24 +445,14 @@ class FunctionRouter:
         """
         prompt = f"请将以下内容进行翻译：{user_input}。请识别源语言并翻译为目标语言（通常是中文和英文互译）。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
+                'cache': True,
+                'cache_allow_sampling': True,
                 'temperature': 0.1,  # 低温度确保翻译准确性
                 'max_tokens': 500,
                 'top_p': 0.9,
@@ -574,29 +474,12 @@ class FunctionRouter:
         """
         prompt = f"请作为编程专家回答以下问题，提供代码示例和技术指导：{user_input}"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            # 如果是代码相关的问题，优先使用通义千问代码模型
-            if 'code' in model or 'Coder' in model or 'coder' in model:
-                api_instance = QwenApi()
-                model = 'qwen-code-coder'  # 使用专门的代码模型
-            else:
-                api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.4,  # 适度温度平衡创造性和准确性
                 'max_tokens': 1000,
                 'top_p': 0.8,
@@ -618,24 +501,12 @@ class FunctionRouter:
         """
         prompt = f"请提供关于以下问题的生活建议和实用指导：{user_input}"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.5,
                 'max_tokens': 600,
                 'top_p': 0.8,
@@ -672,24 +543,12 @@ class FunctionRouter:
         # 使用AI生成模拟新闻
         prompt = f"请提供关于以下主题的最新新闻信息：{user_input}。如果是日常查询，请提供一些有趣的知识或今日关注点。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.4,
                 'max_tokens': 600,
                 'top_p': 0.8,
@@ -723,24 +582,12 @@ class FunctionRouter:
         """
         prompt = f"请提供温暖的情感支持和心理疏导：{user_input}。请用温柔、鼓励的语气回应。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.6,
                 'max_tokens': 500,
                 'top_p': 0.8,
@@ -815,24 +662,12 @@ class FunctionRouter:
             # 使用AI提供游戏体验
             prompt = f"让我们玩一个游戏：{user_input}。请选择合适的游戏类型并提供游戏规则和互动。"
             
-            if model.startswith('gpt'):
-                api_instance = OpenAIApi()
-            elif model.startswith('gemini'):
-                api_instance = GoogleGeminiApi()
-            elif model.startswith('kimi'):
-                api_instance = MoonshotKimiApi()
-            elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-                api_instance = QwenApi()
-            elif model.startswith('deepseek'):
-                api_instance = DeepSeekApi()
-            elif model.startswith('qwen'):
-                api_instance = QwenApi()
-            else:
-                api_instance = OpenAIApi()
+            api_instance, api_key = provider_registry.resolve(model)
             
             try:
                 config = {
                     'model': model,
+                    'api_key': api_key,
                     'temperature': 0.7,
                     'max_tokens': 500,
                     'top_p': 0.9,
@@ -854,24 +689,12 @@ class FunctionRouter:
         """
         prompt = f"请作为老师或教育专家，对以下学习问题提供指导：{user_input}。请提供清晰的解释和实用的学习建议。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.4,
                 'max_tokens': 700,
                 'top_p': 0.8,
@@ -907,24 +730,12 @@ class FunctionRouter:
         """
         prompt = f"请提供关于以下健康问题的专业建议：{user_input}。请注意，这仅供参考，不能替代专业医疗建议。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.3,
                 'max_tokens': 600,
                 'top_p': 0.8,
@@ -960,24 +771,12 @@ class FunctionRouter:
         """
         prompt = f"请提供关于以下金融理财问题的专业建议：{user_input}。请注意，这仅供参考，投资有风险。"
         
-        if model.startswith('gpt'):
-            api_instance = OpenAIApi()
-        elif model.startswith('gemini'):
-            api_instance = GoogleGeminiApi()
-        elif model.startswith('kimi'):
-            api_instance = MoonshotKimiApi()
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            api_instance = QwenApi()
-        elif model.startswith('deepseek'):
-            api_instance = DeepSeekApi()
-        elif model.startswith('qwen'):
-            api_instance = QwenApi()
-        else:
-            api_instance = OpenAIApi()
+        api_instance, api_key = provider_registry.resolve(model)
         
         try:
             config = {
                 'model': model,
+                'api_key': api_key,
                 'temperature': 0.4,
                 'max_tokens': 700,
                 'top_p': 0.8,
@@ -91,8 +91,9 @@ def sync_knowledge_base(request):
     手动同步知识库
     """
     try:
-        # 同步数据库内容
-        real_time_source.sync_from_database()
+        # 增量同步数据库内容，full为true时全量同步
+        full = str(request.data.get('full', '')).lower() in ('1', 'true')
+        stats = real_time_source.sync_from_database(full=full)
         
         # 可选：同步外部API（如果有配置）
         external_sources = request.data.get('external_sources', [])
@@ -105,6 +106,7 @@ def sync_knowledge_base(request):
         return Response({
             'success': True,
             'message': 'Knowledge base synchronized successfully',
+            'synced': stats,
             'timestamp': timezone.now().isoformat()
         })
     except Exception as e:
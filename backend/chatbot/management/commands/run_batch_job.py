@@ -0,0 +1,34 @@
+"""
+在当前进程中执行批量对话补全任务的管理命令
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import BatchJob
+from chatbot.utils.batch_jobs import reset_batch_job, run_batch_job
+
+
+class Command(BaseCommand):
+    help = '执行（或继续执行）批量对话补全任务，不依赖Celery worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_id', type=int, help='批量任务ID')
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='同时重新执行失败的条目',
+        )
+
+    def handle(self, *args, **options):
+        job = BatchJob.objects.filter(id=options['job_id']).first()
+        if job is None:
+            raise CommandError(f"批量任务{options['job_id']}不存在")
+        if options['retry_failed'] or job.status == 'cancelled':
+            reset_batch_job(job, options['retry_failed'])
+
+        self.stdout.write(f"开始执行批量任务{job.id}...")
+        job = run_batch_job(job.id)
+        if job is None:
+            raise CommandError('该任务正在其他进程中执行')
+        self.stdout.write(self.style.SUCCESS(
+            f"批量任务{job.id}{job.get_status_display()}：成功{job.succeeded_items}条，失败{job.failed_items}条，共{job.total_items}条"
+        ))
@@ -22,6 +22,11 @@ class Command(BaseCommand):
             action='store_true',
             help='从外部数据源同步内容到知识库',
         )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='忽略水位线，全量重新同步数据库内容',
+        )
         parser.add_argument(
             '--async',
             action='store_true',
@@ -32,13 +37,13 @@ class Command(BaseCommand):
         if options['from_db']:
             if options['async']:
                 self.stdout.write('开始异步同步数据库内容到知识库...')
-                task = sync_knowledge_base_from_db.delay()
+                task = sync_knowledge_base_from_db.delay(full=options['full'])
                 self.stdout.write(f'异步任务已启动，任务ID: {task.id}')
             else:
                 self.stdout.write('开始同步数据库内容到知识库...')
-                real_time_source.sync_from_database()
+                stats = real_time_source.sync_from_database(full=options['full'])
                 self.stdout.write(
-                    self.style.SUCCESS('数据库内容同步到知识库完成!')
+                    self.style.SUCCESS(f'数据库内容同步到知识库完成! {stats or ""}')
                 )
         elif options['from_external']:
             if options['async']:
@@ -56,11 +61,11 @@ class Command(BaseCommand):
             self.stdout.write('开始同步所有数据源到知识库...')
             
             if options['async']:
-                db_task = sync_knowledge_base_from_db.delay()
+                db_task = sync_knowledge_base_from_db.delay(full=options['full'])
                 ext_task = sync_external_data_sources.delay()
                 self.stdout.write(f'异步任务已启动，数据库同步任务ID: {db_task.id}, 外部数据同步任务ID: {ext_task.id}')
             else:
-                real_time_source.sync_from_database()
+                real_time_source.sync_from_database(full=options['full'])
                 # real_time_source.sync_from_external_api() # 如果有外部数据源配置
                 self.stdout.write(
                     self.style.SUCCESS('所有数据源同步到知识库完成!')
@@ -0,0 +1,58 @@
+"""
+按模型统计token消耗和延迟的管理命令
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chatbot.utils.usage_metrics import aggregate_usage, parse_window
+
+
+class Command(BaseCommand):
+    help = '按模型汇总助手回复的token消耗和延迟p50/p95'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window',
+            default='24h',
+            help='统计的时间窗口，如30m、24h、7d（默认24h）',
+        )
+        parser.add_argument(
+            '--bucket',
+            choices=['hour', 'day'],
+            help='按小时或天分组',
+        )
+        parser.add_argument(
+            '--model',
+            help='只统计指定模型',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='以JSON格式输出',
+        )
+
+    def handle(self, *args, **options):
+        until = timezone.now()
+        try:
+            since = until - parse_window(options['window'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        results = aggregate_usage(since, until, options['bucket'], options['model'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+        if not results:
+            self.stdout.write(f"最近{options['window']}没有用量记录")
+            return
+
+        columns = ['model', 'requests', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'retries',
+                   'latency_p50_ms', 'latency_p95_ms', 'ttft_p50_ms', 'ttft_p95_ms']
+        if options['bucket']:
+            columns.insert(0, 'bucket')
+        rows = [columns] + [['-' if item[column] is None else str(item[column]) for column in columns] for item in results]
+        widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+        for row in rows:
+            self.stdout.write('  '.join(value.ljust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,53 @@
+"""
+ASGI客户端断开检测中间件
+Django 4.2的ASGIHandler在发送流式响应时不会监听http.disconnect，
+客户端关闭连接后异步生成仍会一直运行到结束并持续消耗上游token
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ClientDisconnectMiddleware:
+    """
+    流式响应开始后监听http.disconnect，客户端断开时取消请求任务
+    取消会传递到视图中的异步生成器，由其关闭上游连接并保存已生成的部分
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        watcher = None
+        disconnected = False
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected = True
+                    logger.info(f"客户端断开连接，取消请求: {scope.get('path')}")
+                    app_task.cancel()
+                    return
+
+        async def send_wrapper(message):
+            nonlocal watcher
+            # Django在调用视图前已读完请求体，流式响应开始后不会再调用receive
+            if watcher is None and message['type'] == 'http.response.body' and message.get('more_body'):
+                watcher = asyncio.ensure_future(watch_disconnect())
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, receive, send_wrapper))
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
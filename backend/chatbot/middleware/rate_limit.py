@@ -1,9 +1,11 @@
 from django.core.cache import cache
 from django.http import JsonResponse
 from functools import wraps
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from datetime import timedelta
+import asyncio
 import json
 import hashlib
 import re
@@ -77,60 +79,86 @@ def is_dangerous_content(request):
     return False, ""
 
 
+def _check_rate_limit(request, view_name, max_requests, window_size, block_malicious):
+    """
+    执行黑名单、恶意内容和速率检查
+    :return: 被拦截时返回JsonResponse，否则返回None
+    """
+    # 获取客户端IP
+    ip_address = get_client_ip(request)
+    
+    # 检查IP是否在黑名单中
+    if ip_address in BLACKLISTED_IPS:
+        logger.warning(f"Blocked blacklisted IP: {ip_address}")
+        return JsonResponse({
+            'error': '您的IP已被加入黑名单，请联系管理员',
+        }, status=403)
+    
+    # 检查是否包含恶意内容
+    if block_malicious:
+        is_dangerous, reason = is_dangerous_content(request)
+        if is_dangerous:
+            logger.warning(f"Malicious content detected from {ip_address}: {reason}")
+            # 将IP加入临时黑名单
+            BLACKLISTED_IPS.add(ip_address)
+            return JsonResponse({
+                'error': '检测到恶意内容，请求被拒绝',
+            }, status=400)
+    
+    # 创建唯一标识符（基于IP地址和视图函数名）
+    key = f"rate_limit:{ip_address}:{view_name}"
+    
+    # 获取当前窗口内的请求数
+    current_requests = cache.get(key, [])
+    
+    # 移除过期的请求记录
+    now = timezone.now()
+    current_requests = [req_time for req_time in current_requests 
+                      if now - req_time < timedelta(seconds=window_size)]
+    
+    # 检查是否超过限制
+    if len(current_requests) >= max_requests:
+        logger.warning(f"Rate limit exceeded for IP: {ip_address}, View: {view_name}")
+        return JsonResponse({
+            'error': '请求过于频繁，请稍后再试',
+            'retry_after': window_size
+        }, status=429)
+    
+    # 添加当前请求时间
+    current_requests.append(now)
+    cache.set(key, current_requests, timeout=window_size)
+    return None
+
+
 def rate_limit(max_requests=10, window_size=60, block_malicious=True):
     """
-    增强版速率限制装饰器
+    增强版速率限制装饰器，同时支持同步和异步视图
     :param max_requests: 时间窗口内最大请求数
     :param window_size: 时间窗口大小（秒）
     :param block_malicious: 是否阻止恶意请求
     """
     def decorator(view_func):
+        view_name = f"{view_func.__module__}.{view_func.__name__}"
+        
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                blocked = await sync_to_async(_check_rate_limit)(
+                    request, view_name, max_requests, window_size, block_malicious
+                )
+                if blocked is not None:
+                    return blocked
+                
+                # 执行原始视图函数
+                return await view_func(request, *args, **kwargs)
+            
+            return async_wrapper
+        
         @wraps(view_func)
         def wrapper(request, *args, **kwargs):
-            # 获取客户端IP
-            ip_address = get_client_ip(request)
-            
-            # 检查IP是否在黑名单中
-            if ip_address in BLACKLISTED_IPS:
-                logger.warning(f"Blocked blacklisted IP: {ip_address}")
-                return JsonResponse({
-                    'error': '您的IP已被加入黑名单，请联系管理员',
-                }, status=403)
-            
-            # 检查是否包含恶意内容
-            if block_malicious:
-                is_dangerous, reason = is_dangerous_content(request)
-                if is_dangerous:
-                    logger.warning(f"Malicious content detected from {ip_address}: {reason}")
-                    # 将IP加入临时黑名单
-                    BLACKLISTED_IPS.add(ip_address)
-                    return JsonResponse({
-                        'error': '检测到恶意内容，请求被拒绝',
-                    }, status=400)
-            
-            # 创建唯一标识符（基于IP地址和视图函数名）
-            view_name = f"{view_func.__module__}.{view_func.__name__}"
-            key = f"rate_limit:{ip_address}:{view_name}"
-            
-            # 获取当前窗口内的请求数
-            current_requests = cache.get(key, [])
-            
-            # 移除过期的请求记录
-            now = timezone.now()
-            current_requests = [req_time for req_time in current_requests 
-                              if now - req_time < timedelta(seconds=window_size)]
-            
-            # 检查是否超过限制
-            if len(current_requests) >= max_requests:
-                logger.warning(f"Rate limit exceeded for IP: {ip_address}, View: {view_name}")
-                return JsonResponse({
-                    'error': '请求过于频繁，请稍后再试',
-                    'retry_after': window_size
-                }, status=429)
-            
-            # 添加当前请求时间
-            current_requests.append(now)
-            cache.set(key, current_requests, timeout=window_size)
+            blocked = _check_rate_limit(request, view_name, max_requests, window_size, block_malicious)
+            if blocked is not None:
+                return blocked
             
             # 执行原始视图函数
             return view_func(request, *args, **kwargs)
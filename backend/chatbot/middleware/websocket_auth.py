@@ -0,0 +1,47 @@
+"""
+WebSocket JWT认证中间件
+浏览器的WebSocket无法设置Authorization头，通过查询参数 ?token=<access_token> 传递JWT
+"""
+import logging
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+@database_sync_to_async
+def get_user_from_token(raw_token):
+    """校验JWT并返回对应用户，无效时返回None"""
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError, AuthenticationFailed
+
+    authentication = JWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(validated_token)
+    except (InvalidToken, TokenError, AuthenticationFailed) as e:
+        logger.warning(f"WebSocket JWT认证失败: {str(e)}")
+        return None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    从查询参数中读取JWT并设置scope["user"]
+    没有token时保留会话认证的结果
+    """
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+        token = query.get('token', [None])[0]
+        if token:
+            user = await get_user_from_token(token)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """会话认证 + JWT认证"""
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
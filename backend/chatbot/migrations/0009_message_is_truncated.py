@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 23:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_alter_conversation_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='is_truncated',
+            field=models.BooleanField(default=False, verbose_name='是否被中断'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_message_is_truncated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='token数'),
+        ),
+    ]
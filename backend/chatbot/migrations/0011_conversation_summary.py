@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_message_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True, default='', verbose_name='会话摘要'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_message_id',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='摘要覆盖到的消息ID'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(db_index=True, max_length=100, verbose_name='实际使用的模型')),
+                ('provider', models.CharField(blank=True, default='', max_length=50, verbose_name='提供商')),
+                ('prompt_tokens', models.PositiveIntegerField(default=0, verbose_name='提示词token数')),
+                ('completion_tokens', models.PositiveIntegerField(default=0, verbose_name='回复token数')),
+                ('cached_tokens', models.PositiveIntegerField(default=0, verbose_name='命中前缀缓存的token数')),
+                ('ttft_ms', models.PositiveIntegerField(blank=True, null=True, verbose_name='首token耗时(毫秒)')),
+                ('latency_ms', models.PositiveIntegerField(verbose_name='总耗时(毫秒)')),
+                ('retry_count', models.PositiveSmallIntegerField(default=0, verbose_name='重试次数')),
+                ('cached', models.BooleanField(default=False, verbose_name='是否命中响应缓存')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='chatbot.message', verbose_name='消息')),
+            ],
+            options={
+                'verbose_name': '消息用量',
+                'verbose_name_plural': '消息用量',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['model', 'created_at'], name='chatbot_mes_model_2b2f92_idx')],
+            },
+        ),
+    ]
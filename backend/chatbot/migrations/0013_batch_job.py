@@ -0,0 +1,65 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatbot', '0012_message_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=255, verbose_name='任务名称')),
+                ('model', models.CharField(max_length=100, verbose_name='模型')),
+                ('system_prompt', models.TextField(blank=True, default='', verbose_name='系统提示')),
+                ('temperature', models.FloatField(default=0.3, verbose_name='温度')),
+                ('max_tokens', models.PositiveIntegerField(default=2000, verbose_name='最大回复token数')),
+                ('use_cache', models.BooleanField(default=False, verbose_name='是否使用响应缓存')),
+                ('status', models.CharField(choices=[('pending', '等待执行'), ('running', '执行中'), ('completed', '已完成'), ('cancelled', '已取消'), ('failed', '执行失败')], db_index=True, default='pending', max_length=10, verbose_name='状态')),
+                ('total_items', models.PositiveIntegerField(default=0, verbose_name='条目数')),
+                ('succeeded_items', models.PositiveIntegerField(default=0, verbose_name='成功条目数')),
+                ('failed_items', models.PositiveIntegerField(default=0, verbose_name='失败条目数')),
+                ('error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batch_jobs', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '批量任务',
+                'verbose_name_plural': '批量任务',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BatchItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField(verbose_name='序号')),
+                ('custom_id', models.CharField(blank=True, default='', max_length=255, verbose_name='调用方ID')),
+                ('prompt', models.TextField(verbose_name='提示词')),
+                ('status', models.CharField(choices=[('pending', '等待执行'), ('succeeded', '成功'), ('failed', '失败')], default='pending', max_length=10, verbose_name='状态')),
+                ('content', models.TextField(blank=True, default='', verbose_name='回复')),
+                ('error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('model', models.CharField(blank=True, default='', max_length=100, verbose_name='实际使用的模型')),
+                ('usage', models.JSONField(blank=True, null=True, verbose_name='用量')),
+                ('latency_ms', models.PositiveIntegerField(blank=True, null=True, verbose_name='耗时(毫秒)')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='chatbot.batchjob', verbose_name='批量任务')),
+            ],
+            options={
+                'verbose_name': '批量任务条目',
+                'verbose_name_plural': '批量任务条目',
+                'ordering': ['job', 'index'],
+                'indexes': [models.Index(fields=['job', 'status'], name='chatbot_bat_job_id_c9f03f_idx')],
+                'unique_together': {('job', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_batch_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KnowledgeDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_id', models.CharField(max_length=100, verbose_name='文档ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='删除时间')),
+            ],
+            options={
+                'verbose_name': '知识库待删除文档',
+                'verbose_name_plural': '知识库待删除文档',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='KnowledgeSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=50, unique=True, verbose_name='数据源')),
+                ('last_updated_at', models.DateTimeField(blank=True, null=True, verbose_name='已同步的最后更新时间')),
+                ('last_id', models.BigIntegerField(default=0, verbose_name='已同步的最后ID')),
+                ('synced_at', models.DateTimeField(auto_now=True, verbose_name='同步时间')),
+            ],
+            options={
+                'verbose_name': '知识库同步状态',
+                'verbose_name_plural': '知识库同步状态',
+            },
+        ),
+    ]
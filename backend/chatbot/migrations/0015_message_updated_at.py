@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-18 00:44
+
+from django.db import migrations, models
+
+
+def backfill_message_updated_at(apps, schema_editor):
+    """已有消息的更新时间取创建时间，消息同步的水位线由自增ID换算为(updated_at, id)"""
+    Message = apps.get_model('chatbot', 'Message')
+    KnowledgeSyncState = apps.get_model('chatbot', 'KnowledgeSyncState')
+
+    Message.objects.update(updated_at=models.F('created_at'))
+    state = KnowledgeSyncState.objects.filter(source='message', last_updated_at__isnull=True).first()
+    if state is None or not state.last_id:
+        return
+    last = Message.objects.filter(id__lte=state.last_id).order_by('-created_at', '-id').first()
+    if last is not None:
+        state.last_updated_at, state.last_id = last.updated_at, last.id
+        state.save(update_fields=['last_updated_at', 'last_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_knowledge_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgesyncstate',
+            name='start_id',
+            field=models.BigIntegerField(default=0, verbose_name='首次同步的起始ID'),
+        ),
+        migrations.AddField(
+            model_name='knowledgesyncstate',
+            name='start_updated_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='首次同步的起始更新时间'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='更新时间'),
+        ),
+        migrations.RunPython(backfill_message_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0015_message_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='summary_message_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='摘要覆盖到的消息ID'),
+        ),
+    ]
@@ -1,6 +1,6 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from datetime import datetime, timedelta
 
@@ -40,6 +40,8 @@ class Conversation(models.Model):
     updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='更新时间')
     model = models.CharField(max_length=50, default='gpt-3.5-turbo', db_index=True, verbose_name='使用的模型')
     mode = models.CharField(max_length=10, choices=CHAT_MODES, default='text', db_index=True, verbose_name='聊天模式')
+    summary = models.TextField(blank=True, default='', verbose_name='会话摘要')
+    summary_message_id = models.BigIntegerField(blank=True, null=True, verbose_name='摘要覆盖到的消息ID')
 
     class Meta:
         verbose_name = '会话'
@@ -68,8 +70,11 @@ class Message(models.Model):
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text', db_index=True, verbose_name='消息类型')
     content = models.TextField(verbose_name='内容')
     created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='更新时间')
     image_url = models.URLField(max_length=2000, blank=True, null=True, verbose_name='图片URL')
     is_read = models.BooleanField(default=False, db_index=True, verbose_name='是否已读')
+    is_truncated = models.BooleanField(default=False, verbose_name='是否被中断')
+    token_count = models.PositiveIntegerField(blank=True, null=True, verbose_name='token数')
     
     # 语音消息相关字段
     audio_file = models.FileField(upload_to='voice_messages/', blank=True, null=True, verbose_name='语音文件')
@@ -84,6 +89,106 @@ class Message(models.Model):
     def __str__(self):
         return f"{self.get_role_display()}: {self.content[:50]}"
 
+    def save(self, *args, **kwargs):
+        """保存时计算内容的token数，构建上下文时不再重复计算；修改内容时同时更新updated_at，知识库同步重新写入"""
+        from .utils.context_builder import count_tokens
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'content' in update_fields:
+            self.token_count = count_tokens(self.content)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'token_count', 'updated_at'}
+        super().save(*args, **kwargs)
+
+
+class MessageUsage(models.Model):
+    """助手消息的用量和延迟，用于按模型统计成本和性能"""
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='usage', verbose_name='消息')
+    model = models.CharField(max_length=100, db_index=True, verbose_name='实际使用的模型')
+    provider = models.CharField(max_length=50, blank=True, default='', verbose_name='提供商')
+    prompt_tokens = models.PositiveIntegerField(default=0, verbose_name='提示词token数')
+    completion_tokens = models.PositiveIntegerField(default=0, verbose_name='回复token数')
+    cached_tokens = models.PositiveIntegerField(default=0, verbose_name='命中前缀缓存的token数')
+    ttft_ms = models.PositiveIntegerField(blank=True, null=True, verbose_name='首token耗时(毫秒)')
+    latency_ms = models.PositiveIntegerField(verbose_name='总耗时(毫秒)')
+    retry_count = models.PositiveSmallIntegerField(default=0, verbose_name='重试次数')
+    cached = models.BooleanField(default=False, verbose_name='是否命中响应缓存')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = '消息用量'
+        verbose_name_plural = '消息用量'
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['model', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.model}: {self.prompt_tokens}+{self.completion_tokens} tokens, {self.latency_ms}ms"
+
+
+class BatchJob(models.Model):
+    """批量对话补全任务，用于翻译、重命名会话等离线任务"""
+    STATUS_CHOICES = (
+        ('pending', '等待执行'),
+        ('running', '执行中'),
+        ('completed', '已完成'),
+        ('cancelled', '已取消'),
+        ('failed', '执行失败'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='batch_jobs', db_index=True, verbose_name='用户')
+    name = models.CharField(max_length=255, blank=True, default='', verbose_name='任务名称')
+    model = models.CharField(max_length=100, verbose_name='模型')
+    system_prompt = models.TextField(blank=True, default='', verbose_name='系统提示')
+    temperature = models.FloatField(default=0.3, verbose_name='温度')
+    max_tokens = models.PositiveIntegerField(default=2000, verbose_name='最大回复token数')
+    use_cache = models.BooleanField(default=False, verbose_name='是否使用响应缓存')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True, verbose_name='状态')
+    total_items = models.PositiveIntegerField(default=0, verbose_name='条目数')
+    succeeded_items = models.PositiveIntegerField(default=0, verbose_name='成功条目数')
+    failed_items = models.PositiveIntegerField(default=0, verbose_name='失败条目数')
+    error = models.TextField(blank=True, default='', verbose_name='错误信息')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='创建时间')
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name='开始时间')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='结束时间')
+
+    class Meta:
+        verbose_name = '批量任务'
+        verbose_name_plural = '批量任务'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.name or self.id} ({self.status})"
+
+
+class BatchItem(models.Model):
+    """批量任务中的一条提示词及其结果"""
+    STATUS_CHOICES = (
+        ('pending', '等待执行'),
+        ('succeeded', '成功'),
+        ('failed', '失败'),
+    )
+
+    job = models.ForeignKey(BatchJob, on_delete=models.CASCADE, related_name='items', verbose_name='批量任务')
+    index = models.PositiveIntegerField(verbose_name='序号')
+    custom_id = models.CharField(max_length=255, blank=True, default='', verbose_name='调用方ID')
+    prompt = models.TextField(verbose_name='提示词')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name='状态')
+    content = models.TextField(blank=True, default='', verbose_name='回复')
+    error = models.TextField(blank=True, default='', verbose_name='错误信息')
+    model = models.CharField(max_length=100, blank=True, default='', verbose_name='实际使用的模型')
+    usage = models.JSONField(blank=True, null=True, verbose_name='用量')
+    latency_ms = models.PositiveIntegerField(blank=True, null=True, verbose_name='耗时(毫秒)')
+
+    class Meta:
+        verbose_name = '批量任务条目'
+        verbose_name_plural = '批量任务条目'
+        ordering = ['job', 'index']
+        unique_together = [('job', 'index')]
+        indexes = [models.Index(fields=['job', 'status'])]
+
+    def __str__(self):
+        return f"{self.job_id}#{self.index} ({self.status})"
+
 
 class UserProfile(models.Model):
     """用户配置文件，扩展Django内置User模型"""
@@ -111,6 +216,37 @@ class UserProfile(models.Model):
         return f"{self.user.username}的配置"
 
 
+class KnowledgeSyncState(models.Model):
+    """知识库增量同步的水位线，每个数据源一条"""
+    source = models.CharField(max_length=50, unique=True, verbose_name='数据源')
+    last_updated_at = models.DateTimeField(null=True, blank=True, verbose_name='已同步的最后更新时间')
+    last_id = models.BigIntegerField(default=0, verbose_name='已同步的最后ID')
+    start_updated_at = models.DateTimeField(null=True, blank=True, verbose_name='首次同步的起始更新时间')
+    start_id = models.BigIntegerField(default=0, verbose_name='首次同步的起始ID')
+    synced_at = models.DateTimeField(auto_now=True, verbose_name='同步时间')
+
+    class Meta:
+        verbose_name = '知识库同步状态'
+        verbose_name_plural = '知识库同步状态'
+
+    def __str__(self):
+        return f"{self.source} ({self.last_updated_at}, {self.last_id})"
+
+
+class KnowledgeDeletion(models.Model):
+    """已删除记录对应的知识库文档，下次同步时删除其向量"""
+    doc_id = models.CharField(max_length=100, verbose_name='文档ID')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='删除时间')
+
+    class Meta:
+        verbose_name = '知识库待删除文档'
+        verbose_name_plural = '知识库待删除文档'
+        ordering = ['id']
+
+    def __str__(self):
+        return self.doc_id
+
+
 class VoiceCallRecord(models.Model):
     """语音通话记录模型"""
     STATUS_CHOICES = [
@@ -158,4 +294,47 @@ def create_user_profile(sender, instance, created, **kwargs):
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     """保存用户时自动保存用户配置"""
-    instance.profile.save()
\ No newline at end of file
+    instance.profile.save()
+
+
+@receiver(post_save, sender=Message)
+def update_history_cache(sender, instance, created, **kwargs):
+    """
+    事务提交后把新消息追加到会话历史窗口缓存，提交前其他请求读取数据库时还看不到这条消息
+    修改消息时立即清除窗口，提交后再清除一次，事务期间重新加载的旧内容不会留在窗口中
+    """
+    from .utils import history_cache
+
+    if created:
+        transaction.on_commit(lambda: history_cache.append_message(instance))
+    else:
+        history_cache.invalidate(instance.conversation_id)
+        transaction.on_commit(lambda: history_cache.invalidate(instance.conversation_id))
+
+
+@receiver(post_save, sender=Message)
+def schedule_conversation_summary(sender, instance, created, **kwargs):
+    """助手回复的事务提交后（已追加到历史窗口），未摘要的消息过长时提交摘要任务"""
+    from .utils.conversation_summary import maybe_schedule_summary
+
+    if created and instance.role == 'assistant':
+        transaction.on_commit(lambda: maybe_schedule_summary(instance))
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_history_cache(sender, instance, **kwargs):
+    """删除消息（包括删除会话时级联删除）时清除会话窗口，事务提交后再清除一次"""
+    from .utils import history_cache
+
+    history_cache.invalidate(instance.conversation_id)
+    transaction.on_commit(lambda: history_cache.invalidate(instance.conversation_id))
+
+
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_delete, sender=Conversation)
+@receiver(post_delete, sender=Message)
+def record_knowledge_deletion(sender, instance, **kwargs):
+    """记录被删除的记录，同一次删除（包括级联删除）在事务提交时批量写入，知识库同步时删除对应的向量"""
+    from .utils.knowledge_sync import record_deletion
+
+    record_deletion(instance)
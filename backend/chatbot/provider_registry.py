@@ -0,0 +1,209 @@
+"""
+大模型提供商注册表
+模型目录（available_models接口返回的模型列表）与提供商实现在此集中维护，
+根据模型ID查表得到长期复用的提供商实例，新增提供商只需修改本文件
+"""
+import threading
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .utils.circuit_breaker import get_health
+from .api_base import BaseAIApi, OpenAIApi, GoogleGeminiApi, MoonshotKimiApi, DoubaoApi, QwenApi, DeepSeekApi
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderSpec(NamedTuple):
+    """提供商配置"""
+    api_class: Optional[type]       # 为None表示仅在模型列表中展示，尚无调用实现
+    profile_field: Optional[str]    # UserProfile中的用户API密钥字段
+    config_key: str                 # settings.LLM_CONFIG中的全局API密钥
+
+
+PROVIDERS: Dict[str, ProviderSpec] = {
+    'openai': ProviderSpec(OpenAIApi, 'openai_api_key', 'OPENAI_API_KEY'),
+    'gemini': ProviderSpec(GoogleGeminiApi, 'gemini_api_key', 'GEMINI_API_KEY'),
+    'qwen': ProviderSpec(QwenApi, 'qwen_api_key', 'QWEN_API_KEY'),
+    'qwen_code': ProviderSpec(QwenApi, 'qwen_code_api_key', 'QWEN_CODE_API_KEY'),
+    'deepseek': ProviderSpec(DeepSeekApi, 'deepseek_api_key', 'DEEPSEEK_API_KEY'),
+    'kimi': ProviderSpec(MoonshotKimiApi, 'kimi_api_key', 'KIMI_API_KEY'),
+    'doubao': ProviderSpec(DoubaoApi, 'doubao_api_key', 'DOUBAO_API_KEY'),
+    'anthropic': ProviderSpec(None, None, 'ANTHROPIC_API_KEY'),
+    'baidu': ProviderSpec(None, None, 'BAIDU_API_KEY'),
+    'iflytek': ProviderSpec(None, None, 'IFLYTEK_API_KEY'),
+    'zhipu': ProviderSpec(None, None, 'ZHIPU_API_KEY'),
+}
+
+# 未知模型及暂无调用实现的模型默认使用OpenAI
+DEFAULT_PROVIDER = 'openai'
+
+# 模型目录，provider_key对应PROVIDERS中的提供商
+MODEL_CATALOG: List[Dict] = [
+    # OpenAI 模型
+    {'id': 'gpt-4o', 'name': 'GPT-4o', 'provider': 'OpenAI', 'provider_key': 'openai', 'group': 'High-End', 'capabilities': ['text', 'vision', 'audio'], 'pricing': {'input': 5.0, 'output': 15.0}, 'performance': {'speed': 'fast', 'accuracy': 'very_high'}},
+    {'id': 'gpt-4o-mini', 'name': 'GPT-4o Mini', 'provider': 'OpenAI', 'provider_key': 'openai', 'group': 'Efficient', 'capabilities': ['text', 'vision', 'audio'], 'pricing': {'input': 0.15, 'output': 0.6}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'gpt-4-turbo', 'name': 'GPT-4 Turbo', 'provider': 'OpenAI', 'provider_key': 'openai', 'group': 'High-End', 'capabilities': ['text', 'vision'], 'pricing': {'input': 10.0, 'output': 30.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'gpt-4', 'name': 'GPT-4', 'provider': 'OpenAI', 'provider_key': 'openai', 'group': 'High-End', 'capabilities': ['text'], 'pricing': {'input': 30.0, 'output': 60.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
+    {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'OpenAI', 'provider_key': 'openai', 'group': 'Basic', 'capabilities': ['text'], 'pricing': {'input': 0.5, 'output': 1.5}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
+
+    # Google Gemini 模型
+    {'id': 'gemini-1.5-pro', 'name': 'Gemini 1.5 Pro', 'provider': 'Google', 'provider_key': 'gemini', 'group': 'High-End', 'capabilities': ['text', 'vision', 'audio', 'code', 'multimodal'], 'pricing': {'input': 3.5, 'output': 10.5}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'gemini-1.5-flash', 'name': 'Gemini 1.5 Flash', 'provider': 'Google', 'provider_key': 'gemini', 'group': 'Efficient', 'capabilities': ['text', 'vision', 'audio', 'code', 'multimodal'], 'pricing': {'input': 0.35, 'output': 1.05}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'gemini-pro', 'name': 'Gemini Pro', 'provider': 'Google', 'provider_key': 'gemini', 'group': 'Mid-Range', 'capabilities': ['text', 'vision'], 'pricing': {'input': 0.5, 'output': 1.5}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+
+    # 阿里通义千问系列
+    {'id': 'qwen-max', 'name': '通义千问Max', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'High-End', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'qwen-plus', 'name': '通义千问Plus', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Mid-Range', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'qwen-turbo', 'name': '通义千问Turbo', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Efficient', 'capabilities': ['text'], 'pricing': {'input': 0.014, 'output': 0.028}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
+    {'id': 'qwen-coder', 'name': '通义千问Coder', 'provider': 'Alibaba', 'provider_key': 'qwen_code', 'group': 'Specialized', 'capabilities': ['code'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+    {'id': 'qwen-math', 'name': '通义千问Math', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Specialized', 'capabilities': ['math'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'qwen-vl-max', 'name': '通义千问VL-Max', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Vision', 'capabilities': ['vision', 'text'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},  # 视觉语言模型
+    {'id': 'qwen-vl-plus', 'name': '通义千问VL-Plus', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Vision', 'capabilities': ['vision', 'text'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},  # 视觉语言模型
+    {'id': 'qwen-audio-turbo', 'name': '通义千问Audio-Turbo', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Audio', 'capabilities': ['audio', 'text'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},  # 音频模型
+    {'id': 'qwen_coder_plus', 'name': '通义千问Coder+', 'provider': 'Alibaba', 'provider_key': 'qwen_code', 'group': 'Specialized', 'capabilities': ['code'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+    {'id': 'qwen_code_interpreter', 'name': '通义千问Code Interpreter', 'provider': 'Alibaba', 'provider_key': 'qwen', 'group': 'Specialized', 'capabilities': ['code', 'execution'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+
+    # DeepSeek
+    {'id': 'deepseek-chat', 'name': 'DeepSeek Chat', 'provider': 'DeepSeek', 'provider_key': 'deepseek', 'group': 'General', 'capabilities': ['text'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'deepseek-coder', 'name': 'DeepSeek Coder', 'provider': 'DeepSeek', 'provider_key': 'deepseek', 'group': 'Specialized', 'capabilities': ['code'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'fast', 'accuracy': 'very_high'}},
+
+    # 月之暗面(Kimi)
+    {'id': 'kimi-large', 'name': 'Kimi Large', 'provider': 'Moonshot', 'provider_key': 'kimi', 'group': 'High-End', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 12.0, 'output': 12.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
+
+    # 豆包
+    {'id': 'doubao-pro', 'name': '豆包Pro', 'provider': 'ByteDance', 'provider_key': 'doubao', 'group': 'General', 'capabilities': ['text', 'multimodal'], 'pricing': {'input': 0.5, 'output': 0.5}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+
+    # 其他模型（仅使用全局配置中的API密钥）
+    {'id': 'claude-3-5-sonnet', 'name': 'Claude 3.5 Sonnet', 'provider': 'Anthropic', 'provider_key': 'anthropic', 'group': 'High-End', 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 3.0, 'output': 15.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'claude-3-opus', 'name': 'Claude 3 Opus', 'provider': 'Anthropic', 'provider_key': 'anthropic', 'group': 'High-End', 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 15.0, 'output': 75.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
+    {'id': 'claude-3-sonnet', 'name': 'Claude 3 Sonnet', 'provider': 'Anthropic', 'provider_key': 'anthropic', 'group': 'Mid-Range', 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 3.0, 'output': 15.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'claude-3-haiku', 'name': 'Claude 3 Haiku', 'provider': 'Anthropic', 'provider_key': 'anthropic', 'group': 'Efficient', 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 0.8, 'output': 4.0}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'ernie-bot-4.5', 'name': '文心一言4.5', 'provider': 'Baidu', 'provider_key': 'baidu', 'group': 'Mid-Range', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.12, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+    {'id': 'ernie-bot-4', 'name': '文心一言4', 'provider': 'Baidu', 'provider_key': 'baidu', 'group': 'Basic', 'capabilities': ['text'], 'pricing': {'input': 0.08, 'output': 0.08}, 'performance': {'speed': 'medium', 'accuracy': 'medium'}},
+    {'id': 'spark-max', 'name': '讯飞星火Max', 'provider': 'iFlytek', 'provider_key': 'iflytek', 'group': 'High-End', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.05, 'output': 0.05}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
+    {'id': 'spark-pro', 'name': '讯飞星火Pro', 'provider': 'iFlytek', 'provider_key': 'iflytek', 'group': 'Mid-Range', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.02, 'output': 0.02}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
+    {'id': 'spark-lite', 'name': '讯飞星火Lite', 'provider': 'iFlytek', 'provider_key': 'iflytek', 'group': 'Efficient', 'capabilities': ['text'], 'pricing': {'input': 0.008, 'output': 0.008}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
+    {'id': 'glm-4', 'name': 'GLM-4', 'provider': 'ZhipuAI', 'provider_key': 'zhipu', 'group': 'High-End', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.1, 'output': 0.1}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
+    {'id': 'glm-4-air', 'name': 'GLM-4 Air', 'provider': 'ZhipuAI', 'provider_key': 'zhipu', 'group': 'Mid-Range', 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.05, 'output': 0.05}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
+    {'id': 'glm-4-flash', 'name': 'GLM-4 Flash', 'provider': 'ZhipuAI', 'provider_key': 'zhipu', 'group': 'Efficient', 'capabilities': ['text'], 'pricing': {'input': 0.01, 'output': 0.01}, 'performance': {'speed': 'very_fast', 'accuracy': 'medium'}},
+]
+
+# 目录外的模型ID（如带版本后缀的模型名）按前缀匹配，顺序即优先级
+MODEL_PREFIXES: Tuple[Tuple[str, str], ...] = (
+    ('qwen-code', 'qwen_code'),
+    ('qwen_coder', 'qwen_code'),
+    ('gpt', 'openai'),
+    ('gemini', 'gemini'),
+    ('kimi', 'kimi'),
+    ('doubao', 'doubao'),
+    ('deepseek', 'deepseek'),
+    ('qwen', 'qwen'),
+)
+
+# 前缀匹配结果的缓存上限，防止任意模型名撑大缓存
+MAX_RESOLVED_MODELS = 1024
+
+
+class ProviderRegistry:
+    """
+    提供商注册表
+    模型ID -> 提供商的映射按字典查找，提供商实例在进程内长期复用（共享连接池）
+    """
+
+    def __init__(self, providers: Dict[str, ProviderSpec] = None, catalog: List[Dict] = None):
+        self.providers = providers if providers is not None else PROVIDERS
+        self.catalog = catalog if catalog is not None else MODEL_CATALOG
+        self._lock = threading.Lock()
+        self._instances: Dict[type, BaseAIApi] = {}
+        self._catalog_index = {model['id']: model['provider_key'] for model in self.catalog}
+        self._catalog_groups = {model['id']: model['group'] for model in self.catalog}
+        self._resolved: Dict[str, str] = {}
+
+    def provider_key_for(self, model: str, default: str = DEFAULT_PROVIDER) -> str:
+        """
+        获取模型对应的提供商标识
+        :param default: 未知模型或暂无调用实现的模型使用的提供商
+        """
+        key = self._catalog_index.get(model) or self._resolved.get(model)
+        if key is None:
+            key = next((k for prefix, k in MODEL_PREFIXES if model.startswith(prefix)), '')
+            if len(self._resolved) < MAX_RESOLVED_MODELS:
+                self._resolved[model] = key
+
+        spec = self.providers.get(key)
+        if spec is None or spec.api_class is None:
+            return default
+        return key
+
+    def group_for(self, model: str) -> Optional[str]:
+        """获取模型在目录中的分组，目录外的模型返回None"""
+        return self._catalog_groups.get(model)
+
+    def get_provider(self, provider_key: str) -> BaseAIApi:
+        """获取提供商的共享实例，首次使用时创建"""
+        api_class = self.providers[provider_key].api_class
+        instance = self._instances.get(api_class)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(api_class)
+                if instance is None:
+                    instance = api_class()
+                    self._instances[api_class] = instance
+                    logger.info(f"注册大模型提供商实例: {instance.name}")
+        return instance
+
+    def get_api_key(self, provider_key: str, user=None) -> Optional[str]:
+        """获取API密钥，优先使用用户配置，其次使用全局配置"""
+        spec = self.providers[provider_key]
+        profile = getattr(user, 'profile', None) if user is not None else None
+        user_key = getattr(profile, spec.profile_field, None) if spec.profile_field else None
+        return user_key or settings.LLM_CONFIG.get(spec.config_key)
+
+    def resolve(self, model: str, user=None, default: str = DEFAULT_PROVIDER) -> Tuple[BaseAIApi, Optional[str]]:
+        """
+        根据模型解析提供商实例和API密钥
+        :return: (提供商实例, API密钥)
+        """
+        provider_key = self.provider_key_for(model, default)
+        return self.get_provider(provider_key), self.get_api_key(provider_key, user)
+
+    def available_models(self, user=None) -> List[Dict]:
+        """
+        根据用户及全局配置的API密钥返回可用模型列表
+        附带熔断器的健康状态，熔断或错误率较高的模型标记为degraded
+        """
+        api_keys = {}
+        models = []
+        for entry in self.catalog:
+            provider_key = entry['provider_key']
+            if provider_key not in api_keys:
+                api_keys[provider_key] = self.get_api_key(provider_key, user)
+            if api_keys[provider_key]:
+                # 暂无调用实现的模型由默认提供商处理，按实际调用的提供商统计健康状态
+                instance = self.get_provider(self.provider_key_for(entry['id']))
+                health = get_health(instance.name, api_keys[provider_key])
+                model = {key: value for key, value in entry.items() if key != 'provider_key'}
+                model['available'] = True
+                model['degraded'] = health['degraded']
+                model['health'] = health
+                models.append(model)
+        return models
+
+    def clear(self):
+        """丢弃缓存的提供商实例（配置变更后重新创建）"""
+        with self._lock:
+            self._instances.clear()
+
+
+provider_registry = ProviderRegistry()
+
+
+@receiver(setting_changed)
+def _reset_provider_registry(setting, **kwargs):
+    """提供商实例在创建时读取配置，相关配置变更后需要重新创建"""
+    if setting == 'LLM_CONFIG' or setting.endswith('_API_BASE_URL') or setting.endswith('_API_KEY'):
+        provider_registry.clear()
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Conversation, Message, PasswordResetToken
+from .models import Conversation, Message, PasswordResetToken, BatchJob
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -7,8 +7,8 @@ class MessageSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Message
-        fields = ['id', 'role', 'content', 'created_at', 'image_url', 'is_read']
-        read_only_fields = ['id', 'created_at', 'is_read']
+        fields = ['id', 'role', 'content', 'created_at', 'image_url', 'is_read', 'is_truncated']
+        read_only_fields = ['id', 'created_at', 'is_read', 'is_truncated']
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -38,4 +38,15 @@ class PasswordResetTokenSerializer(serializers.ModelSerializer):
     class Meta:
         model = PasswordResetToken
         fields = ['id', 'user', 'token', 'created_at', 'expires_at', 'is_expired']
-        read_only_fields = ['id', 'created_at', 'is_expired']
\ No newline at end of file
+        read_only_fields = ['id', 'created_at', 'is_expired']
+
+
+class BatchJobSerializer(serializers.ModelSerializer):
+    """批量任务序列化器"""
+    
+    class Meta:
+        model = BatchJob
+        fields = ['id', 'name', 'model', 'system_prompt', 'temperature', 'max_tokens', 'use_cache', 'status',
+                  'total_items', 'succeeded_items', 'failed_items', 'error', 'created_at', 'started_at', 'finished_at']
+        read_only_fields = ['id', 'status', 'total_items', 'succeeded_items', 'failed_items', 'error',
+                            'created_at', 'started_at', 'finished_at']
@@ -0,0 +1,279 @@
+"""
+流式聊天公共逻辑
+同步的SSE视图与异步的ASGI视图、WebSocket消费者共用
+"""
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+
+from .models import Conversation, Message
+from .provider_registry import provider_registry
+from .serializers import MessageSerializer
+from .utils.knowledge_base import real_time_source
+from .utils.generation_control import start_generation
+from .utils.semantic_cache import standalone_options
+from .utils import history_cache
+from .utils.conversation_summary import summary_message
+from .utils.usage_metrics import record_message_usage
+from .utils.failover import stream_with_failover, astream_with_failover
+
+logger = logging.getLogger(__name__)
+
+
+def build_user_content(content: str, image_url: Optional[str] = None):
+    """构建用户消息内容，带图片时使用多模态格式"""
+    if image_url:
+        return [
+            {"type": "text", "text": content},
+            {"type": "image_url", "image_url": {"url": image_url}}
+        ]
+    return content
+
+
+def build_history(conversation, include_images: bool = False, limit: Optional[int] = None,
+                  exclude_id: Optional[int] = None) -> List[Dict]:
+    """
+    构建对话历史（最近的消息，从会话历史窗口缓存读取）
+    :param include_images: 是否以多模态格式包含用户消息中的图片
+    :param limit: 最多读取的消息条数，默认为历史窗口大小
+    :param exclude_id: 不包含的消息ID（刚保存的当前用户消息，由提供商追加）
+    :return: 消息列表，附带保存时计算的token数(tokens)，组装请求时按token预算截取并去掉该字段；
+             会话有摘要时以摘要开头，之后只包含摘要之后的消息
+    """
+    history = []
+    records = history_cache.get_recent_messages(conversation.id, limit)
+    if conversation.summary:
+        history.append(summary_message(conversation.summary))
+        records = [msg for msg in records if msg['id'] > (conversation.summary_message_id or 0)]
+    for msg in records:
+        if msg['id'] == exclude_id:
+            continue
+        if msg['role'] == 'user':
+            content = build_user_content(msg['content'], msg['image_url'] if include_images else None)
+            history.append({"role": "user", "content": content, "tokens": msg.get('token_count')})
+        elif msg['role'] == 'assistant':
+            history.append({"role": "assistant", "content": msg['content'], "tokens": msg.get('token_count')})
+    return history
+
+
+def get_knowledge_prompt(message: str) -> str:
+    """查询知识库获取相关上下文，失败时返回空字符串"""
+    try:
+        knowledge_contexts = real_time_source.get_relevant_context(message)
+        if knowledge_contexts:
+            # 最多使用3个相关文档
+            return "根据以下最新信息回答问题：" + "\n".join(knowledge_contexts[:3])
+    except Exception as e:
+        logger.warning(f"知识库查询失败: {str(e)}")
+    return ""
+
+
+def build_stream_config(model: str, api_key: Optional[str], history: List[Dict], knowledge_prompt: str,
+                        question: Optional[str] = None, image_url: Optional[str] = None) -> Dict:
+    """
+    构建流式调用的模型参数，传入question时对没有上文的问题使用语义缓存
+    提供商把流式调用的用量和是否命中缓存写入call_info
+    """
+    return {
+        'model': model,
+        'api_key': api_key,
+        'temperature': 0.6,
+        'max_tokens': 2000,
+        'top_p': 0.7,
+        'timeout': 30,
+        'history': history,
+        # 如果有知识库上下文，将其作为系统消息添加
+        'system_prompt': knowledge_prompt,
+        'semantic_cache': standalone_options(question, history, image_url=image_url),
+        'call_info': {},
+    }
+
+
+class StreamTimer:
+    """
+    记录流式调用的首token耗时和总耗时，生成结束时与提供商返回的用量一起保存
+    发生故障转移时模型和提供商取call_info中实际请求的值
+    """
+
+    def __init__(self, api_instance, config: Dict):
+        self.api_instance = api_instance
+        self.config = config
+        self.start = time.monotonic()
+        self.ttft = None
+
+    def token(self):
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.start
+
+    def metrics(self) -> Dict:
+        info = self.config.get('call_info') or {}
+        return {
+            'model': info.get('model') or self.config.get('model'),
+            'provider': info.get('provider') or self.api_instance.name,
+            'usage': info.get('usage'),
+            'cached': info.get('cached'),
+            'attempts': info.get('attempts'),
+            'ttft': self.ttft,
+            'latency': time.monotonic() - self.start,
+        }
+
+
+def _start_generation(user, message, model, conversation_id=None, image_url=None, request_id=None):
+    """
+    生成开始前的数据库操作：获取或创建会话、保存用户消息、读取历史，并登记生成以便取消
+    """
+    if conversation_id:
+        conversation = Conversation.objects.get(id=conversation_id, user=user)
+    else:
+        title = message[:50] if len(message) > 50 else message
+        conversation = Conversation.objects.create(
+            user=user,
+            title=title,
+            model=model
+        )
+
+    user_message = Message.objects.create(
+        conversation=conversation,
+        role='user',
+        content=message,
+        image_url=image_url
+    )
+
+    # 历史中不含刚保存的当前用户消息，由提供商追加
+    history = build_history(conversation, exclude_id=user_message.id)
+    api_instance, api_key = provider_registry.resolve(model, user)
+    generation = start_generation(user.id, request_id)
+    return conversation, MessageSerializer(user_message).data, history, api_instance, api_key, generation
+
+
+def _finish_generation(conversation, content: str, truncated: bool = False, timer: Optional[StreamTimer] = None) -> Optional[Dict]:
+    """
+    生成结束后保存AI回复及用量
+    被取消或客户端断开时保存已生成的部分并标记为中断，没有内容时不保存
+    """
+    if truncated and not content:
+        return None
+    ai_message = Message.objects.create(
+        conversation=conversation,
+        role='assistant',
+        content=content,
+        is_truncated=truncated
+    )
+    if timer is not None:
+        record_message_usage(ai_message, timer.metrics())
+    return MessageSerializer(ai_message).data
+
+
+def iter_chat_events(user, message: str, model: str, conversation_id=None, image_url=None, request_id=None) -> Iterator[Dict]:
+    """
+    同步流式聊天，逐个返回事件字典
+    客户端断开（生成器被关闭）或通过取消接口取消时，立即关闭上游HTTP流并保存已生成的部分
+    """
+    try:
+        conversation, user_message_data, history, api_instance, api_key, generation = _start_generation(
+            user, message, model, conversation_id, image_url, request_id
+        )
+    except Conversation.DoesNotExist:
+        yield {'type': 'error', 'message': '会话不存在'}
+        return
+    except Exception as e:
+        logger.error(f"开始生成失败: {str(e)}")
+        yield {'type': 'error', 'message': '聊天服务暂时不可用'}
+        return
+
+    chunks = []
+    timer = None
+    try:
+        yield {'type': 'user_message', 'request_id': generation.request_id, 'message': user_message_data}
+
+        config = build_stream_config(model, api_key, history, get_knowledge_prompt(message), message, image_url)
+        timer = StreamTimer(api_instance, config)
+        try:
+            # 收到第一个token之前失败时按备用链切换模型
+            upstream = stream_with_failover(model, message, config, user)
+            try:
+                for content in upstream:
+                    timer.token()
+                    chunks.append(content)
+                    yield {'type': 'token', 'content': content}
+                    if generation.cancelled():
+                        break
+            finally:
+                # 关闭上游响应，停止继续消耗token
+                upstream.close()
+        except Exception as e:
+            yield {'type': 'error', 'message': f"抱歉，请求AI服务时发生错误：{str(e)}"}
+            return
+
+        if generation.cancelled():
+            ai_message_data = _finish_generation(conversation, ''.join(chunks), True, timer)
+            yield {'type': 'cancelled', 'request_id': generation.request_id, 'message': ai_message_data}
+        else:
+            yield {'type': 'complete', 'message': _finish_generation(conversation, ''.join(chunks), False, timer)}
+    except GeneratorExit:
+        logger.info(f"客户端断开连接，中断生成 {generation.request_id}")
+        _finish_generation(conversation, ''.join(chunks), True, timer)
+        raise
+    finally:
+        generation.close()
+
+
+async def stream_chat_events(user, message: str, model: str, conversation_id=None, image_url=None, request_id=None) -> AsyncIterator[Dict]:
+    """
+    异步流式聊天，逐个返回事件字典
+    数据库读写只在开始和结束时各批量执行一次，流式过程中不占用线程
+    任务被取消（客户端断开、WebSocket取消）或通过取消接口取消时，立即关闭上游HTTP流并保存已生成的部分
+    """
+    try:
+        conversation, user_message_data, history, api_instance, api_key, generation = await sync_to_async(
+            _start_generation
+        )(user, message, model, conversation_id, image_url, request_id)
+    except Conversation.DoesNotExist:
+        yield {'type': 'error', 'message': '会话不存在'}
+        return
+    except Exception as e:
+        logger.error(f"开始生成失败: {str(e)}")
+        yield {'type': 'error', 'message': '聊天服务暂时不可用'}
+        return
+
+    chunks = []
+    timer = None
+    try:
+        yield {'type': 'user_message', 'request_id': generation.request_id, 'message': user_message_data}
+
+        # 知识库检索是CPU密集的同步操作，放到线程池中执行
+        knowledge_prompt = await sync_to_async(get_knowledge_prompt, thread_sensitive=False)(message)
+        config = build_stream_config(model, api_key, history, knowledge_prompt, message, image_url)
+        timer = StreamTimer(api_instance, config)
+
+        try:
+            upstream = astream_with_failover(model, message, config, user)
+            try:
+                async for content in upstream:
+                    timer.token()
+                    chunks.append(content)
+                    yield {'type': 'token', 'content': content}
+                    if await generation.acancelled():
+                        break
+            finally:
+                # 关闭上游响应，停止继续消耗token
+                await upstream.aclose()
+        except Exception as e:
+            yield {'type': 'error', 'message': f"抱歉，请求AI服务时发生错误：{str(e)}"}
+            return
+
+        if await generation.acancelled():
+            ai_message_data = await sync_to_async(_finish_generation)(conversation, ''.join(chunks), True, timer)
+            yield {'type': 'cancelled', 'request_id': generation.request_id, 'message': ai_message_data}
+        else:
+            ai_message_data = await sync_to_async(_finish_generation)(conversation, ''.join(chunks), False, timer)
+            yield {'type': 'complete', 'message': ai_message_data}
+    except (asyncio.CancelledError, GeneratorExit):
+        logger.info(f"生成任务被取消，中断生成 {generation.request_id}")
+        await sync_to_async(_finish_generation)(conversation, ''.join(chunks), True, timer)
+        raise
+    finally:
+        await sync_to_async(generation.close)()
@@ -1,21 +1,23 @@
 """
-知识库同步任务
+知识库同步任务、会话摘要任务、批量对话补全任务
 """
 from celery import shared_task
 from chatbot.utils.knowledge_base import real_time_source
+from chatbot.utils import conversation_summary
+from chatbot.utils import batch_jobs
 import logging
 
 logger = logging.getLogger(__name__)
 
 @shared_task
-def sync_knowledge_base_from_db():
+def sync_knowledge_base_from_db(full=False):
     """
-    定时同步数据库内容到知识库
+    定时增量同步数据库内容到知识库，full为True时全量同步
     """
     try:
         logger.info("开始同步数据库内容到知识库...")
-        real_time_source.sync_from_database()
-        logger.info("数据库内容同步到知识库完成")
+        stats = real_time_source.sync_from_database(full=full)
+        logger.info(f"数据库内容同步到知识库完成: {stats}")
     except Exception as e:
         logger.error(f"同步数据库内容到知识库失败: {e}")
 
@@ -42,4 +44,24 @@ def sync_external_data_sources():
         
         logger.info("外部数据源同步完成")
     except Exception as e:
-        logger.error(f"同步外部数据源失败: {e}")
\ No newline at end of file
+        logger.error(f"同步外部数据源失败: {e}")
+
+@shared_task
+def summarize_conversation(conversation_id):
+    """
+    把会话中较早的消息合并进会话摘要
+    """
+    try:
+        conversation_summary.summarize_conversation(conversation_id)
+    except Exception as e:
+        logger.error(f"生成会话摘要失败: {e}")
+
+@shared_task
+def run_batch_job(job_id):
+    """
+    执行批量对话补全任务，中断后重新执行只处理未完成的条目
+    """
+    try:
+        batch_jobs.run_batch_job(job_id)
+    except Exception as e:
+        logger.error(f"执行批量任务失败: {e}")
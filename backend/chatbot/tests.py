@@ -1,13 +1,19 @@
 """
 聊天机器人应用的单元测试
 """
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from django.contrib.auth.models import User
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
+from django.test import override_settings
 from .models import Conversation, Message
 from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import asyncio
+import threading
+import time
 
 
 class ModelTestCase(TestCase):
@@ -180,4 +186,2381 @@ class MessageViewSetTestCase(APITestCase):
         
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(Message.objects.count(), 1)
-        self.assertEqual(Message.objects.first().content, 'Hello, AI!')
\ No newline at end of file
+        self.assertEqual(Message.objects.first().content, 'Hello, AI!')
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """本地模拟的OpenAI兼容大模型接口"""
+    protocol_version = 'HTTP/1.1'
+
+    # 流式响应按此切分返回，包含无空格的中文
+    stream_tokens = ['你好', '，', '世界', '!']
+    # 模型名以 -slow 结尾时的响应延迟（秒）
+    slow_delay = 1.0
+    # OpenAI兼容响应的usage，包含DeepSeek的前缀缓存字段
+    usage = {
+        'prompt_tokens': 3, 'completion_tokens': 2, 'total_tokens': 5,
+        'prompt_cache_hit_tokens': 2, 'prompt_cache_miss_tokens': 1,
+    }
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        model = payload.get('model') or ''
+        if model.endswith('-fail'):
+            self._send_body(b'{"error": "stub failure"}', 'application/json', status=500)
+            return
+        if model.endswith('-429'):
+            self._send_body(b'{"error": "rate limited"}', 'application/json', status=429)
+            return
+        if model.endswith('-slow'):
+            time.sleep(self.slow_delay)
+        if ':streamGenerateContent' in self.path:
+            body = ''.join(
+                f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': token}]}}]})}\r\n\r\n"
+                for token in self.stream_tokens
+            ).encode('utf-8')
+            self._send_body(body, 'text/event-stream')
+            return
+        if payload.get('stream'):
+            chunks = [{'choices': [{'delta': {'role': 'assistant'}}]}]
+            chunks += [{'choices': [{'delta': {'content': token}}]} for token in self.stream_tokens]
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                chunks.append({'choices': [], 'usage': self.usage})
+            body = ''.join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+            self._send_body(body.encode('utf-8'), 'text/event-stream')
+            return
+        if ':generateContent' in self.path:
+            # Gemini格式
+            text = payload['contents'][-1]['parts'][0]['text']
+            body = json.dumps({
+                'candidates': [{'content': {'parts': [{'text': f"echo:{text}"}]}}],
+                'usageMetadata': {'promptTokenCount': 3, 'candidatesTokenCount': 2},
+            }).encode('utf-8')
+        else:
+            body = json.dumps({
+                'choices': [{'message': {'role': 'assistant', 'content': f"echo:{payload['messages'][-1]['content']}"}}],
+                'usage': self.usage,
+            }).encode('utf-8')
+        self._send_body(body, 'application/json')
+
+    def _send_body(self, body, content_type, status=200):
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已取消请求
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProviderMixin:
+    """在测试期间启动本地模拟提供商服务"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub_server = ThreadingHTTPServer(('127.0.0.1', 0), StubProviderHandler)
+        cls.stub_url = f"http://127.0.0.1:{cls.stub_server.server_address[1]}"
+        cls.stub_thread = threading.Thread(target=cls.stub_server.serve_forever, daemon=True)
+        cls.stub_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub_server.shutdown()
+        cls.stub_server.server_close()
+        super().tearDownClass()
+
+
+class HTTPPoolTestCase(StubProviderMixin, TestCase):
+    """测试大模型HTTP连接池"""
+
+    def setUp(self):
+        from .utils.http_pool import close_sessions
+        close_sessions()
+
+    def test_session_is_shared_per_provider(self):
+        """同一提供商复用同一个Session"""
+        from .utils.http_pool import get_session
+        self.assertIs(get_session('DeepSeek'), get_session('DeepSeek'))
+        self.assertIsNot(get_session('DeepSeek'), get_session('Qwen'))
+
+    def test_connection_reused_between_calls(self):
+        """连续调用复用keep-alive连接"""
+        from .api_base import DeepSeekApi
+        from .utils.http_pool import get_pool_stats
+        with override_settings(DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions", DEEPSEEK_API_KEY='test'):
+            api = DeepSeekApi()
+            for _ in range(3):
+                result = api.send_message('你好', {'model': 'deepseek-chat'})
+                self.assertEqual(result['content'], 'echo:你好')
+
+        stats = get_pool_stats()['DeepSeek']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_post_not_retried_on_gateway_errors(self):
+        """生成请求（POST）只在连接失败时重试，网关错误不重新发送"""
+        from .utils.http_pool import get_session
+
+        retry = get_session('DeepSeek').get_adapter('https://').max_retries
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertTrue(retry.is_retry('GET', 503))
+        self.assertEqual(retry.connect, retry.total)
+
+
+class AsyncProviderTestCase(StubProviderMixin, TestCase):
+    """测试异步大模型调用"""
+
+    def _stub_settings(self):
+        completions_url = f"{self.stub_url}/v1/chat/completions"
+        return override_settings(
+            OPENAI_API_BASE_URL=completions_url, OPENAI_API_KEY='test',
+            MOONSHOT_API_BASE_URL=completions_url, MOONSHOT_API_KEY='test',
+            QWEN_API_BASE_URL=completions_url, QWEN_API_KEY='test',
+            DEEPSEEK_API_BASE_URL=completions_url, DEEPSEEK_API_KEY='test',
+            GEMINI_API_BASE_URL=f"{self.stub_url}/v1beta/models", GEMINI_API_KEY='test',
+        )
+
+    def test_send_message_async_all_providers(self):
+        """所有提供商均支持异步调用"""
+        import asyncio
+        from .api_base import OpenAIApi, GoogleGeminiApi, MoonshotKimiApi, QwenApi, DeepSeekApi
+        from .utils.http_pool import close_async_clients
+
+        cases = [
+            (OpenAIApi, 'gpt-4o-mini'),
+            (GoogleGeminiApi, 'gemini-1.5-flash'),
+            (MoonshotKimiApi, 'moonshot-v1-8k'),
+            (QwenApi, 'qwen-plus'),
+            (DeepSeekApi, 'deepseek-chat'),
+        ]
+
+        async def run_all():
+            try:
+                return await asyncio.gather(*[
+                    api_class().send_message_async(f"hi-{model}", {'model': model})
+                    for api_class, model in cases
+                ])
+            finally:
+                await close_async_clients()
+
+        with self._stub_settings():
+            results = asyncio.run(run_all())
+
+        for (_, model), result in zip(cases, results):
+            self.assertEqual(result['content'], f"echo:hi-{model}")
+
+    def test_concurrent_requests_share_client(self):
+        """同一事件循环内的并发请求共享一个异步客户端"""
+        import asyncio
+        from .api_base import DeepSeekApi
+        from .utils.http_pool import get_async_client, close_async_clients
+
+        async def run_many():
+            api = DeepSeekApi()
+            try:
+                results = await asyncio.gather(*[
+                    api.send_message_async(f"msg-{i}", {'model': 'deepseek-chat'})
+                    for i in range(20)
+                ])
+                self.assertIs(get_async_client('DeepSeek'), get_async_client('DeepSeek'))
+                return results
+            finally:
+                await close_async_clients()
+
+        with self._stub_settings():
+            results = asyncio.run(run_many())
+
+        self.assertEqual([r['content'] for r in results], [f"echo:msg-{i}" for i in range(20)])
+
+
+class StreamMessageTestCase(StubProviderMixin, TestCase):
+    """测试提供商流式输出"""
+
+    def test_openai_compatible_stream(self):
+        """OpenAI兼容接口逐token返回"""
+        from .api_base import QwenApi
+        with override_settings(QWEN_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            tokens = list(QwenApi().stream_message('hi', {'model': 'qwen-plus', 'api_key': 'test'}))
+        self.assertEqual(tokens, StubProviderHandler.stream_tokens)
+
+    def test_gemini_stream(self):
+        """Gemini streamGenerateContent逐token返回"""
+        from .api_base import GoogleGeminiApi
+        with override_settings(GEMINI_API_BASE_URL=f"{self.stub_url}/v1beta/models"):
+            tokens = list(GoogleGeminiApi().stream_message('hi', {'model': 'gemini-1.5-flash', 'api_key': 'test'}))
+        self.assertEqual(tokens, StubProviderHandler.stream_tokens)
+
+    def test_stream_chat_forwards_provider_tokens(self):
+        """stream_chat直接转发提供商的token并保存完整回复"""
+        from django.conf import settings
+        user = User.objects.create_user(username='streamer', password='testpass123')
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        with override_settings(LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            response = client.post('/api/v1/stream-chat/', {'message': '你好', 'model': 'deepseek-chat'}, format='json')
+            events = [
+                json.loads(line[len('data: '):])
+                for line in b''.join(response.streaming_content).decode('utf-8').split('\n\n') if line
+            ]
+
+        tokens = [event['content'] for event in events if event['type'] == 'token']
+        self.assertEqual(tokens, StubProviderHandler.stream_tokens)
+        self.assertEqual(events[-1]['type'], 'complete')
+        self.assertEqual(Message.objects.get(role='assistant').content, '你好，世界!')
+
+    def test_stream_chat_rejects_invalid_conversation_id(self):
+        """非法的会话ID在开始流式响应前返回400，开始生成时的其他错误以error事件返回"""
+        from unittest import mock
+        from .streaming import iter_chat_events
+
+        user = User.objects.create_user(username='streamer', password='testpass123')
+        client = APIClient()
+        client.force_authenticate(user=user)
+        response = client.post('/api/v1/stream-chat/', {'message': '你好', 'conversation_id': 'abc'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch('chatbot.streaming.provider_registry.resolve', side_effect=RuntimeError('boom')):
+            events = list(iter_chat_events(user, '你好', 'deepseek-chat'))
+        self.assertEqual(events, [{'type': 'error', 'message': '聊天服务暂时不可用'}])
+
+
+class AsyncStreamChatTestCase(StubProviderMixin, TestCase):
+    """测试异步流式聊天接口"""
+
+    async def test_async_stream_chat(self):
+        """异步接口转发token并在结束时保存回复"""
+        from asgiref.sync import sync_to_async
+        from django.conf import settings
+        from rest_framework_simplejwt.tokens import RefreshToken
+        from .utils.http_pool import close_async_clients
+
+        user = await sync_to_async(User.objects.create_user)(username='async-streamer', password='testpass123')
+        token = str(RefreshToken.for_user(user).access_token)
+
+        llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test')
+        with override_settings(LLM_CONFIG=llm_config, QWEN_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            response = await self.async_client.post(
+                '/api/v1/stream-chat/async/',
+                {'message': '你好', 'model': 'qwen-plus'},
+                content_type='application/json',
+                headers={'Authorization': f'Bearer {token}'},
+            )
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode('utf-8')
+            await close_async_clients()
+
+        events = [json.loads(line[len('data: '):]) for line in body.split('\n\n') if line]
+        self.assertEqual(events[0]['type'], 'user_message')
+        self.assertEqual([e['content'] for e in events if e['type'] == 'token'], StubProviderHandler.stream_tokens)
+        self.assertEqual(events[-1]['type'], 'complete')
+        self.assertEqual(events[-1]['message']['content'], '你好，世界!')
+
+    async def test_async_stream_chat_requires_auth(self):
+        """未认证请求被拒绝"""
+        response = await self.async_client.post(
+            '/api/v1/stream-chat/async/', {'message': 'hi'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+
+
+class ChatConsumerTestCase(StubProviderMixin, TransactionTestCase):
+    """测试聊天WebSocket"""
+
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        self.user = User.objects.create_user(username='ws-user', password='testpass123')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    def _communicator(self, token=None):
+        from channels.testing import WebsocketCommunicator
+        from config.asgi import application
+
+        path = f'/ws/chat/?token={token}' if token else '/ws/chat/'
+        return WebsocketCommunicator(application, path)
+
+    async def _receive_until(self, communicator, event_type, request_id):
+        events = []
+        while True:
+            event = await communicator.receive_json_from(timeout=5)
+            events.append(event)
+            if event['type'] == event_type and event.get('request_id') == request_id:
+                return events
+
+    async def test_rejects_unauthenticated(self):
+        """未认证连接被拒绝"""
+        communicator = self._communicator('invalid-token')
+        connected, close_code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(close_code, 4001)
+
+    async def test_stream_tokens(self):
+        """通过WebSocket流式返回token并保存回复"""
+        from django.conf import settings
+        from .utils.http_pool import close_async_clients
+
+        llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test')
+        with override_settings(LLM_CONFIG=llm_config, QWEN_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            communicator = self._communicator(self.token)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({'type': 'chat', 'request_id': 'r1', 'message': '你好', 'model': 'qwen-plus'})
+            events = await self._receive_until(communicator, 'complete', 'r1')
+            await communicator.disconnect()
+            await close_async_clients()
+
+        self.assertEqual(events[0]['type'], 'user_message')
+        self.assertTrue(all(e['request_id'] == 'r1' for e in events))
+        self.assertEqual([e['content'] for e in events if e['type'] == 'token'], StubProviderHandler.stream_tokens)
+        self.assertEqual(events[-1]['message']['content'], '你好，世界!')
+
+    async def test_multiplex_and_cancel(self):
+        """同一连接上并发多个请求，并可按request_id取消"""
+        import asyncio
+        from unittest import mock
+
+        async def fake_events(user, message, model, conversation_id=None, image_url=None, request_id=None):
+            yield {'type': 'token', 'content': message}
+            if message == 'slow':
+                await asyncio.sleep(60)
+            yield {'type': 'complete', 'message': {'content': message}}
+
+        with mock.patch('chatbot.consumers.stream_chat_events', fake_events):
+            communicator = self._communicator(self.token)
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'chat', 'request_id': 'slow-1', 'message': 'slow'})
+            await communicator.send_json_to({'type': 'chat', 'request_id': 'fast-1', 'message': 'fast'})
+
+            events = await self._receive_until(communicator, 'complete', 'fast-1')
+            self.assertIn({'type': 'token', 'content': 'slow', 'request_id': 'slow-1'}, events)
+
+            await communicator.send_json_to({'type': 'cancel', 'request_id': 'slow-1'})
+            events = await self._receive_until(communicator, 'cancelled', 'slow-1')
+            self.assertNotIn('complete', [e['type'] for e in events])
+
+            await communicator.send_json_to({'type': 'cancel', 'request_id': 'slow-1'})
+            event = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(event['type'], 'error')
+            await communicator.disconnect()
+
+
+class GenerationCancelTestCase(StubProviderMixin, TestCase):
+    """测试生成取消与客户端断开"""
+
+    def setUp(self):
+        from django.conf import settings
+
+        self.user = User.objects.create_user(username='canceller', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config, QWEN_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_disconnect_saves_truncated_message(self):
+        """客户端断开时保存已生成的部分并标记为中断"""
+        from .streaming import iter_chat_events
+
+        events = iter_chat_events(self.user, '你好', 'qwen-plus')
+        self.assertEqual(next(events)['type'], 'user_message')
+        self.assertEqual(next(events), {'type': 'token', 'content': '你好'})
+        events.close()
+
+        ai_message = Message.objects.get(role='assistant')
+        self.assertEqual(ai_message.content, '你好')
+        self.assertTrue(ai_message.is_truncated)
+
+    def test_cancel_api(self):
+        """通过取消接口按请求ID中断生成"""
+        from .streaming import iter_chat_events
+
+        events = iter_chat_events(self.user, '你好', 'qwen-plus', request_id='req-1')
+        self.assertEqual(next(events)['request_id'], 'req-1')
+
+        response = self.client.post('/api/v1/stream-chat/cancel/', {'request_id': 'req-1'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        remaining = list(events)
+        self.assertEqual(remaining[0]['type'], 'token')
+        self.assertEqual(remaining[-1]['type'], 'cancelled')
+        self.assertTrue(remaining[-1]['message']['is_truncated'])
+        self.assertEqual(Message.objects.get(role='assistant').content, '你好')
+
+        # 生成结束后再取消返回404
+        response = self.client.post('/api/v1/stream-chat/cancel/', {'request_id': 'req-1'}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cancel_requires_owner(self):
+        """只能取消自己的生成"""
+        from .utils.generation_control import start_generation
+
+        other = User.objects.create_user(username='other', password='testpass123')
+        generation = start_generation(other.id, 'req-2')
+        response = self.client.post('/api/v1/stream-chat/cancel/', {'request_id': 'req-2'}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(generation.cancelled())
+        generation.close()
+
+    async def test_async_close_saves_truncated_message(self):
+        """异步生成器被关闭时中断上游请求并保存已生成的部分"""
+        from .streaming import stream_chat_events
+        from .utils.http_pool import close_async_clients
+
+        events = stream_chat_events(self.user, '你好', 'qwen-plus')
+        self.assertEqual((await events.__anext__())['type'], 'user_message')
+        self.assertEqual((await events.__anext__())['content'], '你好')
+        await events.aclose()
+        await close_async_clients()
+
+        ai_message = await Message.objects.aget(role='assistant')
+        self.assertEqual(ai_message.content, '你好')
+        self.assertTrue(ai_message.is_truncated)
+
+    async def test_disconnect_middleware_cancels_stream(self):
+        """流式响应期间客户端断开时取消请求任务"""
+        import asyncio
+        from .middleware.disconnect import ClientDisconnectMiddleware
+
+        disconnect = asyncio.Event()
+        stopped = asyncio.Event()
+
+        async def streaming_app(scope, receive, send):
+            await receive()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            try:
+                while True:
+                    await send({'type': 'http.response.body', 'body': b'data', 'more_body': True})
+                    await asyncio.sleep(0.01)
+            finally:
+                stopped.set()
+
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                disconnect.set()
+
+        app = ClientDisconnectMiddleware(streaming_app)
+        await asyncio.wait_for(app({'type': 'http', 'path': '/'}, receive, send), timeout=5)
+        self.assertTrue(stopped.is_set())
+
+
+class ProviderRegistryTestCase(StubProviderMixin, TestCase):
+    """测试提供商注册表"""
+
+    def test_resolve_models(self):
+        """目录内模型直接查表，目录外模型按前缀匹配，未知模型使用默认提供商"""
+        from .provider_registry import provider_registry
+
+        self.assertEqual(provider_registry.provider_key_for('deepseek-chat'), 'deepseek')
+        self.assertEqual(provider_registry.provider_key_for('qwen-coder'), 'qwen_code')
+        self.assertEqual(provider_registry.provider_key_for('qwen-plus-latest'), 'qwen')
+        self.assertEqual(provider_registry.provider_key_for('gpt-4o-2024-08-06'), 'openai')
+        self.assertEqual(provider_registry.provider_key_for('unknown-model'), 'openai')
+        # 仅展示的模型暂无调用实现，使用默认提供商
+        self.assertEqual(provider_registry.provider_key_for('claude-3-opus'), 'openai')
+        self.assertEqual(provider_registry.provider_key_for('unknown-model', default='qwen'), 'qwen')
+
+    def test_instances_are_shared(self):
+        """同一提供商复用同一个实例"""
+        from .api_base import QwenApi
+        from .provider_registry import provider_registry
+
+        first, _ = provider_registry.resolve('qwen-plus')
+        second, _ = provider_registry.resolve('qwen-coder')
+        self.assertIsInstance(first, QwenApi)
+        self.assertIs(first, second)
+
+    def test_user_api_key_preferred(self):
+        """优先使用用户配置的API密钥"""
+        from django.conf import settings
+        from .models import UserProfile
+        from .provider_registry import provider_registry
+
+        user = User.objects.create_user(username='keyed', password='testpass123')
+        UserProfile.objects.update_or_create(user=user, defaults={'deepseek_api_key': 'user-key'})
+        user.refresh_from_db()
+        with override_settings(LLM_CONFIG=dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='global-key')):
+            self.assertEqual(provider_registry.resolve('deepseek-chat', user)[1], 'user-key')
+            self.assertEqual(provider_registry.resolve('deepseek-chat')[1], 'global-key')
+
+    def test_available_models_follow_catalog(self):
+        """可用模型列表由目录和已配置的API密钥决定"""
+        from django.conf import settings
+
+        llm_config = {key: value for key, value in settings.LLM_CONFIG.items() if not key.endswith('_API_KEY')}
+        llm_config['DEEPSEEK_API_KEY'] = 'test'
+        with override_settings(LLM_CONFIG=llm_config):
+            response = self.client.get('/api/v1/models/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.json()], ['deepseek-chat', 'deepseek-coder'])
+        self.assertNotIn('provider_key', response.json()[0])
+
+    def test_settings_change_recreates_instances(self):
+        """配置变更后重新创建提供商实例，函数路由使用注册表中的提供商"""
+        from django.conf import settings
+        from .function_router import function_router
+        from .provider_registry import provider_registry
+
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        with override_settings(LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            api_instance, _ = provider_registry.resolve('deepseek-chat')
+            self.assertTrue(api_instance.base_url.startswith(self.stub_url))
+            self.assertEqual(function_router.chat_handler('你好', 'deepseek-chat'), 'echo:你好')
+        self.assertFalse(provider_registry.resolve('deepseek-chat')[0].base_url.startswith(self.stub_url))
+
+    def test_message_chat_uses_registry(self):
+        """非流式聊天接口通过注册表调用提供商"""
+        from django.conf import settings
+
+        user = User.objects.create_user(username='chatter', password='testpass123')
+        client = APIClient()
+        client.force_authenticate(user=user)
+        llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test')
+        with override_settings(LLM_CONFIG=llm_config, QWEN_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"):
+            response = client.post('/api/v1/messages/chat/', {'message': '你好', 'model': 'qwen-plus'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['ai_message']['content'], 'echo:你好')
+
+
+class FailoverTestCase(StubProviderMixin, TestCase):
+    """测试故障转移与对冲请求"""
+
+    def setUp(self):
+        from django.conf import settings
+        from .utils.circuit_breaker import reset_breakers
+        from .utils.failover import latency_tracker
+
+        latency_tracker.clear()
+        reset_breakers()
+        stub_completions = f"{self.stub_url}/v1/chat/completions"
+        self.llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test', DEEPSEEK_API_KEY='test', OPENAI_API_KEY=None)
+        self.settings_override = override_settings(
+            LLM_CONFIG=self.llm_config, QWEN_API_BASE_URL=stub_completions, DEEPSEEK_API_BASE_URL=stub_completions
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def _failover_config(self, chains, **overrides):
+        config = {'CHAINS': chains, 'HEDGE_ENABLED': False}
+        config.update(overrides)
+        return override_settings(LLM_FAILOVER_CONFIG=config)
+
+    def test_failover_on_error(self):
+        """主模型失败时切换到备用模型"""
+        from .utils.failover import complete_with_failover
+
+        with self._failover_config({'qwen-fail': ['deepseek-chat']}):
+            result = complete_with_failover('qwen-fail', '你好', {'model': 'qwen-fail'})
+        self.assertEqual(result['model'], 'deepseek-chat')
+        self.assertEqual(result['content'], 'echo:你好')
+        self.assertEqual(result['attempts'], 2)
+
+    def test_hedged_request(self):
+        """主模型超过对冲阈值时向备用模型发起请求，先返回者胜出"""
+        from .utils.failover import complete_with_failover
+
+        with self._failover_config(
+            {'qwen-slow': ['deepseek-chat']}, HEDGE_ENABLED=True, HEDGE_DEFAULT_DELAY=0.1, HEDGE_MIN_DELAY=0.05
+        ):
+            start = time.monotonic()
+            result = complete_with_failover('qwen-slow', '你好', {'model': 'qwen-slow'})
+            elapsed = time.monotonic() - start
+        self.assertEqual(result['model'], 'deepseek-chat')
+        self.assertTrue(result['hedged'])
+        self.assertLess(elapsed, StubProviderHandler.slow_delay)
+
+    def test_skip_fallback_without_api_key(self):
+        """跳过未配置API密钥的备用模型"""
+        from .utils.failover import complete_with_failover
+
+        with self._failover_config({'qwen-fail': ['gpt-4o-mini']}):
+            with self.assertRaises(Exception):
+                complete_with_failover('qwen-fail', '你好', {'model': 'qwen-fail'})
+
+    def test_stream_failover_before_first_token(self):
+        """流式请求在收到第一个token之前失败时切换到备用模型，用量按实际模型保存"""
+        from .models import MessageUsage
+        from .streaming import iter_chat_events
+
+        user = User.objects.create_user(username='streamer', password='testpass123')
+        with self._failover_config({'qwen-fail': ['deepseek-chat']}):
+            with self.captureOnCommitCallbacks(execute=True):
+                events = list(iter_chat_events(user, '你好', 'qwen-fail'))
+        self.assertEqual(events[-1]['type'], 'complete')
+        self.assertEqual(''.join(event['content'] for event in events if event['type'] == 'token'), '你好，世界!')
+        usage = MessageUsage.objects.get(message__role='assistant')
+        self.assertEqual((usage.model, usage.provider, usage.retry_count), ('deepseek-chat', 'DeepSeek', 1))
+
+        # 没有备用模型时返回原错误
+        events = list(iter_chat_events(user, '你好', 'qwen-fail'))
+        self.assertEqual(events[-1]['type'], 'error')
+
+    async def test_async_stream_failover(self):
+        """异步流式请求同样在首token之前切换模型"""
+        from .utils.failover import astream_with_failover
+        from .utils.http_pool import close_async_clients
+
+        with self._failover_config({'qwen-fail': ['deepseek-chat']}):
+            config = {'model': 'qwen-fail', 'call_info': {}}
+            chunks = [content async for content in astream_with_failover('qwen-fail', '你好', config)]
+        await close_async_clients()
+        self.assertEqual(''.join(chunks), '你好，世界!')
+        self.assertEqual(config['call_info']['model'], 'deepseek-chat')
+
+    def test_chain_by_group(self):
+        """按模型分组查找备用链，且不包含模型本身"""
+        from .utils.failover import get_fallback_chain
+
+        with self._failover_config({'High-End': ['deepseek-chat', 'qwen-max'], 'qwen-plus': ['gpt-4o-mini']}):
+            self.assertEqual(get_fallback_chain('qwen-max'), ['deepseek-chat'])
+            self.assertEqual(get_fallback_chain('qwen-plus'), ['gpt-4o-mini'])
+            self.assertEqual(get_fallback_chain('unknown-model'), [])
+
+    def test_latency_percentile(self):
+        """样本足够时按百分位计算对冲延迟"""
+        from .utils.failover import LatencyTracker
+
+        tracker = LatencyTracker()
+        for latency in range(1, 101):
+            tracker.record('m', latency / 100, window=50)
+        self.assertIsNone(tracker.percentile('other', 95, min_samples=1))
+        self.assertEqual(tracker.percentile('m', 50, min_samples=20), 0.75)
+        self.assertEqual(tracker.percentile('m', 100, min_samples=20), 1.0)
+
+
+class CircuitBreakerTestCase(StubProviderMixin, TestCase):
+    """测试提供商熔断器"""
+
+    def setUp(self):
+        from django.conf import settings
+        from .utils.circuit_breaker import reset_breakers
+
+        reset_breakers()
+        stub_completions = f"{self.stub_url}/v1/chat/completions"
+        llm_config = dict(settings.LLM_CONFIG, QWEN_API_KEY='test', DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config, QWEN_API_BASE_URL=stub_completions, DEEPSEEK_API_BASE_URL=stub_completions,
+            LLM_CIRCUIT_BREAKER_CONFIG={'MIN_REQUESTS': 2, 'OPEN_SECONDS': 60},
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        from .utils.circuit_breaker import reset_breakers
+
+        self.settings_override.disable()
+        reset_breakers()
+
+    def _trip_qwen(self):
+        from .provider_registry import provider_registry
+
+        api_instance, api_key = provider_registry.resolve('qwen-fail')
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                api_instance.send_message('你好', {'model': 'qwen-fail', 'api_key': api_key})
+        return api_instance, api_key
+
+    def test_open_circuit_fails_fast(self):
+        """错误率超过阈值后熔断，请求不再发送到上游"""
+        from unittest import mock
+        from .utils.circuit_breaker import CircuitOpenError, get_health
+
+        api_instance, api_key = self._trip_qwen()
+        self.assertEqual(get_health('Qwen', api_key)['state'], 'open')
+        with mock.patch.object(api_instance, '_make_request') as make_request:
+            with self.assertRaises(CircuitOpenError):
+                api_instance.send_message('你好', {'model': 'qwen-plus', 'api_key': api_key})
+        make_request.assert_not_called()
+
+    def test_half_open_probe_recovers(self):
+        """冷却结束后放行探测请求，探测成功则恢复"""
+        from .utils.circuit_breaker import get_health
+
+        with override_settings(LLM_CIRCUIT_BREAKER_CONFIG={'MIN_REQUESTS': 2, 'OPEN_SECONDS': 0}):
+            api_instance, api_key = self._trip_qwen()
+            self.assertEqual(get_health('Qwen', api_key)['state'], 'half_open')
+            result = api_instance.send_message('你好', {'model': 'qwen-plus', 'api_key': api_key})
+        self.assertEqual(result['content'], 'echo:你好')
+        self.assertEqual(get_health('Qwen', api_key)['state'], 'closed')
+
+    def test_api_key_breaker_is_isolated(self):
+        """单个API密钥的熔断不影响同一提供商的其他密钥"""
+        from .utils.circuit_breaker import get_circuit, get_health
+
+        with override_settings(LLM_CIRCUIT_BREAKER_CONFIG={'MIN_REQUESTS': 2, 'FAILURE_RATE_THRESHOLD': 0.6}):
+            for _ in range(2):
+                get_circuit('DeepSeek', 'good-key').record(True, 0.1)
+                get_circuit('DeepSeek', 'bad-key').record(False, 0.1)
+            self.assertEqual(get_health('DeepSeek', 'bad-key')['state'], 'open')
+            self.assertEqual(get_health('DeepSeek', 'good-key')['state'], 'closed')
+            self.assertEqual(get_health('DeepSeek')['state'], 'closed')
+
+    def test_client_errors_do_not_trip_provider(self):
+        """401/403只熔断对应的API密钥，其他4xx不计入统计，429和5xx熔断整个提供商"""
+        from .api_base import ProviderAPIError, ProviderCall
+        from .utils.circuit_breaker import get_circuit, get_health
+        from .utils.concurrency_limiter import Lease
+
+        def fail(api_key, status_code):
+            for _ in range(2):
+                ProviderCall(get_circuit('DeepSeek', api_key), Lease(None)).finish(
+                    error=ProviderAPIError(f'DeepSeek API错误: {status_code}', status_code))
+
+        fail('bad-input-key', 400)
+        self.assertEqual(get_health('DeepSeek', 'bad-input-key')['state'], 'closed')
+        fail('revoked-key', 401)
+        self.assertEqual(get_health('DeepSeek', 'revoked-key')['state'], 'open')
+        self.assertEqual(get_health('DeepSeek')['state'], 'closed')
+        fail('good-key', 503)
+        self.assertEqual(get_health('DeepSeek')['state'], 'open')
+
+    def test_models_and_health_check_show_state(self):
+        """模型列表标记降级模型，健康检查返回熔断器状态"""
+        self._trip_qwen()
+
+        models = {m['id']: m for m in self.client.get('/api/v1/models/').json()}
+        self.assertTrue(models['qwen-plus']['degraded'])
+        self.assertEqual(models['qwen-plus']['health']['state'], 'open')
+        self.assertFalse(models['deepseek-chat']['degraded'])
+
+        breakers = self.client.get('/api/v1/health/').json()['circuit_breakers']
+        self.assertEqual(breakers['providers']['Qwen']['state'], 'open')
+        self.assertEqual(breakers['api_keys']['open'], 1)
+
+    def test_failover_skips_open_fallback(self):
+        """熔断中的备用模型不参与故障转移，熔断的主模型立即切换到备用模型"""
+        from .utils.failover import complete_with_failover, _build_candidates
+
+        self._trip_qwen()
+        with override_settings(LLM_FAILOVER_CONFIG={'CHAINS': {'deepseek-chat': ['qwen-plus'], 'qwen-plus': ['deepseek-chat']}}):
+            self.assertEqual([c['model'] for c in _build_candidates('deepseek-chat', {'model': 'deepseek-chat'})], ['deepseek-chat'])
+            result = complete_with_failover('qwen-plus', '你好', {'model': 'qwen-plus'})
+        self.assertEqual(result['model'], 'deepseek-chat')
+
+
+class ConcurrencyLimiterTestCase(StubProviderMixin, TestCase):
+    """测试提供商自适应并发限制"""
+
+    limiter_config = {'BACKEND': 'local', 'INITIAL_LIMIT': 1, 'MAX_LIMIT': 4, 'POLL_INTERVAL': 0.01}
+
+    def setUp(self):
+        from .utils.concurrency_limiter import reset_limiters
+
+        reset_limiters()
+        self.settings_override = override_settings(LLM_CONCURRENCY_CONFIG=self.limiter_config)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        from .utils.concurrency_limiter import reset_limiters
+
+        self.settings_override.disable()
+        reset_limiters()
+
+    def test_queue_deadline(self):
+        """名额用尽时排队，超过截止时间失败，归还后可继续获取"""
+        from .utils.concurrency_limiter import get_limiter, QueueTimeoutError
+
+        limiter = get_limiter('DeepSeek', 'key')
+        lease = limiter.acquire()
+        self.assertEqual(limiter.stats()['in_flight'], 1)
+        with self.assertRaises(QueueTimeoutError):
+            limiter.acquire(timeout=0.05)
+        self.assertEqual(limiter.stats()['queued'], 0)
+
+        lease.release(cancelled=True)
+        limiter.acquire(timeout=0.05).release(cancelled=True)
+
+    def test_fifo_order(self):
+        """排队的请求按先来先到获取名额"""
+        from .utils.concurrency_limiter import get_limiter
+
+        limiter = get_limiter('DeepSeek', 'key')
+        lease = limiter.acquire()
+        order = []
+
+        def worker(index):
+            acquired = limiter.acquire(timeout=5)
+            order.append(index)
+            acquired.release(cancelled=True)
+
+        threads = []
+        for index in range(3):
+            thread = threading.Thread(target=worker, args=(index,))
+            thread.start()
+            threads.append(thread)
+            while limiter.stats()['queued'] < index + 1:
+                time.sleep(0.01)
+        lease.release(cancelled=True)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_aimd(self):
+        """成功时加性增加并发上限，429时乘性减少"""
+        from .api_base import ProviderAPIError
+        from .utils.concurrency_limiter import get_limiter
+
+        limiter = get_limiter('DeepSeek', 'key')
+        limiter.acquire().release(latency=0.1)
+        self.assertEqual(limiter.stats()['limit'], 2.0)
+        limiter.acquire().release(latency=0.1)
+        self.assertEqual(limiter.stats()['limit'], 2.5)
+        limiter.acquire().release(error=ProviderAPIError('DeepSeek API错误: 429', 429))
+        self.assertEqual(limiter.stats()['limit'], 1.25)
+        # 其他错误不调整并发上限
+        limiter.acquire().release(error=Exception('DeepSeek API请求超时'))
+        self.assertEqual(limiter.stats()['limit'], 1.25)
+
+    def test_initial_limit_defaults_to_max(self):
+        """未配置初始并发上限时从MAX_LIMIT开始，按提供商覆盖的MAX_LIMIT同样生效"""
+        from .utils.concurrency_limiter import get_limiter
+
+        config = {'BACKEND': 'local', 'MAX_LIMIT': 32, 'PROVIDERS': {'Qwen': {'MAX_LIMIT': 16}}}
+        with override_settings(LLM_CONCURRENCY_CONFIG=config):
+            self.assertEqual(get_limiter('DeepSeek', 'key').stats()['limit'], 32.0)
+            self.assertEqual(get_limiter('Qwen', 'key').stats()['limit'], 16.0)
+
+    def test_tokens_per_minute(self):
+        """超过每分钟token上限时排队"""
+        from .utils.concurrency_limiter import get_limiter, QueueTimeoutError
+
+        with override_settings(LLM_CONCURRENCY_CONFIG=dict(self.limiter_config, INITIAL_LIMIT=4, TPM_LIMIT=100)):
+            limiter = get_limiter('DeepSeek', 'key')
+            limiter.acquire(tokens=80).release(cancelled=True)
+            with self.assertRaises(QueueTimeoutError):
+                limiter.acquire(tokens=50, timeout=0.05)
+            limiter.acquire(tokens=20, timeout=0.05).release(cancelled=True)
+            self.assertEqual(limiter.stats()['tokens_per_minute'], 100)
+
+    def test_actual_usage_replaces_estimate(self):
+        """上游返回usage后，每分钟token统计用实际消耗替换估算值"""
+        from django.conf import settings
+        from .provider_registry import provider_registry
+        from .utils.concurrency_limiter import get_limiter, usage_tokens
+        from .utils.circuit_breaker import reset_breakers
+
+        self.assertEqual(usage_tokens({'totalTokenCount': 7}), 7)
+        self.assertIsNone(usage_tokens({}))
+
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        config = dict(self.limiter_config, INITIAL_LIMIT=4)
+        with override_settings(LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+                               LLM_CONCURRENCY_CONFIG=config):
+            api_instance, api_key = provider_registry.resolve('deepseek-chat')
+            limiter = get_limiter(api_instance.name, api_key)
+            api_instance.send_message('你好', {'model': 'deepseek-chat', 'api_key': api_key})
+            self.assertEqual(limiter.stats()['tokens_per_minute'], 5)
+            list(api_instance.stream_message('你好', {'model': 'deepseek-chat', 'api_key': api_key}))
+            self.assertEqual(limiter.stats()['tokens_per_minute'], 10)
+        reset_breakers()
+
+    def test_async_acquire(self):
+        """异步排队不阻塞事件循环，归还后立即获取"""
+        from asgiref.sync import async_to_sync
+        from .utils.concurrency_limiter import get_limiter
+
+        limiter = get_limiter('DeepSeek', 'key')
+
+        async def scenario():
+            lease = await limiter.aacquire()
+            waiter = asyncio.ensure_future(limiter.aacquire(timeout=5))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiter.done())
+            lease.release(cancelled=True)
+            (await waiter).release(cancelled=True)
+
+        async_to_sync(scenario)()
+
+    def test_provider_429_shrinks_limit(self):
+        """提供商返回429时减少该API密钥的并发上限，健康检查返回排队统计"""
+        from django.conf import settings
+        from .provider_registry import provider_registry
+        from .utils.concurrency_limiter import get_limiter
+        from .utils.circuit_breaker import reset_breakers
+
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        config = dict(self.limiter_config, INITIAL_LIMIT=4)
+        with override_settings(LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+                               LLM_CONCURRENCY_CONFIG=config):
+            api_instance, api_key = provider_registry.resolve('deepseek-chat')
+            with self.assertRaises(Exception):
+                api_instance.send_message('你好', {'model': 'deepseek-429', 'api_key': api_key})
+            self.assertEqual(get_limiter(api_instance.name, api_key).stats()['limit'], 2.0)
+
+            concurrency = self.client.get('/api/v1/health/').json()['concurrency']
+            self.assertEqual(len(concurrency), 1)
+            self.assertEqual(list(concurrency.values())[0]['in_flight'], 0)
+        reset_breakers()
+
+
+class ResponseCacheTestCase(StubProviderMixin, TestCase):
+    """测试大模型响应缓存"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import caches
+        from .provider_registry import provider_registry
+        from .utils.response_cache import clear_cache_stats
+
+        caches['api_cache'].clear()
+        clear_cache_stats()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions"
+        )
+        self.settings_override.enable()
+        self.api_instance, self.api_key = provider_registry.resolve('deepseek-chat')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def _config(self, **overrides):
+        config = {'model': 'deepseek-chat', 'api_key': self.api_key, 'cache': True, 'temperature': 0}
+        config.update(overrides)
+        return config
+
+    def _send(self, message, **overrides):
+        from unittest import mock
+
+        with mock.patch.object(self.api_instance, '_make_request', wraps=self.api_instance._make_request) as make_request:
+            result = self.api_instance.send_message(message, self._config(**overrides))
+        return result, make_request.call_count
+
+    def test_identical_request_hits_cache(self):
+        """相同的请求（忽略首尾空白）直接返回缓存的回答"""
+        first, calls = self._send('什么是量子计算')
+        self.assertEqual(calls, 1)
+        self.assertNotIn('cached', first)
+
+        second, calls = self._send('什么是量子计算  \r\n')
+        self.assertEqual(calls, 0)
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['content'], first['content'])
+
+    def test_parameters_are_part_of_key(self):
+        """采样参数不同或未启用缓存时不命中"""
+        self._send('你好')
+        self.assertEqual(self._send('你好', max_tokens=100)[1], 1)
+        self.assertEqual(self._send('你好', cache=False)[1], 1)
+
+    def test_sampling_bypass(self):
+        """temperature>0的请求默认不缓存，显式允许后缓存"""
+        from .utils.response_cache import get_cache_stats
+
+        self._send('讲个笑话', temperature=0.8)
+        self.assertEqual(self._send('讲个笑话', temperature=0.8)[1], 1)
+        self.assertEqual(get_cache_stats()['deepseek-chat']['bypassed'], 2)
+
+        self._send('讲个笑话', temperature=0.8, cache_allow_sampling=True)
+        self.assertEqual(self._send('讲个笑话', temperature=0.8, cache_allow_sampling=True)[1], 0)
+
+    def test_stats_models_registered_concurrently(self):
+        """多个进程同时登记不同模型时，统计中不丢失模型"""
+        from .utils.model_stats import ModelStats
+
+        processes = [ModelStats('test_stats', ('hits',), '测试统计') for _ in range(4)]
+        threads = [
+            threading.Thread(target=stats.incr, args=(f"model-{index}",), kwargs={'hits': 1})
+            for index, stats in enumerate(processes)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        processes[0].incr('model-1', hits=2)
+
+        stats = processes[3].get()
+        self.assertEqual(sorted(stats), [f"model-{index}" for index in range(4)])
+        self.assertEqual(stats['model-1'], {'hits': 3})
+        processes[0].clear()
+        self.assertEqual(processes[1].get(), {})
+
+    def test_only_deterministic_functions_are_cached(self):
+        """功能路由中翻译和百科使用缓存，笑话和诗词每次重新生成"""
+        from unittest import mock
+        from .function_router import FunctionRouter
+
+        api = mock.Mock()
+        api.send_message.return_value = {'content': '回答'}
+        router = FunctionRouter()
+        with mock.patch('chatbot.function_router.provider_registry.resolve', return_value=(api, 'key')):
+            router.joke_handler('讲个程序员笑话')
+            router.poetry_handler('写一首诗')
+            router.translation_handler('hello')
+            router.encyclopedia_handler('量子计算')
+        cached = [bool(call.args[1].get('cache')) for call in api.send_message.call_args_list]
+        self.assertEqual(cached, [False, False, True, True])
+
+    def test_stats(self):
+        """按模型统计命中率和节省的token数，健康检查返回统计"""
+        self._send('你好')
+        self._send('你好')
+        self._send('你好')
+
+        stats = self.client.get('/api/v1/health/').json()['response_cache']['deepseek-chat']
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.6667)
+        self.assertEqual(stats['saved_tokens'], 10)
+
+    def test_async_hit(self):
+        """异步调用同样使用缓存"""
+        from asgiref.sync import async_to_sync
+
+        self._send('你好')
+        result = async_to_sync(self.api_instance.send_message_async)('你好', self._config())
+        self.assertTrue(result['cached'])
+
+    def test_function_router_uses_cache(self):
+        """百科问答的相同问题只请求一次提供商"""
+        from unittest import mock
+        from .function_router import function_router
+
+        with mock.patch.object(self.api_instance, '_make_request', wraps=self.api_instance._make_request) as make_request:
+            first = function_router.encyclopedia_handler('什么是黑洞', 'deepseek-chat')
+            second = function_router.encyclopedia_handler('什么是黑洞', 'deepseek-chat')
+        self.assertEqual(first, second)
+        self.assertEqual(make_request.call_count, 1)
+
+
+class SemanticCacheTestCase(StubProviderMixin, TestCase):
+    """测试大模型语义缓存"""
+
+    # 测试用的句向量：与“什么是黑洞”的余弦相似度分别约为0.97、0.93和0
+    VECTORS = {
+        '什么是黑洞': [1.0, 0.0],
+        '黑洞是什么': [0.97, 0.2431],
+        '黑洞是怎么形成的': [0.93, 0.3676],
+        '今天天气怎么样': [0.0, 1.0],
+    }
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import caches
+        from .provider_registry import provider_registry
+        from .utils.semantic_cache import SemanticCache
+
+        caches['api_cache'].clear()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config,
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+            LLM_SEMANTIC_CACHE_CONFIG={'THRESHOLDS': {'default': 0.95}, 'NEAR_MISS_MARGIN': 0.05, 'TTL': 3600, 'MAX_ENTRIES': 100},
+        )
+        self.settings_override.enable()
+        self.api_instance, self.api_key = provider_registry.resolve('deepseek-chat')
+        self.cache = SemanticCache(encoder=lambda text: self.VECTORS[text])
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_similar_question_hits(self):
+        """相似度超过阈值时返回缓存的回答"""
+        self.cache.store('什么是黑洞', '黑洞是引力极强的天体', 'deepseek-chat')
+        self.assertEqual(self.cache.lookup('黑洞是什么', 'deepseek-chat'), '黑洞是引力极强的天体')
+        self.assertIsNone(self.cache.lookup('今天天气怎么样', 'deepseek-chat'))
+
+    def test_near_miss_is_logged(self):
+        """低于阈值不命中，接近阈值时记录日志"""
+        self.cache.store('什么是黑洞', '黑洞是引力极强的天体', 'deepseek-chat')
+        with self.assertLogs('chatbot.utils.semantic_cache', level='INFO') as logs:
+            self.assertIsNone(self.cache.lookup('黑洞是怎么形成的', 'deepseek-chat'))
+        self.assertIn('语义缓存接近命中', logs.output[0])
+        self.assertEqual(self.cache.stats()['intents']['chat']['near_misses'], 1)
+
+    def test_per_intent_threshold(self):
+        """按意图使用不同的阈值，阈值为None的意图不使用缓存"""
+        with override_settings(LLM_SEMANTIC_CACHE_CONFIG={'THRESHOLDS': {'default': 0.95, 'encyclopedia': 0.9, 'translation': None}}):
+            self.cache.store('什么是黑洞', '答案', 'deepseek-chat', 'encyclopedia')
+            self.assertEqual(self.cache.lookup('黑洞是怎么形成的', 'deepseek-chat', 'encyclopedia'), '答案')
+            self.cache.store('什么是黑洞', '答案', 'deepseek-chat', 'translation')
+            self.assertIsNone(self.cache.lookup('什么是黑洞', 'deepseek-chat', 'translation'))
+
+    def test_scoped_by_model_and_knowledge_context(self):
+        """不同模型、不同知识库上下文的缓存互不命中"""
+        self.cache.store('什么是黑洞', '答案', 'deepseek-chat', knowledge_context='上下文A')
+        self.assertEqual(self.cache.lookup('什么是黑洞', 'deepseek-chat', knowledge_context='上下文A'), '答案')
+        self.assertIsNone(self.cache.lookup('什么是黑洞', 'deepseek-chat', knowledge_context='上下文B'))
+        self.assertIsNone(self.cache.lookup('什么是黑洞', 'qwen-turbo', knowledge_context='上下文A'))
+
+    def test_lru_and_ttl_eviction(self):
+        """超过条目上限淘汰最久未使用的条目，过期条目不命中"""
+        with override_settings(LLM_SEMANTIC_CACHE_CONFIG={'THRESHOLDS': {'default': 0.95}, 'MAX_ENTRIES': 2}):
+            self.cache.store('什么是黑洞', '答案1', 'model-a')
+            self.cache.store('什么是黑洞', '答案2', 'model-b')
+            self.cache.lookup('什么是黑洞', 'model-a')
+            self.cache.store('什么是黑洞', '答案3', 'model-c')
+            self.assertEqual(self.cache.lookup('什么是黑洞', 'model-a'), '答案1')
+            self.assertIsNone(self.cache.lookup('什么是黑洞', 'model-b'))
+
+        with override_settings(LLM_SEMANTIC_CACHE_CONFIG={'THRESHOLDS': {'default': 0.95}, 'TTL': 0}):
+            time.sleep(0.01)
+            self.assertIsNone(self.cache.lookup('什么是黑洞', 'model-a'))
+            self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_lookup_masks_expired_rows_without_rebuilding(self):
+        """查找只屏蔽过期的行，不重建矩阵；过期条目在下次写入时按写入顺序清除"""
+        self.cache.store('什么是黑洞', '旧答案', 'deepseek-chat')
+        time.sleep(0.05)
+        self.cache.store('黑洞是什么', '新答案', 'deepseek-chat')
+        self.assertEqual(self.cache.lookup('什么是黑洞', 'deepseek-chat'), '旧答案')
+        scope = self.cache.scope_for('deepseek-chat', None)
+        matrix = self.cache._scopes[scope]['matrix']
+
+        with override_settings(LLM_SEMANTIC_CACHE_CONFIG={'THRESHOLDS': {'default': 0.95}, 'TTL': 0.03}):
+            self.assertEqual(self.cache.lookup('什么是黑洞', 'deepseek-chat'), '新答案')
+            self.assertIs(self.cache._scopes[scope]['matrix'], matrix)
+            self.assertEqual(len(self.cache._entries), 2)
+
+            time.sleep(0.05)
+            self.cache.store('今天天气怎么样', '晴', 'deepseek-chat')
+            self.assertEqual([entry['answer'] for entry in self.cache._entries.values()], ['晴'])
+            self.assertEqual(len(self.cache._expiry), 1)
+
+    def test_provider_uses_semantic_cache_for_standalone_questions(self):
+        """没有上文的问题复用相似问题的回答，有上文时不使用语义缓存"""
+        from unittest import mock
+        from .utils.semantic_cache import semantic_cache, standalone_options
+
+        def send(message, history):
+            config = {
+                'model': 'deepseek-chat', 'api_key': self.api_key, 'history': history,
+                'semantic_cache': standalone_options(message, history),
+            }
+            with mock.patch.object(self.api_instance, '_make_request', wraps=self.api_instance._make_request) as make_request:
+                result = self.api_instance.send_message(message, config)
+            return result, make_request.call_count
+
+        with mock.patch.object(semantic_cache, 'encoder', lambda text: self.VECTORS[text]):
+            semantic_cache.clear()
+            try:
+                first, calls = send('什么是黑洞', [])
+                self.assertEqual(calls, 1)
+                second, calls = send('黑洞是什么', [])
+                self.assertEqual(calls, 0)
+                self.assertTrue(second['semantic'])
+                self.assertEqual(second['content'], first['content'])
+
+                history = [{'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好'}]
+                self.assertEqual(send('黑洞是什么', history)[1], 1)
+            finally:
+                semantic_cache.clear()
+
+
+class SingleFlightTestCase(StubProviderMixin, TestCase):
+    """测试相同请求的合并"""
+
+    def setUp(self):
+        from django.conf import settings
+        from .provider_registry import provider_registry
+        from .utils.single_flight import reset_single_flight
+
+        reset_single_flight()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config,
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+            LLM_SINGLE_FLIGHT_CONFIG={'BACKEND': 'local', 'WAIT_TIMEOUT': 5},
+        )
+        self.settings_override.enable()
+        self.api_instance, self.api_key = provider_registry.resolve('deepseek-chat')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def _config(self, **overrides):
+        # temperature>0的请求不使用响应缓存，只验证合并
+        config = {'model': 'deepseek-chat-slow', 'api_key': self.api_key, 'cache': True, 'temperature': 0.8}
+        config.update(overrides)
+        return config
+
+    def _run_threads(self, target, count=5):
+        results = [None] * count
+
+        def worker(index):
+            results[index] = target()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        """相同请求同时进行时只调用一次上游，其余请求共享结果"""
+        from unittest import mock
+
+        with mock.patch.object(self.api_instance, '_make_request', wraps=self.api_instance._make_request) as make_request:
+            results = self._run_threads(lambda: self.api_instance.send_message('讲个笑话', self._config()))
+        self.assertEqual(make_request.call_count, 1)
+        self.assertEqual({result['content'] for result in results}, {'echo:讲个笑话'})
+        self.assertEqual(sum(1 for result in results if result.get('coalesced')), 4)
+
+    def test_different_or_uncacheable_requests_not_merged(self):
+        """请求内容不同或未声明可共享时不合并"""
+        from unittest import mock
+
+        messages = iter(['问题1', '问题2', '问题3'])
+        lock = threading.Lock()
+
+        def send():
+            with lock:
+                message = next(messages)
+            return self.api_instance.send_message(message, self._config())
+
+        with mock.patch.object(self.api_instance, '_make_request', wraps=self.api_instance._make_request) as make_request:
+            self._run_threads(send, count=3)
+            self._run_threads(lambda: self.api_instance.send_message('讲个笑话', self._config(cache=False)), count=2)
+        self.assertEqual(make_request.call_count, 5)
+
+    def test_async_requests_share_one_call(self):
+        """异步请求同样合并"""
+        from unittest import mock
+        from asgiref.sync import async_to_sync
+
+        async def send_all():
+            return await asyncio.gather(*[
+                self.api_instance.send_message_async('讲个笑话', self._config()) for _ in range(5)
+            ])
+
+        with mock.patch.object(self.api_instance, '_make_request_async', wraps=self.api_instance._make_request_async) as make_request:
+            results = async_to_sync(send_all)()
+        self.assertEqual(make_request.call_count, 1)
+        self.assertEqual({result['content'] for result in results}, {'echo:讲个笑话'})
+
+    def test_stream_is_fanned_out(self):
+        """相同的独立问题流式请求共享上游的增量文本"""
+        from unittest import mock
+
+        config = self._config(cache=False, semantic_cache={'question': '你好', 'intent': 'chat'})
+        with mock.patch.object(self.api_instance, '_iter_stream', wraps=self.api_instance._iter_stream) as iter_stream:
+            results = self._run_threads(lambda: list(self.api_instance.stream_message('你好', config)), count=3)
+        self.assertEqual(iter_stream.call_count, 1)
+        self.assertEqual(results, [StubProviderHandler.stream_tokens] * 3)
+
+    def test_leader_error_is_shared(self):
+        """领头请求失败时等待方收到同样的错误"""
+        from .utils import single_flight
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing_call():
+            started.set()
+            release.wait(5)
+            raise Exception('上游错误')
+
+        def call():
+            try:
+                return single_flight.run('key', failing_call)
+            except Exception as e:
+                return str(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        followers = []
+        follower_results = []
+        for _ in range(2):
+            thread = threading.Thread(target=lambda: follower_results.append(call()))
+            thread.start()
+            followers.append(thread)
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(follower_results, ['上游错误', '上游错误'])
+
+    def test_cancelled_leader_lets_followers_retry(self):
+        """领头请求被取消时，等待方自行请求上游"""
+        from asgiref.sync import async_to_sync
+        from .utils import single_flight
+
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.2 if len(calls) == 1 else 0)
+            return {'content': f"第{len(calls)}次"}
+
+        async def scenario():
+            leader = asyncio.ensure_future(single_flight.arun('key', upstream))
+            await asyncio.sleep(0.05)
+            follower = asyncio.ensure_future(single_flight.arun('key', upstream))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(async_to_sync(scenario)(), {'content': '第2次'})
+        self.assertEqual(len(calls), 2)
+
+    def test_follower_fails_when_leader_stops_mid_stream(self):
+        """领头请求输出部分内容后中断，等待方不重新请求上游（新回答与已返回的内容不连贯），直接报错"""
+        from .utils import single_flight
+
+        calls = []
+
+        def upstream():
+            calls.append(1)
+            yield from StubProviderHandler.stream_tokens
+
+        leader = single_flight.stream('key', upstream)
+        self.assertEqual(next(leader), '你好')
+        follower = single_flight.stream('key', upstream)
+        self.assertEqual(next(follower), '你好')
+        leader.close()
+        with self.assertRaises(Exception):
+            next(follower)
+        self.assertEqual(len(calls), 1)
+
+    def test_follower_requests_upstream_when_leader_stops_before_output(self):
+        """领头请求在输出之前中断时，等待方自行请求上游"""
+        from .utils import single_flight
+
+        def upstream():
+            yield from StubProviderHandler.stream_tokens
+
+        flight, leader = single_flight._acquire('key')
+        self.assertTrue(leader)
+        chunks = []
+        follower = threading.Thread(target=lambda: chunks.extend(single_flight.stream('key', upstream)))
+        follower.start()
+        time.sleep(0.05)
+        single_flight._publish(flight, single_flight.ABANDONED)
+        follower.join(5)
+        self.assertEqual(''.join(chunks), '你好，世界!')
+
+    def test_redis_chunks_are_batched(self):
+        """跨进程合并时第一个增量立即写入，之后的增量和最终结果批量写入"""
+        from unittest import mock
+        from .utils.single_flight import CHUNK, RESULT, RedisFlight, get_single_flight_config
+
+        client = mock.MagicMock()
+        config = dict(get_single_flight_config(), CHUNK_FLUSH_INTERVAL_MS=60000, CHUNK_FLUSH_SIZE=16)
+        flight = RedisFlight(client, 'key', 'token', config)
+        for token in StubProviderHandler.stream_tokens:
+            flight.publish(CHUNK, token)
+        flight.publish(RESULT, {'content': '你好，世界!'})
+
+        pushes = [len(call.args) - 1 for call in client.pipeline.return_value.rpush.call_args_list]
+        self.assertEqual(pushes, [1, 4])
+
+
+class HistoryCacheTestCase(TestCase):
+    """测试会话历史窗口缓存"""
+
+    def setUp(self):
+        from .utils.history_cache import clear_history_cache
+
+        clear_history_cache()
+        self.user = User.objects.create_user(username='historyuser', password='testpass123')
+        self.conversation = Conversation.objects.create(user=self.user, title='历史', model='deepseek-chat')
+        for index in range(6):
+            Message.objects.create(
+                conversation=self.conversation, role='user' if index % 2 == 0 else 'assistant', content=f"消息{index}"
+            )
+
+    def _contents(self, **kwargs):
+        from .streaming import build_history
+
+        return [item['content'] for item in build_history(self.conversation, **kwargs)]
+
+    def test_window_is_served_from_cache(self):
+        """首次读取后从缓存返回，新消息追加到窗口而不重新读取数据库"""
+        self.assertEqual(self._contents(), [f"消息{index}" for index in range(6)])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self._contents()), 6)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conversation, role='user', content='新消息')
+        with self.assertNumQueries(0):
+            self.assertEqual(self._contents()[-1], '新消息')
+
+    def test_limit_returns_latest_messages(self):
+        """按条数读取最近的消息，窗口只保留配置的条数"""
+        self.assertEqual(self._contents(limit=2), ['消息4', '消息5'])
+        with override_settings(CHAT_HISTORY_CACHE_CONFIG={'WINDOW': 3}):
+            from .utils.history_cache import clear_history_cache
+
+            clear_history_cache()
+            self.assertEqual(self._contents(), ['消息3', '消息4', '消息5'])
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(conversation=self.conversation, role='user', content='新消息')
+            self.assertEqual(self._contents(), ['消息4', '消息5', '新消息'])
+            # 超过窗口大小时直接读取数据库
+            self.assertEqual(len(self._contents(limit=5)), 5)
+
+    def test_message_saved_while_loading_is_kept(self):
+        """加载窗口期间提交的消息（追加时窗口还不存在）不会丢失"""
+        from unittest import mock
+        from .utils import history_cache
+
+        load = history_cache._load_from_db
+        saved = []
+
+        def load_then_save(conversation_id, limit):
+            records = load(conversation_id, limit)
+            if not saved:
+                with self.captureOnCommitCallbacks(execute=True):
+                    saved.append(Message.objects.create(conversation=self.conversation, role='user', content='加载期间'))
+            return records
+
+        with mock.patch.object(history_cache, '_load_from_db', side_effect=load_then_save):
+            self.assertEqual(self._contents()[-1], '加载期间')
+        self.assertEqual(self._contents()[-1], '加载期间')
+
+    def test_edit_and_delete_invalidate_window(self):
+        """修改或删除消息后重新从数据库加载"""
+        self._contents()
+        message = Message.objects.get(conversation=self.conversation, content='消息5')
+        message.content = '已修改'
+        message.save()
+        self.assertEqual(self._contents()[-1], '已修改')
+
+        message.delete()
+        self.assertEqual(self._contents()[-1], '消息4')
+
+    def test_bulk_create_invalidates_window(self):
+        """批量创建消息后清除窗口"""
+        from .utils.db_optimizer import bulk_create_messages
+
+        self._contents()
+        bulk_create_messages([{
+            'conversation_id': self.conversation.id, 'role': 'assistant', 'message_type': 'text', 'content': '批量消息',
+        }])
+        self.assertEqual(self._contents()[-1], '批量消息')
+
+
+class ContextBuilderTestCase(TestCase):
+    """测试按token预算组装上下文"""
+
+    def _history(self, count, content='短消息'):
+        return [
+            {'role': 'user' if index % 2 == 0 else 'assistant', 'content': f"{content}{index}"}
+            for index in range(count)
+        ]
+
+    def test_estimate_tokens(self):
+        """中文按字符计数，英文按字符数估算"""
+        from .utils.context_builder import estimate_tokens
+
+        self.assertEqual(estimate_tokens('你好世界'), 4)
+        self.assertEqual(estimate_tokens('hello world'), 4)
+        self.assertEqual(estimate_tokens('你好 world'), 4)
+
+    def test_short_messages_are_not_limited_by_count(self):
+        """短消息在预算内全部保留，不再固定只取8条"""
+        from .utils.context_builder import pack_context
+
+        _, history = pack_context(self._history(20), None, '你好', 'DeepSeek', {'model': 'deepseek-chat'})
+        self.assertEqual(len(history), 20)
+
+    def test_newest_history_within_budget(self):
+        """超出历史预算时保留最新的消息，并去掉附带的tokens字段"""
+        from .utils.context_builder import pack_context
+
+        history = self._history(10, content='长' * 300)
+        history[-1]['tokens'] = 10
+        with override_settings(LLM_CONTEXT_CONFIG={'MAX_HISTORY_TOKENS': 700}):
+            _, packed = pack_context(history, None, '你好', 'DeepSeek', {'model': 'deepseek-chat'})
+        self.assertEqual([item['content'] for item in packed], [item['content'] for item in history[-3:]])
+        self.assertEqual(set(packed[-1].keys()), {'role', 'content'})
+
+    def test_context_window_truncates_system_prompt(self):
+        """系统提示超出上下文窗口时被截断，历史被舍弃"""
+        from .utils.context_builder import pack_context, count_tokens
+
+        config = {'model': 'unknown-model', 'max_tokens': 500}
+        with override_settings(LLM_CONTEXT_CONFIG={'DEFAULT_CONTEXT_WINDOW': 1000, 'RESERVE_TOKENS': 0}):
+            system_prompt, packed = pack_context(self._history(4), '知' * 2000, '你好', 'DeepSeek', config)
+        self.assertEqual(packed, [])
+        # 系统提示、回复预留和当前消息（各含4个token的格式开销）不超过上下文窗口
+        self.assertLessEqual(count_tokens(system_prompt) + 4 + 500 + 2 + 4, 1000)
+        self.assertGreater(len(system_prompt), 400)
+
+    def test_provider_payload_uses_budget(self):
+        """提供商请求载荷按预算组装"""
+        from .api_base import DeepSeekApi
+
+        history = self._history(30)
+        history[0]['tokens'] = 5
+        with override_settings(LLM_CONTEXT_CONFIG={'MAX_HISTORY_TOKENS': 100, 'PROMPT_LAYOUT': 'classic'}):
+            payload = DeepSeekApi()._prepare_payload('你好', history, {'model': 'deepseek-chat', 'system_prompt': '资料'})
+        messages = payload['messages']
+        self.assertEqual(messages[0], {'role': 'system', 'content': '资料'})
+        self.assertEqual(messages[-1], {'role': 'user', 'content': '你好'})
+        self.assertEqual(messages[-2]['content'], history[-1]['content'])
+        self.assertLess(len(messages), 32)
+        self.assertTrue(all('tokens' not in message for message in messages))
+
+    def test_message_token_count_is_saved(self):
+        """消息保存时计算token数，修改内容后重新计算"""
+        from .utils.context_builder import count_tokens
+
+        user = User.objects.create_user(username='tokenuser', password='testpass123')
+        conversation = Conversation.objects.create(user=user, title='token', model='deepseek-chat')
+        message = Message.objects.create(conversation=conversation, role='user', content='你好世界')
+        self.assertEqual(Message.objects.get(id=message.id).token_count, count_tokens('你好世界'))
+
+        message.content = 'hello world, this is longer'
+        message.save(update_fields=['content'])
+        self.assertEqual(Message.objects.get(id=message.id).token_count, count_tokens('hello world, this is longer'))
+
+
+class ConversationSummaryTestCase(StubProviderMixin, TestCase):
+    """测试会话滚动摘要"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import cache
+        from .utils.history_cache import clear_history_cache
+
+        clear_history_cache()
+        cache.clear()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config,
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+            CONVERSATION_SUMMARY_CONFIG={'TRIGGER_TOKENS': 50, 'KEEP_RECENT_MESSAGES': 2, 'MODEL': 'deepseek-chat'},
+        )
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='summaryuser', password='testpass123')
+        self.conversation = Conversation.objects.create(user=self.user, title='摘要', model='deepseek-chat')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def _add_messages(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            return [
+                Message.objects.create(
+                    conversation=self.conversation, role='user' if index % 2 == 0 else 'assistant', content=f"第{index}条消息，内容较长"
+                )
+                for index in range(count)
+            ]
+
+    def test_long_conversation_schedules_one_task(self):
+        """未摘要消息超过阈值时提交一次摘要任务，任务运行期间不重复提交"""
+        from unittest import mock
+        from .tasks import summarize_conversation
+
+        with mock.patch.object(summarize_conversation, 'apply_async') as apply_async:
+            self._add_messages(4)
+            apply_async.assert_not_called()
+            self._add_messages(6)
+        apply_async.assert_called_once_with(args=[self.conversation.id], retry=False)
+
+    def test_messages_without_token_count_are_counted(self):
+        """迁移前保存的消息没有token数，按内容计算后参与阈值判断"""
+        from .utils.conversation_summary import get_summary_config, needs_summary
+
+        records = [{'id': index, 'content': '较早保存的长消息' * 5, 'token_count': None} for index in range(1, 6)]
+        self.assertTrue(needs_summary(records, None, get_summary_config()))
+        self.assertFalse(needs_summary([dict(record, token_count=0) for record in records], None, get_summary_config()))
+
+    def test_summary_replaces_older_messages_in_history(self):
+        """摘要覆盖较早的消息，历史使用 摘要 + 最近消息"""
+        from unittest import mock
+        from .streaming import build_history
+        from .tasks import summarize_conversation
+        from .utils.conversation_summary import summarize_conversation as summarize
+
+        with mock.patch.object(summarize_conversation, 'apply_async'):
+            messages = self._add_messages(6)
+        self.assertTrue(summarize(self.conversation.id))
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_message_id, messages[3].id)
+        self.assertIn('第0条消息', self.conversation.summary)
+
+        history = build_history(self.conversation)
+        self.assertEqual(history[0]['role'], 'system')
+        self.assertIn(self.conversation.summary, history[0]['content'])
+        self.assertEqual([item['content'] for item in history[1:]], [messages[4].content, messages[5].content])
+
+        # 没有新的较早消息时不再摘要
+        self.assertFalse(summarize(self.conversation.id))
+
+    def test_summary_is_kept_within_budget(self):
+        """组装上下文时会话摘要始终保留"""
+        from .utils.context_builder import pack_context
+
+        history = [{'role': 'system', 'content': '摘要内容'}] + [
+            {'role': 'user', 'content': '长' * 400}, {'role': 'assistant', 'content': '短回复'},
+        ]
+        with override_settings(LLM_CONTEXT_CONFIG={'MAX_HISTORY_TOKENS': 50}):
+            _, packed = pack_context(history, None, '你好', 'DeepSeek', {'model': 'deepseek-chat'})
+        self.assertEqual([item['content'] for item in packed], ['摘要内容', '短回复'])
+
+
+class PromptCacheTestCase(StubProviderMixin, TestCase):
+    """测试提示词前缀缓存布局和缓存token统计"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.settings_override = override_settings(
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions", DEEPSEEK_API_KEY='test',
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_prefix_layout_keeps_stable_prefix(self):
+        """知识库上下文放在当前消息之前，下一轮请求以上一轮的摘要和历史为前缀"""
+        from .api_base import DeepSeekApi
+
+        api = DeepSeekApi()
+        history = [{'role': 'system', 'content': '摘要'}, {'role': 'user', 'content': '问题1'}, {'role': 'assistant', 'content': '回答1'}]
+        first = api._build_messages('问题2', history, '资料A', {'model': 'deepseek-chat'})
+        self.assertEqual(first[-2:], [{'role': 'system', 'content': '资料A'}, {'role': 'user', 'content': '问题2'}])
+
+        history += [{'role': 'user', 'content': '问题2'}, {'role': 'assistant', 'content': '回答2'}]
+        second = api._build_messages('问题3', history, '资料B', {'model': 'deepseek-chat'})
+        self.assertEqual(second[:3], first[:3])
+        self.assertEqual(second[-2]['content'], '资料B')
+
+    def test_classic_layout_override(self):
+        """按提供商覆盖为系统提示在最前的布局"""
+        from .api_base import DeepSeekApi, GoogleGeminiApi
+
+        with override_settings(LLM_CONTEXT_CONFIG={'LAYOUT_OVERRIDES': {'DeepSeek': 'classic'}}):
+            messages = DeepSeekApi()._build_messages('你好', [], '资料', {'model': 'deepseek-chat'})
+        self.assertEqual(messages[0], {'role': 'system', 'content': '资料'})
+
+        # Gemini在prefix_cache布局下把知识库上下文随当前消息传入
+        with override_settings(GEMINI_API_KEY='test'):
+            payload = GoogleGeminiApi()._build_request('你好', {'model': 'gemini-pro', 'system_prompt': '资料'})['payload']
+        self.assertNotIn('systemInstruction', payload)
+        self.assertEqual(payload['contents'][-1]['parts'], [{'text': '资料'}, {'text': '你好'}])
+
+    def test_parse_usage(self):
+        """统一各提供商的缓存token字段"""
+        from .utils.prompt_cache import parse_usage
+
+        self.assertEqual(parse_usage({'prompt_tokens': 100, 'prompt_tokens_details': {'cached_tokens': 64}}), (100, 64))
+        self.assertEqual(parse_usage({'prompt_cache_hit_tokens': 30, 'prompt_cache_miss_tokens': 10}), (40, 30))
+        self.assertEqual(parse_usage({'promptTokenCount': 50, 'cachedContentTokenCount': 20}), (50, 20))
+        self.assertEqual(parse_usage({'prompt_tokens': 100, 'cached_tokens': 80}), (100, 80))
+        self.assertEqual(parse_usage({'prompt_tokens': 100}), (100, None))
+        self.assertEqual(parse_usage({}), (0, None))
+
+    def test_usage_is_recorded_per_model(self):
+        """普通请求和流式请求都按模型记录缓存token数"""
+        from .api_base import DeepSeekApi
+        from .utils.prompt_cache import get_prompt_cache_stats, clear_prompt_cache_stats
+
+        clear_prompt_cache_stats()
+        api = DeepSeekApi()
+        api.send_message('你好', {'model': 'deepseek-chat'})
+        self.assertEqual(''.join(api.stream_message('你好', {'model': 'deepseek-chat'})), '你好，世界!')
+
+        stats = get_prompt_cache_stats()['deepseek-chat']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['prompt_tokens'], 6)
+        self.assertEqual(stats['cached_tokens'], 4)
+        self.assertAlmostEqual(stats['hit_rate'], 0.6667)
+
+
+class UsageMetricsTestCase(StubProviderMixin, TestCase):
+    """测试消息用量和延迟统计"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import cache
+
+        cache.clear()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config,
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+        )
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='usageuser', password='testpass123')
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_stream_chat_records_usage(self):
+        """流式回复保存时记录提供商返回的用量和首token耗时"""
+        from .models import MessageUsage
+        from .streaming import iter_chat_events
+
+        events = list(iter_chat_events(self.user, '你好', 'deepseek-chat'))
+        self.assertEqual(events[-1]['type'], 'complete')
+
+        usage = MessageUsage.objects.get(message__role='assistant')
+        self.assertEqual((usage.model, usage.provider), ('deepseek-chat', 'DeepSeek'))
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens, usage.cached_tokens), (3, 2, 2))
+        self.assertIsNotNone(usage.ttft_ms)
+        self.assertGreaterEqual(usage.latency_ms, usage.ttft_ms)
+
+    def test_chat_records_usage(self):
+        """非流式回复记录用量，调用失败时不记录"""
+        from rest_framework.test import APIClient
+        from .models import MessageUsage
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.post('/api/v1/messages/chat/', {'message': '你好', 'model': 'deepseek-chat'}, format='json')
+        self.assertEqual(response.data['status'], 'completed')
+        usage = MessageUsage.objects.get()
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens, usage.retry_count), (3, 2, 0))
+        self.assertIsNone(usage.ttft_ms)
+
+        client.post('/api/v1/messages/chat/', {'message': '你好', 'model': 'deepseek-chat-fail'}, format='json')
+        self.assertEqual(MessageUsage.objects.count(), 1)
+
+    def _record(self, model, latency_ms, ttft_ms=None):
+        from .models import MessageUsage
+
+        conversation = Conversation.objects.create(user=self.user, title='usage', model=model)
+        message = Message.objects.create(conversation=conversation, role='assistant', content='回复')
+        return MessageUsage.objects.create(
+            message=message, model=model, latency_ms=latency_ms, ttft_ms=ttft_ms, prompt_tokens=10, completion_tokens=5
+        )
+
+    def test_aggregate_percentiles(self):
+        """按模型汇总token消耗和延迟百分位"""
+        from datetime import timedelta
+        from .utils.usage_metrics import aggregate_usage
+
+        for latency in range(100, 2100, 100):
+            self._record('deepseek-chat', latency, ttft_ms=latency // 10)
+        self._record('qwen-plus', 500)
+
+        results = {item['model']: item for item in aggregate_usage(timezone.now() - timedelta(hours=1))}
+        self.assertEqual(results['deepseek-chat']['requests'], 20)
+        self.assertEqual(results['deepseek-chat']['prompt_tokens'], 200)
+        self.assertEqual(results['deepseek-chat']['latency_p50_ms'], 1000)
+        self.assertEqual(results['deepseek-chat']['latency_p95_ms'], 1900)
+        self.assertEqual(results['deepseek-chat']['ttft_p95_ms'], 190)
+        self.assertIsNone(results['qwen-plus']['ttft_p50_ms'])
+
+        bucketed = aggregate_usage(timezone.now() - timedelta(hours=1), bucket='hour', model='qwen-plus')
+        self.assertEqual(len(bucketed), 1)
+        self.assertIn('bucket', bucketed[0])
+
+    def test_usage_stats_endpoint_and_command(self):
+        """统计接口仅管理员可用，管理命令输出同样的统计"""
+        from io import StringIO
+        from django.core.management import call_command
+        from rest_framework.test import APIClient
+
+        self._record('deepseek-chat', 800)
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        self.assertEqual(client.get('/api/v1/usage/stats/').status_code, 403)
+
+        admin = User.objects.create_user(username='usageadmin', password='testpass123', is_staff=True)
+        client.force_authenticate(user=admin)
+        response = client.get('/api/v1/usage/stats/', {'window': '1h'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['latency_p50_ms'], 800)
+        self.assertEqual(client.get('/api/v1/usage/stats/', {'window': 'soon'}).status_code, 400)
+
+        out = StringIO()
+        call_command('usage_report', '--window', '1h', '--json', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())[0]['model'], 'deepseek-chat')
+
+
+class BatchJobTestCase(StubProviderMixin, TransactionTestCase):
+    """测试批量对话补全任务"""
+
+    def setUp(self):
+        from django.conf import settings
+        from django.core.cache import cache
+
+        cache.clear()
+        llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='test')
+        self.settings_override = override_settings(
+            LLM_CONFIG=llm_config,
+            DEEPSEEK_API_BASE_URL=f"{self.stub_url}/v1/chat/completions",
+            LLM_BATCH_CONFIG={'CONCURRENCY': 3, 'CHECKPOINT_SIZE': 2},
+        )
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='batchuser', password='testpass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def _create(self, **data):
+        from unittest import mock
+
+        payload = {'model': 'deepseek-chat', 'items': [{'custom_id': f"q{index}", 'prompt': f"问题{index}"} for index in range(7)]}
+        payload.update(data)
+        with mock.patch('chatbot.utils.batch_jobs.enqueue_batch_job', return_value=True) as enqueue:
+            response = self.client.post('/api/v1/batches/', payload, format='json')
+        self.assertEqual(response.status_code, 201)
+        enqueue.assert_called_once()
+        return response.data
+
+    def test_run_and_export_jsonl(self):
+        """执行全部条目，结果按序号以JSONL导出"""
+        from .utils.batch_jobs import run_batch_job
+
+        job_data = self._create()
+        self.assertEqual(job_data['total_items'], 7)
+        job = run_batch_job(job_data['id'])
+        self.assertEqual((job.status, job.succeeded_items, job.failed_items), ('completed', 7, 0))
+
+        response = self.client.get(f"/api/v1/batches/{job.id}/results/")
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual([row['custom_id'] for row in rows], [f"q{index}" for index in range(7)])
+        self.assertEqual(rows[3]['content'], 'echo:问题3')
+        self.assertEqual(rows[3]['usage']['total_tokens'], 5)
+
+    def test_resume_only_processes_pending_items(self):
+        """继续执行时跳过已完成的条目，失败的条目可重新执行"""
+        from unittest import mock
+        from .models import BatchItem, BatchJob
+        from .utils.batch_jobs import run_batch_job
+
+        job_id = self._create()['id']
+        BatchItem.objects.filter(job_id=job_id, index__lt=3).update(status='succeeded', content='已完成')
+        BatchItem.objects.filter(job_id=job_id, index=3).update(status='failed', error='超时')
+        BatchJob.objects.filter(id=job_id).update(status='running', succeeded_items=3, failed_items=1)
+
+        job = run_batch_job(job_id)
+        self.assertEqual((job.succeeded_items, job.failed_items), (6, 1))
+        self.assertEqual(BatchItem.objects.get(job_id=job_id, index=0).content, '已完成')
+
+        with mock.patch('chatbot.utils.batch_jobs.enqueue_batch_job', return_value=True):
+            response = self.client.post(f"/api/v1/batches/{job_id}/resume/", {'retry_failed': True}, format='json')
+        self.assertEqual(response.data['status'], 'pending')
+        job = run_batch_job(job_id)
+        self.assertEqual((job.status, job.succeeded_items, job.failed_items), ('completed', 7, 0))
+
+    def test_run_lock_heartbeat_and_owner(self):
+        """执行期间定时续期执行锁，只删除仍属于自己的锁；锁丢失时停止执行且不更新任务状态"""
+        from unittest import mock
+        from django.core.cache import cache
+        from .utils.batch_jobs import _lock_key, _RunLock, run_batch_job
+
+        job_id = self._create()['id']
+        lock = _RunLock(job_id, 600)
+        self.assertTrue(lock.acquire())
+        self.assertIsNone(run_batch_job(job_id))
+        cache.set(_lock_key(job_id), 'other', 600)
+        self.assertFalse(lock.renew())
+        lock.release()
+        self.assertEqual(cache.get(_lock_key(job_id)), 'other')
+        cache.delete(_lock_key(job_id))
+
+        renewals = []
+        renew = _RunLock.renew
+
+        def fake_renew(self):
+            renewals.append(1)
+            # 第一次续期时模拟锁已被其他进程接手
+            cache.set(self.key, 'other', 600)
+            return renew(self)
+
+        async def slow_complete(model, message, config, user=None):
+            await asyncio.sleep(0.05)
+            return {'content': 'ok'}
+
+        with override_settings(LLM_BATCH_CONFIG={'CONCURRENCY': 1, 'CHECKPOINT_SIZE': 1, 'HEARTBEAT_INTERVAL': 0.01}), \
+                mock.patch.object(_RunLock, 'renew', fake_renew), \
+                mock.patch('chatbot.utils.failover.acomplete_with_failover', slow_complete):
+            job = run_batch_job(job_id)
+        self.assertTrue(renewals)
+        self.assertEqual(job.status, 'running')
+        self.assertLess(job.succeeded_items, 7)
+        self.assertEqual(cache.get(_lock_key(job_id)), 'other')
+
+    def test_resume_running_job_without_lock(self):
+        """执行进程已退出（没有执行锁）的任务可以继续执行，持有锁时返回409"""
+        from unittest import mock
+        from django.core.cache import cache
+        from .models import BatchJob
+        from .utils.batch_jobs import _lock_key
+
+        job_id = self._create()['id']
+        BatchJob.objects.filter(id=job_id).update(status='running')
+        cache.set(_lock_key(job_id), 'token', 600)
+        response = self.client.post(f"/api/v1/batches/{job_id}/resume/")
+        self.assertEqual(response.status_code, 409)
+
+        cache.delete(_lock_key(job_id))
+        with mock.patch('chatbot.utils.batch_jobs.enqueue_batch_job', return_value=True):
+            response = self.client.post(f"/api/v1/batches/{job_id}/resume/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'pending')
+
+    def test_cancelled_job_is_not_run(self):
+        """已取消的任务不再执行"""
+        from .models import BatchItem
+        from .utils.batch_jobs import run_batch_job
+
+        job_id = self._create()['id']
+        response = self.client.post(f"/api/v1/batches/{job_id}/cancel/")
+        self.assertEqual(response.data['status'], 'cancelled')
+        self.assertEqual(run_batch_job(job_id).status, 'cancelled')
+        self.assertEqual(BatchItem.objects.filter(job_id=job_id, status='pending').count(), 7)
+
+    def test_jsonl_upload_and_validation(self):
+        """支持上传JSONL文件，格式错误的条目返回400"""
+        from unittest import mock
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        upload = SimpleUploadedFile('items.jsonl', '{"prompt": "你好"}\n\n"再见"\n'.encode('utf-8'))
+        with mock.patch('chatbot.utils.batch_jobs.enqueue_batch_job', return_value=False):
+            response = self.client.post('/api/v1/batches/', {'model': 'deepseek-chat', 'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_items'], 2)
+        self.assertFalse(response.data['queued'])
+
+        response = self.client.post('/api/v1/batches/', {'model': 'deepseek-chat', 'items': [{'custom_id': 'x'}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.client.get('/api/v1/batches/').data), 1)
+
+
+class LLMSimulatorTestCase(TestCase):
+    """测试离线压测使用的模拟提供商"""
+
+    def _run(self, provider, scenario):
+        import asyncio
+        from .utils.http_pool import close_async_clients
+
+        async def run():
+            await provider.start()
+            try:
+                with override_settings(
+                    DEEPSEEK_API_BASE_URL=provider.completions_url, DEEPSEEK_API_KEY='test',
+                    GEMINI_API_BASE_URL=provider.gemini_base_url, GEMINI_API_KEY='test',
+                ):
+                    return await scenario()
+            finally:
+                await close_async_clients()
+                await provider.stop()
+
+        return asyncio.run(run())
+
+    def test_openai_and_gemini_protocols(self):
+        """同一个模拟服务同时提供OpenAI兼容和Gemini兼容接口，流式和非流式都返回usage"""
+        from llm_simulator import FakeLLMProvider
+        from .api_base import DeepSeekApi, GoogleGeminiApi
+
+        provider = FakeLLMProvider(first_token_delay=0, token_delay=0, tokens=3, prompt_cache_ratio=0.5)
+
+        async def scenario():
+            usage = {}
+            streamed = [chunk async for chunk in DeepSeekApi()._iter_stream_async(
+                DeepSeekApi()._build_stream_request('你好', {'model': 'deepseek-chat'}), usage)]
+            gemini = await GoogleGeminiApi().send_message_async('你好', {'model': 'gemini-1.5-flash'})
+            gemini_stream = [chunk async for chunk in GoogleGeminiApi().stream_message_async('你好', {'model': 'gemini-1.5-flash'})]
+            return streamed, usage, gemini, gemini_stream
+
+        streamed, usage, gemini, gemini_stream = self._run(provider, scenario)
+        self.assertEqual(''.join(streamed), '词0 词1 词2 ')
+        self.assertEqual(usage['completion_tokens'], 3)
+        self.assertEqual(usage['prompt_cache_hit_tokens'], usage['prompt_tokens'] // 2)
+        self.assertEqual(gemini['content'], '词0 词1 词2 ')
+        self.assertEqual(''.join(gemini_stream), '词0 词1 词2 ')
+        self.assertEqual(provider.stats, {'requests': 3, 'streams': 2, 'errors': 0, 'rate_limited': 0})
+
+    def test_failure_injection_and_latency_distribution(self):
+        """按比例注入429，延迟分布可复现"""
+        from llm_simulator import FakeLLMProvider
+        from .api_base import DeepSeekApi
+
+        provider = FakeLLMProvider(first_token_delay=0, token_delay=0, tokens=1, rate_limit_rate=1.0)
+
+        async def scenario():
+            with self.assertRaises(Exception):
+                await DeepSeekApi().send_message_async('你好', {'model': 'deepseek-chat'})
+
+        self._run(provider, scenario)
+        self.assertGreaterEqual(provider.stats['rate_limited'], 1)
+        self.assertEqual(provider.stats['requests'], provider.stats['rate_limited'])
+
+        first = FakeLLMProvider(first_token_delay=0.2, latency='lognormal', seed=7)
+        second = FakeLLMProvider(first_token_delay=0.2, latency='lognormal', seed=7)
+        samples = [first.sample_first_token_delay() for _ in range(200)]
+        self.assertEqual(samples, [second.sample_first_token_delay() for _ in range(200)])
+        self.assertAlmostEqual(sum(samples) / len(samples), 0.2, delta=0.05)
+        with self.assertRaises(ValueError):
+            FakeLLMProvider(latency='pareto')
+
+
+class FakeEmbeddingModel:
+    """记录每次encode调用的句向量模型"""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        import numpy as np
+
+        self.calls.append(len(texts))
+        return np.array([[float(len(text)), 1.0] for text in texts], dtype='float32')
+
+
+class FakeCollection:
+    """内存中的Chroma集合，记录写入调用"""
+
+    def __init__(self):
+        self.records = {}
+        self.upserts = []
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        self.upserts.append(len(ids))
+        for doc_id, document, metadata, embedding in zip(ids, documents, metadatas, embeddings):
+            self.records[doc_id] = {'document': document, 'metadata': metadata, 'embedding': embedding}
+
+    def get(self, ids=None, where=None, include=None):
+        if ids is None and where is None:
+            raise AssertionError('不应读取整个集合')
+        if where is not None:
+            found = [doc_id for doc_id, record in self.records.items()
+                     if record['metadata'].get('parent_doc_id') == where['parent_doc_id']]
+        else:
+            found = [doc_id for doc_id in ids if doc_id in self.records]
+        return {'ids': found}
+
+    def delete(self, ids=None, where=None):
+        if where is not None:
+            parents = set(where['parent_doc_id']['$in'])
+            ids = [doc_id for doc_id, record in self.records.items() if record['metadata'].get('parent_doc_id') in parents]
+        for doc_id in ids or []:
+            self.records.pop(doc_id, None)
+
+
+class KnowledgeIngestionTestCase(TestCase):
+    """测试知识库批量写入"""
+
+    def setUp(self):
+        from unittest import mock
+        from .utils.knowledge_base import KnowledgeBaseManager
+
+        self.manager = KnowledgeBaseManager('test')
+        patcher = mock.patch('chatbot.utils.knowledge_base.CHROMADB_AVAILABLE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG={'ENABLED': False})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.manager.embeddings = FakeEmbeddingModel()
+        self.manager.collection = FakeCollection()
+
+    def test_documents_are_batched(self):
+        """多个文档的块汇总后按批计算向量、按批写入"""
+        documents = ((f"doc{i}", 'x' * 600, {'type': 'test'}) for i in range(10))
+        with override_settings(KNOWLEDGE_BASE_INGESTION_CONFIG={'EMBED_BATCH_SIZE': 8, 'UPSERT_BATCH_SIZE': 8}):
+            chunks_added = self.manager.add_documents(documents)
+
+        # 每个文档切成512+88两个块，共20个块，每攒满8个写入一次
+        self.assertEqual(chunks_added, 20)
+        self.assertEqual(self.manager.collection.upserts, [8, 8, 4])
+        self.assertEqual(self.manager.embeddings.calls, [8, 8, 4])
+        self.assertEqual(self.manager.collection.records['doc3_1']['embedding'], [88.0, 1.0])
+
+    def test_sync_from_database_streams_documents(self):
+        """数据库同步不再逐条写入，没有变更时重复同步不写入"""
+        from .utils.knowledge_base import RealTimeDataSource
+
+        for i in range(3):
+            user = User.objects.create_user(username=f'kb{i}', password='testpass123')
+            conversation = Conversation.objects.create(user=user, title=f'会话{i}')
+            Message.objects.create(conversation=conversation, role='user', content='你好')
+
+        source = RealTimeDataSource()
+        source._kb_manager = self.manager
+        source.sync_from_database()
+        source.sync_from_database()
+
+        # 每个数据源批量写入一次
+        self.assertEqual(self.manager.collection.upserts, [3, 3, 3])
+        self.assertEqual(len(self.manager.collection.records), 9)
+        self.assertIn(f"profile_{User.objects.get(username='kb0').id}_0", self.manager.collection.records)
+
+
+class KnowledgeSyncTestCase(TestCase):
+    """测试知识库增量同步"""
+
+    def setUp(self):
+        from unittest import mock
+        from django.core.cache import cache
+        from .utils.knowledge_base import KnowledgeBaseManager, RealTimeDataSource
+
+        cache.clear()
+        manager = KnowledgeBaseManager('test')
+        patcher = mock.patch('chatbot.utils.knowledge_base.CHROMADB_AVAILABLE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG={'ENABLED': False})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        manager.embeddings = FakeEmbeddingModel()
+        manager.collection = FakeCollection()
+        self.collection = manager.collection
+        self.source = RealTimeDataSource()
+        self.source._kb_manager = manager
+
+        self.user = User.objects.create_user(username='kbsync', password='testpass123')
+        self.conversation = Conversation.objects.create(user=self.user, title='原标题')
+        self.message = Message.objects.create(conversation=self.conversation, role='user', content='你好')
+
+    def test_only_changed_rows_are_synced(self):
+        """第二次同步只写入修改和新增的记录"""
+        first = self.source.sync_from_database()
+        self.assertEqual(first, {'deleted': 0, 'user_profile': 1, 'conversation': 1, 'message': 1})
+
+        self.conversation.title = '新标题'
+        self.conversation.save()
+        Message.objects.create(conversation=self.conversation, role='assistant', content='回复')
+        second = self.source.sync_from_database()
+
+        self.assertEqual(second, {'deleted': 0, 'user_profile': 0, 'conversation': 1, 'message': 1})
+        self.assertIn('新标题', self.collection.records[f"conversation_{self.conversation.id}_0"]['document'])
+        self.assertEqual(self.source.sync_from_database(), {'deleted': 0, 'user_profile': 0, 'conversation': 0, 'message': 0})
+
+    def test_edited_message_is_resynced(self):
+        """修改过的消息在下次同步时重新写入"""
+        self.source.sync_from_database()
+        self.message.content = '修改后的内容'
+        self.message.save(update_fields=['content'])
+
+        self.assertEqual(self.source.sync_from_database()['message'], 1)
+        self.assertIn('修改后的内容', self.collection.records[f"message_{self.message.id}_0"]['document'])
+
+    def test_deleted_rows_are_removed(self):
+        """删除会话时级联删除的消息和会话本身的向量在下次同步时删除"""
+        self.source.sync_from_database()
+        self.assertIn(f"message_{self.message.id}_0", self.collection.records)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.delete()
+        stats = self.source.sync_from_database()
+
+        self.assertEqual(stats['deleted'], 2)
+        self.assertEqual(sorted(self.collection.records), [f"profile_{self.user.id}_0"])
+
+    def test_deletions_are_batched_and_skip_unsynced(self):
+        """级联删除只写入一次，尚未同步的消息不记录"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import KnowledgeDeletion
+
+        self.source.sync_from_database()
+        conversation_id = self.conversation.id
+        for index in range(3):
+            Message.objects.create(conversation=self.conversation, role='user', content=f"未同步{index}")
+
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.conversation.delete()
+        inserts = [query for query in queries if 'INSERT INTO "chatbot_knowledgedeletion"' in query['sql']]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(sorted(KnowledgeDeletion.objects.values_list('doc_id', flat=True)),
+                         [f"conversation_{conversation_id}", f"message_{self.message.id}"])
+
+    def test_rolled_back_deletions_are_not_recorded(self):
+        """回滚的删除不写入记录，也不影响之后提交的删除"""
+        from django.db import transaction
+        from .models import KnowledgeDeletion
+
+        other = Conversation.objects.create(user=self.user, title='另一个会话', model='deepseek-chat')
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.conversation.delete()
+                    raise RuntimeError('回滚')
+            except RuntimeError:
+                pass
+        self.assertTrue(Conversation.objects.filter(title=self.conversation.title).exists())
+
+        other_id = other.id
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertEqual(list(KnowledgeDeletion.objects.values_list('doc_id', flat=True)), [f"conversation_{other_id}"])
+
+    def test_initial_message_limit_and_full_sync(self):
+        """首次同步只包含最近的消息，全量同步重新写入所有记录"""
+        Message.objects.create(conversation=self.conversation, role='assistant', content='回复')
+        with override_settings(KNOWLEDGE_BASE_SYNC_CONFIG={'INITIAL_MESSAGE_LIMIT': 1}):
+            self.assertEqual(self.source.sync_from_database()['message'], 1)
+            self.assertNotIn(f"message_{self.message.id}_0", self.collection.records)
+            self.assertEqual(self.source.sync_from_database(full=True)['conversation'], 1)
+
+
+class EmbeddingCacheTestCase(TestCase):
+    """测试块向量的持久化缓存"""
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+
+    def _override(self, **config):
+        return override_settings(KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG=dict({'PATH': self.path}, **config))
+
+    def test_unchanged_chunks_are_not_reencoded(self):
+        """相同内容的块只计算一次，同一批中的重复块也只计算一次"""
+        from .utils.knowledge_ingestion import encode_texts
+
+        model = FakeEmbeddingModel()
+        with self._override():
+            first = encode_texts(model, ['甲', '乙乙', '甲'])
+            second = encode_texts(model, ['乙乙', '丙丙丙'])
+
+        self.assertEqual(model.calls, [2, 1])
+        self.assertEqual(first, [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]])
+        self.assertEqual(second, [[2.0, 1.0], [3.0, 1.0]])
+
+    def test_persisted_and_lru_evicted(self):
+        """新实例从磁盘加载索引，超过上限时淘汰最久未使用的向量"""
+        from .utils.embedding_cache import EmbeddingCache
+
+        cache = EmbeddingCache(self.path, 'test-model', max_entries=2)
+        cache.put_many(['a', 'b'], [[1.0, 0.0], [0.0, 1.0]])
+        cache.get_many(['a'])
+        cache.put_many(['c'], [[0.5, 0.5]])
+
+        reopened = EmbeddingCache(self.path, 'test-model', max_entries=2)
+        self.assertEqual(reopened.get_many(['a', 'b', 'c']), [[1.0, 0.0], None, [0.5, 0.5]])
+        self.assertEqual(cache.stats['evictions'], 1)
+
+
+class KnowledgeDeleteTestCase(TestCase):
+    """测试按parent_doc_id删除和更新知识库文档"""
+
+    def setUp(self):
+        from unittest import mock
+        from .utils.knowledge_base import KnowledgeBaseManager
+
+        self.manager = KnowledgeBaseManager('test')
+        patcher = mock.patch('chatbot.utils.knowledge_base.CHROMADB_AVAILABLE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG={'ENABLED': False})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.manager.embeddings = FakeEmbeddingModel()
+        self.manager.collection = FakeCollection()
+
+    def test_delete_only_matching_document(self):
+        """只删除该文档的块，前缀相同的其他文档不受影响"""
+        self.manager.add_document('doc1', 'x' * 1100)
+        self.manager.add_document('doc10', 'y' * 10)
+        self.manager.delete_document('doc1')
+        self.assertEqual(sorted(self.manager.collection.records), ['doc10_0'])
+
+    def test_delete_without_local_index(self):
+        """其他进程写入的文档按parent_doc_id查询，没有该元数据的旧文档按块ID探测"""
+        from .utils.knowledge_base import KnowledgeBaseManager
+
+        self.manager.add_document('doc1', 'x' * 1100)
+        collection = self.manager.collection
+        collection.records['legacy_0'] = {'document': 'a', 'metadata': {}, 'embedding': [1.0]}
+        collection.records['legacy_1'] = {'document': 'b', 'metadata': {}, 'embedding': [1.0]}
+
+        other = KnowledgeBaseManager('test')
+        other.collection = collection
+        other.delete_document('doc1')
+        other.delete_document('legacy')
+        self.assertEqual(collection.records, {})
+
+    def test_update_removes_stale_chunks(self):
+        """文档变短时删除多出来的旧块"""
+        self.manager.add_document('doc1', 'x' * 1100)
+        self.manager.update_document('doc1', 'short', {'type': 'test'})
+        self.assertEqual(list(self.manager.collection.records), ['doc1_0'])
+        self.assertEqual(self.manager.collection.records['doc1_0']['document'], 'short')
+
+        # 内容为空时删除全部旧块
+        self.manager.update_document('doc1', '', {'type': 'test'})
+        self.assertEqual(self.manager.collection.records, {})
+
+
+class QueryEmbeddingTestCase(TestCase):
+    """测试查询向量缓存和微批编码"""
+
+    def setUp(self):
+        from django.core.cache import caches
+
+        caches['api_cache'].clear()
+
+    def test_normalized_queries_share_cache(self):
+        """空白和大小写不同的问题命中同一条缓存"""
+        from .utils.query_embedding import QueryEncoder
+
+        model = FakeEmbeddingModel()
+        encoder = QueryEncoder(model)
+        with override_settings(KNOWLEDGE_BASE_QUERY_CACHE_CONFIG={'BATCH_WINDOW_MS': 0}):
+            first = encoder.encode('Hello  World')
+            second = encoder.encode(' hello world ')
+        self.assertEqual(model.calls, [1])
+        self.assertEqual(first.tolist(), second.tolist())
+        self.assertEqual(encoder.stats['hits'], 1)
+
+    def test_concurrent_queries_are_batched(self):
+        """同一时间窗口内到达的查询合并为一次编码"""
+        from .utils.query_embedding import QueryEncoder
+
+        model = FakeEmbeddingModel()
+        encoder = QueryEncoder(model)
+        barrier = threading.Barrier(8)
+        results = {}
+
+        def run(index):
+            barrier.wait()
+            results[index] = encoder.encode('问' * (index + 1))
+
+        with override_settings(KNOWLEDGE_BASE_QUERY_CACHE_CONFIG={'BATCH_WINDOW_MS': 200}):
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sum(model.calls), 8)
+        self.assertLess(len(model.calls), 8)
+        self.assertEqual([results[i][0] for i in range(8)], [float(i + 1) for i in range(8)])
+
+    def test_shared_cache_across_encoders(self):
+        """配置共享缓存时，其他进程（编码器）计算过的查询不再重新编码"""
+        from .utils.query_embedding import QueryEncoder
+
+        config = {'BATCH_WINDOW_MS': 0, 'SHARED_ALIAS': 'api_cache'}
+        with override_settings(KNOWLEDGE_BASE_QUERY_CACHE_CONFIG=config):
+            QueryEncoder(FakeEmbeddingModel()).encode('黑洞是什么')
+            model = FakeEmbeddingModel()
+            encoder = QueryEncoder(model)
+            vector = encoder.encode('黑洞是什么')
+        self.assertEqual(model.calls, [])
+        self.assertEqual(vector.tolist(), [5.0, 1.0])
+        self.assertEqual(encoder.stats['shared_hits'], 1)
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ConversationViewSet, MessageViewSet, login_view, register_view, health_check, available_models, request_password_reset, reset_password, reset_password_test, function_router, stream_chat
+from .views import ConversationViewSet, MessageViewSet, BatchJobViewSet, login_view, register_view, health_check, available_models, request_password_reset, reset_password, reset_password_test, function_router, stream_chat, async_stream_chat, cancel_stream_chat, usage_stats
 from .voice_views import initiate_call, answer_call, reject_call, end_call, get_call_status, signaling, get_signaling, get_call_history, get_active_calls
 # Knowledge base views are now imported from their dedicated file
 from .knowledge_base_views import (
@@ -14,6 +14,7 @@ from .knowledge_base_views import (
 router = DefaultRouter()
 router.register(r'conversations', ConversationViewSet, basename='conversation')
 router.register(r'messages', MessageViewSet, basename='message')
+router.register(r'batches', BatchJobViewSet, basename='batch')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -21,6 +22,8 @@ urlpatterns = [
     path('register/', register_view, name='register'),
     path('health/', health_check, name='health_check'),
     path('models/', available_models, name='available-models'),
+    # 按模型统计token消耗和延迟（管理员）
+    path('usage/stats/', usage_stats, name='usage-stats'),
 
     path('password/reset/request/', request_password_reset, name='request-password-reset'),
     path('password/reset/', reset_password, name='reset-password'),
@@ -29,6 +32,10 @@ urlpatterns = [
     path('function-router/', function_router, name='function-router'),
     # 流式聊天API
     path('stream-chat/', stream_chat, name='stream-chat'),
+    # 异步流式聊天API（ASGI部署时使用）
+    path('stream-chat/async/', async_stream_chat, name='async-stream-chat'),
+    # 取消进行中的流式生成
+    path('stream-chat/cancel/', cancel_stream_chat, name='cancel-stream-chat'),
     # 语音通话API
     path('voice/initiate/', initiate_call, name='initiate-call'),
     path('voice/answer/', answer_call, name='answer-call'),
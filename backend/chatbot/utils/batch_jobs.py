@@ -0,0 +1,303 @@
+"""
+批量对话补全
+离线任务（FAQ翻译、会话重命名等）一次提交成千上万条提示词，由Celery任务在后台事件循环中并发调用提供商：
+总并发受CONCURRENCY限制，每个提供商的并发和排队由并发限制器（AIMD）控制，吞吐只受提供商限流约束；
+结果每CHECKPOINT_SIZE条批量写入数据库，任务中断后重新执行只处理未完成的条目；结果以JSONL流式导出。
+同一任务同时只在一个进程中执行：执行锁的值为本次执行的令牌，执行期间定时续期，只续期和删除仍属于自己的锁
+"""
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 批量任务默认配置，可通过settings.LLM_BATCH_CONFIG覆盖
+DEFAULT_BATCH_CONFIG = {
+    'MAX_ITEMS': 50000,               # 单个任务的条目上限
+    'MAX_PROMPT_CHARS': 20000,        # 单条提示词的长度上限
+    'CONCURRENCY': 16,                # 单个任务同时进行的请求数上限
+    'CHECKPOINT_SIZE': 50,            # 每完成多少条写入一次数据库
+    'QUEUE_TIMEOUT': 600,             # 等待提供商并发名额的超时时间（秒），批量任务可以排队更久
+    'REQUEST_TIMEOUT': 120,           # 单个请求的超时时间（秒）
+    'LOCK_TIMEOUT': 600,              # 执行锁的有效期（秒），进程退出后到期可重新执行
+    'HEARTBEAT_INTERVAL': 60,         # 执行期间续期执行锁的间隔（秒），应远小于LOCK_TIMEOUT
+}
+
+CREATE_BATCH_SIZE = 1000
+
+
+def get_batch_config() -> Dict:
+    """读取批量任务配置"""
+    config = getattr(settings, 'LLM_BATCH_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_BATCH_CONFIG.items()}
+
+
+def _lock_key(job_id: int) -> str:
+    return f"batch_job:{job_id}:lock"
+
+
+class _RunLock:
+    """任务执行锁，值为本次执行的令牌"""
+
+    def __init__(self, job_id: int, timeout: int):
+        self.key = _lock_key(job_id)
+        self.token = uuid.uuid4().hex
+        self.timeout = timeout
+        self.lost = False
+
+    def acquire(self) -> bool:
+        return cache.add(self.key, self.token, self.timeout)
+
+    def renew(self) -> bool:
+        """续期，锁已过期或被其他进程持有时返回False"""
+        if cache.get(self.key) != self.token:
+            self.lost = True
+            return False
+        cache.touch(self.key, self.timeout)
+        return True
+
+    def release(self):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+def is_batch_job_running(job) -> bool:
+    """任务是否正由某个进程执行（持有执行锁），状态为running但没有锁时说明执行进程已退出"""
+    return cache.get(_lock_key(job.id)) is not None
+
+
+def parse_items(items) -> List[Dict]:
+    """
+    校验并规范化条目：每条为字符串，或包含prompt（或message）和可选custom_id的字典
+    :raises ValueError: 条目为空、超过数量上限或格式错误
+    """
+    config = get_batch_config()
+    if not isinstance(items, list) or not items:
+        raise ValueError("items必须是非空列表")
+    if len(items) > config['MAX_ITEMS']:
+        raise ValueError(f"条目数不能超过{config['MAX_ITEMS']}")
+
+    parsed = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'prompt': item}
+        if not isinstance(item, dict):
+            raise ValueError(f"第{index + 1}条格式错误")
+        prompt = item.get('prompt', item.get('message'))
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError(f"第{index + 1}条缺少prompt")
+        if len(prompt) > config['MAX_PROMPT_CHARS']:
+            raise ValueError(f"第{index + 1}条超过{config['MAX_PROMPT_CHARS']}个字符")
+        parsed.append({'custom_id': str(item.get('custom_id') or '')[:255], 'prompt': prompt})
+    return parsed
+
+
+def parse_jsonl(lines) -> List:
+    """解析上传的JSONL文件，每行一个条目"""
+    items = []
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError:
+            raise ValueError(f"第{number}行不是有效的JSON")
+    return items
+
+
+def create_batch_job(user, model: str, items: List[Dict], **options):
+    """创建批量任务并分批写入条目"""
+    from ..models import BatchJob, BatchItem
+
+    job = BatchJob.objects.create(user=user, model=model, total_items=len(items), **options)
+    BatchItem.objects.bulk_create(
+        [BatchItem(job=job, index=index, custom_id=item['custom_id'], prompt=item['prompt'])
+         for index, item in enumerate(items)],
+        batch_size=CREATE_BATCH_SIZE,
+    )
+    return job
+
+
+def enqueue_batch_job(job) -> bool:
+    """提交Celery任务，消息队列不可用时返回False，可用run_batch_job管理命令执行"""
+    try:
+        from ..tasks import run_batch_job as run_batch_job_task
+        run_batch_job_task.apply_async(args=[job.id], retry=False)
+        return True
+    except Exception as e:
+        logger.warning(f"提交批量任务{job.id}失败: {str(e)}")
+        return False
+
+
+def reset_batch_job(job, retry_failed: bool = False):
+    """把已取消或中断的任务恢复为等待执行，retry_failed时失败的条目也重新执行"""
+    from ..models import BatchJob
+
+    if retry_failed:
+        reset = job.items.filter(status='failed').update(status='pending', error='')
+        BatchJob.objects.filter(id=job.id).update(failed_items=F('failed_items') - reset)
+    BatchJob.objects.filter(id=job.id).update(status='pending', finished_at=None)
+
+
+def resume_batch_job(job, retry_failed: bool = False) -> bool:
+    """恢复任务并重新提交Celery任务"""
+    reset_batch_job(job, retry_failed)
+    return enqueue_batch_job(job)
+
+
+def cancel_batch_job(job):
+    """取消任务，执行中的任务在下一个检查点停止"""
+    from ..models import BatchJob
+
+    BatchJob.objects.filter(id=job.id, status__in=['pending', 'running']).update(
+        status='cancelled', finished_at=timezone.now()
+    )
+
+
+class _Checkpoint:
+    """缓存已完成的条目，批量写入数据库并检查任务是否被取消"""
+
+    def __init__(self, job, config: Dict):
+        self.job = job
+        self.config = config
+        self.buffer = []
+        # 任务被取消或执行锁丢失时停止领取新条目
+        self.cancelled = False
+        self._lock = asyncio.Lock()
+
+    async def add(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.config['CHECKPOINT_SIZE']:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            items, self.buffer = self.buffer, []
+            if await sync_to_async(self._save)(items):
+                self.cancelled = True
+
+    def _save(self, items) -> bool:
+        from django.db import transaction
+        from ..models import BatchJob, BatchItem
+
+        succeeded = sum(1 for item in items if item.status == 'succeeded')
+        with transaction.atomic():
+            BatchItem.objects.bulk_update(items, ['status', 'content', 'error', 'model', 'usage', 'latency_ms'])
+            BatchJob.objects.filter(id=self.job.id).update(
+                succeeded_items=F('succeeded_items') + succeeded,
+                failed_items=F('failed_items') + len(items) - succeeded,
+            )
+        return BatchJob.objects.filter(id=self.job.id, status='cancelled').exists()
+
+
+async def _heartbeat(lock: _RunLock, checkpoint: _Checkpoint, interval: float):
+    """定时续期执行锁，锁丢失时停止领取新条目，避免与其他进程重复执行"""
+    while True:
+        await asyncio.sleep(interval)
+        if not await sync_to_async(lock.renew, thread_sensitive=False)():
+            logger.warning(f"批量任务{checkpoint.job.id}的执行锁已丢失，停止执行")
+            checkpoint.cancelled = True
+            return
+
+
+async def _run_items(job, items, config: Dict, lock: _RunLock) -> bool:
+    """
+    并发执行条目
+    :return: 任务是否在执行期间被取消（或执行锁丢失）
+    """
+    from .failover import acomplete_with_failover
+
+    call_config = {
+        'model': job.model,
+        'temperature': job.temperature,
+        'max_tokens': job.max_tokens,
+        'top_p': 0.7,
+        'timeout': config['REQUEST_TIMEOUT'],
+        'queue_timeout': config['QUEUE_TIMEOUT'],
+        'history': [],
+        'system_prompt': job.system_prompt,
+        'cache': job.use_cache,
+    }
+    checkpoint = _Checkpoint(job, config)
+    queue = iter(items)
+
+    async def worker():
+        # 各worker从同一个迭代器领取条目，同时进行的请求数等于worker数
+        for item in queue:
+            if checkpoint.cancelled:
+                return
+            start = time.monotonic()
+            try:
+                result = await acomplete_with_failover(job.model, item.prompt, dict(call_config), job.user)
+                item.status, item.content, item.error = 'succeeded', result.get('content') or '', ''
+                item.model, item.usage = result.get('model') or job.model, result.get('usage') or None
+            except Exception as e:
+                item.status, item.error = 'failed', str(e)[:2000]
+            item.latency_ms = int((time.monotonic() - start) * 1000)
+            await checkpoint.add(item)
+
+    heartbeat = asyncio.ensure_future(_heartbeat(lock, checkpoint, config['HEARTBEAT_INTERVAL']))
+    try:
+        await asyncio.gather(*[worker() for _ in range(min(config['CONCURRENCY'], len(items)) or 1)])
+    finally:
+        heartbeat.cancel()
+    await checkpoint.flush()
+    return checkpoint.cancelled
+
+
+def run_batch_job(job_id: int):
+    """
+    执行（或继续执行）批量任务，只处理未完成的条目
+    同一任务同时只在一个进程中执行，已在执行时直接返回
+    :return: 执行结束后的任务，任务不存在或正在其他进程执行时返回None
+    """
+    from ..models import BatchJob
+    from .failover import run_in_loop
+
+    config = get_batch_config()
+    lock = _RunLock(job_id, config['LOCK_TIMEOUT'])
+    if not lock.acquire():
+        logger.info(f"批量任务{job_id}正在执行")
+        return None
+    try:
+        job = BatchJob.objects.select_related('user').filter(id=job_id).first()
+        if job is None or job.status in ('completed', 'cancelled'):
+            return job
+        BatchJob.objects.filter(id=job.id).update(status='running', started_at=job.started_at or timezone.now())
+
+        items = list(job.items.filter(status='pending').order_by('index').only('id', 'index', 'prompt'))
+        logger.info(f"批量任务{job.id}开始执行，待处理{len(items)}条")
+        try:
+            cancelled = run_in_loop(_run_items(job, items, config, lock)) if items else False
+        except Exception as e:
+            logger.error(f"批量任务{job.id}执行失败: {str(e)}")
+            BatchJob.objects.filter(id=job.id).update(status='failed', error=str(e), finished_at=timezone.now())
+        else:
+            # 最后一个检查点之后被取消的任务保持取消状态；执行锁丢失时由接手的进程更新状态
+            if not cancelled and not lock.lost:
+                BatchJob.objects.filter(id=job.id, status='running').update(status='completed', finished_at=timezone.now())
+        job.refresh_from_db()
+        return job
+    finally:
+        lock.release()
+
+
+def iter_results_jsonl(job, status: Optional[str] = None) -> Iterator[str]:
+    """按序号逐行导出结果（JSONL），分块读取数据库，不一次性加载全部条目"""
+    items = job.items.order_by('index')
+    if status:
+        items = items.filter(status=status)
+    fields = ('index', 'custom_id', 'status', 'content', 'error', 'model', 'usage', 'latency_ms')
+    for row in items.values(*fields).iterator(chunk_size=CREATE_BATCH_SIZE):
+        yield json.dumps(row, ensure_ascii=False) + '\n'
@@ -0,0 +1,274 @@
+"""
+大模型提供商熔断器
+按提供商和API密钥分别统计滑动窗口内的错误率和慢请求比例，超过阈值后熔断：
+熔断期间请求立即失败（由故障转移切换到备用模型），冷却结束后进入半开状态放行一个探测请求，
+探测成功则恢复，失败则继续熔断
+只有连接错误、超时、429和5xx计为提供商故障；401/403只计入该API密钥的熔断器，
+其他4xx是请求本身的问题，不计入统计，避免单个用户的无效密钥或输入熔断整个提供商
+熔断状态保存在进程内，每个工作进程独立判断
+"""
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 熔断器默认配置，可通过settings.LLM_CIRCUIT_BREAKER_CONFIG覆盖
+DEFAULT_BREAKER_CONFIG = {
+    'ENABLED': True,
+    'WINDOW_SECONDS': 60,             # 滑动窗口长度（秒）
+    'MIN_REQUESTS': 5,                # 窗口内请求数达到该值后才判断是否熔断
+    'FAILURE_RATE_THRESHOLD': 0.5,    # 错误率阈值
+    'SLOW_CALL_SECONDS': 20.0,        # 超过该耗时（流式请求为首token耗时）视为慢请求
+    'SLOW_CALL_RATE_THRESHOLD': 0.8,  # 慢请求比例阈值
+    'OPEN_SECONDS': 30,               # 熔断持续时间，之后进入半开状态
+    'DEGRADED_SCORE': 0.8,            # 健康分低于该值时标记为降级
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 错误计入的范围
+PROVIDER_FAILURE = 'provider'  # 提供商和API密钥的熔断器都计为失败
+KEY_FAILURE = 'key'            # 只计入API密钥的熔断器
+
+
+class CircuitOpenError(Exception):
+    """熔断期间拒绝请求"""
+
+
+def get_breaker_config() -> Dict:
+    """读取熔断器配置"""
+    config = getattr(settings, 'LLM_CIRCUIT_BREAKER_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_BREAKER_CONFIG.items()}
+
+
+def failure_scope(error: BaseException) -> Optional[str]:
+    """
+    按异常判断计入哪些熔断器
+    :return: 没有状态码（连接错误、超时、响应解析失败）、429和5xx返回PROVIDER_FAILURE，
+             401/403返回KEY_FAILURE，其他4xx返回None（不计入统计）
+    """
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return PROVIDER_FAILURE
+    if status_code in (401, 403):
+        return KEY_FAILURE
+    return None
+
+
+class CircuitBreaker:
+    """单个提供商或API密钥的熔断器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._calls = deque()  # (时间, 是否成功, 耗时)
+        self._opened_at = 0.0
+        self._probe_started = None
+
+    def _trim(self, now: float, window: float):
+        while self._calls and now - self._calls[0][0] > window:
+            self._calls.popleft()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self._opened_at = now
+        self._probe_started = None
+        self._calls.clear()
+        logger.warning(f"{self.name} 触发熔断")
+
+    def allow_request(self) -> bool:
+        """是否允许发起请求，半开状态下同一时间只放行一个探测请求"""
+        config = get_breaker_config()
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN:
+                if now - self._opened_at < config['OPEN_SECONDS']:
+                    return False
+                self.state = HALF_OPEN
+                logger.info(f"{self.name} 熔断冷却结束，进入半开状态")
+            if self.state == HALF_OPEN:
+                # 探测请求超时未返回结果时允许重新探测
+                if self._probe_started is not None and now - self._probe_started < config['OPEN_SECONDS']:
+                    return False
+                self._probe_started = now
+            return True
+
+    def release(self):
+        """请求被取消、没有结果时释放探测名额"""
+        with self._lock:
+            self._probe_started = None
+
+    def record_success(self, latency: float):
+        config = get_breaker_config()
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self._probe_started = None
+                self._calls.clear()
+                logger.info(f"{self.name} 探测成功，熔断恢复")
+                return
+            self._calls.append((now, True, latency))
+            self._evaluate(now, config)
+
+    def record_failure(self, latency: float):
+        config = get_breaker_config()
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._open(now)
+                return
+            self._calls.append((now, False, latency))
+            self._evaluate(now, config)
+
+    def _rates(self, config: Dict):
+        total = len(self._calls)
+        if not total:
+            return 0, 0.0, 0.0, None
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        slow = sum(1 for _, _, latency in self._calls if latency >= config['SLOW_CALL_SECONDS'])
+        avg_latency = sum(latency for _, _, latency in self._calls) / total
+        return total, failures / total, slow / total, avg_latency
+
+    def _evaluate(self, now: float, config: Dict):
+        if self.state != CLOSED:
+            return
+        self._trim(now, config['WINDOW_SECONDS'])
+        total, failure_rate, slow_rate, _ = self._rates(config)
+        if total < config['MIN_REQUESTS']:
+            return
+        if failure_rate >= config['FAILURE_RATE_THRESHOLD'] or slow_rate >= config['SLOW_CALL_RATE_THRESHOLD']:
+            self._open(now)
+
+    def stats(self) -> Dict:
+        """当前状态和健康分（0-1）"""
+        config = get_breaker_config()
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= config['OPEN_SECONDS']:
+                state = HALF_OPEN
+            else:
+                state = self.state
+            self._trim(now, config['WINDOW_SECONDS'])
+            total, failure_rate, slow_rate, avg_latency = self._rates(config)
+
+        if state == OPEN:
+            score = 0.0
+        elif state == HALF_OPEN:
+            score = 0.5
+        else:
+            score = (1 - failure_rate) * (1 - slow_rate / 2)
+        return {
+            'state': state,
+            'health_score': round(score, 3),
+            'degraded': state != CLOSED or score < config['DEGRADED_SCORE'],
+            'requests': total,
+            'failure_rate': round(failure_rate, 3),
+            'slow_rate': round(slow_rate, 3),
+            'avg_latency': round(avg_latency, 3) if avg_latency is not None else None,
+        }
+
+
+class ProviderCircuit:
+    """一次请求涉及的熔断器（提供商 + API密钥）"""
+
+    def __init__(self, breakers: List[CircuitBreaker], key_breaker: Optional[CircuitBreaker] = None):
+        self.breakers = breakers
+        self.key_breaker = key_breaker
+
+    def before_request(self):
+        """请求前检查，任一熔断器打开时抛出CircuitOpenError"""
+        allowed = []
+        for breaker in self.breakers:
+            if not breaker.allow_request():
+                for other in allowed:
+                    other.release()
+                raise CircuitOpenError(f"{breaker.name} 熔断中，暂停请求")
+            allowed.append(breaker)
+
+    def record(self, ok: Optional[bool], latency: float):
+        """
+        记录请求结果
+        :param ok: 为None表示请求被取消，不计入统计
+        """
+        for breaker in self.breakers:
+            if ok is None:
+                breaker.release()
+            elif ok:
+                breaker.record_success(latency)
+            else:
+                breaker.record_failure(latency)
+
+    def record_error(self, error: BaseException, latency: float):
+        """按failure_scope记录请求失败，不计入统计的熔断器只释放探测名额"""
+        scope = failure_scope(error)
+        for breaker in self.breakers:
+            if scope == PROVIDER_FAILURE or (scope == KEY_FAILURE and breaker is self.key_breaker):
+                breaker.record_failure(latency)
+            else:
+                breaker.release()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def api_key_label(provider: str, api_key: str) -> str:
+    """提供商 + API密钥摘要，不在内存和日志中保留API密钥明文"""
+    return f"{provider}:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}"
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def get_circuit(provider: str, api_key: Optional[str] = None) -> ProviderCircuit:
+    """获取提供商及API密钥对应的熔断器"""
+    if not get_breaker_config()['ENABLED']:
+        return ProviderCircuit([])
+    if not api_key:
+        return ProviderCircuit([get_breaker(provider)])
+    key_breaker = get_breaker(api_key_label(provider, api_key))
+    return ProviderCircuit([get_breaker(provider), key_breaker], key_breaker)
+
+
+def get_health(provider: str, api_key: Optional[str] = None) -> Dict:
+    """提供商（及API密钥）的综合健康状态，取较差的一方"""
+    names = [provider] + ([api_key_label(provider, api_key)] if api_key else [])
+    stats = [_breakers[name].stats() for name in names if name in _breakers]
+    if not stats:
+        return {'state': CLOSED, 'health_score': 1.0, 'degraded': False}
+    worst = min(stats, key=lambda item: item['health_score'])
+    return {'state': worst['state'], 'health_score': worst['health_score'], 'degraded': any(item['degraded'] for item in stats)}
+
+
+def get_breaker_stats() -> Dict:
+    """健康检查使用的熔断器统计，API密钥只汇总数量"""
+    providers = {}
+    key_states = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+    for name, breaker in list(_breakers.items()):
+        stats = breaker.stats()
+        if ':' in name:
+            key_states[stats['state']] += 1
+        else:
+            providers[name] = stats
+    return {'providers': providers, 'api_keys': key_states}
+
+
+def reset_breakers():
+    """清空所有熔断器状态"""
+    with _breakers_lock:
+        _breakers.clear()
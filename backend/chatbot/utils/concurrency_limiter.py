@@ -0,0 +1,499 @@
+"""
+大模型提供商自适应并发限制
+按 提供商 + API密钥 限制同时进行的请求数和每分钟token数，超出时按先来先到排队，超过截止时间仍未轮到则失败
+并发上限按AIMD调整：请求成功且延迟正常时缓慢增加，遇到429或延迟过高时成倍减少，
+使吞吐量稳定在提供商的限额附近，而不是在429风暴中反复震荡
+默认缓存为Redis时多个进程共享限额，否则在进程内限制
+"""
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .circuit_breaker import api_key_label
+
+logger = logging.getLogger(__name__)
+
+# 并发限制默认配置，可通过settings.LLM_CONCURRENCY_CONFIG覆盖
+DEFAULT_CONCURRENCY_CONFIG = {
+    'ENABLED': True,
+    'BACKEND': 'auto',            # auto：默认缓存为Redis时使用Redis，否则使用进程内限制；也可指定redis/local
+    # 初始并发上限，None时等于MAX_LIMIT：流式请求在整个生成期间占用名额，从较小的上限缓慢增加会限制正常流量，
+    # 因此默认从上限开始，只在遇到429或延迟过高时减少
+    'INITIAL_LIMIT': None,
+    'MIN_LIMIT': 1,
+    'MAX_LIMIT': 64,
+    'INCREASE_STEP': 1.0,         # 加性增加：每次成功增加 INCREASE_STEP / 当前上限
+    'DECREASE_FACTOR': 0.5,       # 乘性减少：遇到429时乘以该系数
+    'LATENCY_THRESHOLD': 20.0,    # 超过该延迟（流式请求为首token耗时）视为过载
+    'LATENCY_DECREASE_FACTOR': 0.9,
+    'TPM_LIMIT': None,            # 每分钟token上限，None表示不限制
+    'QUEUE_TIMEOUT': 30.0,        # 排队截止时间（秒）
+    'LEASE_TTL': 600,             # 并发名额的最长占用时间，进程异常退出时自动回收
+    'POLL_INTERVAL': 0.05,        # 排队时检查名额的间隔（秒）
+    'PROVIDERS': {},              # 按提供商名称覆盖以上配置，如 {'DeepSeek': {'MAX_LIMIT': 16, 'TPM_LIMIT': 300000}}
+}
+
+# 统计每分钟token数的窗口（秒）
+TOKEN_WINDOW = 60
+
+
+class QueueTimeoutError(Exception):
+    """排队超过截止时间"""
+
+
+def get_concurrency_config() -> Dict:
+    """读取并发限制配置"""
+    config = getattr(settings, 'LLM_CONCURRENCY_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_CONCURRENCY_CONFIG.items()}
+
+
+def _provider_params(provider: str) -> Dict:
+    config = get_concurrency_config()
+    params = {key: value for key, value in config.items() if key != 'PROVIDERS'}
+    params.update((config['PROVIDERS'] or {}).get(provider, {}))
+    if params['INITIAL_LIMIT'] is None:
+        params['INITIAL_LIMIT'] = params['MAX_LIMIT']
+    return params
+
+
+def estimate_request_tokens(payload: Dict) -> int:
+    """
+    粗略估算一次请求消耗的token数（输入 + 最大输出），用于每分钟token限制
+    中文约1字1个token，英文约4个字符1个token，按2个字符1个token折中估算
+    """
+    messages = payload.get('messages') or payload.get('contents') or []
+    prompt_chars = len(json.dumps(messages, ensure_ascii=False))
+    max_tokens = payload.get('max_tokens') or (payload.get('generationConfig') or {}).get('maxOutputTokens') or 0
+    return prompt_chars // 2 + int(max_tokens)
+
+
+def usage_tokens(usage: Optional[Dict]) -> Optional[int]:
+    """从上游返回的usage中读取实际消耗的token数，用于替换估算值；未返回时为None"""
+    if not usage:
+        return None
+    # Gemini: usageMetadata.totalTokenCount，其余提供商: usage.total_tokens
+    total = usage.get('totalTokenCount', usage.get('total_tokens'))
+    try:
+        return int(total) if total is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalLimiterBackend:
+    """进程内限制，线程和事件循环共用"""
+
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict] = {}
+
+    def _state(self, label: str, params: Dict) -> Dict:
+        state = self._states.get(label)
+        if state is None:
+            state = self._states[label] = {
+                'limit': float(params['INITIAL_LIMIT']),
+                'in_flight': {},            # 名额ID -> 过期时间
+                'queue': OrderedDict(),     # 排队ID -> 截止时间
+                'tokens': deque(),          # (时间, 名额ID, token数)
+            }
+        return state
+
+    def _cleanup(self, state: Dict, now: float):
+        for lease_id, expiry in list(state['in_flight'].items()):
+            if expiry <= now:
+                del state['in_flight'][lease_id]
+        for ticket, deadline in list(state['queue'].items()):
+            if deadline <= now:
+                del state['queue'][ticket]
+        while state['tokens'] and now - state['tokens'][0][0] > TOKEN_WINDOW:
+            state['tokens'].popleft()
+
+    def enqueue(self, label: str, ticket: str, deadline: float, params: Dict):
+        with self._lock:
+            self._state(label, params)['queue'][ticket] = deadline
+
+    def try_acquire(self, label: str, ticket: str, lease_id: str, tokens: int, params: Dict) -> bool:
+        now = time.time()
+        with self._lock:
+            state = self._state(label, params)
+            self._cleanup(state, now)
+            if ticket not in state['queue']:
+                raise QueueTimeoutError(f"{label} 排队超时")
+            rank = list(state['queue']).index(ticket)
+            if rank >= int(state['limit']) - len(state['in_flight']):
+                return False
+            tpm_limit = params['TPM_LIMIT']
+            used = sum(item[2] for item in state['tokens'])
+            if tpm_limit and used and used + tokens > tpm_limit:
+                return False
+            del state['queue'][ticket]
+            state['in_flight'][lease_id] = now + params['LEASE_TTL']
+            state['tokens'].append((now, lease_id, tokens))
+            return True
+
+    def leave(self, label: str, ticket: str):
+        with self._lock:
+            state = self._states.get(label)
+            if state is not None:
+                state['queue'].pop(ticket, None)
+
+    def release(self, label: str, lease_id: str, estimated: int, actual: Optional[int]):
+        with self._lock:
+            state = self._states.get(label)
+            if state is None:
+                return
+            state['in_flight'].pop(lease_id, None)
+            if actual is not None:
+                # 用实际消耗替换估算值
+                state['tokens'] = deque(
+                    (ts, lid, actual if lid == lease_id else count) for ts, lid, count in state['tokens']
+                )
+
+    def adjust(self, label: str, mode: str, value: float, params: Dict) -> float:
+        with self._lock:
+            state = self._state(label, params)
+            limit = state['limit'] * value if mode == 'mul' else state['limit'] + value / state['limit']
+            state['limit'] = max(float(params['MIN_LIMIT']), min(float(params['MAX_LIMIT']), limit))
+            return state['limit']
+
+    def stats(self, label: str, params: Dict) -> Dict:
+        now = time.time()
+        with self._lock:
+            state = self._state(label, params)
+            self._cleanup(state, now)
+            return {
+                'limit': round(state['limit'], 2),
+                'in_flight': len(state['in_flight']),
+                'queued': len(state['queue']),
+                'tokens_per_minute': sum(item[2] for item in state['tokens']),
+            }
+
+    def labels(self):
+        with self._lock:
+            return list(self._states)
+
+    def reset(self):
+        with self._lock:
+            self._states.clear()
+
+
+# 排队与获取名额在Lua脚本中原子执行
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', now)
+for _, member in ipairs(expired) do redis.call('ZREM', KEYS[2], member) end
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - tonumber(ARGV[8]))
+local rank = redis.call('ZRANK', KEYS[2], ARGV[2])
+if not rank then return -1 end
+local limit = math.floor(tonumber(redis.call('GET', KEYS[4]) or ARGV[7]))
+if rank >= limit - redis.call('ZCARD', KEYS[1]) then return 0 end
+local tpm = tonumber(ARGV[6])
+if tpm > 0 then
+    local used = 0
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[3], 0, -1)) do
+        used = used + tonumber(string.match(member, ':(%d+)$'))
+    end
+    if used > 0 and used + tonumber(ARGV[4]) > tpm then return 0 end
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZREM', KEYS[5], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[5], ARGV[3])
+redis.call('ZADD', KEYS[3], now, ARGV[3] .. ':' .. ARGV[4])
+return 1
+"""
+
+_ADJUST_SCRIPT = """
+local limit = tonumber(redis.call('GET', KEYS[1]) or ARGV[5])
+if ARGV[1] == 'mul' then
+    limit = limit * tonumber(ARGV[2])
+else
+    limit = limit + tonumber(ARGV[2]) / limit
+end
+limit = math.max(tonumber(ARGV[3]), math.min(tonumber(ARGV[4]), limit))
+redis.call('SET', KEYS[1], tostring(limit), 'EX', 86400)
+return tostring(limit)
+"""
+
+
+class RedisLimiterBackend:
+    """Redis共享限制，多个进程/实例共用同一组名额"""
+
+    blocking = True
+    prefix = 'llm_limiter'
+
+    def __init__(self, client):
+        self.client = client
+        self._acquire = client.register_script(_ACQUIRE_SCRIPT)
+        self._adjust = client.register_script(_ADJUST_SCRIPT)
+
+    def _keys(self, label: str):
+        base = f"{self.prefix}:{label}"
+        return [f"{base}:inflight", f"{base}:queue", f"{base}:tokens", f"{base}:limit", f"{base}:deadlines"]
+
+    def enqueue(self, label: str, ticket: str, deadline: float, params: Dict):
+        inflight, queue, _, _, deadlines = self._keys(label)
+        seq = self.client.incr(f"{self.prefix}:{label}:seq")
+        pipe = self.client.pipeline()
+        pipe.zadd(queue, {ticket: seq})
+        pipe.zadd(deadlines, {ticket: deadline})
+        pipe.sadd(f"{self.prefix}:labels", label)
+        pipe.execute()
+
+    def try_acquire(self, label: str, ticket: str, lease_id: str, tokens: int, params: Dict) -> bool:
+        now = time.time()
+        result = self._acquire(keys=self._keys(label), args=[
+            now, ticket, lease_id, tokens, now + params['LEASE_TTL'],
+            params['TPM_LIMIT'] or 0, params['INITIAL_LIMIT'], TOKEN_WINDOW,
+        ])
+        if int(result) < 0:
+            raise QueueTimeoutError(f"{label} 排队超时")
+        return int(result) == 1
+
+    def leave(self, label: str, ticket: str):
+        _, queue, _, _, deadlines = self._keys(label)
+        pipe = self.client.pipeline()
+        pipe.zrem(queue, ticket)
+        pipe.zrem(deadlines, ticket)
+        pipe.execute()
+
+    def release(self, label: str, lease_id: str, estimated: int, actual: Optional[int]):
+        inflight, _, tokens_key, _, _ = self._keys(label)
+        self.client.zrem(inflight, lease_id)
+        if actual is not None:
+            member = f"{lease_id}:{estimated}"
+            score = self.client.zscore(tokens_key, member)
+            if score is not None:
+                pipe = self.client.pipeline()
+                pipe.zrem(tokens_key, member)
+                pipe.zadd(tokens_key, {f"{lease_id}:{actual}": score})
+                pipe.execute()
+
+    def adjust(self, label: str, mode: str, value: float, params: Dict) -> float:
+        result = self._adjust(keys=[self._keys(label)[3]], args=[
+            mode, value, params['MIN_LIMIT'], params['MAX_LIMIT'], params['INITIAL_LIMIT'],
+        ])
+        return float(result)
+
+    def stats(self, label: str, params: Dict) -> Dict:
+        now = time.time()
+        inflight, queue, tokens_key, limit_key, _ = self._keys(label)
+        pipe = self.client.pipeline()
+        pipe.get(limit_key)
+        pipe.zcount(inflight, now, '+inf')
+        pipe.zcard(queue)
+        pipe.zrangebyscore(tokens_key, now - TOKEN_WINDOW, '+inf')
+        limit, in_flight, queued, token_members = pipe.execute()
+        return {
+            'limit': round(float(limit or params['INITIAL_LIMIT']), 2),
+            'in_flight': in_flight,
+            'queued': queued,
+            'tokens_per_minute': sum(int(member.rsplit(b':', 1)[1]) for member in token_members),
+        }
+
+    def labels(self):
+        return [label.decode('utf-8') for label in self.client.smembers(f"{self.prefix}:labels")]
+
+    def reset(self):
+        for label in self.labels():
+            self.client.delete(*self._keys(label), f"{self.prefix}:{label}:seq")
+        self.client.delete(f"{self.prefix}:labels")
+
+
+_local_backend = LocalLimiterBackend()
+_redis_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """按配置选择Redis或进程内限制，Redis不可用时回退到进程内限制"""
+    global _redis_backend
+    backend = get_concurrency_config()['BACKEND']
+    if backend == 'local':
+        return _local_backend
+    if backend == 'auto' and not settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        return _local_backend
+    if _redis_backend is None:
+        with _backend_lock:
+            if _redis_backend is None:
+                try:
+                    from django_redis import get_redis_connection
+                    _redis_backend = RedisLimiterBackend(get_redis_connection('default'))
+                except Exception as e:
+                    logger.warning(f"Redis并发限制不可用，使用进程内限制: {str(e)}")
+                    return _local_backend
+    return _redis_backend
+
+
+class Lease:
+    """一次上游请求占用的并发名额"""
+
+    def __init__(self, limiter: Optional['ConcurrencyLimiter'], backend=None, lease_id: str = '', tokens: int = 0):
+        self.limiter = limiter
+        self.backend = backend
+        self.lease_id = lease_id
+        self.tokens = tokens
+        self._released = False
+
+    def release(self, error: Optional[BaseException] = None, cancelled: bool = False,
+                latency: Optional[float] = None, tokens_used: Optional[int] = None):
+        """
+        归还名额并按请求结果调整并发上限
+        :param error: 请求抛出的异常，429时减少并发上限
+        :param cancelled: 请求被取消，不调整并发上限
+        :param tokens_used: 实际消耗的token数，传入时替换每分钟token统计中的估算值
+        """
+        if self._released or self.limiter is None:
+            return
+        self._released = True
+        self.limiter._release(self, error, cancelled, latency, tokens_used)
+
+
+class ConcurrencyLimiter:
+    """单个 提供商 + API密钥 的并发限制"""
+
+    def __init__(self, provider: str, label: str):
+        self.provider = provider
+        self.label = label
+
+    def _call(self, backend, method: str, *args):
+        try:
+            return getattr(backend, method)(self.label, *args)
+        except QueueTimeoutError:
+            raise
+        except Exception as e:
+            if backend is _local_backend:
+                raise
+            logger.warning(f"Redis并发限制操作失败，使用进程内限制: {str(e)}")
+            return None
+
+    def _prepare(self, timeout: Optional[float]):
+        params = _provider_params(self.provider)
+        backend = get_backend()
+        ticket = uuid.uuid4().hex
+        deadline = time.time() + (timeout if timeout is not None else params['QUEUE_TIMEOUT'])
+        try:
+            backend.enqueue(self.label, ticket, deadline, params)
+        except Exception as e:
+            if backend is _local_backend:
+                raise
+            logger.warning(f"Redis并发限制不可用，使用进程内限制: {str(e)}")
+            backend = _local_backend
+            backend.enqueue(self.label, ticket, deadline, params)
+        return params, backend, ticket, deadline
+
+    def _timeout(self, backend, ticket: str):
+        backend.leave(self.label, ticket)
+        logger.warning(f"{self.label} 排队超时")
+        return QueueTimeoutError(f"{self.provider} 请求排队超时，请稍后重试")
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        """同步获取名额，排队超过截止时间时抛出QueueTimeoutError"""
+        params, backend, ticket, deadline = self._prepare(timeout)
+        lease_id = uuid.uuid4().hex
+        try:
+            while True:
+                if backend.try_acquire(self.label, ticket, lease_id, tokens, params):
+                    return Lease(self, backend, lease_id, tokens)
+                if time.time() >= deadline:
+                    raise self._timeout(backend, ticket)
+                time.sleep(params['POLL_INTERVAL'])
+        except QueueTimeoutError:
+            raise
+        except BaseException:
+            backend.leave(self.label, ticket)
+            raise
+
+    async def aacquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        """异步获取名额，排队期间不阻塞事件循环"""
+        params, backend, ticket, deadline = await self._run(self._prepare, timeout)
+        lease_id = uuid.uuid4().hex
+        try:
+            while True:
+                if await self._run(backend.try_acquire, self.label, ticket, lease_id, tokens, params, backend=backend):
+                    return Lease(self, backend, lease_id, tokens)
+                if time.time() >= deadline:
+                    raise self._timeout(backend, ticket)
+                await asyncio.sleep(params['POLL_INTERVAL'])
+        except QueueTimeoutError:
+            raise
+        except BaseException:
+            # 等待期间被取消
+            backend.leave(self.label, ticket)
+            raise
+
+    async def _run(self, func, *args, backend=None):
+        if (backend or get_backend()).blocking:
+            return await sync_to_async(func, thread_sensitive=False)(*args)
+        return func(*args)
+
+    def _release(self, lease: Lease, error, cancelled: bool, latency: Optional[float], tokens_used: Optional[int]):
+        params = _provider_params(self.provider)
+        backend = lease.backend
+        self._call(backend, 'release', lease.lease_id, lease.tokens, tokens_used)
+        if cancelled:
+            return
+        if getattr(error, 'status_code', None) == 429:
+            limit = self._call(backend, 'adjust', 'mul', params['DECREASE_FACTOR'], params)
+            logger.warning(f"{self.label} 触发限流(429)，并发上限降至 {limit}")
+        elif error is None:
+            if latency is not None and latency > params['LATENCY_THRESHOLD']:
+                self._call(backend, 'adjust', 'mul', params['LATENCY_DECREASE_FACTOR'], params)
+            else:
+                self._call(backend, 'adjust', 'add', params['INCREASE_STEP'], params)
+
+    def stats(self) -> Dict:
+        return get_backend().stats(self.label, _provider_params(self.provider))
+
+
+class _NoopLimiter:
+    """关闭并发限制时使用"""
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        return Lease(None)
+
+    async def aacquire(self, tokens: int = 0, timeout: Optional[float] = None) -> Lease:
+        return Lease(None)
+
+
+_limiters: Dict[str, ConcurrencyLimiter] = {}
+
+
+def get_limiter(provider: str, api_key: Optional[str] = None):
+    """获取 提供商 + API密钥 的并发限制"""
+    if not get_concurrency_config()['ENABLED']:
+        return _NoopLimiter()
+    label = api_key_label(provider, api_key) if api_key else provider
+    limiter = _limiters.get(label)
+    if limiter is None:
+        limiter = _limiters.setdefault(label, ConcurrencyLimiter(provider, label))
+    return limiter
+
+
+def get_limiter_stats() -> Dict:
+    """各 提供商 + API密钥 的并发上限、进行中请求数、排队数和每分钟token数"""
+    backend = get_backend()
+    stats = {}
+    for label in backend.labels():
+        provider = label.split(':', 1)[0]
+        try:
+            stats[label] = backend.stats(label, _provider_params(provider))
+        except Exception as e:
+            logger.warning(f"读取并发限制统计失败: {str(e)}")
+    return stats
+
+
+def reset_limiters():
+    """清空所有并发限制状态"""
+    _limiters.clear()
+    get_backend().reset()
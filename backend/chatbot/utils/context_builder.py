@@ -0,0 +1,200 @@
+"""
+按token预算组装上下文
+统计系统提示（知识库上下文）、当前消息和历史消息的token数，在模型上下文窗口和配置的历史预算内
+保留尽可能多的最新历史，超出窗口时截断知识库上下文，避免提供商因上下文超长返回400
+安装了tiktoken时按cl100k_base编码计数，否则使用按中英文字符校准的估算；
+其他提供商的分词器与cl100k_base的差异通过TOKEN_RATIOS校准
+消息的token数在保存时计算并写入Message.token_count，构建历史时直接使用
+PROMPT_LAYOUT为prefix_cache时，稳定内容（会话摘要、历史消息）在前、每轮变化的知识库上下文放在当前消息之前，
+相邻两轮请求的消息前缀字节相同，可以命中提供商的提示词前缀缓存
+"""
+import math
+import logging
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+# 上下文组装默认配置，可通过settings.LLM_CONTEXT_CONFIG覆盖
+DEFAULT_CONTEXT_CONFIG = {
+    'ENABLED': True,
+    'ENCODING': 'cl100k_base',        # tiktoken编码
+    'DEFAULT_CONTEXT_WINDOW': 8192,   # 未在CONTEXT_WINDOWS中列出的模型的上下文窗口
+    'CONTEXT_WINDOWS': {
+        'gpt-4o': 128000,
+        'gpt-4o-mini': 128000,
+        'gpt-4-turbo': 128000,
+        'gpt-4': 8192,
+        'gpt-3.5-turbo': 16385,
+        'gemini-1.5-pro': 1000000,
+        'gemini-1.5-flash': 1000000,
+        'gemini-pro': 32768,
+        'deepseek-chat': 64000,
+        'deepseek-coder': 64000,
+        'qwen-max': 32768,
+        'qwen-plus': 131072,
+        'qwen-turbo': 8192,
+        'moonshot-v1-8k': 8192,
+        'moonshot-v1-32k': 32768,
+        'moonshot-v1-128k': 128000,
+    },
+    'MAX_HISTORY_TOKENS': 4000,       # 历史消息的token上限（控制成本和延迟），None表示只受上下文窗口限制
+    'RESERVE_TOKENS': 256,            # 预留给消息格式等开销的token数
+    'TOKEN_RATIOS': {},               # 提供商名称 -> 相对cl100k_base的token数比例
+    'PROMPT_LAYOUT': 'prefix_cache',  # prefix_cache（知识库上下文放在当前消息之前）/ classic（系统提示在最前）
+    'LAYOUT_OVERRIDES': {},           # 提供商名称 -> 布局，例如不接受中间系统消息的提供商使用classic
+}
+
+PROMPT_LAYOUTS = ('classic', 'prefix_cache')
+
+# 每条消息的格式开销（角色、分隔符）
+MESSAGE_OVERHEAD = 4
+# 多模态消息中每张图片按低精度计费估算
+IMAGE_TOKENS = 85
+
+_encoders = {}
+
+
+def get_context_config() -> Dict:
+    """读取上下文组装配置"""
+    config = getattr(settings, 'LLM_CONTEXT_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_CONTEXT_CONFIG.items()}
+
+
+def _get_encoder(name: str):
+    if name not in _encoders:
+        try:
+            _encoders[name] = tiktoken.get_encoding(name)
+        except Exception as e:
+            # 编码文件需要联网下载，失败时使用估算
+            logger.warning(f"加载tiktoken编码{name}失败，使用估算: {str(e)}")
+            _encoders[name] = None
+    return _encoders[name]
+
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (
+        0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0x3000 <= code <= 0x303F
+        or 0xFF00 <= code <= 0xFFEF or 0xAC00 <= code <= 0xD7AF or 0x3040 <= code <= 0x30FF
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算token数：中日韩字符及全角标点约1个token，其他字符约3.5个字符1个token
+    （按cl100k_base对中英文混合文本的统计校准，略偏多以免超出上下文窗口）
+    """
+    cjk = sum(1 for char in text if _is_cjk(char))
+    return cjk + math.ceil((len(text) - cjk) / 3.5)
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """按cl100k_base计算文本的token数，不可用时估算"""
+    if not text:
+        return 0
+    encoder = _get_encoder(get_context_config()['ENCODING']) if TIKTOKEN_AVAILABLE else None
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def _content_tokens(content) -> int:
+    """消息内容的token数，多模态内容按文本和图片分别计算"""
+    if isinstance(content, list):
+        return sum(
+            count_tokens(part.get('text')) if part.get('type') == 'text' else IMAGE_TOKENS
+            for part in content
+        )
+    return count_tokens(content)
+
+
+def _message_tokens(message: Dict) -> int:
+    # 历史消息由build_history附带保存时计算的token数
+    tokens = message.get('tokens')
+    if tokens is None or isinstance(message.get('content'), list):
+        tokens = _content_tokens(message.get('content'))
+    return tokens + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截断文本，使其不超过max_tokens个token"""
+    if max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+    # 二分查找最长的前缀
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def context_window(model: str, config: Optional[Dict] = None) -> int:
+    config = config or get_context_config()
+    return config['CONTEXT_WINDOWS'].get(model, config['DEFAULT_CONTEXT_WINDOW'])
+
+
+def prompt_layout(provider: str) -> str:
+    """提供商使用的消息布局"""
+    config = get_context_config()
+    layout = (config['LAYOUT_OVERRIDES'] or {}).get(provider, config['PROMPT_LAYOUT'])
+    return layout if layout in PROMPT_LAYOUTS else 'classic'
+
+
+def pack_context(history: List[Dict], system_prompt: Optional[str], user_message, provider: str, call_config: Dict):
+    """
+    在token预算内组装上下文
+    :param history: 按时间正序的历史消息，可附带tokens字段（保存时计算的token数），开头可以是会话摘要
+    :param call_config: 调用配置，使用其中的model和max_tokens（为回复预留）
+    :return: (截断后的系统提示, 保留的历史消息)，历史消息只包含role和content
+    """
+    history = history or []
+    config = get_context_config()
+    if not config['ENABLED']:
+        return system_prompt, [{'role': item['role'], 'content': item['content']} for item in history]
+
+    ratio = (config['TOKEN_RATIOS'] or {}).get(provider, 1.0)
+    budget = context_window(call_config.get('model') or '', config) / ratio
+    budget -= call_config.get('max_tokens', 2000) / ratio + config['RESERVE_TOKENS']
+    budget -= _content_tokens(user_message) + MESSAGE_OVERHEAD
+
+    if system_prompt:
+        system_tokens = count_tokens(system_prompt)
+        if system_tokens + MESSAGE_OVERHEAD > budget:
+            logger.warning(f"系统提示超出上下文窗口，截断为{int(budget)}个token")
+            system_prompt = truncate_to_tokens(system_prompt, int(budget) - MESSAGE_OVERHEAD)
+            system_tokens = count_tokens(system_prompt)
+        budget -= system_tokens + MESSAGE_OVERHEAD
+
+    if config['MAX_HISTORY_TOKENS'] is not None:
+        budget = min(budget, config['MAX_HISTORY_TOKENS'] / ratio)
+
+    # 历史开头的系统消息（会话摘要）始终保留
+    pinned = []
+    while history and history[0]['role'] == 'system':
+        pinned.append({'role': 'system', 'content': history[0]['content']})
+        budget -= _message_tokens(history[0])
+        history = history[1:]
+
+    # 从最新的消息开始保留，直到超出预算
+    packed = []
+    for item in reversed(history):
+        tokens = _message_tokens(item)
+        if tokens > budget:
+            break
+        budget -= tokens
+        packed.append({'role': item['role'], 'content': item['content']})
+    packed.reverse()
+    return system_prompt, pinned + packed
@@ -0,0 +1,136 @@
+"""
+会话滚动摘要
+会话中尚未摘要的消息超过token阈值时，由Celery任务用低成本模型把较早的消息合并进会话摘要，
+构建历史时使用 摘要 + 最近的消息，会话再长提示词长度也保持稳定
+"""
+import logging
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .context_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 会话摘要默认配置，可通过settings.CONVERSATION_SUMMARY_CONFIG覆盖
+DEFAULT_SUMMARY_CONFIG = {
+    'ENABLED': True,
+    'TRIGGER_TOKENS': 3000,           # 未摘要消息的token数超过该值时生成摘要
+    'KEEP_RECENT_MESSAGES': 6,        # 保留原文的最近消息条数，不参与摘要
+    'MODEL': 'deepseek-chat',         # 生成摘要使用的模型
+    'MAX_SUMMARY_TOKENS': 500,        # 摘要的最大token数
+    'LOCK_TIMEOUT': 300,              # 同一会话同时只运行一个摘要任务（秒）
+}
+
+SUMMARY_PROMPT = (
+    "请把下面的对话内容合并进已有摘要，生成一段新的摘要。"
+    "保留用户的关键信息、偏好、已确认的结论和未解决的问题，省略寒暄，使用第三人称，不超过{max_chars}字。\n\n"
+    "已有摘要：\n{summary}\n\n对话内容：\n{dialogue}"
+)
+
+
+def get_summary_config() -> Dict:
+    """读取会话摘要配置"""
+    config = getattr(settings, 'CONVERSATION_SUMMARY_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_SUMMARY_CONFIG.items()}
+
+
+def _lock_key(conversation_id: int) -> str:
+    return f"conversation_summary:{conversation_id}:lock"
+
+
+def summary_message(summary: str) -> Dict:
+    """摘要在历史中的表示：放在最近消息之前的系统消息"""
+    return {'role': 'system', 'content': f"以下是之前对话的摘要：\n{summary}"}
+
+
+def needs_summary(records: List[Dict], summary_message_id: Optional[int], config: Optional[Dict] = None) -> bool:
+    """未摘要消息的token数是否超过阈值，迁移0010之前保存的消息没有token数，按内容计算"""
+    config = config or get_summary_config()
+    pending = [record for record in records if record['id'] > (summary_message_id or 0)]
+    if len(pending) <= config['KEEP_RECENT_MESSAGES']:
+        return False
+    tokens = sum(
+        record['token_count'] if record.get('token_count') is not None else count_tokens(record.get('content'))
+        for record in pending
+    )
+    return tokens > config['TRIGGER_TOKENS']
+
+
+def maybe_schedule_summary(message):
+    """
+    助手消息保存后检查是否需要生成摘要，需要时提交Celery任务
+    未摘要消息从历史窗口缓存读取，不额外查询数据库
+    """
+    from . import history_cache
+
+    config = get_summary_config()
+    if not config['ENABLED']:
+        return
+    conversation = message.conversation
+    records = history_cache.get_recent_messages(conversation.id)
+    if not needs_summary(records, conversation.summary_message_id, config):
+        return
+    # 任务执行期间不重复提交，任务结束时释放
+    if not cache.add(_lock_key(conversation.id), 1, config['LOCK_TIMEOUT']):
+        return
+    try:
+        from ..tasks import summarize_conversation
+        # 消息队列不可用时不重试，避免阻塞请求
+        summarize_conversation.apply_async(args=[conversation.id], retry=False)
+    except Exception as e:
+        cache.delete(_lock_key(conversation.id))
+        logger.warning(f"提交会话摘要任务失败: {str(e)}")
+
+
+def _dialogue(messages) -> str:
+    names = {'user': '用户', 'assistant': '助手'}
+    return '\n'.join(f"{names.get(message.role, message.role)}：{message.content}" for message in messages)
+
+
+def summarize_conversation(conversation_id: int) -> bool:
+    """
+    把较早的未摘要消息合并进会话摘要
+    :return: 是否更新了摘要
+    """
+    from ..models import Conversation, Message
+    from .failover import complete_with_failover
+
+    config = get_summary_config()
+    try:
+        conversation = Conversation.objects.select_related('user').get(id=conversation_id)
+        pending = list(
+            Message.objects.filter(conversation=conversation, id__gt=conversation.summary_message_id or 0)
+            .order_by('created_at', 'id')
+        )
+        older = pending[:-config['KEEP_RECENT_MESSAGES']] if config['KEEP_RECENT_MESSAGES'] else pending
+        if not older:
+            return False
+
+        prompt = SUMMARY_PROMPT.format(
+            max_chars=config['MAX_SUMMARY_TOKENS'],
+            summary=conversation.summary or '无',
+            dialogue=_dialogue(older),
+        )
+        result = complete_with_failover(config['MODEL'], prompt, {
+            'model': config['MODEL'],
+            'temperature': 0.3,
+            'max_tokens': config['MAX_SUMMARY_TOKENS'],
+            'timeout': 60,
+        }, conversation.user)
+        summary = (result.get('content') or '').strip()
+        if not summary:
+            return False
+
+        # 只在摘要进度未被其他任务更新时写入
+        updated = Conversation.objects.filter(
+            id=conversation.id, summary_message_id=conversation.summary_message_id
+        ).update(summary=summary, summary_message_id=older[-1].id)
+        if updated:
+            logger.info(f"会话{conversation.id}已摘要至消息{older[-1].id}")
+        return bool(updated)
+    except Conversation.DoesNotExist:
+        return False
+    finally:
+        cache.delete(_lock_key(conversation_id))
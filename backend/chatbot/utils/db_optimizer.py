@@ -6,6 +6,7 @@ from django.db.models import Prefetch, Count, Q
 from django.core.paginator import Paginator
 from chatbot.models import Conversation, Message, UserProfile, PasswordResetToken, VoiceCallRecord
 from django.contrib.auth.models import User
+from chatbot.utils.context_builder import count_tokens
 import logging
 
 logger = logging.getLogger(__name__)
@@ -82,10 +83,17 @@ def bulk_create_messages(messages_data):
             is_read=data.get('is_read', False),
             audio_file=data.get('audio_file'),
             audio_duration=data.get('audio_duration'),
-            transcription_confidence=data.get('transcription_confidence')
+            transcription_confidence=data.get('transcription_confidence'),
+            # bulk_create不调用save()，需要在这里计算token数
+            token_count=count_tokens(data['content'])
         ))
     
-    return Message.objects.bulk_create(messages)
+    created = Message.objects.bulk_create(messages)
+    # bulk_create不触发post_save信号，需要手动清除涉及会话的历史窗口
+    from .history_cache import invalidate
+    for conversation_id in {message.conversation_id for message in messages}:
+        invalidate(conversation_id)
+    return created
 
 
 def get_statistics_for_dashboard():
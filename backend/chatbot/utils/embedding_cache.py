@@ -0,0 +1,222 @@
+"""
+知识库块向量的持久化缓存
+按(模型名, 块内容哈希)缓存向量，计算向量前先查缓存，内容未变的块在update_document和每次同步时不再重新计算。
+每个模型对应两个文件：内存映射的float32矩阵（{模型}.f32，每行一个向量）和索引文件（{模型}.index.json，
+按最近使用顺序记录哈希对应的行号），超过MAX_ENTRIES时淘汰最久未使用的条目并复用其行。
+Web进程和Celery worker可能同时写入，修改索引时持有文件锁（fcntl），其他进程保存过索引时先重新加载
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows下不加跨进程锁
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 向量缓存默认配置，可通过settings.KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG覆盖
+DEFAULT_EMBEDDING_CACHE_CONFIG = {
+    'ENABLED': True,
+    'PATH': None,                     # 缓存目录，默认为BASE_DIR/embedding_cache
+    'MAX_ENTRIES': 200000,            # 每个模型最多缓存的向量数
+}
+
+INITIAL_CAPACITY = 1024
+
+_caches: Dict[tuple, 'EmbeddingCache'] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache_config() -> Dict:
+    """读取向量缓存配置"""
+    config = getattr(settings, 'KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG', {}) or {}
+    config = {key: config.get(key, default) for key, default in DEFAULT_EMBEDDING_CACHE_CONFIG.items()}
+    if not config['PATH']:
+        config['PATH'] = os.path.join(settings.BASE_DIR, 'embedding_cache')
+    return config
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """单个模型的向量缓存"""
+
+    def __init__(self, path: str, model_name: str, max_entries: int):
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in model_name)
+        self.matrix_path = os.path.join(path, f"{safe_name}.f32")
+        self.index_path = os.path.join(path, f"{safe_name}.index.json")
+        self.lock_path = os.path.join(path, f"{safe_name}.lock")
+        self.dim = None
+        self.capacity = 0
+        self.entries: 'OrderedDict[str, int]' = OrderedDict()
+        self.matrix = None
+        self._index_mtime = None
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """进程内线程锁 + 跨进程文件锁，持有期间索引与磁盘一致"""
+        with self._lock:
+            if fcntl is None:
+                self._reload_if_changed()
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._reload_if_changed()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.dim, self.capacity = index['dim'], index['capacity']
+            self.entries = OrderedDict((key, slot) for key, slot in index['entries'])
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+        except Exception as e:
+            # 索引损坏时从空缓存开始
+            logger.warning(f"向量缓存索引加载失败，已重置: {e}")
+            self.dim, self.capacity, self.entries, self.matrix = None, 0, OrderedDict(), None
+        self._index_mtime = mtime
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'model': self.model_name,
+                'dim': self.dim,
+                'capacity': self.capacity,
+                'entries': list(self.entries.items()),
+            }, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def _ensure_capacity(self, size: int):
+        """按需扩大矩阵文件，容量翻倍直到MAX_ENTRIES"""
+        if size <= self.capacity:
+            return
+        capacity = max(self.capacity, INITIAL_CAPACITY)
+        while capacity < size:
+            capacity *= 2
+        capacity = min(capacity, self.max_entries)
+        if self.matrix is not None:
+            self.matrix.flush()
+        with open(self.matrix_path, 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """查询向量，未命中的位置为None"""
+        with self._locked():
+            results = []
+            for key in keys:
+                slot = self.entries.get(key)
+                if slot is None:
+                    results.append(None)
+                    continue
+                self.entries.move_to_end(key)
+                results.append(self.matrix[slot].tolist())
+            hits = sum(1 for result in results if result is not None)
+            self.stats['hits'] += hits
+            self.stats['misses'] += len(keys) - hits
+            return results
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """写入向量，超出容量时淘汰最久未使用的条目"""
+        if not keys:
+            return
+        with self._locked():
+            if self.dim is None:
+                self.dim = len(vectors[0])
+            elif len(vectors[0]) != self.dim:
+                raise Exception(f"向量维度{len(vectors[0])}与缓存的维度{self.dim}不一致")
+            self._ensure_capacity(min(len(self.entries) + len(keys), self.max_entries))
+
+            for key, vector in zip(keys, vectors):
+                slot = self.entries.get(key)
+                if slot is None:
+                    if len(self.entries) < self.capacity:
+                        slot = len(self.entries)
+                    else:
+                        _, slot = self.entries.popitem(last=False)
+                        self.stats['evictions'] += 1
+                self.entries[key] = slot
+                self.entries.move_to_end(key)
+                self.matrix[slot] = vector
+            self.matrix.flush()
+            self._save_index()
+
+
+def get_embedding_cache(model_name: str) -> Optional[EmbeddingCache]:
+    """获取模型对应的向量缓存，未启用时返回None"""
+    config = get_embedding_cache_config()
+    if not config['ENABLED']:
+        return None
+    key = (config['PATH'], model_name, config['MAX_ENTRIES'])
+    with _caches_lock:
+        if key not in _caches:
+            try:
+                _caches[key] = EmbeddingCache(config['PATH'], model_name, config['MAX_ENTRIES'])
+            except Exception as e:
+                logger.warning(f"向量缓存不可用: {e}")
+                return None
+        return _caches[key]
+
+
+def encode_with_cache(model_name: str, texts: List[str], encode) -> List[List[float]]:
+    """
+    先查缓存，只对未缓存的块调用encode，结果写回缓存
+    :param encode: 接收文本列表、返回向量列表的函数
+    """
+    embedding_cache = get_embedding_cache(model_name)
+    if embedding_cache is None:
+        return encode(texts)
+
+    keys = [content_hash(text) for text in texts]
+    try:
+        vectors = embedding_cache.get_many(keys)
+    except Exception as e:
+        logger.warning(f"读取向量缓存失败: {e}")
+        return encode(texts)
+
+    # 同一批中内容相同的块只计算一次
+    missing = {}
+    for text, key, vector in zip(texts, keys, vectors):
+        if vector is None and key not in missing:
+            missing[key] = text
+    if missing:
+        encoded = encode(list(missing.values()))
+        computed = dict(zip(missing.keys(), encoded))
+        vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        try:
+            embedding_cache.put_many(list(computed.keys()), list(computed.values()))
+        except Exception as e:
+            logger.warning(f"写入向量缓存失败: {e}")
+    return vectors
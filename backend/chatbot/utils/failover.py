@@ -0,0 +1,279 @@
+"""
+大模型故障转移与对冲请求
+按备用链依次尝试模型：请求失败立即切换到下一个模型；
+启用对冲时，主请求超过历史延迟的百分位仍未返回，则向下一个模型再发一次请求，先成功者胜出，其余请求被取消。
+流式请求只在收到第一个token之前切换（连接失败、熔断中、排队超时等），已输出内容后的错误直接抛出，不做对冲
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .circuit_breaker import get_health, OPEN
+logger = logging.getLogger(__name__)
+
+# 故障转移默认配置，可通过settings.LLM_FAILOVER_CONFIG覆盖
+DEFAULT_FAILOVER_CONFIG = {
+    'CHAINS': {},
+    'HEDGE_ENABLED': False,
+    'HEDGE_PERCENTILE': 95,
+    'HEDGE_DEFAULT_DELAY': 3.0,
+    'HEDGE_MIN_DELAY': 0.5,
+    'LATENCY_WINDOW': 200,
+    'LATENCY_MIN_SAMPLES': 20,
+}
+
+
+def get_failover_config() -> Dict:
+    """读取故障转移配置"""
+    config = getattr(settings, 'LLM_FAILOVER_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_FAILOVER_CONFIG.items()}
+
+
+class LatencyTracker:
+    """按模型记录最近的成功请求延迟，用于计算对冲等待时间"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(deque)
+
+    def record(self, model: str, latency: float, window: int):
+        with self._lock:
+            samples = self._samples[model]
+            samples.append(latency)
+            while len(samples) > window:
+                samples.popleft()
+
+    def percentile(self, model: str, pct: float, min_samples: int) -> Optional[float]:
+        """计算延迟百分位，样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+        return samples[index]
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+latency_tracker = LatencyTracker()
+
+
+def get_fallback_chain(model: str) -> List[str]:
+    """
+    获取模型的备用链（不含模型本身）
+    先按模型ID查找，再按模型在目录中的分组查找
+    """
+    from ..provider_registry import provider_registry
+
+    chains = get_failover_config()['CHAINS']
+    chain = chains.get(model)
+    if chain is None:
+        chain = chains.get(provider_registry.group_for(model), [])
+    return [candidate for candidate in chain if candidate != model]
+
+
+def _build_candidates(model: str, config: Dict, user=None) -> List[Dict]:
+    """构建候选列表，跳过未配置API密钥或熔断中的备用模型"""
+    from ..provider_registry import provider_registry
+
+    candidates = []
+    for index, candidate in enumerate([model] + get_fallback_chain(model)):
+        api_instance, api_key = provider_registry.resolve(candidate, user)
+        # 主模型使用调用方传入的密钥
+        if index == 0:
+            api_key = config.get('api_key') or api_key
+        elif not api_key:
+            continue
+        elif get_health(api_instance.name, api_key)['state'] == OPEN:
+            # 熔断中的备用模型直接跳过；主模型保留，请求时立即失败并切换
+            continue
+        candidates.append({
+            'model': candidate,
+            'api_instance': api_instance,
+            'config': dict(config, model=candidate, api_key=api_key),
+        })
+    return candidates
+
+
+def _hedge_delay(model: str, failover_config: Dict) -> float:
+    """对冲等待时间：模型历史延迟的百分位，样本不足时使用默认值"""
+    delay = latency_tracker.percentile(
+        model, failover_config['HEDGE_PERCENTILE'], failover_config['LATENCY_MIN_SAMPLES']
+    )
+    if delay is None:
+        delay = failover_config['HEDGE_DEFAULT_DELAY']
+    return max(delay, failover_config['HEDGE_MIN_DELAY'])
+
+
+async def _attempt(candidate: Dict, message, window: int) -> Dict:
+    """请求单个候选模型并记录延迟"""
+    start = time.monotonic()
+    result = await candidate['api_instance'].send_message_async(message, candidate['config'])
+    latency_tracker.record(candidate['model'], time.monotonic() - start, window)
+    return result
+
+
+async def _run_candidates(model: str, candidates: List[Dict], message) -> Dict:
+    """依次/对冲请求候选模型，返回第一个成功的结果"""
+    failover_config = get_failover_config()
+    hedge_enabled = failover_config['HEDGE_ENABLED']
+
+    pending = {}
+    errors = []
+    next_index = 0
+    hedged = False
+
+    def launch():
+        nonlocal next_index
+        candidate = candidates[next_index]
+        next_index += 1
+        task = asyncio.ensure_future(_attempt(candidate, message, failover_config['LATENCY_WINDOW']))
+        pending[task] = candidate
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if hedge_enabled and next_index < len(candidates):
+                timeout = _hedge_delay(candidates[next_index - 1]['model'], failover_config)
+
+            done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 超过延迟阈值仍未返回，向下一个模型发起对冲请求
+                logger.info(f"{candidates[next_index - 1]['model']} 响应过慢，对冲请求 {candidates[next_index]['model']}")
+                hedged = True
+                launch()
+                continue
+
+            for task in done:
+                candidate = pending.pop(task)
+                if task.exception() is None:
+                    result = dict(task.result())
+                    result.update({
+                        'model': candidate['model'], 'provider': candidate['api_instance'].name,
+                        'hedged': hedged, 'attempts': next_index,
+                    })
+                    if candidate['model'] != model:
+                        logger.warning(f"{model} 不可用，已由 {candidate['model']} 完成请求")
+                    return result
+                errors.append(f"{candidate['model']}: {task.exception()}")
+                logger.warning(f"{candidate['model']} 请求失败: {task.exception()}")
+
+            # 请求失败时立即切换到下一个模型
+            if next_index < len(candidates) and (not pending or not hedge_enabled):
+                launch()
+
+        raise Exception(f"所有模型均请求失败：{'；'.join(errors)}")
+    finally:
+        # 取消未完成的请求，httpx会关闭对应的连接
+        for task in pending:
+            task.cancel()
+
+
+async def acomplete_with_failover(model: str, message, config: Dict, user=None) -> Dict:
+    """
+    带故障转移和对冲的异步调用
+    :return: 提供商返回的结果，附加实际使用的模型(model)、提供商(provider)、是否发生对冲(hedged)和尝试次数(attempts)
+    """
+    # 解析API密钥可能读取用户配置（数据库），在线程中执行
+    candidates = await sync_to_async(_build_candidates)(model, config, user)
+    return await _run_candidates(model, candidates, message)
+
+
+# 同步调用方使用的后台事件循环，异步客户端在该循环中长期复用
+_loop = None
+_loop_lock = threading.Lock()
+_loop_pid = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name='llm-failover-loop', daemon=True).start()
+        return _loop
+
+
+def run_in_loop(coro):
+    """在后台事件循环中执行协程并等待结果，供同步调用方批量发起异步请求"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def complete_with_failover(model: str, message, config: Dict, user=None) -> Dict:
+    """
+    带故障转移和对冲的同步调用
+    没有可用的备用模型时直接同步调用，否则在后台事件循环中执行以便取消落后的请求
+    """
+    candidates = _build_candidates(model, config, user)
+    if len(candidates) == 1:
+        candidate = candidates[0]
+        start = time.monotonic()
+        result = dict(candidate['api_instance'].send_message(message, candidate['config']))
+        latency_tracker.record(model, time.monotonic() - start, get_failover_config()['LATENCY_WINDOW'])
+        result.update({'model': model, 'provider': candidate['api_instance'].name, 'hedged': False, 'attempts': 1})
+        return result
+
+    return run_in_loop(_run_candidates(model, candidates, message))
+
+
+def _report_candidate(config: Dict, candidate: Dict, attempts: int):
+    """把实际请求的模型、提供商和尝试次数写入config['call_info']，流式调用方以此保存用量"""
+    if isinstance(config.get('call_info'), dict):
+        config['call_info'].update(
+            model=candidate['model'], provider=candidate['api_instance'].name, attempts=attempts
+        )
+
+
+def stream_with_failover(model: str, message, config: Dict, user=None) -> Iterator[str]:
+    """
+    带故障转移的同步流式调用，收到第一个token之前失败时切换到下一个模型，最后一个模型的错误直接抛出
+    关闭返回的生成器时关闭上游HTTP流
+    """
+    candidates = _build_candidates(model, config, user)
+    for index, candidate in enumerate(candidates):
+        _report_candidate(config, candidate, index + 1)
+        upstream = candidate['api_instance'].stream_message(message, candidate['config'])
+        started = False
+        try:
+            for content in upstream:
+                started = True
+                yield content
+            return
+        except Exception as e:
+            if started or index == len(candidates) - 1:
+                raise
+            logger.warning(f"{candidate['model']} 流式请求失败，切换到 {candidates[index + 1]['model']}: {e}")
+        finally:
+            upstream.close()
+
+
+async def astream_with_failover(model: str, message, config: Dict, user=None) -> AsyncIterator[str]:
+    """带故障转移的异步流式调用，行为同stream_with_failover"""
+    # 解析API密钥可能读取用户配置（数据库），在线程中执行
+    candidates = await sync_to_async(_build_candidates)(model, config, user)
+    for index, candidate in enumerate(candidates):
+        _report_candidate(config, candidate, index + 1)
+        upstream = candidate['api_instance'].stream_message_async(message, candidate['config'])
+        started = False
+        try:
+            async for content in upstream:
+                started = True
+                yield content
+            return
+        except Exception as e:
+            if started or index == len(candidates) - 1:
+                raise
+            logger.warning(f"{candidate['model']} 流式请求失败，切换到 {candidates[index + 1]['model']}: {e}")
+        finally:
+            await upstream.aclose()
@@ -0,0 +1,114 @@
+"""
+生成任务取消控制
+按 用户 + request_id 登记进行中的生成；取消标记写入缓存，其他进程/实例上的取消请求也能生效
+同一进程内的取消通过事件立即生效，跨进程的取消按固定间隔轮询缓存
+"""
+import time
+import uuid
+import logging
+import threading
+from typing import Dict, Optional
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# 轮询缓存中取消标记的最小间隔（秒），避免每个token都访问一次缓存
+CANCEL_POLL_INTERVAL = 0.5
+# 登记信息的过期时间（秒），进程异常退出时自动清理
+GENERATION_TTL = 60 * 60
+
+_local_generations: Dict[str, 'GenerationHandle'] = {}
+_local_lock = threading.Lock()
+
+
+def _active_key(user_id, request_id) -> str:
+    return f"generation:active:{user_id}:{request_id}"
+
+
+def _cancel_key(user_id, request_id) -> str:
+    return f"generation:cancel:{user_id}:{request_id}"
+
+
+def new_request_id() -> str:
+    """生成新的请求ID"""
+    return uuid.uuid4().hex
+
+
+class GenerationHandle:
+    """一次进行中的生成"""
+
+    def __init__(self, user_id, request_id: str):
+        self.user_id = user_id
+        self.request_id = request_id
+        self._event = threading.Event()
+        self._last_poll = time.monotonic()
+
+    @property
+    def local_key(self) -> str:
+        return f"{self.user_id}:{self.request_id}"
+
+    def cancel(self):
+        """在本进程内立即标记为已取消"""
+        self._event.set()
+
+    def _should_poll(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_poll < CANCEL_POLL_INTERVAL:
+            return False
+        self._last_poll = now
+        return True
+
+    def cancelled(self) -> bool:
+        """是否已被取消（同步调用）"""
+        if not self._event.is_set() and self._should_poll():
+            if cache.get(_cancel_key(self.user_id, self.request_id)):
+                self._event.set()
+        return self._event.is_set()
+
+    async def acancelled(self) -> bool:
+        """是否已被取消（异步调用，不阻塞事件循环）"""
+        if not self._event.is_set() and self._should_poll():
+            if await cache.aget(_cancel_key(self.user_id, self.request_id)):
+                self._event.set()
+        return self._event.is_set()
+
+    def close(self):
+        """生成结束后注销"""
+        with _local_lock:
+            if _local_generations.get(self.local_key) is self:
+                del _local_generations[self.local_key]
+        cache.delete_many([
+            _active_key(self.user_id, self.request_id),
+            _cancel_key(self.user_id, self.request_id),
+        ])
+
+
+def start_generation(user_id, request_id: Optional[str] = None) -> GenerationHandle:
+    """
+    登记一次生成
+    :param request_id: 客户端提供的请求ID，为空时自动生成
+    """
+    handle = GenerationHandle(user_id, request_id or new_request_id())
+    with _local_lock:
+        _local_generations[handle.local_key] = handle
+    cache.set(_active_key(user_id, handle.request_id), 1, GENERATION_TTL)
+    return handle
+
+
+def cancel_generation(user_id, request_id: str) -> bool:
+    """
+    取消指定的生成
+    :return: 生成是否存在
+    """
+    with _local_lock:
+        handle = _local_generations.get(f"{user_id}:{request_id}")
+    if handle is not None:
+        handle.cancel()
+
+    if cache.get(_active_key(user_id, request_id)):
+        # 其他进程中的生成通过缓存标记取消
+        cache.set(_cancel_key(user_id, request_id), 1, GENERATION_TTL)
+        logger.info(f"用户 {user_id} 取消生成 {request_id}")
+        return True
+    return handle is not None
@@ -0,0 +1,241 @@
+"""
+会话历史窗口缓存
+每个会话缓存最近的若干条消息，新消息的事务提交后追加到窗口末尾，构建历史时按O(K)读取最近K条，
+不再每轮读取整个会话；消息被修改或删除时清除该会话的窗口，下次读取时从数据库重新加载。
+窗口只在不存在时写入，写入后再确认数据库中的最新消息，加载期间保存的消息不会被漏掉
+默认缓存为Redis时使用Redis列表（多个进程共享），否则使用进程内窗口
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 历史窗口缓存默认配置，可通过settings.CHAT_HISTORY_CACHE_CONFIG覆盖
+DEFAULT_HISTORY_CACHE_CONFIG = {
+    'ENABLED': True,
+    'BACKEND': 'auto',                # auto（默认缓存为Redis时使用Redis）/ redis / local
+    'WINDOW': 50,                     # 每个会话缓存的消息条数
+    'TTL': 60 * 60 * 24,              # Redis窗口的有效期（秒），每次写入时续期
+    'MAX_CONVERSATIONS': 1000,        # 进程内最多缓存的会话数，超过时淘汰最久未使用的会话
+}
+
+KEY_PREFIX = 'chat_history'
+
+
+def get_history_cache_config() -> Dict:
+    """读取历史窗口缓存配置"""
+    config = getattr(settings, 'CHAT_HISTORY_CACHE_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_HISTORY_CACHE_CONFIG.items()}
+
+
+def message_record(message) -> Dict:
+    """缓存中保存的消息字段"""
+    return {
+        'id': message.id,
+        'role': message.role,
+        'content': message.content,
+        'image_url': message.image_url,
+        'token_count': message.token_count,
+    }
+
+
+def _load_from_db(conversation_id: int, limit: int) -> List[Dict]:
+    """从数据库读取最近limit条消息，按时间正序返回"""
+    from ..models import Message
+
+    messages = Message.objects.filter(conversation_id=conversation_id).order_by('-created_at', '-id')[:limit]
+    return [message_record(message) for message in reversed(list(messages))]
+
+
+def _latest_message_id(conversation_id: int) -> Optional[int]:
+    """数据库中会话最新一条消息的ID"""
+    from ..models import Message
+
+    return Message.objects.filter(conversation_id=conversation_id).order_by('-created_at', '-id').values_list(
+        'id', flat=True).first()
+
+
+class LocalHistoryBackend:
+    """进程内窗口，按会话LRU淘汰"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows: OrderedDict = OrderedDict()
+
+    def get(self, conversation_id: int) -> Optional[List[Dict]]:
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is None:
+                return None
+            self._windows.move_to_end(conversation_id)
+            return list(window)
+
+    def fill(self, conversation_id: int, records: List[Dict], config: Dict):
+        # 其他线程已加载的窗口可能已经追加了新消息，不覆盖
+        with self._lock:
+            if conversation_id in self._windows:
+                return
+            self._windows[conversation_id] = deque(records, maxlen=config['WINDOW'])
+            self._windows.move_to_end(conversation_id)
+            while len(self._windows) > config['MAX_CONVERSATIONS']:
+                self._windows.popitem(last=False)
+
+    def append(self, conversation_id: int, record: Dict, config: Dict):
+        # 窗口不存在时不创建，下次读取时从数据库加载完整窗口；加载时已包含的消息不重复追加
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is not None and (not window or window[-1]['id'] < record['id']):
+                window.append(record)
+
+    def invalidate(self, conversation_id: int):
+        with self._lock:
+            self._windows.pop(conversation_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+# 窗口不存在时才写入，其他进程已加载（并可能已追加）的窗口不被旧快照覆盖
+_FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# 只在窗口已存在、且最后一条消息早于新消息时追加
+_APPEND_SCRIPT = """
+local last = redis.call('LINDEX', KEYS[1], -1)
+if not last or cjson.decode(last)['id'] >= tonumber(ARGV[2]) then return 0 end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[3]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class RedisHistoryBackend:
+    """Redis列表窗口，多个进程共享"""
+
+    def __init__(self, client):
+        self.client = client
+        self._fill = client.register_script(_FILL_SCRIPT)
+        self._append = client.register_script(_APPEND_SCRIPT)
+
+    @staticmethod
+    def _key(conversation_id: int) -> str:
+        return f"{KEY_PREFIX}:{conversation_id}"
+
+    def get(self, conversation_id: int) -> Optional[List[Dict]]:
+        key = self._key(conversation_id)
+        pipe = self.client.pipeline()
+        pipe.exists(key)
+        pipe.lrange(key, 0, -1)
+        exists, items = pipe.execute()
+        if not exists:
+            return None
+        return [json.loads(item) for item in items]
+
+    def fill(self, conversation_id: int, records: List[Dict], config: Dict):
+        if records:
+            self._fill(keys=[self._key(conversation_id)],
+                       args=[config['TTL']] + [json.dumps(record, ensure_ascii=False) for record in records])
+
+    def append(self, conversation_id: int, record: Dict, config: Dict):
+        self._append(keys=[self._key(conversation_id)],
+                     args=[json.dumps(record, ensure_ascii=False), record['id'], config['WINDOW'], config['TTL']])
+
+    def invalidate(self, conversation_id: int):
+        self.client.delete(self._key(conversation_id))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{KEY_PREFIX}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+_local_backend = LocalHistoryBackend()
+_redis_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """按配置选择Redis或进程内窗口，Redis不可用时回退到进程内窗口"""
+    global _redis_backend
+    backend = get_history_cache_config()['BACKEND']
+    if backend == 'local':
+        return _local_backend
+    if backend == 'auto' and not settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        return _local_backend
+    if _redis_backend is None:
+        with _backend_lock:
+            if _redis_backend is None:
+                try:
+                    from django_redis import get_redis_connection
+                    _redis_backend = RedisHistoryBackend(get_redis_connection('default'))
+                except Exception as e:
+                    logger.warning(f"Redis历史窗口缓存不可用，使用进程内缓存: {str(e)}")
+                    return _local_backend
+    return _redis_backend
+
+
+def get_recent_messages(conversation_id: int, limit: Optional[int] = None) -> List[Dict]:
+    """
+    获取会话最近的消息记录（按时间正序）
+    :param limit: 返回的条数，默认为窗口大小；超过窗口大小时直接读取数据库
+    """
+    config = get_history_cache_config()
+    limit = limit or config['WINDOW']
+    if not config['ENABLED'] or limit > config['WINDOW']:
+        return _load_from_db(conversation_id, limit)
+
+    backend = get_backend()
+    try:
+        records = backend.get(conversation_id)
+    except Exception as e:
+        logger.warning(f"读取历史窗口缓存失败: {str(e)}")
+        return _load_from_db(conversation_id, limit)
+
+    if records is None:
+        records = _load_from_db(conversation_id, config['WINDOW'])
+        try:
+            backend.fill(conversation_id, records, config)
+            # 读取数据库之后、写入窗口之前提交的消息追加时窗口还不存在，追加会被跳过；
+            # 写入后数据库中的最新消息与快照不一致时清除窗口，返回重新读取的记录
+            if _latest_message_id(conversation_id) != (records[-1]['id'] if records else None):
+                backend.invalidate(conversation_id)
+                records = _load_from_db(conversation_id, config['WINDOW'])
+        except Exception as e:
+            logger.warning(f"写入历史窗口缓存失败: {str(e)}")
+    return records[-limit:]
+
+
+def append_message(message):
+    """新消息的事务提交后追加到会话窗口"""
+    config = get_history_cache_config()
+    if not config['ENABLED']:
+        return
+    try:
+        get_backend().append(message.conversation_id, message_record(message), config)
+    except Exception as e:
+        logger.warning(f"追加历史窗口缓存失败: {str(e)}")
+        invalidate(message.conversation_id)
+
+
+def invalidate(conversation_id: int):
+    """消息被修改或删除时清除会话窗口"""
+    try:
+        get_backend().invalidate(conversation_id)
+    except Exception as e:
+        logger.warning(f"清除历史窗口缓存失败: {str(e)}")
+
+
+def clear_history_cache():
+    """清空所有会话窗口"""
+    get_backend().clear()
@@ -0,0 +1,175 @@
+"""
+大模型HTTP连接池管理
+每个进程、每个提供商复用一个长连接Session，避免每次调用都重新进行TCP + TLS握手
+异步客户端按事件循环分别缓存，供ASGI视图和Channels消费者使用
+"""
+import os
+import asyncio
+import threading
+import logging
+import weakref
+from typing import Dict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 连接池默认配置，可通过settings.LLM_CONFIG覆盖
+DEFAULT_POOL_CONFIG = {
+    'HTTP_POOL_CONNECTIONS': 4,       # 每个Session缓存的主机连接池数量
+    'HTTP_POOL_MAXSIZE': 20,          # 每个主机连接池的最大连接数
+    'HTTP_POOL_BLOCK': False,         # 连接池满时是否阻塞等待
+    'HTTP_MAX_RETRIES': 2,            # 连接失败（及GET请求网关错误）的重试次数
+    'HTTP_RETRY_BACKOFF': 0.3,        # 重试退避系数（秒）
+}
+
+# GET请求在网关类错误时重试；生成请求（POST）可能已送达上游，只在连接失败时重试，避免重复生成
+RETRY_STATUS_CODES = (502, 503, 504)
+RETRY_STATUS_METHODS = frozenset(['GET'])
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = os.getpid()
+
+# 事件循环 -> {提供商: AsyncClient}，事件循环关闭后自动回收
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_pool_config() -> Dict:
+    """读取连接池配置"""
+    llm_config = getattr(settings, 'LLM_CONFIG', {}) or {}
+    return {key: llm_config.get(key, default) for key, default in DEFAULT_POOL_CONFIG.items()}
+
+
+def _create_session() -> requests.Session:
+    """创建带连接池和重试策略的Session"""
+    config = get_pool_config()
+
+    # 连接失败时请求尚未发出，任何方法都可以重试；读取错误和状态码重试只对allowed_methods中的方法生效
+    retry = Retry(
+        total=config['HTTP_MAX_RETRIES'],
+        connect=config['HTTP_MAX_RETRIES'],
+        read=0,
+        other=0,
+        status=config['HTTP_MAX_RETRIES'],
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=RETRY_STATUS_METHODS,
+        backoff_factor=config['HTTP_RETRY_BACKOFF'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config['HTTP_POOL_CONNECTIONS'],
+        pool_maxsize=config['HTTP_POOL_MAXSIZE'],
+        pool_block=config['HTTP_POOL_BLOCK'],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _reset_after_fork():
+    """进程fork后丢弃从父进程继承的连接"""
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _sessions_pid = os.getpid()
+
+
+def get_session(provider: str) -> requests.Session:
+    """
+    获取指定提供商的共享Session
+    :param provider: 提供商名称，例如 "OpenAI"、"DeepSeek"
+    """
+    with _sessions_lock:
+        _reset_after_fork()
+        session = _sessions.get(provider)
+        if session is None:
+            session = _create_session()
+            _sessions[provider] = session
+            logger.info(f"为 {provider} 创建HTTP连接池")
+        return session
+
+
+def _create_async_client() -> httpx.AsyncClient:
+    """创建带连接池限制的异步客户端"""
+    config = get_pool_config()
+
+    limits = httpx.Limits(
+        max_connections=config['HTTP_POOL_CONNECTIONS'] * config['HTTP_POOL_MAXSIZE'],
+        max_keepalive_connections=config['HTTP_POOL_MAXSIZE'],
+    )
+    # httpx的传输层重试只针对连接失败，不会重复发送已送达的请求
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=config['HTTP_MAX_RETRIES'])
+    return httpx.AsyncClient(transport=transport)
+
+
+def get_async_client(provider: str) -> httpx.AsyncClient:
+    """
+    获取当前事件循环中指定提供商的共享异步客户端
+    httpx.AsyncClient绑定事件循环，因此按循环分别缓存
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = {}
+        _async_clients[loop] = clients
+
+    client = clients.get(provider)
+    if client is None or client.is_closed:
+        client = _create_async_client()
+        clients[provider] = client
+        logger.info(f"为 {provider} 创建异步HTTP连接池")
+    return client
+
+
+async def close_async_clients():
+    """关闭当前事件循环中的所有异步客户端"""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
+
+
+def close_sessions():
+    """关闭所有Session并释放连接"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_pool_stats() -> Dict[str, Dict]:
+    """
+    获取连接池命中统计
+    hits为复用已有连接的请求数，misses为新建连接数
+    """
+    stats = {}
+    with _sessions_lock:
+        _reset_after_fork()
+        for provider, session in _sessions.items():
+            requests_count = 0
+            connections_count = 0
+            hosts = 0
+            for adapter in set(session.adapters.values()):
+                for pool_key in list(adapter.poolmanager.pools.keys()):
+                    pool = adapter.poolmanager.pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    hosts += 1
+                    requests_count += pool.num_requests
+                    connections_count += pool.num_connections
+            hits = max(requests_count - connections_count, 0)
+            stats[provider] = {
+                'requests': requests_count,
+                'hits': hits,
+                'misses': connections_count,
+                'hit_rate': round(hits / requests_count, 4) if requests_count else 0.0,
+                'hosts': hosts,
+            }
+    return stats
@@ -2,12 +2,14 @@
 实时知识库管理系统
 """
 import os
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterable, Optional, Tuple
 from django.core.cache import cache
 from django.conf import settings
 from django.utils import timezone
 import logging
+import threading
 import uuid
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +18,84 @@ CHROMADB_AVAILABLE = False
 try:
     import chromadb
     from chromadb.config import Settings
-    from sentence_transformers import SentenceTransformer
     CHROMADB_AVAILABLE = True
 except ImportError:
     logger.warning("ChromaDB not available. Knowledge base functionality will be limited.")
 
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+_embedding_model = None
+_embedding_model_loaded = False
+_embedding_model_lock = threading.Lock()
+
+
+def get_embedding_model():
+    """
+    获取进程内共享的句向量模型，知识库和语义缓存共用同一个实例
+    未安装sentence-transformers或加载失败时返回None，且不再重复尝试加载
+    """
+    global _embedding_model, _embedding_model_loaded
+    if _embedding_model_loaded:
+        return _embedding_model
+    with _embedding_model_lock:
+        if not _embedding_model_loaded:
+            try:
+                from sentence_transformers import SentenceTransformer
+                import socket
+                socket.setdefaulttimeout(10)  # 设置10秒超时
+                try:
+                    _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+                finally:
+                    socket.setdefaulttimeout(None)  # 恢复默认超时
+            except Exception as e:
+                logger.warning(f"Failed to load embedding model: {e}")
+            _embedding_model_loaded = True
+    return _embedding_model
+
+
+# 本地块索引最多记录的文档数，未记录的文档按parent_doc_id查询
+CHUNK_INDEX_MAX_DOCS = 100000
+# 没有parent_doc_id元数据的旧文档按块ID逐页探测
+LEGACY_PROBE_PAGE_SIZE = 64
+
+
+class ChunkIndex:
+    """
+    文档ID到块ID的本地索引，删除和更新文档时不需要查询集合
+    只记录本进程写入或查询过的文档，超出上限时淘汰最久未使用的
+    """
+    def __init__(self, max_docs: int = CHUNK_INDEX_MAX_DOCS):
+        self.max_docs = max_docs
+        self._docs: 'OrderedDict[str, List[str]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_id: str) -> Optional[List[str]]:
+        with self._lock:
+            chunk_ids = self._docs.get(doc_id)
+            if chunk_ids is not None:
+                self._docs.move_to_end(doc_id)
+            return chunk_ids
+
+    def set(self, doc_id: str, chunk_ids: List[str]):
+        with self._lock:
+            self._docs[doc_id] = list(chunk_ids)
+            self._docs.move_to_end(doc_id)
+            while len(self._docs) > self.max_docs:
+                self._docs.popitem(last=False)
+
+    def record(self, chunk_ids: List[str], metadatas: List[Dict]):
+        """记录一次写入的块，同一批中包含每个文档的全部块"""
+        grouped: Dict[str, List[str]] = {}
+        for chunk_id, metadata in zip(chunk_ids, metadatas):
+            grouped.setdefault(metadata['parent_doc_id'], []).append(chunk_id)
+        for doc_id, ids in grouped.items():
+            self.set(doc_id, ids)
+
+    def discard(self, doc_ids: Iterable[str]):
+        with self._lock:
+            for doc_id in doc_ids:
+                self._docs.pop(doc_id, None)
+
 
 class KnowledgeBaseManager:
     """
@@ -32,6 +107,7 @@ class KnowledgeBaseManager:
         self.collection = None
         self.embeddings = None
         self.text_splitter = None
+        self.chunk_index = ChunkIndex()
         
         if CHROMADB_AVAILABLE:
             try:
@@ -47,14 +123,10 @@ class KnowledgeBaseManager:
                     metadata={"hnsw:space": "cosine"}
                 )
                 
-                # 初始化嵌入模型 - 添加超时和错误处理
-                try:
-                    import socket
-                    socket.setdefaulttimeout(10)  # 设置10秒超时
-                    self.embeddings = SentenceTransformer('all-MiniLM-L6-v2')
-                    socket.setdefaulttimeout(None)  # 恢复默认超时
-                except Exception as e:
-                    logger.warning(f"Failed to load embedding model, ChromaDB will be disabled: {e}")
+                # 初始化嵌入模型（与语义缓存共用）
+                self.embeddings = get_embedding_model()
+                if self.embeddings is None:
+                    logger.warning("Embedding model unavailable, ChromaDB will be disabled")
                     self.client = None
                     self.collection = None
                     return
@@ -84,24 +156,34 @@ class KnowledgeBaseManager:
             logger.warning("ChromaDB not available, skipping document addition")
             return
         
-        if metadata is None:
-            metadata = {}
-        
-        # 分割文档
-        chunks = self._split_text(content)
-        
-        # 为每个块生成嵌入
-        embeddings = self.embeddings.encode(chunks).tolist()
-        
-        # 添加到向量数据库
-        self.collection.add(
-            documents=chunks,
-            metadatas=[metadata for _ in chunks],
-            ids=[f"{doc_id}_{i}" for i in range(len(chunks))],
-            embeddings=embeddings
-        )
-        
-        logger.info(f"Added document {doc_id} with {len(chunks)} chunks to knowledge base")
+        chunks_added = self.add_documents([(doc_id, content, metadata)])
+        logger.info(f"Added document {doc_id} with {chunks_added} chunks to knowledge base")
+
+    def add_documents(self, documents: Iterable[Tuple[str, str, Dict]], replace: bool = False) -> int:
+        """
+        批量添加文档，documents为(doc_id, content, metadata)的可迭代对象，可以是生成器
+        :param replace: 写入前删除这些文档已有的块
+        :return: 写入的块数
+        """
+        if not CHROMADB_AVAILABLE or self.collection is None:
+            logger.warning("ChromaDB not available, skipping document addition")
+            return 0
+
+        from .knowledge_ingestion import IngestionPipeline
+
+        with IngestionPipeline(self, replace=replace) as pipeline:
+            pipeline.add_many(documents)
+        return pipeline.chunks_added
+
+    def delete_documents(self, doc_ids: List[str]):
+        """
+        按parent_doc_id批量删除文档的所有块
+        """
+        if not CHROMADB_AVAILABLE or self.collection is None or not doc_ids:
+            return
+
+        self.collection.delete(where={"parent_doc_id": {"$in": list(doc_ids)}})
+        self.chunk_index.discard(doc_ids)
     
     def search(self, query: str, n_results: int = 5) -> List[Dict]:
         """
@@ -112,8 +194,10 @@ class KnowledgeBaseManager:
             return []
         
         try:
-            # 生成查询嵌入
-            query_embedding = self.embeddings.encode([query]).tolist()[0]
+            # 生成查询嵌入（按问题文本缓存，并发的查询合并为一次编码）
+            from .query_embedding import encode_query
+
+            query_embedding = encode_query(query, self.embeddings).tolist()
             
             # 执行相似性搜索
             results = self.collection.query(
@@ -137,16 +221,24 @@ class KnowledgeBaseManager:
     
     def update_document(self, doc_id: str, content: str, metadata: Dict = None):
         """
-        更新文档
+        更新文档：upsert新的块后只删除多出来的旧块，开销与该文档的块数成正比
         """
         if not CHROMADB_AVAILABLE or self.collection is None:
             logger.warning("ChromaDB not available, skipping document update")
             return
         
-        # 删除现有文档
-        self.delete_document(doc_id)
-        # 添加新文档
+        old_ids = self._chunk_ids(doc_id)
+        # 新的块ID与写入流水线的编号规则一致；内容为空时没有新块，旧块全部删除
+        new_ids = [f"{doc_id}_{index}" for index in range(len(self._split_text(content)))]
         self.add_document(doc_id, content, metadata)
+        keep = set(new_ids)
+        stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in keep]
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+        if new_ids:
+            self.chunk_index.set(doc_id, new_ids)
+        else:
+            self.chunk_index.discard([doc_id])
     
     def delete_document(self, doc_id: str):
         """
@@ -156,16 +248,37 @@ class KnowledgeBaseManager:
             logger.warning("ChromaDB not available, skipping document deletion")
             return
         
-        # 获取匹配的文档ID
         try:
-            all_docs = self.collection.get()
-            ids_to_delete = [doc_id for doc_id in all_docs['ids'] if doc_id.startswith(f"{doc_id}_")]
-            
-            if ids_to_delete:
-                self.collection.delete(ids=ids_to_delete)
-                logger.info(f"Deleted document {doc_id} from knowledge base")
+            chunk_ids = self._chunk_ids(doc_id)
+            if chunk_ids:
+                self.collection.delete(ids=chunk_ids)
+                logger.info(f"Deleted document {doc_id} ({len(chunk_ids)} chunks) from knowledge base")
+            self.chunk_index.discard([doc_id])
         except Exception as e:
             logger.error(f"Error deleting document {doc_id}: {e}")
+
+    def _chunk_ids(self, doc_id: str) -> List[str]:
+        """
+        获取文档的所有块ID：先查本地索引，再按parent_doc_id过滤查询，
+        都没有时按块ID探测没有parent_doc_id元数据的旧文档
+        """
+        chunk_ids = self.chunk_index.get(doc_id)
+        if chunk_ids is not None:
+            return chunk_ids
+
+        chunk_ids = self.collection.get(where={"parent_doc_id": doc_id}, include=[])['ids']
+        if not chunk_ids:
+            start = 0
+            while True:
+                page = [f"{doc_id}_{i}" for i in range(start, start + LEGACY_PROBE_PAGE_SIZE)]
+                found = self.collection.get(ids=page, include=[])['ids']
+                chunk_ids.extend(found)
+                if len(found) < LEGACY_PROBE_PAGE_SIZE:
+                    break
+                start += LEGACY_PROBE_PAGE_SIZE
+        if chunk_ids:
+            self.chunk_index.set(doc_id, chunk_ids)
+        return chunk_ids
     
     def refresh_cache(self):
         """
@@ -190,84 +303,22 @@ class RealTimeDataSource:
             self._kb_manager = KnowledgeBaseManager()
         return self._kb_manager
     
-    def sync_from_database(self):
+    def sync_from_database(self, full: bool = False) -> Optional[Dict]:
         """
-        从数据库同步数据到知识库
+        从数据库增量同步数据到知识库，只处理上次同步之后新增、修改和删除的记录
+        :param full: 忽略水位线，全量同步
         """
-        if not CHROMADB_AVAILABLE:
+        if not CHROMADB_AVAILABLE or self.kb_manager.collection is None:
             logger.warning("ChromaDB not available, skipping database sync")
-            return
-        
-        from chatbot.models import Conversation, Message, UserProfile
+            return None
         
+        from .knowledge_sync import sync_database
+
         try:
-            # 同步用户配置信息
-            profiles = UserProfile.objects.all()
-            for profile in profiles:
-                doc_content = f"用户配置信息:\n" \
-                             f"用户: {profile.user.username}\n" \
-                             f"电话: {profile.phone or '未设置'}\n" \
-                             f"API密钥配置: OpenAI={bool(profile.openai_api_key)}, " \
-                             f"Qwen={bool(profile.qwen_api_key)}, " \
-                             f"Gemini={bool(profile.gemini_api_key)}\n" \
-                             f"更新时间: {profile.updated_at}\n"
-                
-                self.kb_manager.add_document(
-                    doc_id=f"profile_{profile.user.id}",
-                    content=doc_content,
-                    metadata={
-                        "type": "user_profile",
-                        "user_id": profile.user.id,
-                        "username": profile.user.username
-                    }
-                )
-            
-            # 同步会话信息
-            conversations = Conversation.objects.all()
-            for conv in conversations:
-                doc_content = f"会话信息:\n" \
-                             f"标题: {conv.title}\n" \
-                             f"用户: {conv.user.username}\n" \
-                             f"模型: {conv.model}\n" \
-                             f"模式: {conv.mode}\n" \
-                             f"创建时间: {conv.created_at}\n" \
-                             f"更新时间: {conv.updated_at}\n"
-                
-                self.kb_manager.add_document(
-                    doc_id=f"conversation_{conv.id}",
-                    content=doc_content,
-                    metadata={
-                        "type": "conversation",
-                        "user_id": conv.user.id,
-                        "conversation_id": conv.id,
-                        "model": conv.model
-                    }
-                )
-            
-            # 同步最近的消息内容（限制数量避免过多数据）
-            recent_messages = Message.objects.order_by('-created_at')[:500]  # 限制数量
-            for msg in recent_messages:
-                doc_content = f"消息内容:\n" \
-                             f"会话: {msg.conversation.title}\n" \
-                             f"角色: {msg.role}\n" \
-                             f"内容: {msg.content[:200]}...\n" \
-                             f"时间: {msg.created_at}\n" \
-                             f"类型: {msg.message_type}\n"
-                
-                self.kb_manager.add_document(
-                    doc_id=f"message_{msg.id}",
-                    content=doc_content,
-                    metadata={
-                        "type": "message",
-                        "conversation_id": msg.conversation.id,
-                        "role": msg.role,
-                        "user_id": msg.conversation.user.id
-                    }
-                )
-            
-            logger.info(f"Synchronized {profiles.count()} profiles, {conversations.count()} conversations, and {recent_messages.count()} messages to knowledge base")
+            return sync_database(self.kb_manager, full=full)
         except Exception as e:
             logger.error(f"Error syncing from database: {e}")
+            return None
     
     def sync_from_external_api(self, api_endpoint: str, headers: dict = None):
         """
@@ -0,0 +1,120 @@
+"""
+知识库批量写入
+逐条调用add_document时，每个文档都是一次小批量的encode和一次collection.add；同步成千上万条记录时开销集中在调用次数上。
+这里把文档流式切块后汇总：按EMBED_BATCH_SIZE批量计算向量（EMBED_WORKERS大于1时使用sentence-transformers的多进程池），
+攒够UPSERT_BATCH_SIZE个块后一次upsert到Chroma，同步耗时随总token数而不是文档数增长。
+每个块的元数据带有parent_doc_id，用于按文档删除
+"""
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 批量写入默认配置，可通过settings.KNOWLEDGE_BASE_INGESTION_CONFIG覆盖
+DEFAULT_INGESTION_CONFIG = {
+    'EMBED_BATCH_SIZE': 64,           # 每次前向计算的块数
+    'EMBED_WORKERS': 1,               # 计算向量的进程数，1表示在当前进程中计算
+    'UPSERT_BATCH_SIZE': 1000,        # 每次写入Chroma的块数
+}
+
+
+def get_ingestion_config() -> Dict:
+    """读取批量写入配置"""
+    config = getattr(settings, 'KNOWLEDGE_BASE_INGESTION_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_INGESTION_CONFIG.items()}
+
+
+def encode_texts(model, texts: List[str], config: Optional[Dict] = None, pool=None) -> List[List[float]]:
+    """
+    批量计算向量，内容未变的块直接使用向量缓存
+    :param pool: sentence-transformers的多进程池，为None时在当前进程中计算
+    """
+    from .embedding_cache import encode_with_cache
+    from .knowledge_base import EMBEDDING_MODEL_NAME
+
+    if not texts:
+        return []
+    config = config or get_ingestion_config()
+
+    def encode(batch):
+        if pool is not None:
+            vectors = model.encode_multi_process(batch, pool, batch_size=config['EMBED_BATCH_SIZE'])
+        else:
+            vectors = model.encode(batch, batch_size=config['EMBED_BATCH_SIZE'])
+        return vectors.tolist() if hasattr(vectors, 'tolist') else [list(vector) for vector in vectors]
+
+    return encode_with_cache(EMBEDDING_MODEL_NAME, texts, encode)
+
+
+class IngestionPipeline:
+    """
+    汇总多个文档的块，批量计算向量并批量写入
+    用法：
+        with IngestionPipeline(kb_manager) as pipeline:
+            for doc_id, content, metadata in documents:
+                pipeline.add(doc_id, content, metadata)
+    """
+
+    def __init__(self, kb_manager, config: Optional[Dict] = None, replace: bool = False):
+        """
+        :param replace: 写入前删除缓冲区中这些文档已有的块，文档变短时不会留下多余的块
+        """
+        self.kb_manager = kb_manager
+        self.config = config or get_ingestion_config()
+        self.replace = replace
+        self.pool = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self.documents_added = 0
+        self.chunks_added = 0
+
+    def __enter__(self):
+        workers = self.config['EMBED_WORKERS']
+        if workers > 1:
+            try:
+                self.pool = self.kb_manager.embeddings.start_multi_process_pool(['cpu'] * workers)
+            except Exception as e:
+                logger.warning(f"启动向量计算进程池失败，改为在当前进程中计算: {e}")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self.pool is not None:
+                self.kb_manager.embeddings.stop_multi_process_pool(self.pool)
+                self.pool = None
+
+    def add(self, doc_id: str, content: str, metadata: Dict = None):
+        """切块并加入缓冲区，缓冲的块数达到UPSERT_BATCH_SIZE时写入"""
+        metadata = dict(metadata or {}, parent_doc_id=doc_id)
+        for index, chunk in enumerate(self.kb_manager._split_text(content)):
+            self.ids.append(f"{doc_id}_{index}")
+            self.documents.append(chunk)
+            self.metadatas.append(metadata)
+        self.documents_added += 1
+        if len(self.ids) >= self.config['UPSERT_BATCH_SIZE']:
+            self.flush()
+
+    def add_many(self, documents: Iterable[Tuple[str, str, Dict]]):
+        for doc_id, content, metadata in documents:
+            self.add(doc_id, content, metadata)
+
+    def flush(self):
+        """计算缓冲区中所有块的向量并一次写入"""
+        if not self.ids:
+            return
+        ids, documents, metadatas = self.ids, self.documents, self.metadatas
+        self.ids, self.documents, self.metadatas = [], [], []
+
+        embeddings = encode_texts(self.kb_manager.embeddings, documents, self.config, self.pool)
+        if self.replace:
+            self.kb_manager.delete_documents(sorted({metadata['parent_doc_id'] for metadata in metadatas}))
+        self.kb_manager.collection.upsert(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+        self.kb_manager.chunk_index.record(ids, metadatas)
+        self.chunks_added += len(ids)
+        logger.debug(f"Upserted {len(ids)} chunks to knowledge base")
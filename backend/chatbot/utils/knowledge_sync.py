@@ -0,0 +1,259 @@
+"""
+知识库增量同步
+每个数据源记录一条(updated_at, id)水位线（KnowledgeSyncState），修改过的记录updated_at变大，下次同步时重新写入。
+每次同步只读取水位线之后的记录并upsert，被删除的记录由post_delete信号收集，同一次删除在事务提交时
+批量写入KnowledgeDeletion（从未同步过的消息不记录），同步时删除对应的向量，每小时同步的开销与变更量成正比
+"""
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+# 增量同步默认配置，可通过settings.KNOWLEDGE_BASE_SYNC_CONFIG覆盖
+DEFAULT_SYNC_CONFIG = {
+    'INITIAL_MESSAGE_LIMIT': 500,     # 首次同步（或全量重建）时只同步最近的消息数量
+    'DELETE_BATCH_SIZE': 500,         # 每次删除的文档数
+    'LOCK_TIMEOUT': 3600,             # 同步锁的有效期（秒），避免定时任务和手动同步同时执行
+}
+
+SYNC_LOCK_KEY = 'knowledge_base:sync:lock'
+
+
+def get_sync_config() -> Dict:
+    """读取增量同步配置"""
+    config = getattr(settings, 'KNOWLEDGE_BASE_SYNC_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_SYNC_CONFIG.items()}
+
+
+def document_id(instance) -> str:
+    """记录在知识库中的文档ID"""
+    from ..models import Conversation, Message, UserProfile
+
+    if isinstance(instance, UserProfile):
+        return f"profile_{instance.user_id}"
+    if isinstance(instance, Conversation):
+        return f"conversation_{instance.id}"
+    if isinstance(instance, Message):
+        return f"message_{instance.id}"
+    raise Exception(f"不支持同步的记录类型: {type(instance).__name__}")
+
+
+def profile_document(profile) -> Tuple[str, str, Dict]:
+    doc_content = f"用户配置信息:\n" \
+                 f"用户: {profile.user.username}\n" \
+                 f"电话: {profile.phone or '未设置'}\n" \
+                 f"API密钥配置: OpenAI={bool(profile.openai_api_key)}, " \
+                 f"Qwen={bool(profile.qwen_api_key)}, " \
+                 f"Gemini={bool(profile.gemini_api_key)}\n" \
+                 f"更新时间: {profile.updated_at}\n"
+    return document_id(profile), doc_content, {
+        "type": "user_profile",
+        "user_id": profile.user.id,
+        "username": profile.user.username
+    }
+
+
+def conversation_document(conv) -> Tuple[str, str, Dict]:
+    doc_content = f"会话信息:\n" \
+                 f"标题: {conv.title}\n" \
+                 f"用户: {conv.user.username}\n" \
+                 f"模型: {conv.model}\n" \
+                 f"模式: {conv.mode}\n" \
+                 f"创建时间: {conv.created_at}\n" \
+                 f"更新时间: {conv.updated_at}\n"
+    return document_id(conv), doc_content, {
+        "type": "conversation",
+        "user_id": conv.user.id,
+        "conversation_id": conv.id,
+        "model": conv.model
+    }
+
+
+def message_document(msg) -> Tuple[str, str, Dict]:
+    doc_content = f"消息内容:\n" \
+                 f"会话: {msg.conversation.title}\n" \
+                 f"角色: {msg.role}\n" \
+                 f"内容: {msg.content[:200]}...\n" \
+                 f"时间: {msg.created_at}\n" \
+                 f"类型: {msg.message_type}\n"
+    return document_id(msg), doc_content, {
+        "type": "message",
+        "conversation_id": msg.conversation_id,
+        "role": msg.role,
+        "user_id": msg.conversation.user_id
+    }
+
+
+class _SourceReader:
+    """按水位线读取一个数据源的新增和修改记录，迭代结束后水位线前移到最后一条"""
+
+    def __init__(self, state, queryset, builder):
+        self.state = state
+        self.queryset = queryset
+        self.builder = builder
+        self.count = 0
+
+    def rows(self):
+        state = self.state
+        queryset = self.queryset.order_by('updated_at', 'id')
+        if state.last_updated_at is not None:
+            queryset = queryset.filter(
+                Q(updated_at__gt=state.last_updated_at) | Q(updated_at=state.last_updated_at, id__gt=state.last_id)
+            )
+        return queryset.iterator(chunk_size=500)
+
+    def documents(self) -> Iterator[Tuple[str, str, Dict]]:
+        for row in self.rows():
+            yield self.builder(row)
+            self.count += 1
+            self.state.last_updated_at = row.updated_at
+            self.state.last_id = row.id
+
+
+def _message_start(limit: int) -> Tuple[Optional[object], int]:
+    """首次同步消息时，从最近修改的limit条消息开始，返回起始水位线(updated_at, id)"""
+    from ..models import Message
+
+    rows = list(Message.objects.order_by('-updated_at', '-id').values_list('updated_at', 'id')[limit:limit + 1])
+    return rows[0] if rows else (None, 0)
+
+
+def _message_synced(state, row: Tuple) -> bool:
+    """
+    被删除的消息是否可能已写入知识库
+    (updated_at, id)不晚于首次同步的起始水位线的消息从未同步过；创建时间晚于当前水位线的消息还没有同步
+    """
+    created_at, updated_at, message_id = row
+    if state is None:
+        return True
+    if state.start_updated_at is not None and (updated_at, message_id) <= (state.start_updated_at, state.start_id):
+        return False
+    if state.last_updated_at is None or (created_at, message_id) > (state.last_updated_at, state.last_id):
+        return False
+    return True
+
+
+class _PendingDeletion:
+    """一条待写入的删除记录，所在事务提交时由提交回调标记"""
+
+    __slots__ = ('doc_id', 'message_row', 'committed')
+
+    def __init__(self, doc_id: str, message_row: Optional[Tuple]):
+        self.doc_id = doc_id
+        self.message_row = message_row  # 消息为(created_at, updated_at, id)，其他记录为None
+        self.committed = False
+
+
+class _DeletionBuffer:
+    """
+    一个连接上待写入的删除记录，事务提交时批量写入KnowledgeDeletion
+    每条记录注册自己的提交回调，回调只标记该记录已提交；回调按注册顺序执行，最后一条记录的回调执行时
+    同一事务的记录都已标记，一次写入全部已提交的记录。事务或保存点回滚时回调被丢弃，对应的记录没有标记，写入时丢弃
+    （保存点回滚掉最后几条记录时，已提交的记录在该连接下一次删除提交时写入）
+    """
+
+    def __init__(self):
+        self.pending: List[_PendingDeletion] = []
+
+    def add(self, instance):
+        from ..models import Message
+
+        message_row = (instance.created_at, instance.updated_at, instance.id) if isinstance(instance, Message) else None
+        pending = _PendingDeletion(document_id(instance), message_row)
+        self.pending.append(pending)
+        transaction.on_commit(lambda: self._committed(pending))
+
+    def _committed(self, pending: _PendingDeletion):
+        pending.committed = True
+        if not self.pending or self.pending[-1] is not pending:
+            return
+        committed = [item for item in self.pending if item.committed]
+        self.pending = []
+        self._write(committed)
+
+    @staticmethod
+    def _write(items: List[_PendingDeletion]):
+        from ..models import KnowledgeDeletion, KnowledgeSyncState
+
+        state = None
+        if any(item.message_row for item in items):
+            # 同步正在执行时新写入的消息可能还没有保存水位线，全部记录
+            state = None if cache.get(SYNC_LOCK_KEY) else KnowledgeSyncState.objects.filter(source='message').first()
+        doc_ids = [item.doc_id for item in items if item.message_row is None or _message_synced(state, item.message_row)]
+        KnowledgeDeletion.objects.bulk_create([KnowledgeDeletion(doc_id=doc_id) for doc_id in doc_ids], batch_size=500)
+
+
+def record_deletion(instance):
+    """
+    记录被删除的记录，同一事务中的删除（如删除会话时级联删除的消息）在提交时一次写入
+    Django的delete()总是在事务中执行，级联删除只产生一次批量插入
+    """
+    connection = transaction.get_connection()
+    buffer = getattr(connection, '_knowledge_deletions', None)
+    if buffer is None:
+        buffer = connection._knowledge_deletions = _DeletionBuffer()
+    buffer.add(instance)
+
+
+def _apply_deletions(kb_manager, config: Dict) -> int:
+    """删除已删除记录的向量，返回处理的文档数"""
+    from ..models import KnowledgeDeletion
+
+    deleted = 0
+    while True:
+        batch = list(KnowledgeDeletion.objects.order_by('id').values_list('id', 'doc_id')[:config['DELETE_BATCH_SIZE']])
+        if not batch:
+            return deleted
+        kb_manager.delete_documents(sorted({doc_id for _, doc_id in batch}))
+        KnowledgeDeletion.objects.filter(id__lte=batch[-1][0]).delete()
+        deleted += len(batch)
+
+
+def reset_sync_state():
+    """清除所有水位线，下次同步为全量同步"""
+    from ..models import KnowledgeSyncState
+
+    KnowledgeSyncState.objects.all().delete()
+
+
+def sync_database(kb_manager, full: bool = False) -> Optional[Dict]:
+    """
+    增量同步数据库内容到知识库
+    :param full: 清除水位线后全量同步
+    :return: 各数据源同步的记录数和删除的文档数，同步正在其他进程执行时返回None
+    """
+    from ..models import Conversation, KnowledgeSyncState, Message, UserProfile
+
+    config = get_sync_config()
+    if not cache.add(SYNC_LOCK_KEY, 1, config['LOCK_TIMEOUT']):
+        logger.info("知识库同步正在执行")
+        return None
+    try:
+        if full:
+            reset_sync_state()
+        stats = {'deleted': _apply_deletions(kb_manager, config)}
+        sources = [
+            ('user_profile', UserProfile.objects.select_related('user'), profile_document),
+            ('conversation', Conversation.objects.select_related('user'), conversation_document),
+            ('message', Message.objects.select_related('conversation'), message_document),
+        ]
+        for source, queryset, builder in sources:
+            state, created = KnowledgeSyncState.objects.get_or_create(source=source)
+            if created and source == 'message':
+                state.last_updated_at, state.last_id = _message_start(config['INITIAL_MESSAGE_LIMIT'])
+                state.start_updated_at, state.start_id = state.last_updated_at, state.last_id
+            reader = _SourceReader(state, queryset, builder)
+            # 修改过的记录可能切出更少的块，先删除旧块再写入
+            kb_manager.add_documents(reader.documents(), replace=True)
+            # 写入成功后才保存水位线，失败时下次从上一个水位线重新同步
+            state.save()
+            stats[source] = reader.count
+        logger.info(f"知识库增量同步完成: {stats}")
+        return stats
+    finally:
+        cache.delete(SYNC_LOCK_KEY)
@@ -0,0 +1,92 @@
+"""
+按模型累计的统计计数（响应缓存、提示词前缀缓存共用）
+计数写入Django缓存（生产环境为Redis，多个进程共享），通过add + incr原子累加。
+模型列表不做读-改-写：模型首次出现时用add抢占登记键，抢到的进程再用incr分配序号并写入对应的槽位，
+多个进程同时登记不同模型时不会互相覆盖
+"""
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from django.core.cache import cache as default_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStats:
+    """一组按模型累计的计数器"""
+
+    def __init__(self, prefix: str, fields: Tuple[str, ...], label: str, get_cache: Callable = None):
+        """
+        :param prefix: 统计键前缀，例如 llm_response:stats
+        :param fields: 计数字段
+        :param label: 写日志时使用的名称
+        :param get_cache: 返回所用缓存的函数，默认为default缓存
+        """
+        self.prefix = prefix
+        self.fields = fields
+        self.label = label
+        self._get_cache = get_cache or (lambda: default_cache)
+        # 本进程已登记的模型，避免每次计数都访问登记键
+        self._registered = set()
+        self._lock = threading.Lock()
+
+    def _key(self, model: str, field: str) -> str:
+        return f"{self.prefix}:{model}:{field}"
+
+    def _slot_key(self, index) -> str:
+        return f"{self.prefix}:_models:{index}"
+
+    def _register(self, cache, model: str):
+        if model in self._registered:
+            return
+        if cache.add(f"{self.prefix}:_registered:{model}", 1, None):
+            count_key = self._slot_key('count')
+            cache.add(count_key, 0, None)
+            cache.set(self._slot_key(cache.incr(count_key)), model, None)
+        with self._lock:
+            self._registered.add(model)
+
+    def incr(self, model: str, **amounts: int):
+        """累加计数，为0的字段跳过"""
+        amounts = {field: amount for field, amount in amounts.items() if amount}
+        if not model or not amounts:
+            return
+        cache = self._get_cache()
+        try:
+            for field, amount in amounts.items():
+                key = self._key(model, field)
+                cache.add(key, 0, None)
+                cache.incr(key, amount)
+            self._register(cache, model)
+        except Exception as e:
+            logger.warning(f"{self.label}失败: {str(e)}")
+
+    def models(self) -> List[str]:
+        cache = self._get_cache()
+        count = cache.get(self._slot_key('count')) or 0
+        slots = cache.get_many([self._slot_key(index) for index in range(1, count + 1)])
+        return [slots[key] for key in sorted(slots, key=lambda key: int(key.rsplit(':', 1)[1]))]
+
+    def get(self) -> Dict[str, Dict[str, int]]:
+        """各模型的计数"""
+        cache = self._get_cache()
+        stats = {}
+        for model in self.models():
+            values = cache.get_many([self._key(model, field) for field in self.fields])
+            stats[model] = {field: values.get(self._key(model, field), 0) for field in self.fields}
+        return stats
+
+    def clear(self):
+        """清空计数和模型登记"""
+        cache = self._get_cache()
+        models = self.models()
+        count = cache.get(self._slot_key('count')) or 0
+        cache.delete_many(
+            [self._key(model, field) for model in models for field in self.fields]
+            + [f"{self.prefix}:_registered:{model}" for model in models]
+            + [self._slot_key(index) for index in range(1, count + 1)]
+            + [self._slot_key('count')]
+        )
+        with self._lock:
+            self._registered.clear()
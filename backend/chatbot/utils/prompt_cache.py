@@ -0,0 +1,86 @@
+"""
+提供商提示词前缀缓存统计
+DeepSeek、OpenAI、Qwen、Moonshot、Gemini等对与之前请求字节相同的提示词前缀自动缓存，命中部分按折扣计费且首token更快
+各提供商在usage中返回命中缓存的token数，字段不同，这里统一为 (提示词token数, 命中缓存的token数)，
+按模型累计写入默认缓存（多个进程共享），用于衡量前缀缓存命中率
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+
+from .model_stats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'llm_prompt_cache'
+STATS_FIELDS = ('requests', 'reported', 'prompt_tokens', 'cached_tokens')
+
+_stats = ModelStats(f"{KEY_PREFIX}:stats", STATS_FIELDS, '前缀缓存统计')
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_usage(usage: Optional[Dict]) -> Tuple[int, Optional[int]]:
+    """
+    从usage中读取提示词token数和命中缓存的token数
+    :return: (prompt_tokens, cached_tokens)，提供商未返回缓存字段时cached_tokens为None
+    """
+    if not usage:
+        return 0, None
+    # Gemini: usageMetadata
+    if 'promptTokenCount' in usage:
+        cached = usage.get('cachedContentTokenCount')
+        return _int(usage.get('promptTokenCount')), None if cached is None else _int(cached)
+
+    prompt_tokens = _int(usage.get('prompt_tokens'))
+    # DeepSeek: prompt_cache_hit_tokens / prompt_cache_miss_tokens
+    if 'prompt_cache_hit_tokens' in usage:
+        hit = _int(usage['prompt_cache_hit_tokens'])
+        return prompt_tokens or hit + _int(usage.get('prompt_cache_miss_tokens')), hit
+    # OpenAI、Qwen、豆包: prompt_tokens_details.cached_tokens
+    details = usage.get('prompt_tokens_details') or {}
+    if isinstance(details, dict) and 'cached_tokens' in details:
+        return prompt_tokens, _int(details['cached_tokens'])
+    # Moonshot: cached_tokens
+    if 'cached_tokens' in usage:
+        return prompt_tokens, _int(usage['cached_tokens'])
+    return prompt_tokens, None
+
+
+def record_usage(model: Optional[str], usage: Optional[Dict]):
+    """累计一次上游调用的提示词token数和命中缓存的token数"""
+    prompt_tokens, cached_tokens = parse_usage(usage)
+    if not model or not prompt_tokens:
+        return
+    # 只有返回了缓存字段的请求计入token数，命中率不被不支持前缀缓存的请求拉低
+    amounts = {'requests': 1}
+    if cached_tokens is not None:
+        amounts.update(reported=1, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+    _stats.incr(model, **amounts)
+
+
+arecord_usage = sync_to_async(record_usage, thread_sensitive=False)
+
+
+def get_prompt_cache_stats() -> Dict:
+    """
+    按模型返回前缀缓存命中率（命中缓存的token数 / 提示词token数）
+    prompt_tokens和cached_tokens只包含返回了缓存字段的请求（reported），没有这类请求时hit_rate为None
+    """
+    stats = _stats.get()
+    for item in stats.values():
+        item['hit_rate'] = (
+            round(item['cached_tokens'] / item['prompt_tokens'], 4) if item['prompt_tokens'] else None
+        )
+    return stats
+
+
+def clear_prompt_cache_stats():
+    """清空统计"""
+    _stats.clear()
@@ -0,0 +1,207 @@
+"""
+查询向量缓存与微批编码
+知识库搜索和语义缓存在首token之前都要对用户问题计算句向量。这里按规范化后的问题文本缓存向量：
+进程内LRU，可选再加一层共享缓存（settings.CACHES中的别名，生产环境为Redis），多个进程共用。
+未命中的问题进入微批队列，后台线程等待BATCH_WINDOW_MS毫秒收集同时到达的其他问题，一次前向计算全部编码，
+CPU上多个并发请求不再各自排队做一次encode
+"""
+import time
+import queue
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:  # 未安装时句向量模型同样不可用，get_query_encoder返回None
+    np = None
+
+# 查询向量缓存默认配置，可通过settings.KNOWLEDGE_BASE_QUERY_CACHE_CONFIG覆盖
+DEFAULT_QUERY_CACHE_CONFIG = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 2048,              # 进程内LRU的条目上限
+    'SHARED_ALIAS': None,             # 共享缓存的别名（如api_cache），为None时只使用进程内缓存
+    'SHARED_TTL': 24 * 60 * 60,       # 共享缓存的有效期（秒）
+    'BATCH_WINDOW_MS': 5,             # 微批等待时间（毫秒），为0时不做微批
+    'MAX_BATCH_SIZE': 32,             # 每批最多编码的问题数
+    'TIMEOUT': 30,                    # 等待编码结果的超时时间（秒）
+}
+
+KEY_PREFIX = 'query_embedding'
+
+
+def get_query_cache_config() -> Dict:
+    """读取查询向量缓存配置"""
+    config = getattr(settings, 'KNOWLEDGE_BASE_QUERY_CACHE_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_QUERY_CACHE_CONFIG.items()}
+
+
+def normalize_query(text: str) -> str:
+    """统一Unicode形式、合并空白并转为小写（句向量模型不区分大小写）"""
+    return ' '.join(unicodedata.normalize('NFKC', text).split()).lower()
+
+
+class _MicroBatcher:
+    """后台线程按时间窗口收集查询，一次调用encode编码整批"""
+
+    def __init__(self, encode_batch):
+        self.encode_batch = encode_batch
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='query-embedding-batcher', daemon=True)
+                self._thread.start()
+        return future
+
+    def _collect(self, config: Dict) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + config['BATCH_WINDOW_MS'] / 1000
+        while len(batch) < config['MAX_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect(get_query_cache_config())
+            # 同一批中相同的问题只编码一次
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.encode_batch(texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+
+class QueryEncoder:
+    """某个句向量模型的查询编码器，返回归一化的float32向量"""
+
+    def __init__(self, model):
+        self.model = model
+        self._lru: 'OrderedDict[str, "np.ndarray"]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._batcher = _MicroBatcher(self._encode_batch)
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'batches': 0, 'encoded': 0}
+
+    def _encode_batch(self, texts: List[str]) -> List['np.ndarray']:
+        vectors = self.model.encode(texts, batch_size=len(texts), normalize_embeddings=True)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['encoded'] += len(texts)
+        return [np.asarray(vector, dtype=np.float32) for vector in vectors]
+
+    def _shared_key(self, text: str) -> str:
+        from .knowledge_base import EMBEDDING_MODEL_NAME
+
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{KEY_PREFIX}:{EMBEDDING_MODEL_NAME}:{digest}"
+
+    def _remember(self, text: str, vector: 'np.ndarray', config: Dict):
+        with self._lock:
+            self._lru[text] = vector
+            self._lru.move_to_end(text)
+            while len(self._lru) > config['MAX_ENTRIES']:
+                self._lru.popitem(last=False)
+
+    def encode(self, query: str) -> 'np.ndarray':
+        """计算查询向量，依次查进程内缓存、共享缓存，都未命中时进入微批队列"""
+        config = get_query_cache_config()
+        if not config['ENABLED']:
+            return self._encode_batch([query])[0]
+
+        text = normalize_query(query)
+        with self._lock:
+            vector = self._lru.get(text)
+            if vector is not None:
+                self._lru.move_to_end(text)
+                self.stats['hits'] += 1
+                return vector
+
+        shared = caches[config['SHARED_ALIAS']] if config['SHARED_ALIAS'] in settings.CACHES else None
+        if shared is not None:
+            try:
+                data = shared.get(self._shared_key(text))
+            except Exception as e:
+                logger.warning(f"读取共享查询向量缓存失败: {e}")
+                data = None
+            if data is not None:
+                vector = np.frombuffer(data, dtype=np.float32)
+                self._remember(text, vector, config)
+                with self._lock:
+                    self.stats['shared_hits'] += 1
+                return vector
+
+        with self._lock:
+            self.stats['misses'] += 1
+        if config['BATCH_WINDOW_MS'] > 0:
+            vector = self._batcher.submit(text).result(timeout=config['TIMEOUT'])
+        else:
+            vector = self._encode_batch([text])[0]
+
+        self._remember(text, vector, config)
+        if shared is not None:
+            try:
+                shared.set(self._shared_key(text), vector.tobytes(), config['SHARED_TTL'])
+            except Exception as e:
+                logger.warning(f"写入共享查询向量缓存失败: {e}")
+        return vector
+
+
+_encoders: Dict[int, QueryEncoder] = {}
+_encoders_lock = threading.Lock()
+
+
+def get_query_encoder(model=None) -> Optional[QueryEncoder]:
+    """获取模型对应的查询编码器，默认使用知识库共享的句向量模型，模型不可用时返回None"""
+    if model is None:
+        from .knowledge_base import get_embedding_model
+
+        model = get_embedding_model()
+        if model is None or np is None:
+            return None
+    with _encoders_lock:
+        encoder = _encoders.get(id(model))
+        if encoder is None or encoder.model is not model:
+            encoder = _encoders[id(model)] = QueryEncoder(model)
+        return encoder
+
+
+def encode_query(query: str, model=None) -> Optional['np.ndarray']:
+    """计算查询的归一化向量，模型不可用时返回None"""
+    encoder = get_query_encoder(model)
+    return encoder.encode(query) if encoder is not None else None
+
+
+def get_query_cache_stats() -> Dict:
+    """各查询编码器的命中和批量统计"""
+    with _encoders_lock:
+        encoders = list(_encoders.values())
+    stats = {key: 0 for key in ('hits', 'shared_hits', 'misses', 'batches', 'encoded')}
+    for encoder in encoders:
+        for key in stats:
+            stats[key] += encoder.stats[key]
+    stats['avg_batch_size'] = round(stats['encoded'] / stats['batches'], 2) if stats['batches'] else 0.0
+    return stats
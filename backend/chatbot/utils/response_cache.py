@@ -0,0 +1,189 @@
+"""
+大模型响应缓存（精确匹配）
+按 提供商 + 模型 + 规范化后的请求载荷（消息和采样参数）计算哈希，命中时直接返回缓存的回答
+调用方在config中传入 cache=True 才会使用缓存；temperature>0 的请求结果不固定，
+默认不缓存，除非传入 cache_allow_sampling=True 或在配置中允许
+缓存写入settings.CACHES中的api_cache，超过条目上限时淘汰最早写入的条目
+"""
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+from typing import Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .model_stats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+# 响应缓存默认配置，可通过settings.LLM_RESPONSE_CACHE_CONFIG覆盖
+DEFAULT_RESPONSE_CACHE_CONFIG = {
+    'ENABLED': True,                  # 总开关，关闭后所有请求都不使用缓存
+    'ALIAS': 'api_cache',             # 使用的缓存别名，不存在时使用default
+    'TTL': 60 * 60,                   # 缓存有效期（秒）
+    'MAX_ENTRIES': 10000,             # 缓存条目上限（Redis缓存时按写入时间淘汰）
+    'MAX_CONTENT_CHARS': 20000,       # 超过该长度的回答不缓存
+    'ALLOW_SAMPLING': False,          # 是否缓存temperature>0的请求
+}
+
+KEY_PREFIX = 'llm_response'
+STATS_FIELDS = ('hits', 'misses', 'bypassed', 'saved_tokens')
+
+
+def get_response_cache_config() -> Dict:
+    """读取响应缓存配置"""
+    config = getattr(settings, 'LLM_RESPONSE_CACHE_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_RESPONSE_CACHE_CONFIG.items()}
+
+
+def get_cache(config: Optional[Dict] = None):
+    config = config or get_response_cache_config()
+    alias = config['ALIAS'] if config['ALIAS'] in settings.CACHES else 'default'
+    return caches[alias]
+
+
+def _normalize(value):
+    """规范化文本：统一Unicode形式和换行，去掉行尾及首尾空白，不改变正文中的缩进"""
+    if isinstance(value, str):
+        text = unicodedata.normalize('NFKC', value).replace('\r\n', '\n')
+        return '\n'.join(line.rstrip() for line in text.split('\n')).strip()
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def _temperature(payload: Dict) -> float:
+    temperature = payload.get('temperature')
+    if temperature is None:
+        temperature = (payload.get('generationConfig') or {}).get('temperature', 0)
+    return float(temperature or 0)
+
+
+def build_cache_key(provider: str, model: str, payload: Dict) -> str:
+    """规范化后的请求载荷的哈希，载荷中包含消息和全部采样参数"""
+    canonical = json.dumps(
+        {'provider': provider, 'model': model, 'payload': _normalize(payload)},
+        ensure_ascii=False, sort_keys=True, separators=(',', ':'),
+    )
+    return f"{KEY_PREFIX}:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()}"
+
+
+def lookup_key(provider: str, config: Dict, payload: Dict) -> Optional[str]:
+    """
+    返回本次请求的缓存键，不使用缓存时返回None
+    :param config: 调用配置，cache=True 时使用缓存，cache_allow_sampling=True 时允许缓存temperature>0的请求
+    """
+    if not config.get('cache'):
+        return None
+    cache_config = get_response_cache_config()
+    if not cache_config['ENABLED']:
+        return None
+    model = config.get('model') or ''
+    allow_sampling = config.get('cache_allow_sampling', cache_config['ALLOW_SAMPLING'])
+    if _temperature(payload) > 0 and not allow_sampling:
+        record_stat(model, 'bypassed')
+        return None
+    return build_cache_key(provider, model, payload)
+
+
+def _usage_tokens(result: Dict, payload: Dict) -> int:
+    """回答消耗的token数，提供商未返回usage时按字符数估算"""
+    usage = result.get('usage') or {}
+    tokens = usage.get('total_tokens') or usage.get('totalTokenCount')
+    if tokens:
+        return int(tokens)
+    prompt_chars = len(json.dumps(payload.get('messages') or payload.get('contents') or [], ensure_ascii=False))
+    return (prompt_chars + len(result.get('content') or '')) // 2
+
+
+def get_cached(cache_key: str, model: str) -> Optional[Dict]:
+    """读取缓存，命中时返回提供商的原始结果并附加 cached=True"""
+    try:
+        entry = get_cache().get(cache_key)
+    except Exception as e:
+        logger.warning(f"读取响应缓存失败: {str(e)}")
+        entry = None
+    if entry is None:
+        record_stat(model, 'misses')
+        return None
+    record_stat(model, 'hits')
+    record_stat(model, 'saved_tokens', entry['tokens'])
+    return dict(entry['result'], cached=True)
+
+
+def _entry(result: Dict, payload: Dict, cache_config: Dict) -> Optional[Dict]:
+    content = result.get('content')
+    if not content or len(content) > cache_config['MAX_CONTENT_CHARS']:
+        return None
+    return {'result': result, 'tokens': _usage_tokens(result, payload)}
+
+
+def set_cached(cache_key: str, result: Dict, payload: Dict):
+    """写入缓存，空回答和超长回答不缓存"""
+    cache_config = get_response_cache_config()
+    entry = _entry(result, payload, cache_config)
+    if entry is None:
+        return
+    cache = get_cache(cache_config)
+    try:
+        cache.set(cache_key, entry, cache_config['TTL'])
+    except Exception as e:
+        logger.warning(f"写入响应缓存失败: {str(e)}")
+        return
+    _evict(cache, cache_key, cache_config)
+
+
+def _evict(cache, cache_key: str, cache_config: Dict):
+    """
+    Redis缓存按写入时间维护索引，超过条目上限时删除最早写入的条目
+    进程内缓存由其自身的MAX_ENTRIES淘汰
+    """
+    if not cache.__class__.__module__.startswith('django_redis'):
+        return
+    try:
+        from django_redis import get_redis_connection
+
+        client = get_redis_connection(cache_config['ALIAS'] if cache_config['ALIAS'] in settings.CACHES else 'default')
+        index_key = cache.make_key(f"{KEY_PREFIX}:index")
+        client.zadd(index_key, {cache_key: time.time()})
+        overflow = client.zcard(index_key) - cache_config['MAX_ENTRIES']
+        if overflow > 0:
+            expired = [member.decode('utf-8') for member, _ in client.zpopmin(index_key, overflow)]
+            cache.delete_many(expired)
+    except Exception as e:
+        logger.warning(f"响应缓存淘汰失败: {str(e)}")
+
+
+# 异步调用方使用，缓存读写（含统计计数）在线程中执行，不阻塞事件循环
+alookup_key = sync_to_async(lookup_key, thread_sensitive=False)
+aget_cached = sync_to_async(get_cached, thread_sensitive=False)
+aset_cached = sync_to_async(set_cached, thread_sensitive=False)
+
+
+# 统计计数写入与缓存相同的存储，多个进程共享
+_stats = ModelStats(f"{KEY_PREFIX}:stats", STATS_FIELDS, '响应缓存统计', get_cache)
+
+
+def record_stat(model: str, field: str, amount: int = 1):
+    """累加统计计数"""
+    _stats.incr(model, **{field: amount})
+
+
+def get_cache_stats() -> Dict:
+    """按模型返回命中率和节省的token数"""
+    stats = _stats.get()
+    for item in stats.values():
+        lookups = item['hits'] + item['misses']
+        item['hit_rate'] = round(item['hits'] / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def clear_cache_stats():
+    """清空统计"""
+    _stats.clear()
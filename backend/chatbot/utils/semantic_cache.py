@@ -0,0 +1,234 @@
+"""
+大模型语义缓存
+对没有上文的独立问题计算句向量，与同一作用域（模型 + 知识库上下文）中缓存的问题比较余弦相似度，
+超过该意图的阈值时直接返回缓存的回答
+向量索引保存在进程内，按LRU和TTL淘汰：查找时只屏蔽过期的行，过期条目在写入时按写入顺序从队首清除，
+查找不遍历全部条目也不重建矩阵；接近阈值但未命中的相似度会写入日志，用于调整阈值
+"""
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, defaultdict, deque
+from typing import Callable, Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# 语义缓存默认配置，可通过settings.LLM_SEMANTIC_CACHE_CONFIG覆盖
+DEFAULT_SEMANTIC_CACHE_CONFIG = {
+    'ENABLED': True,
+    # 按意图设置的相似度阈值，未列出的意图使用default，阈值为None表示该意图不使用语义缓存
+    'THRESHOLDS': {'default': 0.95},
+    'NEAR_MISS_MARGIN': 0.05,         # 相似度低于阈值不超过该值时记录日志
+    'MAX_ENTRIES': 5000,              # 进程内缓存的问题数上限
+    'TTL': 60 * 60,                   # 缓存有效期（秒）
+    'MAX_QUESTION_CHARS': 500,        # 超过该长度的问题不缓存
+}
+
+
+def get_semantic_cache_config() -> Dict:
+    """读取语义缓存配置"""
+    config = getattr(settings, 'LLM_SEMANTIC_CACHE_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_SEMANTIC_CACHE_CONFIG.items()}
+
+
+def _default_encoder(text: str):
+    """使用知识库的查询编码器（与知识库搜索共用查询向量缓存），未安装或加载失败时返回None"""
+    from .query_embedding import encode_query
+
+    return encode_query(text)
+
+
+def standalone_options(question: str, history: Optional[list] = None, intent: str = 'chat', image_url: Optional[str] = None) -> Optional[Dict]:
+    """
+    生成调用配置中的semantic_cache参数，只有没有上文、不带图片的问题才使用语义缓存
+    有上文时同样的问题可能指代不同内容，不能复用回答
+    """
+    if history or image_url or not question:
+        return None
+    return {'question': question, 'intent': intent}
+
+
+class SemanticCache:
+    """
+    进程内的语义缓存
+    每个作用域维护一个向量矩阵和对应的写入时间，条目增删时重建；所有作用域共享LRU顺序和条目上限
+    """
+
+    def __init__(self, encoder: Optional[Callable] = None):
+        self.encoder = encoder or _default_encoder
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # 条目ID -> 条目，按最近使用排序
+        self._expiry = deque()           # (写入时间, 条目ID)，按写入顺序排列，用于清除过期条目
+        self._scopes = {}                # 作用域 -> {'ids': [...], 'matrix': 矩阵或None, 'created': 写入时间数组}
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'near_misses': 0})
+        self._next_id = 0
+
+    @staticmethod
+    def scope_for(model: str, knowledge_context: Optional[str]) -> str:
+        """作用域：模型 + 知识库上下文的摘要，上下文不同的问题互不命中"""
+        digest = hashlib.sha256((knowledge_context or '').encode('utf-8')).hexdigest()[:16]
+        return f"{model}:{digest}"
+
+    def _threshold(self, intent: str, config: Dict) -> Optional[float]:
+        thresholds = config['THRESHOLDS'] or {}
+        return thresholds.get(intent, thresholds.get('default'))
+
+    def _encode(self, question: str):
+        vector = self.encoder(question)
+        if vector is None:
+            return None
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _eligible(self, question: str, intent: str, config: Dict) -> bool:
+        return (
+            NUMPY_AVAILABLE and config['ENABLED'] and bool(question)
+            and len(question) <= config['MAX_QUESTION_CHARS']
+            and self._threshold(intent, config) is not None
+        )
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        scope = self._scopes[entry['scope']]
+        scope['ids'].remove(entry_id)
+        scope['matrix'] = None
+        if not scope['ids']:
+            del self._scopes[entry['scope']]
+
+    def _purge_expired(self, now: float, ttl: float):
+        """从写入队列的队首清除过期条目，已被LRU淘汰的条目直接跳过"""
+        while self._expiry and now - self._expiry[0][0] > ttl:
+            _, entry_id = self._expiry.popleft()
+            if entry_id in self._entries:
+                self._remove(entry_id)
+
+    def _matrix(self, scope: str):
+        data = self._scopes.get(scope)
+        if data is None:
+            return None, None, []
+        if data['matrix'] is None:
+            entries = [self._entries[eid] for eid in data['ids']]
+            data['matrix'] = np.stack([entry['vector'] for entry in entries])
+            data['created'] = np.array([entry['created'] for entry in entries])
+        return data['matrix'], data['created'], data['ids']
+
+    def lookup(self, question: str, model: str, intent: str = 'chat', knowledge_context: Optional[str] = None) -> Optional[str]:
+        """查找相似问题的回答，未命中返回None"""
+        config = get_semantic_cache_config()
+        if not self._eligible(question, intent, config):
+            return None
+        vector = self._encode(question)
+        if vector is None:
+            return None
+
+        threshold = self._threshold(intent, config)
+        scope = self.scope_for(model, knowledge_context)
+        with self._lock:
+            matrix, created, ids = self._matrix(scope)
+            if matrix is None:
+                self._stats[intent]['misses'] += 1
+                return None
+            scores = matrix @ vector
+            # 过期的条目在下次写入时清除，这里只屏蔽
+            scores[created < time.time() - config['TTL']] = -np.inf
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            if score == -np.inf:
+                self._stats[intent]['misses'] += 1
+                return None
+            entry = self._entries[ids[best]]
+            if score >= threshold:
+                self._entries.move_to_end(ids[best])
+                self._stats[intent]['hits'] += 1
+                logger.info(f"语义缓存命中: intent={intent}, score={score:.4f}")
+                return entry['answer']
+            self._stats[intent]['misses'] += 1
+            if score >= threshold - config['NEAR_MISS_MARGIN']:
+                self._stats[intent]['near_misses'] += 1
+                logger.info(
+                    f"语义缓存接近命中: intent={intent}, score={score:.4f}, threshold={threshold}, "
+                    f"question={question[:50]!r}, cached_question={entry['question'][:50]!r}"
+                )
+        return None
+
+    def store(self, question: str, answer: str, model: str, intent: str = 'chat', knowledge_context: Optional[str] = None):
+        """缓存问题和回答，超过条目上限时淘汰最久未使用的条目"""
+        config = get_semantic_cache_config()
+        if not answer or not self._eligible(question, intent, config):
+            return
+        vector = self._encode(question)
+        if vector is None:
+            return
+
+        scope = self.scope_for(model, knowledge_context)
+        with self._lock:
+            now = time.time()
+            self._purge_expired(now, config['TTL'])
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                'scope': scope, 'question': question, 'answer': answer, 'vector': vector, 'created': now,
+            }
+            self._expiry.append((now, entry_id))
+            data = self._scopes.setdefault(scope, {'ids': [], 'matrix': None, 'created': None})
+            data['ids'].append(entry_id)
+            data['matrix'] = None
+            while len(self._entries) > config['MAX_ENTRIES']:
+                self._remove(next(iter(self._entries)))
+            # 被LRU淘汰的条目仍留在写入队列中，过多时压缩
+            if len(self._expiry) > 2 * config['MAX_ENTRIES']:
+                self._expiry = deque(item for item in self._expiry if item[1] in self._entries)
+
+    def lookup_for(self, config: Dict) -> Optional[str]:
+        """按调用配置查找，config['semantic_cache'] 为 {'question': 独立问题, 'intent': 意图}"""
+        options = config.get('semantic_cache')
+        if not options:
+            return None
+        return self.lookup(options['question'], config.get('model') or '', options.get('intent', 'chat'), config.get('system_prompt'))
+
+    def store_for(self, config: Dict, answer: str):
+        options = config.get('semantic_cache')
+        if options:
+            self.store(options['question'], answer, config.get('model') or '', options.get('intent', 'chat'), config.get('system_prompt'))
+
+    async def alookup_for(self, config: Dict) -> Optional[str]:
+        """异步调用方使用，计算句向量在线程中执行"""
+        if not config.get('semantic_cache'):
+            return None
+        return await sync_to_async(self.lookup_for, thread_sensitive=False)(config)
+
+    async def astore_for(self, config: Dict, answer: str):
+        if config.get('semantic_cache'):
+            await sync_to_async(self.store_for, thread_sensitive=False)(config, answer)
+
+    def stats(self) -> Dict:
+        """按意图统计命中、未命中和接近命中的次数"""
+        with self._lock:
+            self._purge_expired(time.time(), get_semantic_cache_config()['TTL'])
+            stats = {intent: dict(item) for intent, item in self._stats.items()}
+            entries = len(self._entries)
+        for item in stats.values():
+            lookups = item['hits'] + item['misses']
+            item['hit_rate'] = round(item['hits'] / lookups, 4) if lookups else 0.0
+        return {'entries': entries, 'intents': stats}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self._scopes.clear()
+            self._stats.clear()
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,518 @@
+"""
+大模型请求合并（single-flight）
+同一时刻相同的规范化请求只向提供商发送一次：第一个请求作为领头请求调用上游，
+其余请求等待并共享其结果（流式请求共享增量文本）
+默认缓存为Redis时通过Redis锁和发布订阅跨进程合并，否则在进程内合并；跨进程时增量文本按时间窗口批量写入Redis
+领头请求被取消、进程退出或超时没有新内容时，等待方自行请求上游；流式请求已向客户端返回部分内容时，
+新请求的回答是另一次采样，不能接在已返回的内容之后，直接报错
+"""
+import json
+import time
+import asyncio
+import uuid
+import logging
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .response_cache import build_cache_key
+
+logger = logging.getLogger(__name__)
+
+# 请求合并默认配置，可通过settings.LLM_SINGLE_FLIGHT_CONFIG覆盖
+DEFAULT_SINGLE_FLIGHT_CONFIG = {
+    'ENABLED': True,
+    'BACKEND': 'auto',                # auto（默认缓存为Redis时使用Redis）/ redis / local
+    'WAIT_TIMEOUT': 120,              # 等待领头请求产生新内容的最长时间（秒）
+    'LOCK_TTL': 120,                  # Redis锁有效期（秒），领头请求每次写入内容时续期
+    'CHUNK_FLUSH_INTERVAL_MS': 50,    # Redis增量文本批量写入的时间窗口（毫秒），第一个增量立即写入
+    'CHUNK_FLUSH_SIZE': 16,           # 攒够该数量的增量文本时立即写入
+}
+
+KEY_PREFIX = 'llm_flight'
+# 有序集合：领头请求的锁token -> 锁的过期时间，用于统计进行中的合并请求数
+LEADERS_KEY = f"{KEY_PREFIX}:leaders"
+
+# 事件类型：增量文本、最终结果、错误、领头请求放弃（被取消或进程退出）
+CHUNK = 'chunk'
+RESULT = 'result'
+ERROR = 'error'
+ABANDONED = 'abandoned'
+
+
+class LeaderGone(Exception):
+    """领头请求已放弃或超时没有新内容，等待方需要自行请求上游"""
+
+
+def get_single_flight_config() -> Dict:
+    """读取请求合并配置"""
+    config = getattr(settings, 'LLM_SINGLE_FLIGHT_CONFIG', {}) or {}
+    return {key: config.get(key, default) for key, default in DEFAULT_SINGLE_FLIGHT_CONFIG.items()}
+
+
+def flight_key(provider: str, config: Dict, payload: Dict) -> Optional[str]:
+    """
+    返回请求的合并键，不合并时返回None
+    只有调用方声明回答可以共享（使用响应缓存或语义缓存）的请求才合并
+    """
+    if not (config.get('cache') or config.get('semantic_cache')):
+        return None
+    if not get_single_flight_config()['ENABLED']:
+        return None
+    return build_cache_key(provider, config.get('model') or '', payload).split(':', 1)[1]
+
+
+class LocalFlight:
+    """进程内的一次合并请求，事件按顺序追加，等待方按序号读取"""
+
+    blocking = False
+
+    def __init__(self, key: str, backend: 'LocalFlightBackend'):
+        self.key = key
+        self.backend = backend
+        self._events = []
+        self._condition = threading.Condition()
+        self._async_waiters = []  # (事件循环, asyncio.Event)
+
+    def publish(self, kind: str, value=None):
+        with self._condition:
+            self._events.append((kind, value))
+            self._condition.notify_all()
+            for loop, event in self._async_waiters:
+                loop.call_soon_threadsafe(event.set)
+        if kind != CHUNK:
+            self.backend.finish(self)
+
+    def wait(self, index: int, timeout: float) -> List[Tuple]:
+        """返回序号index之后的事件，超时仍没有新事件时返回空列表"""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._events) > index, timeout)
+            return list(self._events[index:])
+
+    async def await_events(self, index: int, timeout: float) -> List[Tuple]:
+        """异步等待，不占用线程，大量等待方同时等待时不会耗尽线程池"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            if len(self._events) > index:
+                return list(self._events[index:])
+            self._async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._condition:
+                self._async_waiters.remove(waiter)
+        with self._condition:
+            return list(self._events[index:])
+
+    def close(self):
+        pass
+
+
+class LocalFlightBackend:
+    """进程内合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, LocalFlight] = {}
+
+    def acquire(self, key: str) -> Tuple[LocalFlight, bool]:
+        """加入合并请求，返回 (请求, 是否为领头请求)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = LocalFlight(key, self)
+            return flight, True
+
+    def finish(self, flight: LocalFlight):
+        # 结束后的新请求重新发起，由响应缓存负责复用已完成的结果
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+# 移出进行中的统计，仅当锁仍属于当前领头请求时才删除锁
+_RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisFlight:
+    """
+    跨进程的一次合并请求
+    事件写入Redis列表，并通过频道通知等待方；锁过期且没有最终结果时视为领头请求已放弃。
+    领头请求的增量文本先缓冲，距上次写入超过CHUNK_FLUSH_INTERVAL_MS或攒够CHUNK_FLUSH_SIZE条时一次写入
+    """
+
+    blocking = True
+
+    def __init__(self, client, key: str, token: str, config: Dict):
+        self.client = client
+        self.token = token
+        self.ttl = config['LOCK_TTL']
+        self.flush_interval = config['CHUNK_FLUSH_INTERVAL_MS'] / 1000
+        self.flush_size = config['CHUNK_FLUSH_SIZE']
+        self.lock_key = f"{KEY_PREFIX}:{key}:lock"
+        self.events_key = f"{KEY_PREFIX}:{key}:events"
+        self.channel = f"{KEY_PREFIX}:{key}:channel"
+        self._pubsub = None
+        self._pending: List[str] = []
+        self._flushed_at = None
+
+    def publish(self, kind: str, value=None):
+        self._pending.append(json.dumps([kind, value], ensure_ascii=False))
+        if kind == CHUNK:
+            now = time.monotonic()
+            if (self._flushed_at is not None and len(self._pending) < self.flush_size
+                    and now - self._flushed_at < self.flush_interval):
+                return
+            self._flushed_at = now
+        events, self._pending = self._pending, []
+        pipe = self.client.pipeline()
+        pipe.rpush(self.events_key, *events)
+        pipe.expire(self.events_key, self.ttl)
+        if kind == CHUNK:
+            pipe.expire(self.lock_key, self.ttl)
+            pipe.zadd(LEADERS_KEY, {self.token: time.time() + self.ttl})
+        pipe.publish(self.channel, '1')
+        pipe.execute()
+        if kind != CHUNK:
+            self.client.eval(_RELEASE_SCRIPT, 2, self.lock_key, LEADERS_KEY, self.token)
+
+    def _read(self, index: int) -> List[Tuple]:
+        return [tuple(json.loads(item)) for item in self.client.lrange(self.events_key, index, -1)]
+
+    def wait(self, index: int, timeout: float) -> List[Tuple]:
+        if self._pubsub is None:
+            # 先订阅再读取列表，避免错过读取和订阅之间发布的事件
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(self.channel)
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self._read(index)
+            if events:
+                return events
+            if not self.client.exists(self.lock_key):
+                return self._read(index) or [(ABANDONED, None)]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            self._pubsub.get_message(timeout=min(remaining, 1.0))
+
+    async def await_events(self, index: int, timeout: float) -> List[Tuple]:
+        return await sync_to_async(self.wait, thread_sensitive=False)(index, timeout)
+
+    def close(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+
+class RedisFlightBackend:
+    """基于Redis的跨进程合并"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def acquire(self, key: str) -> Tuple[RedisFlight, bool]:
+        config = get_single_flight_config()
+        flight = RedisFlight(self.client, key, uuid.uuid4().hex, config)
+        leader = bool(self.client.set(flight.lock_key, flight.token, nx=True, ex=flight.ttl))
+        if leader:
+            # 清除上一次同键请求遗留的事件，登记到进行中的统计
+            pipe = self.client.pipeline()
+            pipe.delete(flight.events_key)
+            pipe.zadd(LEADERS_KEY, {flight.token: time.time() + flight.ttl})
+            pipe.execute()
+        return flight, leader
+
+    def in_flight(self) -> int:
+        # 进程退出时没有移出的领头请求在锁过期后清除
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(LEADERS_KEY, '-inf', time.time())
+        pipe.zcard(LEADERS_KEY)
+        return pipe.execute()[1]
+
+
+_local_backend = LocalFlightBackend()
+_redis_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """按配置选择Redis或进程内合并，Redis不可用时回退到进程内合并"""
+    global _redis_backend
+    backend = get_single_flight_config()['BACKEND']
+    if backend == 'local':
+        return _local_backend
+    if backend == 'auto' and not settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        return _local_backend
+    if _redis_backend is None:
+        with _backend_lock:
+            if _redis_backend is None:
+                try:
+                    from django_redis import get_redis_connection
+                    _redis_backend = RedisFlightBackend(get_redis_connection('default'))
+                except Exception as e:
+                    logger.warning(f"Redis请求合并不可用，使用进程内合并: {str(e)}")
+                    return _local_backend
+    return _redis_backend
+
+
+def _acquire(key: str):
+    try:
+        return get_backend().acquire(key)
+    except Exception as e:
+        logger.warning(f"请求合并失败，直接请求上游: {str(e)}")
+        return None, True
+
+
+def _publish(flight, kind: str, value=None):
+    if flight is None:
+        return
+    try:
+        flight.publish(kind, value)
+    except Exception as e:
+        logger.warning(f"请求合并结果发布失败: {str(e)}")
+
+
+async def _apublish(flight, kind: str, value=None):
+    if flight is not None and flight.blocking:
+        await sync_to_async(_publish, thread_sensitive=False)(flight, kind, value)
+    else:
+        _publish(flight, kind, value)
+
+
+def _abandon(flight):
+    """领头请求被取消时通知等待方，取消后不能再await，Redis发布在后台线程中执行"""
+    if flight is not None and flight.blocking:
+        threading.Thread(target=_publish, args=(flight, ABANDONED), daemon=True).start()
+    else:
+        _publish(flight, ABANDONED)
+
+
+def _raise_for(kind: str, value):
+    """等待方收到错误或放弃事件时抛出异常"""
+    if kind == ERROR:
+        raise Exception(value)
+    if kind == ABANDONED:
+        raise LeaderGone()
+
+
+def _follow(flight) -> Iterator[Tuple]:
+    """按顺序读取领头请求的事件，直到最终事件；超过WAIT_TIMEOUT没有新事件时视为领头请求已放弃"""
+    timeout = get_single_flight_config()['WAIT_TIMEOUT']
+    index = 0
+    try:
+        while True:
+            events = flight.wait(index, timeout)
+            if not events:
+                raise LeaderGone()
+            for event in events:
+                index += 1
+                yield event
+                if event[0] != CHUNK:
+                    return
+    finally:
+        flight.close()
+
+
+async def _afollow(flight) -> AsyncIterator[Tuple]:
+    timeout = get_single_flight_config()['WAIT_TIMEOUT']
+    index = 0
+    try:
+        while True:
+            events = await flight.await_events(index, timeout)
+            if not events:
+                raise LeaderGone()
+            for event in events:
+                index += 1
+                yield event
+                if event[0] != CHUNK:
+                    return
+    finally:
+        if flight.blocking:
+            await sync_to_async(flight.close, thread_sensitive=False)()
+        else:
+            flight.close()
+
+
+def _log_leader_gone(key: str):
+    logger.info(f"合并请求的领头请求已放弃，直接请求上游: {key[:12]}")
+
+
+def _leader_gone_mid_stream(key: str):
+    """等待方已返回部分内容后领头请求中断，新请求的回答与已返回的内容不连贯，不再重新请求"""
+    logger.warning(f"合并请求的领头请求在流式输出中途中断: {key[:12]}")
+    return Exception("合并请求的领头请求已中断，请重试")
+
+
+def run(key: Optional[str], func: Callable[[], Dict]) -> Dict:
+    """
+    合并执行同步调用
+    :param key: 合并键，为None时直接调用
+    :param func: 调用上游并返回结果字典，只在领头请求中执行
+    :return: 结果字典，等待方得到的结果附加 coalesced=True
+    """
+    if key is None:
+        return func()
+    flight, leader = _acquire(key)
+    if not leader:
+        try:
+            for kind, value in _follow(flight):
+                _raise_for(kind, value)
+                if kind == RESULT:
+                    return dict(value, coalesced=True)
+        except LeaderGone:
+            _log_leader_gone(key)
+            return func()
+    try:
+        result = func()
+    except Exception as e:
+        _publish(flight, ERROR, str(e))
+        raise
+    except BaseException:
+        _publish(flight, ABANDONED)
+        raise
+    _publish(flight, RESULT, result)
+    return result
+
+
+async def arun(key: Optional[str], func) -> Dict:
+    """合并执行异步调用，func为返回协程的函数"""
+    if key is None:
+        return await func()
+    flight, leader = await sync_to_async(_acquire, thread_sensitive=False)(key)
+    if not leader:
+        try:
+            async for kind, value in _afollow(flight):
+                _raise_for(kind, value)
+                if kind == RESULT:
+                    return dict(value, coalesced=True)
+        except LeaderGone:
+            _log_leader_gone(key)
+            return await func()
+    try:
+        result = await func()
+    except Exception as e:
+        await _apublish(flight, ERROR, str(e))
+        raise
+    except BaseException:
+        # 对冲请求落后时被取消，等待方自行请求上游
+        _abandon(flight)
+        raise
+    await _apublish(flight, RESULT, result)
+    return result
+
+
+def stream(key: Optional[str], func: Callable[[], Iterator[str]]) -> Iterator[str]:
+    """
+    合并执行同步流式调用，逐个返回增量文本
+    :param func: 返回上游增量文本生成器的函数，等待方在领头请求放弃时自行调用
+    """
+    flight = None
+    emitted = False
+    if key is not None:
+        flight, leader = _acquire(key)
+        if not leader:
+            try:
+                for kind, value in _follow(flight):
+                    if kind == CHUNK:
+                        emitted = True
+                        yield value
+                        continue
+                    _raise_for(kind, value)
+                    return
+            except LeaderGone:
+                if emitted:
+                    raise _leader_gone_mid_stream(key)
+                _log_leader_gone(key)
+                flight = None
+
+    upstream = func()
+    deltas = []
+    finished = False
+    try:
+        for delta in upstream:
+            deltas.append(delta)
+            _publish(flight, CHUNK, delta)
+            yield delta
+        finished = True
+    except Exception as e:
+        finished = True
+        _publish(flight, ERROR, str(e))
+        raise
+    finally:
+        if not finished:
+            _publish(flight, ABANDONED)
+        upstream.close()
+    _publish(flight, RESULT, {'content': ''.join(deltas)})
+
+
+async def astream(key: Optional[str], func) -> AsyncIterator[str]:
+    """合并执行异步流式调用，func为返回上游异步生成器的函数"""
+    flight = None
+    emitted = False
+    if key is not None:
+        flight, leader = await sync_to_async(_acquire, thread_sensitive=False)(key)
+        if not leader:
+            try:
+                async for kind, value in _afollow(flight):
+                    if kind == CHUNK:
+                        emitted = True
+                        yield value
+                        continue
+                    _raise_for(kind, value)
+                    return
+            except LeaderGone:
+                if emitted:
+                    raise _leader_gone_mid_stream(key)
+                _log_leader_gone(key)
+                flight = None
+
+    upstream = func()
+    deltas = []
+    finished = False
+    try:
+        async for delta in upstream:
+            deltas.append(delta)
+            await _apublish(flight, CHUNK, delta)
+            yield delta
+        finished = True
+    except Exception as e:
+        finished = True
+        await _apublish(flight, ERROR, str(e))
+        raise
+    finally:
+        if not finished:
+            # 客户端断开或任务被取消
+            _abandon(flight)
+        await upstream.aclose()
+    await _apublish(flight, RESULT, {'content': ''.join(deltas)})
+
+
+def get_single_flight_stats() -> Dict:
+    """健康检查使用：当前正在进行的合并请求数"""
+    try:
+        return {'in_flight': get_backend().in_flight()}
+    except Exception as e:
+        logger.warning(f"读取请求合并状态失败: {str(e)}")
+        return {'in_flight': None}
+
+
+def reset_single_flight():
+    """清空进程内的合并请求"""
+    global _local_backend
+    _local_backend = LocalFlightBackend()
@@ -0,0 +1,129 @@
+"""
+助手消息的用量和延迟统计
+保存助手回复时写入MessageUsage（提示词/回复/命中前缀缓存的token数、提供商、首token耗时、总耗时、重试次数），
+按模型和时间段汇总token消耗和延迟百分位，供统计接口和usage_report管理命令使用
+"""
+import re
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .prompt_cache import parse_usage
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = {
+    'hour': TruncHour,
+    'day': TruncDay,
+}
+
+_WINDOW_PATTERN = re.compile(r'^(\d+)([mhd])$')
+_WINDOW_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+
+def usage_counts(usage: Optional[Dict]) -> Dict:
+    """统一各提供商usage中的提示词、回复和命中缓存的token数"""
+    usage = usage or {}
+    prompt_tokens, cached_tokens = parse_usage(usage)
+    completion_tokens = usage.get('completion_tokens', usage.get('candidatesTokenCount')) or 0
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': int(completion_tokens),
+        'cached_tokens': cached_tokens or 0,
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[int]:
+    return None if seconds is None else int(round(seconds * 1000))
+
+
+def record_message_usage(message, metrics: Optional[Dict]):
+    """
+    记录助手消息的用量和延迟，统计失败不影响回复
+    :param metrics: model、provider、usage、latency（秒）、ttft（秒，流式）、attempts（故障转移尝试次数）、cached
+    """
+    from ..models import MessageUsage
+
+    if not metrics or metrics.get('latency') is None or not getattr(settings, 'LLM_USAGE_TRACKING_ENABLED', True):
+        return None
+    try:
+        return MessageUsage.objects.create(
+            message=message,
+            model=metrics.get('model') or message.conversation.model,
+            provider=metrics.get('provider') or '',
+            ttft_ms=_ms(metrics.get('ttft')),
+            latency_ms=_ms(metrics['latency']),
+            retry_count=max((metrics.get('attempts') or 1) - 1, 0),
+            cached=bool(metrics.get('cached')),
+            **usage_counts(metrics.get('usage')),
+        )
+    except Exception as e:
+        logger.warning(f"记录消息用量失败: {str(e)}")
+        return None
+
+
+def parse_window(window: str) -> timedelta:
+    """解析时间窗口，如 30m、24h、7d"""
+    match = _WINDOW_PATTERN.match((window or '').strip())
+    if not match:
+        raise ValueError(f"无效的时间窗口: {window}，应为数字加m/h/d，如24h")
+    return timedelta(**{_WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def percentile(values: List[int], pct: float) -> Optional[int]:
+    """最近秩百分位，values需已排序"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+def aggregate_usage(since, until=None, bucket: Optional[str] = None, model: Optional[str] = None) -> List[Dict]:
+    """
+    按模型（和时间段）汇总用量
+    :param bucket: hour / day，为空时整个时间范围汇总为一组
+    :return: 每组的请求数、token消耗、重试次数和延迟p50/p95（毫秒）
+    """
+    from ..models import MessageUsage
+
+    if bucket and bucket not in BUCKETS:
+        raise ValueError(f"无效的时间段: {bucket}，应为{'/'.join(BUCKETS)}")
+
+    queryset = MessageUsage.objects.filter(created_at__gte=since, created_at__lt=until or timezone.now())
+    if model:
+        queryset = queryset.filter(model=model)
+    fields = ['model', 'latency_ms', 'ttft_ms', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'retry_count', 'cached']
+    if bucket:
+        queryset = queryset.annotate(bucket=BUCKETS[bucket]('created_at'))
+        fields.append('bucket')
+
+    groups = defaultdict(list)
+    for row in queryset.values(*fields).iterator():
+        groups[(row['model'], row.get('bucket'))].append(row)
+
+    results = []
+    for (model_name, bucket_start), rows in sorted(groups.items(), key=lambda item: (item[0][1] or since, item[0][0])):
+        latencies = sorted(row['latency_ms'] for row in rows)
+        ttfts = sorted(row['ttft_ms'] for row in rows if row['ttft_ms'] is not None)
+        item = {
+            'model': model_name,
+            'requests': len(rows),
+            'cached_requests': sum(1 for row in rows if row['cached']),
+            'prompt_tokens': sum(row['prompt_tokens'] for row in rows),
+            'completion_tokens': sum(row['completion_tokens'] for row in rows),
+            'cached_tokens': sum(row['cached_tokens'] for row in rows),
+            'retries': sum(row['retry_count'] for row in rows),
+            'latency_p50_ms': percentile(latencies, 50),
+            'latency_p95_ms': percentile(latencies, 95),
+            'ttft_p50_ms': percentile(ttfts, 50),
+            'ttft_p95_ms': percentile(ttfts, 95),
+        }
+        if bucket:
+            item = {'bucket': bucket_start.isoformat(), **item}
+        results.append(item)
+    return results
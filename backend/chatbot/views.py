@@ -1,5 +1,5 @@
 from django.shortcuts import render
-from rest_framework import viewsets, status, permissions, exceptions
+from rest_framework import viewsets, mixins, status, permissions, exceptions
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -8,8 +8,8 @@ from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_http_methods
-from .models import Conversation, Message, PasswordResetToken
-from .serializers import ConversationSerializer, MessageSerializer, PasswordResetTokenSerializer
+from .models import Conversation, Message, PasswordResetToken, BatchJob
+from .serializers import ConversationSerializer, MessageSerializer, PasswordResetTokenSerializer, BatchJobSerializer
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
@@ -19,17 +19,30 @@ from django.utils import timezone
 from datetime import datetime, timedelta
 import uuid
 import json
-import requests
-import openai
+import time
 import logging
+from asgiref.sync import sync_to_async
 from .function_router import FunctionRouter
+from .streaming import build_history, build_user_content, iter_chat_events, stream_chat_events
+from .provider_registry import provider_registry
+from .utils.generation_control import cancel_generation
+from .utils.failover import complete_with_failover
 from .middleware.rate_limit import rate_limit
+from .utils.http_pool import get_pool_stats
+from .utils.circuit_breaker import get_breaker_stats
+from .utils.concurrency_limiter import get_limiter_stats
+from .utils.response_cache import get_cache_stats
+from .utils.semantic_cache import semantic_cache, standalone_options
+from .utils.single_flight import get_single_flight_stats
+from .utils.prompt_cache import get_prompt_cache_stats
+from .utils.query_embedding import get_query_cache_stats
+from .utils.usage_metrics import record_message_usage, aggregate_usage, parse_window
+from .utils import batch_jobs
 
 logger = logging.getLogger(__name__)
 
 # 导入功能路由器
 from .function_router import FunctionRouter
-from .utils.knowledge_base import real_time_source
 function_router = FunctionRouter()
 
 
@@ -153,12 +166,13 @@ class MessageViewSet(viewsets.ModelViewSet):
                 # 调用AI API
                 ai_response = self._call_ai_api(conversation, user_message, model)
                 
-                # 保存AI回复
+                # 保存AI回复及用量
                 ai_message = Message.objects.create(
                     conversation=conversation,
                     role='assistant',
-                    content=ai_response
+                    content=ai_response['content']
                 )
+                record_message_usage(ai_message, ai_response)
                 
                 # 更新会话更新时间
                 conversation.save()
@@ -176,353 +190,70 @@ class MessageViewSet(viewsets.ModelViewSet):
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
     def _call_ai_api(self, conversation, user_message, model):
-        """调用AI API（优化请求速度）"""
-        # 构建对话历史（优化查询和处理）
-        history = []
-        
-        # 获取最近的对话历史（最多8条，减少API调用时间）
-        messages = Message.objects.filter(conversation=conversation).order_by('created_at')
-        
-        # 只保留用户和助手的消息
-        history_messages = []
-        for msg in messages:
-            if msg.role == 'user':
-                if msg.image_url:
-                    history_messages.append({
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": msg.content},
-                            {"type": "image_url", "image_url": {"url": msg.image_url}}
-                        ]
-                    })
-                else:
-                    history_messages.append({
-                        "role": "user",
-                        "content": msg.content
-                    })
-            elif msg.role == 'assistant':
-                history_messages.append({
-                    "role": "assistant",
-                    "content": msg.content
-                })
-        
-        # 最多保留8条对话历史，减少API调用负载
-        history = history_messages[-8:]
-        
-        # 根据模型类型选择API
-        if model.startswith('gpt'):
-            # OpenAI API
-            try:
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=history,
-                    max_tokens=2000,
-                    temperature=0.6,
-                    top_p=0.7,
-                    top_k=30,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0
-                )
-                
-                if 'choices' in response and len(response['choices']) > 0:
-                    return response['choices'][0]['message']['content']
-            except Exception as e:
-                return f"抱歉，请求OpenAI服务时发生错误：{str(e)}"
-        elif model.startswith('gemini'):
-            # Google Gemini API
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.gemini_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('GEMINI_API_KEY')
-            if not api_key:
-                return "抱歉，Google Gemini API密钥未配置。"
-                
-            import google.generativeai as genai
-            genai.configure(api_key=api_key)
-            
-            # 映射模型名称
-            if model in ['gemini-pro', 'gemini-1.0-pro']:
-                model_name = 'gemini-1.0-pro'
-            elif model in ['gemini-1.5-pro']:
-                model_name = 'gemini-1.5-pro'
-            elif model in ['gemini-ultra', 'gemini-1.0-ultra']:
-                model_name = 'gemini-1.0-ultra'
-            else:
-                model_name = 'gemini-1.0-pro'  # 默认模型
+        """调用AI API"""
+        return _call_ai_api_sync(conversation, user_message, model, user=self.request.user)
 
-            try:
-                gemini_model = genai.GenerativeModel(model_name)
-                
-                # 将历史消息转换为Gemini格式
-                gemini_history = []
-                for msg in history:
-                    role = 'user' if msg['role'] == 'user' else 'model'  # Gemini使用'model'而不是'assistant'
-                    parts = []
-                    
-                    if isinstance(msg['content'], str):
-                        parts.append(msg['content'])
-                    elif isinstance(msg['content'], list):
-                        for item in msg['content']:
-                            if item['type'] == 'text':
-                                parts.append(item['text'])
-                            elif item['type'] == 'image_url':
-                                # Gemini暂时不支持直接处理图像URL，这里简化处理
-                                parts.append("用户发送了一张图片")
-                    
-                    gemini_history.append({
-                        'role': role,
-                        'parts': parts
-                    })
-                
-                generation_config = {
-                    "temperature": 0.6,
-                    "top_p": 0.7,
-                    "top_k": 30,
-                    "max_output_tokens": 2000,
-                }
 
-                # 开始聊天
-                chat = gemini_model.start_chat(history=gemini_history[:-1])  # 除了最后一条消息外的所有历史
-                
-                # 发送最后一条消息
-                response = chat.send_message(
-                    gemini_history[-1]['parts'],  # 最后一条消息的内容
-                    generation_config=generation_config
-                )
-                
-                return response.text
-                
-            except Exception as e:
-                return f"抱歉，请求Google Gemini服务时发生错误：{str(e)}"
-        elif model.startswith('kimi'):  # Moonshot Kimi API
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.kimi_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('KIMI_API_KEY')
-            if not api_key:
-                return "抱歉，Kimi API密钥未配置。"
-                
-            try:
-                headers = {
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-                
-                url = settings.LLM_CONFIG.get('KIMI_API_BASE_URL', 'https://api.moonshot.cn/v1/chat/completions')
-                
-                data = {
-                    'model': model,
-                    'messages': history,
-                    'max_tokens': 2000,
-                    'temperature': 0.6,
-                    'top_p': 0.7,
-                    'top_k': 30,
-                    'frequency_penalty': 0.0,
-                    'presence_penalty': 0.0
-                }
-                
-                response = requests.post(url, headers=headers, json=data, timeout=30)
-                
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if 'choices' in response_data and len(response_data['choices']) > 0:
-                        return response_data['choices'][0]['message']['content']
-                    else:
-                        return "抱歉，Kimi API响应格式错误。"
-                else:
-                    return f"抱歉，请求Kimi服务时发生错误：{response.status_code} - {response.text}"
-                    
-            except requests.exceptions.Timeout:
-                return "抱歉，请求超时。请稍后再试。"
-            except requests.exceptions.RequestException as e:
-                return f"抱歉，请求Kimi服务时发生错误：{str(e)}"
-        elif model.startswith('doubao'):  # 字节跳动豆包API
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.doubao_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('DOUBAO_API_KEY')
-            if not api_key:
-                return "抱歉，豆包API密钥未配置。"
-                
-            try:
-                headers = {
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-                
-                # 豆包API的URL和具体参数可能需要根据实际文档调整
-                url = settings.LLM_CONFIG.get('DOUBAO_API_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3/chat/completions')
-                
-                data = {
-                    'model': model,
-                    'messages': history,
-                    'max_tokens': 2000,
-                    'temperature': 0.6,
-                    'top_p': 0.7,
-                    'top_k': 30,
-                    'frequency_penalty': 0.0,
-                    'presence_penalty': 0.0
-                }
-                
-                response = requests.post(url, headers=headers, json=data, timeout=30)
-                
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if 'choices' in response_data and len(response_data['choices']) > 0:
-                        return response_data['choices'][0]['message']['content']
-                    else:
-                        return "抱歉，豆包API响应格式错误。"
-                else:
-                    return f"抱歉，请求豆包服务时发生错误：{response.status_code} - {response.text}"
-                    
-            except requests.exceptions.Timeout:
-                return "抱歉，请求超时。请稍后再试。"
-            except requests.exceptions.RequestException as e:
-                return f"抱歉，请求豆包服务时发生错误：{str(e)}"
-        elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-            # 针对代码的Qwen模型
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.qwen_code_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('QWEN_CODE_API_KEY')
-            if not api_key:
-                return "抱歉，通义千问代码API密钥未配置。"
-                
-            url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            data = {
-                "model": model,
-                "messages": history,
-                "max_tokens": 2000,
-                "temperature": 0.6,
-                "top_p": 0.7,
-                "top_k": 30,
-                "frequency_penalty": 0.0,
-                "presence_penalty": 0.0
-            }
-            
-            try:
-                response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-                
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if 'choices' in response_data and len(response_data['choices']) > 0:
-                        return response_data['choices'][0]['message']['content']
-                    else:
-                        return "抱歉，Qwen_Code API响应格式错误。"
-                else:
-                    return f"抱歉，请求Qwen_Code服务时发生错误：{response.status_code} - {response.text}"
-                    
-            except requests.exceptions.Timeout:
-                return "抱歉，请求超时。请稍后再试。"
-            except requests.exceptions.RequestException as e:
-                return f"抱歉，请求Qwen_Code服务时发生错误：{str(e)}"
-        elif model.startswith('deepseek'):
-            # DeepSeek API - 优先使用用户的API密钥
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.deepseek_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('DEEPSEEK_API_KEY')
-            if not api_key:
-                return "抱歉，DeepSeek API密钥未配置。"
-                
-            url = "https://api.deepseek.com/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            data = {
-                "model": model,
-                "messages": history,
-                "max_tokens": 2000,
-                "temperature": 0.6,
-                "top_p": 0.7,
-                "top_k": 30,
-                "frequency_penalty": 0.0,
-                "presence_penalty": 0.0
-            }
-            
-            try:
-                response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-                
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if 'choices' in response_data and len(response_data['choices']) > 0:
-                        return response_data['choices'][0]['message']['content']
-                    else:
-                        return "抱歉，DeepSeek API响应格式错误。"
-                else:
-                    return f"抱歉，请求DeepSeek服务时发生错误：{response.status_code} - {response.text}"
-                    
-            except requests.exceptions.Timeout:
-                return "抱歉，请求超时。请稍后再试。"
-            except requests.exceptions.RequestException as e:
-                return f"抱歉，请求DeepSeek服务时发生错误：{str(e)}"
-        elif model.startswith('qwen'):
-            # Qwen API
-            api_key = getattr(request.user, 'profile', None) and request.user.profile.qwen_api_key
-            if not api_key:
-                # 如果用户没有配置，尝试使用全局配置
-                api_key = settings.LLM_CONFIG.get('QWEN_API_KEY')
-            if not api_key:
-                return "抱歉，通义千问API密钥未配置。"
-                
-            url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            data = {
-                "model": model,
-                "messages": history,
-                "max_tokens": 2000,
-                "temperature": 0.6,
-                "top_p": 0.7,
-                "top_k": 30,
-                "frequency_penalty": 0.0,
-                "presence_penalty": 0.0
-            }
-            
-            try:
-                response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-                
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if 'choices' in response_data and len(response_data['choices']) > 0:
-                        return response_data['choices'][0]['message']['content']
-                    else:
-                        return "抱歉，Qwen API响应格式错误。"
-                else:
-                    return f"抱歉，请求Qwen服务时发生错误：{response.status_code} - {response.text}"
-                    
-            except requests.exceptions.Timeout:
-                return "抱歉，请求超时。请稍后再试。"
-            except requests.exceptions.RequestException as e:
-                return f"抱歉，请求Qwen服务时发生错误：{str(e)}"
-        else:
-            # 默认使用OpenAI API
-            try:
-                response = openai.ChatCompletion.create(
-                    model='gpt-3.5-turbo',
-                    messages=history,
-                    max_tokens=2000,
-                    temperature=0.6,
-                    top_p=0.7,
-                    top_k=30,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0
-                )
-                
-                if 'choices' in response and len(response['choices']) > 0:
-                    return response['choices'][0]['message']['content']
-            except Exception as e:
-                return f"抱歉，请求AI服务时发生错误：{str(e)}"
+class BatchJobViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """批量对话补全任务视图集"""
+    serializer_class = BatchJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        return BatchJob.objects.filter(user=self.request.user).order_by('-created_at')
+    
+    def create(self, request):
+        """
+        创建批量任务并提交后台执行
+        条目通过items（JSON列表）传入，或上传JSONL文件（file），每条为 {"custom_id": ..., "prompt": ...}
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            if request.FILES.get('file'):
+                items = batch_jobs.parse_jsonl(request.FILES['file'])
+            else:
+                items = request.data.get('items')
+            items = batch_jobs.parse_items(items)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        job = batch_jobs.create_batch_job(request.user, items=items, **serializer.validated_data)
+        queued = batch_jobs.enqueue_batch_job(job)
+        return Response(dict(self.get_serializer(job).data, queued=queued), status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['get'])
+    def results(self, request, pk=None):
+        """以JSONL流式导出结果，可按status过滤"""
+        job = self.get_object()
+        response = StreamingHttpResponse(
+            batch_jobs.iter_results_jsonl(job, request.query_params.get('status') or None),
+            content_type='application/x-ndjson; charset=utf-8'
+        )
+        response['Content-Disposition'] = f'attachment; filename="batch-{job.id}.jsonl"'
+        return response
+    
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """取消任务，已完成的条目保留"""
+        job = self.get_object()
+        batch_jobs.cancel_batch_job(job)
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+    
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """继续执行中断或取消的任务，retry_failed=true时重新执行失败的条目"""
+        job = self.get_object()
+        # 状态为running但没有执行锁时，执行进程已退出，允许继续执行
+        if job.status == 'running' and batch_jobs.is_batch_job_running(job):
+            return Response({'error': '任务正在执行'}, status=status.HTTP_409_CONFLICT)
+        retry_failed = str(request.data.get('retry_failed', '')).lower() in ('1', 'true')
+        if job.status == 'completed' and not retry_failed:
+            return Response({'error': '任务已完成'}, status=status.HTTP_400_BAD_REQUEST)
+        queued = batch_jobs.resume_batch_job(job, retry_failed)
+        job.refresh_from_db()
+        return Response(dict(self.get_serializer(job).data, queued=queued))
 
 
 @api_view(['POST'])
@@ -572,60 +303,15 @@ def chat(request):
         )
         
         # 调用AI API
-        history = []
-        messages = Message.objects.filter(conversation=conversation).order_by('created_at')
-        for msg in messages:
-            if msg.role == 'user':
-                if msg.image_url:
-                    history.append({
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": msg.content},
-                            {"type": "image_url", "image_url": {"url": msg.image_url}}
-                        ]
-                    })
-                else:
-                    history.append({
-                        "role": "user",
-                        "content": msg.content
-                    })
-            elif msg.role == 'assistant':
-                history.append({
-                    "role": "assistant",
-                    "content": msg.content
-                })
-        
-        # 根据模型类型选择API
-        if model.startswith('gpt'):
-            # OpenAI API
-            try:
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=history,
-                    max_tokens=2000,
-                    temperature=0.6,
-                    top_p=0.7,
-                    top_k=30,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0
-                )
-                
-                if 'choices' in response and len(response['choices']) > 0:
-                    response_text = response['choices'][0]['message']['content']
-                else:
-                    response_text = "抱歉，AI服务暂时不可用。"
-            except Exception as e:
-                response_text = f"抱歉，请求OpenAI服务时发生错误：{str(e)}"
-        else:
-            # 使用通用API调用函数
-            response_text = _call_ai_api_sync(conversation, user_message, model)
+        ai_response = _call_ai_api_sync(conversation, user_message, validated_model, user=request.user)
         
-        # 保存AI回复
+        # 保存AI回复及用量
         ai_message = Message.objects.create(
             conversation=conversation,
             role='assistant',
-            content=response_text
+            content=ai_response['content']
         )
+        record_message_usage(ai_message, ai_response)
         
         return Response({
             'conversation_id': conversation.id,
@@ -667,124 +353,111 @@ def stream_chat(request):
         if not is_valid:
             return Response({'error': validated_model}, status=status.HTTP_400_BAD_REQUEST)
     
+    # 可选的客户端请求ID，用于取消生成
+    is_valid, validated_request_id = validate_input_data(request.data.get('request_id'), '请求ID', max_length=100, allow_empty=True)
+    if not is_valid:
+        return Response({'error': validated_request_id}, status=status.HTTP_400_BAD_REQUEST)
+    
+    is_valid, conversation_id = validate_conversation_id(conversation_id)
+    if not is_valid:
+        return Response({'error': conversation_id}, status=status.HTTP_400_BAD_REQUEST)
+    
     def event_stream():
+        events = iter_chat_events(
+            request.user, validated_message, validated_model, conversation_id,
+            validated_image_url if image_url else None, validated_request_id
+        )
         try:
-            # 创建或获取会话
-            if conversation_id:
-                conversation = Conversation.objects.get(id=conversation_id, user=request.user)
-            else:
-                title = validated_message[:50] if len(validated_message) > 50 else validated_message
-                conversation = Conversation.objects.create(
-                    user=request.user,
-                    title=title,
-                    model=validated_model
-                )
-            
-            # 保存用户消息
-            user_message = Message.objects.create(
-                conversation=conversation,
-                role='user',
-                content=validated_message,
-                image_url=validated_image_url if image_url else None
-            )
-            
-            # 发送初始消息
-            yield f"data: {json.dumps({'type': 'user_message', 'message': MessageSerializer(user_message).data})}\n\n"
-            
-            # 查询知识库获取相关上下文
-            try:
-                knowledge_contexts = real_time_source.get_relevant_context(validated_message)
-                if knowledge_contexts:
-                    # 将知识库上下文添加到历史记录中
-                    knowledge_prompt = "根据以下最新信息回答问题：" + "\n".join(knowledge_contexts[:3])  # 最多使用3个相关文档
-                else:
-                    knowledge_prompt = ""
-            except Exception as e:
-                logger.warning(f"知识库查询失败: {str(e)}")
-                knowledge_prompt = ""
-            
-            # 根据模型类型选择流式API
-            if model.startswith('gpt'):
-                # OpenAI流式API
-                try:
-                    # 构建消息历史，包含知识库上下文
-                    history = [{"role": m['role'], "content": m['content']} for m in _build_history(conversation)]
-                    
-                    # 如果有知识库上下文，将其作为系统消息添加
-                    if knowledge_prompt:
-                        history.insert(0, {"role": "system", "content": knowledge_prompt})
-                    
-                    response = openai.ChatCompletion.create(
-                        model=model,
-                        messages=history,
-                        max_tokens=2000,
-                        temperature=0.6,
-                        top_p=0.7,
-                        top_k=30,
-                        frequency_penalty=0.0,
-                        presence_penalty=0.0,
-                        stream=True  # 启用流式响应
-                    )
-                    
-                    full_response = ""
-                    for chunk in response:
-                        if 'choices' in chunk and len(chunk['choices']) > 0:
-                            delta = chunk['choices'][0]['delta']
-                            if 'content' in delta:
-                                content = delta['content']
-                                full_response += content
-                                
-                                # 发送流式数据
-                                yield f"data: {json.dumps({'type': 'token', 'content': content})}\n\n"
-                    
-                    # 保存完整的AI回复
-                    ai_message = Message.objects.create(
-                        conversation=conversation,
-                        role='assistant',
-                        content=full_response
-                    )
-                    
-                    # 发送完成信号
-                    yield f"data: {json.dumps({'type': 'complete', 'message': MessageSerializer(ai_message).data})}\n\n"
-                    
-                except Exception as e:
-                    error_msg = f"抱歉，请求OpenAI服务时发生错误：{str(e)}"
-                    yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
-            
-            else:
-                # 对于其他模型，我们模拟流式响应
-                try:
-                    # 调用非流式API获取完整响应，传递知识库上下文
-                    full_response = _call_ai_api_sync(conversation, user_message, model, knowledge_prompt)
-                    
-                    # 模拟流式发送（逐字发送）
-                    words = full_response.split(' ')
-                    full_response_text = ""
-                    
-                    for word in words:
-                        full_response_text += word + " "
-                        yield f"data: {json.dumps({'type': 'token', 'content': word + ' '})}\n\n"
-                    
-                    # 保存完整的AI回复
-                    ai_message = Message.objects.create(
-                        conversation=conversation,
-                        role='assistant',
-                        content=full_response
-                    )
-                    
-                    # 发送完成信号
-                    yield f"data: {json.dumps({'type': 'complete', 'message': MessageSerializer(ai_message).data})}\n\n"
-                    
-                except Exception as e:
-                    error_msg = f"抱歉，请求AI服务时发生错误：{str(e)}"
-                    yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
-                    
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            # 客户端断开时WSGI服务器会关闭本生成器，需要同时关闭内层生成器以中断上游请求
+            events.close()
+    
+    return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+
+
+def _authenticate_jwt(request):
+    """使用JWT认证请求，返回用户或None"""
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except exceptions.AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+@rate_limit(max_requests=30, window_size=60, block_malicious=True)  # 每分钟最多30次流式聊天请求
+async def async_stream_chat(request):
+    """异步流式聊天接口（ASGI），流式过程中不占用工作线程"""
+    if request.method != 'POST':
+        return JsonResponse({'error': '仅支持POST请求'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    user = await sync_to_async(_authenticate_jwt)(request)
+    if user is None:
+        return JsonResponse({'error': '用户未认证，请先登录'}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    try:
+        data = json.loads(request.body or b'{}')
+    except json.JSONDecodeError:
+        return JsonResponse({'error': '请求体必须是JSON格式'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    conversation_id = data.get('conversation_id')
+    image_url = data.get('image_url')
+    model = data.get('model', 'gpt-3.5-turbo')
+    
+    # 验证输入数据
+    is_valid, validated_message = validate_input_data(data.get('message'), '消息', max_length=5000)
+    if not is_valid:
+        return JsonResponse({'error': validated_message}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if image_url:
+        is_valid, image_url = validate_input_data(image_url, '图片URL', max_length=2000)
+        if not is_valid:
+            return JsonResponse({'error': image_url}, status=status.HTTP_400_BAD_REQUEST)
+    
+    is_valid, validated_model = validate_input_data(model, '模型', max_length=100)
+    if not is_valid:
+        return JsonResponse({'error': validated_model}, status=status.HTTP_400_BAD_REQUEST)
+    
+    is_valid, request_id = validate_input_data(data.get('request_id'), '请求ID', max_length=100, allow_empty=True)
+    if not is_valid:
+        return JsonResponse({'error': request_id}, status=status.HTTP_400_BAD_REQUEST)
+    
+    is_valid, conversation_id = validate_conversation_id(conversation_id)
+    if not is_valid:
+        return JsonResponse({'error': conversation_id}, status=status.HTTP_400_BAD_REQUEST)
+    
+    async def event_stream():
+        events = stream_chat_events(user, validated_message, validated_model, conversation_id, image_url, request_id)
+        try:
+            async for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            # 客户端断开导致任务取消时，确保内层生成器立即关闭上游请求并保存已生成的部分
+            await events.aclose()
     
     return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
 
 
+# 使用JWT认证，无需CSRF校验（Django 4.2的csrf_exempt装饰器不支持异步视图）
+async_stream_chat.csrf_exempt = True
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def cancel_stream_chat(request):
+    """按请求ID取消进行中的生成，已生成的部分会被保存并标记为中断"""
+    is_valid, request_id = validate_input_data(request.data.get('request_id'), '请求ID', max_length=100)
+    if not is_valid:
+        return Response({'error': request_id}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if not cancel_generation(request.user.id, request_id):
+        return Response({'error': '生成请求不存在或已结束'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({'status': 'cancelling', 'request_id': request_id})
+
+
 def validate_input_data(data, field_name, max_length=1000, allow_empty=False):
     """
     验证输入数据的安全性和有效性
@@ -825,481 +498,67 @@ def validate_input_data(data, field_name, max_length=1000, allow_empty=False):
     return True, data.strip()
 
 
-def _build_history(conversation):
-    """构建对话历史"""
-    messages = Message.objects.filter(conversation=conversation).order_by('created_at')
-    history = []
-    for msg in messages:
-        if msg.role == 'user':
-            history.append({"role": "user", "content": msg.content})
-        elif msg.role == 'assistant':
-            history.append({"role": "assistant", "content": msg.content})
-    return history
-
-
-def _call_ai_api_sync(conversation, user_message, model, knowledge_context=""):
-    """同步调用AI API（复用现有逻辑）"""
-    # 构建对话历史
-    history = []
-    
-    messages = Message.objects.filter(conversation=conversation).order_by('created_at')
-    
-    # 只保留用户和助手的消息
-    history_messages = []
-    for msg in messages:
-        if msg.role == 'user':
-            if msg.image_url:
-                history_messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": msg.content},
-                        {"type": "image_url", "image_url": {"url": msg.image_url}}
-                    ]
-                })
-            else:
-                history_messages.append({
-                    "role": "user",
-                    "content": msg.content
-                })
-        elif msg.role == 'assistant':
-            history_messages.append({
-                "role": "assistant",
-                "content": msg.content
-            })
-    
-    # 最多保留8条对话历史
-    history = history_messages[-8:]
-    
-    # 如果有知识库上下文，将其作为系统消息添加到历史记录的开头
-    if knowledge_context:
-        history.insert(0, {
-            "role": "system",
-            "content": knowledge_context
-        })
+def validate_conversation_id(value):
+    """
+    验证可选的会话ID，流式接口在返回200之前调用，避免非法ID在流中途出错
     
-    # 根据模型类型选择API（与原逻辑相同）
-    if model.startswith('gpt'):
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                max_tokens=2000,
-                temperature=0.6,
-                top_p=0.7,
-                top_k=30,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
-            
-            if 'choices' in response and len(response['choices']) > 0:
-                return response['choices'][0]['message']['content']
-        except Exception as e:
-            return f"抱歉，请求OpenAI服务时发生错误：{str(e)}"
-    elif model.startswith('gemini'):
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.gemini_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('GEMINI_API_KEY')
-        if not api_key:
-            return "抱歉，Gemini API密钥未配置。"
-            
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        
-        if model in ['gemini-pro', 'gemini-1.0-pro']:
-            model_name = 'gemini-1.0-pro'
-        elif model in ['gemini-1.5-pro']:
-            model_name = 'gemini-1.5-pro'
-        elif model in ['gemini-ultra', 'gemini-1.0-ultra']:
-            model_name = 'gemini-1.0-ultra'
-        else:
-            model_name = 'gemini-1.0-pro'
+    Returns:
+        tuple: (is_valid, 会话ID(int)或None or error_message)
+    """
+    if value in (None, ''):
+        return True, None
+    if isinstance(value, bool):
+        return False, "会话ID 必须是正整数"
+    try:
+        conversation_id = int(value)
+    except (TypeError, ValueError):
+        return False, "会话ID 必须是正整数"
+    if conversation_id <= 0 or (isinstance(value, float) and value != conversation_id):
+        return False, "会话ID 必须是正整数"
+    return True, conversation_id
 
-        try:
-            gemini_model = genai.GenerativeModel(model_name)
-            
-            gemini_history = []
-            for msg in history:
-                role = 'user' if msg['role'] == 'user' else 'model'
-                parts = []
-                
-                if isinstance(msg['content'], str):
-                    parts.append(msg['content'])
-                elif isinstance(msg['content'], list):
-                    for item in msg['content']:
-                        if item['type'] == 'text':
-                            parts.append(item['text'])
-                        elif item['type'] == 'image_url':
-                            parts.append("用户发送了一张图片")
-                
-                gemini_history.append({
-                    'role': role,
-                    'parts': parts
-                })
-            
-            generation_config = {
-                "temperature": 0.6,
-                "top_p": 0.7,
-                "top_k": 30,
-                "max_output_tokens": 2000,
-            }
 
-            chat = gemini_model.start_chat(history=gemini_history[:-1])
-            response = chat.send_message(
-                gemini_history[-1]['parts'],
-                generation_config=generation_config
-            )
-            
-            return response.text
-            
-        except Exception as e:
-            return f"抱歉，请求Google Gemini服务时发生错误：{str(e)}"
-    elif model.startswith('kimi'):
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.kimi_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('KIMI_API_KEY')
-        if not api_key:
-            return "抱歉，Kimi API密钥未配置。"
-            
-        try:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            url = settings.LLM_CONFIG.get('KIMI_API_BASE_URL', 'https://api.moonshot.cn/v1/chat/completions')
-            
-            data = {
-                'model': model,
-                'messages': history,
-                'max_tokens': 2000,
-                'temperature': 0.6,
-                'top_p': 0.7,
-                'top_k': 30,
-                'frequency_penalty': 0.0,
-                'presence_penalty': 0.0
-            }
-            
-            response = requests.post(url, headers=headers, json=data, timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    return response_data['choices'][0]['message']['content']
-                else:
-                    return "抱歉，Kimi API响应格式错误。"
-            else:
-                return f"抱歉，请求Kimi服务时发生错误：{response.status_code} - {response.text}"
-                
-        except requests.exceptions.Timeout:
-            return "抱歉，请求超时。请稍后再试。"
-        except requests.exceptions.RequestException as e:
-            return f"抱歉，请求Kimi服务时发生错误：{str(e)}"
-    elif model.startswith('doubao'):
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.doubao_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('DOUBAO_API_KEY')
-        if not api_key:
-            return "抱歉，豆包API密钥未配置。"
-            
-        try:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            url = settings.LLM_CONFIG.get('DOUBAO_API_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3/chat/completions')
-            
-            data = {
-                'model': model,
-                'messages': history,
-                'max_tokens': 2000,
-                'temperature': 0.6,
-                'top_p': 0.7,
-                'top_k': 30,
-                'frequency_penalty': 0.0,
-                'presence_penalty': 0.0
-            }
-            
-            response = requests.post(url, headers=headers, json=data, timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    return response_data['choices'][0]['message']['content']
-                else:
-                    return "抱歉，豆包API响应格式错误。"
-            else:
-                return f"抱歉，请求豆包服务时发生错误：{response.status_code} - {response.text}"
-                
-        except requests.exceptions.Timeout:
-            return "抱歉，请求超时。请稍后再试。"
-        except requests.exceptions.RequestException as e:
-            return f"抱歉，请求豆包服务时发生错误：{str(e)}"
-    elif model.startswith('qwen-code') or model.startswith('qwen_coder'):
-        # Qwen Code API - 优先使用用户的API密钥
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.qwen_code_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('QWEN_CODE_API_KEY')
-        if not api_key:
-            return "抱歉，Qwen_Code API密钥未配置。"
-            
-        url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        data = {
-            "model": model,
-            "messages": history,
-            "max_tokens": 2000,
-            "temperature": 0.6,
-            "top_p": 0.7,
-            "top_k": 30,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0
-        }
-        
-        try:
-            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    return response_data['choices'][0]['message']['content']
-                else:
-                    return "抱歉，Qwen_Code API响应格式错误。"
-            else:
-                return f"抱歉，请求Qwen_Code服务时发生错误：{response.status_code} - {response.text}"
-                
-        except requests.exceptions.Timeout:
-            return "抱歉，请求超时。请稍后再试。"
-        except requests.exceptions.RequestException as e:
-            return f"抱歉，请求Qwen_Code服务时发生错误：{str(e)}"
-    elif model.startswith('deepseek'):
-        # DeepSeek API - 优先使用用户的API密钥
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.deepseek_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('DEEPSEEK_API_KEY')
-        if not api_key:
-            return "抱歉，DeepSeek API密钥未配置。"
-            
-        url = "https://api.deepseek.com/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        data = {
-            "model": model,
-            "messages": history,
-            "max_tokens": 2000,
-            "temperature": 0.6,
-            "top_p": 0.7,
-            "top_k": 30,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0
-        }
-        
-        try:
-            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    return response_data['choices'][0]['message']['content']
-                else:
-                    return "抱歉，DeepSeek API响应格式错误。"
-            else:
-                return f"抱歉，请求DeepSeek服务时发生错误：{response.status_code} - {response.text}"
-                
-        except requests.exceptions.Timeout:
-            return "抱歉，请求超时。请稍后再试。"
-        except requests.exceptions.RequestException as e:
-            return f"抱歉，请求DeepSeek服务时发生错误：{str(e)}"
-    elif model.startswith('qwen'):
-        # Qwen API - 优先使用用户的API密钥
-        api_key = getattr(request.user, 'profile', None) and request.user.profile.qwen_api_key
-        if not api_key:
-            # 如果用户没有配置，尝试使用全局配置
-            api_key = settings.LLM_CONFIG.get('QWEN_API_KEY')
-        if not api_key:
-            return "抱歉，Qwen API密钥未配置。"
-            
-        url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        data = {
-            "model": model,
-            "messages": history,
-            "max_tokens": 2000,
-            "temperature": 0.6,
-            "top_p": 0.7,
-            "top_k": 30,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0
-        }
-        
-        try:
-            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    return response_data['choices'][0]['message']['content']
-                else:
-                    return "抱歉，Qwen API响应格式错误。"
-            else:
-                return f"抱歉，请求Qwen服务时发生错误：{response.status_code} - {response.text}"
-                
-        except requests.exceptions.Timeout:
-            return "抱歉，请求超时。请稍后再试。"
-        except requests.exceptions.RequestException as e:
-            return f"抱歉，请求Qwen服务时发生错误：{str(e)}"
-    else:
-        try:
-            response = openai.ChatCompletion.create(
-                model='gpt-3.5-turbo',
-                messages=history,
-                max_tokens=2000,
-                temperature=0.6,
-                top_p=0.7,
-                top_k=30,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
-            
-            if 'choices' in response and len(response['choices']) > 0:
-                return response['choices'][0]['message']['content']
-        except Exception as e:
-            return f"抱歉，请求AI服务时发生错误：{str(e)}"
+def _call_ai_api_sync(conversation, user_message, model, knowledge_context="", user=None):
+    """
+    同步调用AI API，通过提供商注册表选择实现，支持故障转移和对冲请求
+    :return: 调用结果，包含回复内容(content)、用量(usage)、实际使用的模型和提供商、尝试次数和耗时(latency)；
+             调用失败时content为错误说明，不包含耗时
+    """
+    # 构建对话历史（不含当前用户消息，由提供商追加）
+    history = build_history(conversation, include_images=True, exclude_id=user_message.id)
+    
+    config = {
+        'model': model,
+        'temperature': 0.6,
+        'max_tokens': 2000,
+        'top_p': 0.7,
+        'timeout': 30,
+        'history': history,
+        # 如果有知识库上下文，将其作为系统消息添加
+        'system_prompt': knowledge_context,
+        'semantic_cache': standalone_options(user_message.content, history, image_url=user_message.image_url),
+    }
+    
+    try:
+        # 主模型失败或过慢时按备用链切换到其他模型
+        start = time.monotonic()
+        result = complete_with_failover(
+            model, build_user_content(user_message.content, user_message.image_url), config, user or conversation.user
+        )
+        result['latency'] = time.monotonic() - start
+        return result
+    except Exception as e:
+        logger.error(f"{model} API调用失败: {str(e)}")
+        return {'content': f"抱歉，请求AI服务时发生错误：{str(e)}"}
 
 
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def available_models(request):
-    """获取可用模型列表"""
-    # 从请求中获取用户信息
+    """获取可用模型列表（根据用户或全局配置的API密钥决定哪些模型可用）"""
+    # 从请求中获取用户信息，未登录时只使用全局配置
     user = request.user if hasattr(request, 'user') and request.user.is_authenticated else None
-    
-    # 初始化用户API密钥配置
-    user_api_keys = {}
-    if user and hasattr(user, 'profile'):
-        profile = user.profile
-        user_api_keys = {
-            'openai': profile.openai_api_key if profile.openai_api_key else settings.LLM_CONFIG.get('OPENAI_API_KEY'),
-            'deepseek': profile.deepseek_api_key if profile.deepseek_api_key else settings.LLM_CONFIG.get('DEEPSEEK_API_KEY'),
-            'qwen': profile.qwen_api_key if profile.qwen_api_key else settings.LLM_CONFIG.get('QWEN_API_KEY'),
-            'gemini': profile.gemini_api_key if profile.gemini_api_key else settings.LLM_CONFIG.get('GEMINI_API_KEY'),
-            'kimi': profile.kimi_api_key if profile.kimi_api_key else settings.LLM_CONFIG.get('KIMI_API_KEY'),
-            'doubao': profile.doubao_api_key if profile.doubao_api_key else settings.LLM_CONFIG.get('DOUBAO_API_KEY'),
-            'qwen_code': profile.qwen_code_api_key if profile.qwen_code_api_key else settings.LLM_CONFIG.get('QWEN_CODE_API_KEY'),
-        }
-    else:
-        # 如果用户未登录或无配置，则使用全局配置
-        user_api_keys = {
-            'openai': settings.LLM_CONFIG.get('OPENAI_API_KEY'),
-            'deepseek': settings.LLM_CONFIG.get('DEEPSEEK_API_KEY'),
-            'qwen': settings.LLM_CONFIG.get('QWEN_API_KEY'),
-            'gemini': settings.LLM_CONFIG.get('GEMINI_API_KEY'),
-            'kimi': settings.LLM_CONFIG.get('KIMI_API_KEY'),
-            'doubao': settings.LLM_CONFIG.get('DOUBAO_API_KEY'),
-            'qwen_code': settings.LLM_CONFIG.get('QWEN_CODE_API_KEY'),
-        }
-    
-    # 根据用户配置的API密钥决定哪些模型可用
-    available_models_list = []
-    
-    # OpenAI 模型
-    if user_api_keys.get('openai'):
-        available_models_list.extend([
-            {'id': 'gpt-4o', 'name': 'GPT-4o', 'provider': 'OpenAI', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'vision', 'audio'], 'pricing': {'input': 5.0, 'output': 15.0}, 'performance': {'speed': 'fast', 'accuracy': 'very_high'}},
-            {'id': 'gpt-4o-mini', 'name': 'GPT-4o Mini', 'provider': 'OpenAI', 'group': 'Efficient', 'available': True, 'capabilities': ['text', 'vision', 'audio'], 'pricing': {'input': 0.15, 'output': 0.6}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-            {'id': 'gpt-4-turbo', 'name': 'GPT-4 Turbo', 'provider': 'OpenAI', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'vision'], 'pricing': {'input': 10.0, 'output': 30.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'gpt-4', 'name': 'GPT-4', 'provider': 'OpenAI', 'group': 'High-End', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 30.0, 'output': 60.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
-            {'id': 'gpt-3.5-turbo', 'name': 'GPT-3.5 Turbo', 'provider': 'OpenAI', 'group': 'Basic', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.5, 'output': 1.5}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
-        ])
-    
-    # Google Gemini 模型
-    if user_api_keys.get('gemini'):
-        available_models_list.extend([
-            {'id': 'gemini-1.5-pro', 'name': 'Gemini 1.5 Pro', 'provider': 'Google', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'vision', 'audio', 'code', 'multimodal'], 'pricing': {'input': 3.5, 'output': 10.5}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'gemini-1.5-flash', 'name': 'Gemini 1.5 Flash', 'provider': 'Google', 'group': 'Efficient', 'available': True, 'capabilities': ['text', 'vision', 'audio', 'code', 'multimodal'], 'pricing': {'input': 0.35, 'output': 1.05}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-            {'id': 'gemini-pro', 'name': 'Gemini Pro', 'provider': 'Google', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'vision'], 'pricing': {'input': 0.5, 'output': 1.5}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-        ])
-    
-    # 阿里通义千问系列
-    if user_api_keys.get('qwen') or user_api_keys.get('qwen_code'):
-        available_models_list.extend([
-            {'id': 'qwen-max', 'name': '通义千问Max', 'provider': 'Alibaba', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'qwen-plus', 'name': '通义千问Plus', 'provider': 'Alibaba', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-            {'id': 'qwen-turbo', 'name': '通义千问Turbo', 'provider': 'Alibaba', 'group': 'Efficient', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.014, 'output': 0.028}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
-            {'id': 'qwen-coder', 'name': '通义千问Coder', 'provider': 'Alibaba', 'group': 'Specialized', 'available': True, 'capabilities': ['code'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-            {'id': 'qwen-math', 'name': '通义千问Math', 'provider': 'Alibaba', 'group': 'Specialized', 'available': True, 'capabilities': ['math'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'qwen-vl-max', 'name': '通义千问VL-Max', 'provider': 'Alibaba', 'group': 'Vision', 'available': True, 'capabilities': ['vision', 'text'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},  # 视觉语言模型
-            {'id': 'qwen-vl-plus', 'name': '通义千问VL-Plus', 'provider': 'Alibaba', 'group': 'Vision', 'available': True, 'capabilities': ['vision', 'text'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},  # 视觉语言模型
-            {'id': 'qwen-audio-turbo', 'name': '通义千问Audio-Turbo', 'provider': 'Alibaba', 'group': 'Audio', 'available': True, 'capabilities': ['audio', 'text'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},  # 音频模型
-            {'id': 'qwen_coder_plus', 'name': '通义千问Coder+', 'provider': 'Alibaba', 'group': 'Specialized', 'available': True, 'capabilities': ['code'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-            {'id': 'qwen_code_interpreter', 'name': '通义千问Code Interpreter', 'provider': 'Alibaba', 'group': 'Specialized', 'available': True, 'capabilities': ['code', 'execution'], 'pricing': {'input': 0.04, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-        ])
-    
-    # DeepSeek
-    if user_api_keys.get('deepseek'):
-        available_models_list.extend([
-            {'id': 'deepseek-chat', 'name': 'DeepSeek Chat', 'provider': 'DeepSeek', 'group': 'General', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-            {'id': 'deepseek-coder', 'name': 'DeepSeek Coder', 'provider': 'DeepSeek', 'group': 'Specialized', 'available': True, 'capabilities': ['code'], 'pricing': {'input': 0.14, 'output': 0.28}, 'performance': {'speed': 'fast', 'accuracy': 'very_high'}},
-        ])
-    
-    # 月之暗面(Kimi)
-    if user_api_keys.get('kimi'):
-        available_models_list.extend([
-            {'id': 'kimi-large', 'name': 'Kimi Large', 'provider': 'Moonshot', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 12.0, 'output': 12.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
-        ])
-    
-    # 豆包
-    if user_api_keys.get('doubao'):
-        available_models_list.extend([
-            {'id': 'doubao-pro', 'name': '豆包Pro', 'provider': 'ByteDance', 'group': 'General', 'available': True, 'capabilities': ['text', 'multimodal'], 'pricing': {'input': 0.5, 'output': 0.5}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-        ])
-    
-    # 其他模型（如果全局配置中有API密钥）
-    if settings.LLM_CONFIG.get('ANTHROPIC_API_KEY'):
-        available_models_list.extend([
-            {'id': 'claude-3-5-sonnet', 'name': 'Claude 3.5 Sonnet', 'provider': 'Anthropic', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 3.0, 'output': 15.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'claude-3-opus', 'name': 'Claude 3 Opus', 'provider': 'Anthropic', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 15.0, 'output': 75.0}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
-            {'id': 'claude-3-sonnet', 'name': 'Claude 3 Sonnet', 'provider': 'Anthropic', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 3.0, 'output': 15.0}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'claude-3-haiku', 'name': 'Claude 3 Haiku', 'provider': 'Anthropic', 'group': 'Efficient', 'available': True, 'capabilities': ['text', 'coding', 'reasoning'], 'pricing': {'input': 0.8, 'output': 4.0}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-        ])
-    
-    if settings.LLM_CONFIG.get('BAIDU_API_KEY'):
-        available_models_list.extend([
-            {'id': 'ernie-bot-4.5', 'name': '文心一言4.5', 'provider': 'Baidu', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.12, 'output': 0.12}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-            {'id': 'ernie-bot-4', 'name': '文心一言4', 'provider': 'Baidu', 'group': 'Basic', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.08, 'output': 0.08}, 'performance': {'speed': 'medium', 'accuracy': 'medium'}},
-        ])
-    
-    if settings.LLM_CONFIG.get('IFLYTEK_API_KEY'):
-        available_models_list.extend([
-            {'id': 'spark-max', 'name': '讯飞星火Max', 'provider': 'iFlytek', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.05, 'output': 0.05}, 'performance': {'speed': 'slow', 'accuracy': 'very_high'}},
-            {'id': 'spark-pro', 'name': '讯飞星火Pro', 'provider': 'iFlytek', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.02, 'output': 0.02}, 'performance': {'speed': 'medium', 'accuracy': 'high'}},
-            {'id': 'spark-lite', 'name': '讯飞星火Lite', 'provider': 'iFlytek', 'group': 'Efficient', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.008, 'output': 0.008}, 'performance': {'speed': 'fast', 'accuracy': 'medium'}},
-        ])
-    
-    if settings.LLM_CONFIG.get('ZHIPU_API_KEY'):
-        available_models_list.extend([
-            {'id': 'glm-4', 'name': 'GLM-4', 'provider': 'ZhipuAI', 'group': 'High-End', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.1, 'output': 0.1}, 'performance': {'speed': 'medium', 'accuracy': 'very_high'}},
-            {'id': 'glm-4-air', 'name': 'GLM-4 Air', 'provider': 'ZhipuAI', 'group': 'Mid-Range', 'available': True, 'capabilities': ['text', 'reasoning'], 'pricing': {'input': 0.05, 'output': 0.05}, 'performance': {'speed': 'fast', 'accuracy': 'high'}},
-            {'id': 'glm-4-flash', 'name': 'GLM-4 Flash', 'provider': 'ZhipuAI', 'group': 'Efficient', 'available': True, 'capabilities': ['text'], 'pricing': {'input': 0.01, 'output': 0.01}, 'performance': {'speed': 'very_fast', 'accuracy': 'medium'}},
-        ])
-    
-    return Response(available_models_list)
+    return Response(provider_registry.available_models(user))
 
 
 # 导入功能路由器
@@ -1399,7 +658,40 @@ def register_view(request):
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def health_check(request):
-    return Response({'status': 'ok', 'message': 'AI聊天机器人服务正常运行'})
+    return Response({
+        'status': 'ok',
+        'message': 'AI聊天机器人服务正常运行',
+        'http_pools': get_pool_stats(),
+        'circuit_breakers': get_breaker_stats(),
+        'concurrency': get_limiter_stats(),
+        'response_cache': get_cache_stats(),
+        'semantic_cache': semantic_cache.stats(),
+        'single_flight': get_single_flight_stats(),
+        'prompt_cache': get_prompt_cache_stats(),
+        'query_embedding': get_query_cache_stats(),
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def usage_stats(request):
+    """
+    按模型汇总助手回复的token消耗和延迟百分位
+    查询参数：window（时间窗口，如24h、7d，默认24h）、bucket（hour/day，按时间段分组）、model
+    """
+    bucket = request.query_params.get('bucket') or None
+    try:
+        until = timezone.now()
+        since = until - parse_window(request.query_params.get('window', '24h'))
+        results = aggregate_usage(since, until, bucket, request.query_params.get('model') or None)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'bucket': bucket,
+        'results': results,
+    })
 
 
 @api_view(['POST'])
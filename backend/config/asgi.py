@@ -1,12 +1,20 @@
+import os
+
+from django.core.asgi import get_asgi_application
+
+# 设置Django环境，必须在导入模型和消费者之前初始化
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django_asgi_app = get_asgi_application()
+
 from django.urls import path, include
 from django.contrib import admin
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
-from django.conf.urls import url
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from chatbot.consumers import VoiceCallConsumer
+from chatbot.consumers import VoiceCallConsumer, ChatConsumer
+from chatbot.middleware.websocket_auth import JWTAuthMiddlewareStack
+from chatbot.middleware.disconnect import ClientDisconnectMiddleware
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -31,13 +39,18 @@ urlpatterns = [
 # WebSocket路由
 websocket_urlpatterns = [
     path('ws/voice-call/', VoiceCallConsumer.as_asgi(), name='voice-call-ws'),
+    path('ws/chat/', ChatConsumer.as_asgi(), name='chat-ws'),
 ]
 
 # ASGI应用配置
 application = ProtocolTypeRouter({
-    "websocket": AuthMiddlewareStack(
+    # HTTP请求交给Django处理，异步视图（如异步流式聊天）直接在事件循环中运行
+    # 流式响应期间客户端断开会取消请求，停止上游生成
+    "http": ClientDisconnectMiddleware(django_asgi_app),
+    # 支持会话认证和查询参数中的JWT（?token=<access_token>）
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
     ),
-})
\ No newline at end of file
+})
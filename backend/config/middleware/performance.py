@@ -13,6 +13,7 @@ class PerformanceMiddleware(MiddlewareMixin):
     
     def __init__(self, get_response):
         self.get_response = get_response
+        super().__init__(get_response)
         self.request_times = {}
         self.slow_requests = []
         self.start_monitoring()
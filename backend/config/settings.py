@@ -289,6 +289,174 @@ LLM_CONFIG = {
     'DOUBAO_API_KEY': os.getenv('DOUBAO_API_KEY'),
     'QWEN_CODE_API_KEY': os.getenv('QWEN_CODE_API_KEY'),
     'DEFAULT_MODEL': 'gemini-pro',  # 默认模型
+    # HTTP连接池配置（每个进程、每个提供商一个长连接池）
+    'HTTP_POOL_CONNECTIONS': int(os.getenv('LLM_HTTP_POOL_CONNECTIONS', 4)),
+    'HTTP_POOL_MAXSIZE': int(os.getenv('LLM_HTTP_POOL_MAXSIZE', 20)),
+    'HTTP_POOL_BLOCK': os.getenv('LLM_HTTP_POOL_BLOCK', 'False').lower() == 'true',
+    'HTTP_MAX_RETRIES': int(os.getenv('LLM_HTTP_MAX_RETRIES', 2)),
+    'HTTP_RETRY_BACKOFF': float(os.getenv('LLM_HTTP_RETRY_BACKOFF', 0.3)),
+}
+
+# 大模型故障转移与对冲请求配置
+LLM_FAILOVER_CONFIG = {
+    # 备用链：键为模型ID或模型分组（provider_registry.MODEL_CATALOG中的group），值为依次尝试的备用模型
+    # 未配置API密钥的备用模型会被跳过
+    'CHAINS': {
+        'qwen-plus': ['deepseek-chat', 'gpt-4o-mini'],
+        'deepseek-chat': ['qwen-plus', 'gpt-4o-mini'],
+        'gpt-4o-mini': ['qwen-plus', 'deepseek-chat'],
+    },
+    # 对冲请求：主请求超过历史延迟的指定百分位仍未返回时，向下一个模型再发一次请求，先返回者胜出
+    'HEDGE_ENABLED': os.getenv('LLM_HEDGE_ENABLED', 'False').lower() == 'true',
+    'HEDGE_PERCENTILE': float(os.getenv('LLM_HEDGE_PERCENTILE', 95)),
+    'HEDGE_DEFAULT_DELAY': float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', 3.0)),  # 延迟样本不足时的等待时间（秒）
+    'HEDGE_MIN_DELAY': float(os.getenv('LLM_HEDGE_MIN_DELAY', 0.5)),
+    'LATENCY_WINDOW': 200,        # 每个模型保留的最近延迟样本数
+    'LATENCY_MIN_SAMPLES': 20,    # 按百分位计算前需要的最少样本数
+}
+
+# 大模型提供商熔断器配置（按提供商和API密钥分别统计）
+LLM_CIRCUIT_BREAKER_CONFIG = {
+    'ENABLED': os.getenv('LLM_CIRCUIT_BREAKER_ENABLED', 'True').lower() == 'true',
+    'WINDOW_SECONDS': 60,             # 滑动窗口长度（秒）
+    'MIN_REQUESTS': 5,                # 窗口内请求数达到该值后才判断是否熔断
+    'FAILURE_RATE_THRESHOLD': float(os.getenv('LLM_CIRCUIT_FAILURE_RATE', 0.5)),
+    'SLOW_CALL_SECONDS': 20.0,        # 超过该耗时（流式请求为首token耗时）视为慢请求
+    'SLOW_CALL_RATE_THRESHOLD': 0.8,
+    'OPEN_SECONDS': int(os.getenv('LLM_CIRCUIT_OPEN_SECONDS', 30)),  # 熔断持续时间，之后放行探测请求
+    'DEGRADED_SCORE': 0.8,            # 健康分低于该值时在模型列表中标记为降级
+}
+
+# 大模型提供商自适应并发限制（按 提供商 + API密钥，默认缓存为Redis时多进程共享）
+LLM_CONCURRENCY_CONFIG = {
+    'ENABLED': os.getenv('LLM_CONCURRENCY_ENABLED', 'True').lower() == 'true',
+    'BACKEND': os.getenv('LLM_CONCURRENCY_BACKEND', 'auto'),  # auto/redis/local
+    # 初始并发上限，未设置时等于MAX_LIMIT（只在429或延迟过高时减少）
+    'INITIAL_LIMIT': int(os.getenv('LLM_CONCURRENCY_INITIAL')) if os.getenv('LLM_CONCURRENCY_INITIAL') else None,
+    'MIN_LIMIT': 1,
+    'MAX_LIMIT': int(os.getenv('LLM_CONCURRENCY_MAX', 64)),
+    'INCREASE_STEP': 1.0,             # 成功时增加 INCREASE_STEP / 当前上限
+    'DECREASE_FACTOR': 0.5,           # 遇到429时乘以该系数
+    'LATENCY_THRESHOLD': 20.0,        # 超过该延迟视为过载，并发上限乘以LATENCY_DECREASE_FACTOR
+    'LATENCY_DECREASE_FACTOR': 0.9,
+    'TPM_LIMIT': None,                # 每分钟token上限，None表示不限制
+    'QUEUE_TIMEOUT': float(os.getenv('LLM_QUEUE_TIMEOUT', 30)),  # 排队截止时间（秒）
+    'LEASE_TTL': 600,
+    'POLL_INTERVAL': 0.05,
+    # 按提供商名称覆盖，如 {'DeepSeek': {'MAX_LIMIT': 16, 'TPM_LIMIT': 300000}}
+    'PROVIDERS': {},
+}
+
+# 大模型响应缓存（精确匹配，调用时传入cache=True才使用，写入api_cache缓存）
+LLM_RESPONSE_CACHE_CONFIG = {
+    'ENABLED': os.getenv('LLM_RESPONSE_CACHE_ENABLED', 'True').lower() == 'true',
+    'ALIAS': 'api_cache',
+    'TTL': int(os.getenv('LLM_RESPONSE_CACHE_TTL', 60 * 60)),
+    'MAX_ENTRIES': int(os.getenv('LLM_RESPONSE_CACHE_MAX_ENTRIES', 10000)),
+    'MAX_CONTENT_CHARS': 20000,       # 超过该长度的回答不缓存
+    'ALLOW_SAMPLING': False,          # temperature>0的请求默认不缓存，调用时可传入cache_allow_sampling=True
+}
+
+# 大模型语义缓存：没有上文的问题与缓存问题的句向量相似度超过意图阈值时复用回答
+LLM_SEMANTIC_CACHE_CONFIG = {
+    'ENABLED': os.getenv('LLM_SEMANTIC_CACHE_ENABLED', 'True').lower() == 'true',
+    # 按意图设置的相似度阈值，未列出的意图使用default，设为None的意图不使用语义缓存
+    'THRESHOLDS': {
+        'default': float(os.getenv('LLM_SEMANTIC_CACHE_THRESHOLD', 0.95)),
+        'encyclopedia': float(os.getenv('LLM_SEMANTIC_CACHE_ENCYCLOPEDIA_THRESHOLD', 0.92)),
+    },
+    'NEAR_MISS_MARGIN': 0.05,         # 低于阈值不超过该值的相似度写入日志，用于调整阈值
+    'MAX_ENTRIES': int(os.getenv('LLM_SEMANTIC_CACHE_MAX_ENTRIES', 5000)),
+    'TTL': int(os.getenv('LLM_SEMANTIC_CACHE_TTL', 60 * 60)),
+    'MAX_QUESTION_CHARS': 500,
+}
+
+# 大模型请求合并：相同的可共享请求同时进行时只调用一次上游，默认缓存为Redis时跨进程合并
+LLM_SINGLE_FLIGHT_CONFIG = {
+    'ENABLED': os.getenv('LLM_SINGLE_FLIGHT_ENABLED', 'True').lower() == 'true',
+    'BACKEND': os.getenv('LLM_SINGLE_FLIGHT_BACKEND', 'auto'),  # auto / redis / local
+    'WAIT_TIMEOUT': int(os.getenv('LLM_SINGLE_FLIGHT_WAIT_TIMEOUT', 120)),
+    'LOCK_TTL': 120,
+    'CHUNK_FLUSH_INTERVAL_MS': 50,
+    'CHUNK_FLUSH_SIZE': 16,
+}
+
+# 会话历史窗口缓存：每个会话缓存最近的消息，构建历史时不再读取整个会话
+CHAT_HISTORY_CACHE_CONFIG = {
+    'ENABLED': os.getenv('CHAT_HISTORY_CACHE_ENABLED', 'True').lower() == 'true',
+    'BACKEND': os.getenv('CHAT_HISTORY_CACHE_BACKEND', 'auto'),  # auto / redis / local
+    'WINDOW': int(os.getenv('CHAT_HISTORY_CACHE_WINDOW', 50)),
+    'TTL': 60 * 60 * 24,
+    'MAX_CONVERSATIONS': 1000,
+}
+
+# 按token预算组装上下文：在模型上下文窗口和历史预算内保留最新的历史，上下文窗口见chatbot/utils/context_builder.py
+LLM_CONTEXT_CONFIG = {
+    'ENABLED': os.getenv('LLM_CONTEXT_BUDGET_ENABLED', 'True').lower() == 'true',
+    'MAX_HISTORY_TOKENS': int(os.getenv('LLM_CONTEXT_MAX_HISTORY_TOKENS', 4000)),
+    'DEFAULT_CONTEXT_WINDOW': int(os.getenv('LLM_CONTEXT_DEFAULT_WINDOW', 8192)),
+    # 其他提供商分词器相对cl100k_base的token数比例，如 {'DeepSeek': 0.8}
+    'TOKEN_RATIOS': {},
+    # prefix_cache：知识库上下文放在当前消息之前，摘要和历史组成不变的前缀以命中提供商的前缀缓存；classic：系统提示在最前
+    'PROMPT_LAYOUT': os.getenv('LLM_PROMPT_LAYOUT', 'prefix_cache'),
+    # 按提供商覆盖布局，如 {'Qwen': 'classic'}
+    'LAYOUT_OVERRIDES': {},
+}
+
+# 会话滚动摘要：未摘要消息超过阈值时由Celery任务生成摘要，历史使用 摘要 + 最近消息
+CONVERSATION_SUMMARY_CONFIG = {
+    'ENABLED': os.getenv('CONVERSATION_SUMMARY_ENABLED', 'True').lower() == 'true',
+    'TRIGGER_TOKENS': int(os.getenv('CONVERSATION_SUMMARY_TRIGGER_TOKENS', 3000)),
+    'KEEP_RECENT_MESSAGES': int(os.getenv('CONVERSATION_SUMMARY_KEEP_RECENT', 6)),
+    'MODEL': os.getenv('CONVERSATION_SUMMARY_MODEL', 'deepseek-chat'),
+    'MAX_SUMMARY_TOKENS': 500,
+    'LOCK_TIMEOUT': 300,
+}
+
+# 记录每条助手回复的token用量和延迟（MessageUsage），用于按模型统计成本和性能
+LLM_USAGE_TRACKING_ENABLED = os.getenv('LLM_USAGE_TRACKING_ENABLED', 'True').lower() == 'true'
+
+# 批量对话补全：单个任务的并发上限和检查点间隔，每个提供商的并发仍受LLM_CONCURRENCY_CONFIG限制
+LLM_BATCH_CONFIG = {
+    'MAX_ITEMS': int(os.getenv('LLM_BATCH_MAX_ITEMS', 50000)),
+    'CONCURRENCY': int(os.getenv('LLM_BATCH_CONCURRENCY', 16)),
+    'CHECKPOINT_SIZE': int(os.getenv('LLM_BATCH_CHECKPOINT_SIZE', 50)),
+    'QUEUE_TIMEOUT': int(os.getenv('LLM_BATCH_QUEUE_TIMEOUT', 600)),
+    'REQUEST_TIMEOUT': 120,
+    'LOCK_TIMEOUT': 600,              # 执行锁的有效期（秒），执行期间每HEARTBEAT_INTERVAL秒续期
+    'HEARTBEAT_INTERVAL': 60,
+}
+
+# 知识库批量写入：向量按批计算（可使用多进程），块汇总后批量upsert到Chroma
+KNOWLEDGE_BASE_INGESTION_CONFIG = {
+    'EMBED_BATCH_SIZE': int(os.getenv('KB_EMBED_BATCH_SIZE', 64)),
+    'EMBED_WORKERS': int(os.getenv('KB_EMBED_WORKERS', 1)),
+    'UPSERT_BATCH_SIZE': int(os.getenv('KB_UPSERT_BATCH_SIZE', 1000)),
+}
+
+# 知识库增量同步：按水位线只同步变更的记录，首次同步只包含最近的消息
+KNOWLEDGE_BASE_SYNC_CONFIG = {
+    'INITIAL_MESSAGE_LIMIT': int(os.getenv('KB_SYNC_INITIAL_MESSAGE_LIMIT', 500)),
+    'DELETE_BATCH_SIZE': 500,
+    'LOCK_TIMEOUT': 3600,
+}
+
+# 知识库块向量缓存：按(模型, 块内容哈希)持久化到磁盘，内容未变的块不再重新计算向量
+KNOWLEDGE_BASE_EMBEDDING_CACHE_CONFIG = {
+    'ENABLED': os.getenv('KB_EMBEDDING_CACHE_ENABLED', 'True').lower() == 'true',
+    'PATH': os.getenv('KB_EMBEDDING_CACHE_PATH', os.path.join(BASE_DIR, 'embedding_cache')),
+    'MAX_ENTRIES': int(os.getenv('KB_EMBEDDING_CACHE_MAX_ENTRIES', 200000)),
+}
+
+# 查询向量缓存：按规范化的问题文本缓存句向量（知识库搜索和语义缓存共用），并发的查询按时间窗口合并编码
+KNOWLEDGE_BASE_QUERY_CACHE_CONFIG = {
+    'ENABLED': os.getenv('KB_QUERY_CACHE_ENABLED', 'True').lower() == 'true',
+    'MAX_ENTRIES': int(os.getenv('KB_QUERY_CACHE_MAX_ENTRIES', 2048)),
+    # 设为api_cache等缓存别名时多个进程共享查询向量（生产环境为Redis）
+    'SHARED_ALIAS': os.getenv('KB_QUERY_CACHE_SHARED_ALIAS') or None,
+    'SHARED_TTL': 24 * 60 * 60,
+    'BATCH_WINDOW_MS': int(os.getenv('KB_QUERY_BATCH_WINDOW_MS', 5)),
+    'MAX_BATCH_SIZE': int(os.getenv('KB_QUERY_MAX_BATCH_SIZE', 32)),
 }
 
 # 微信开放平台配置
@@ -338,6 +506,9 @@ except:
         }
     }
 
+# WebSocket聊天：每个连接同时进行的生成请求上限
+CHAT_WS_MAX_CONCURRENT_GENERATIONS = int(os.getenv('CHAT_WS_MAX_CONCURRENT_GENERATIONS', '4'))
+
 # API限流配置
 RATELIMIT_ENABLE = True
 RATELIMIT_VIEW_RATE = '100/m'  # 每分钟100次请求
@@ -405,6 +576,14 @@ except:
         'default': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'unique-snowflake',
+        },
+        'api_cache': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'api-cache',
+            'TIMEOUT': 60 * 5,
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,
+            },
         }
     }
 
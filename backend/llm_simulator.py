@@ -0,0 +1,305 @@
+"""
+离线大模型提供商模拟器
+提供OpenAI兼容的 /v1/chat/completions 接口（支持stream=true）和Gemini兼容的
+/v1beta/models/{model}:generateContent、:streamGenerateContent?alt=sse 接口，用于基准测试和压测
+可配置延迟分布、token速率、500错误和429限流注入，以及usage中返回的前缀缓存命中比例
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from urllib.parse import urlsplit
+
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal', 'exponential')
+
+STATUS_TEXT = {200: 'OK', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+class FakeLLMProvider:
+    """
+    基于asyncio的OpenAI/Gemini兼容模拟服务
+    :param first_token_delay: 首token延迟（秒），按latency分布取样的均值
+    :param token_delay: token间隔（秒），传入tokens_per_second时按速率计算
+    :param tokens: 每次回复的token数量
+    :param latency: 首token延迟的分布，fixed / uniform / lognormal / exponential
+    :param jitter: uniform分布的相对波动范围（±jitter），lognormal分布的sigma
+    :param tokens_per_second: 生成速率，覆盖token_delay
+    :param error_rate: 返回500错误的比例
+    :param rate_limit_rate: 返回429的比例
+    :param prompt_cache_ratio: usage中报告为命中前缀缓存的提示词token比例（DeepSeek字段）
+    :param seed: 随机数种子，便于复现
+    """
+    def __init__(self, host='127.0.0.1', port=0, first_token_delay=0.2, token_delay=0.02, tokens=50,
+                 latency='fixed', jitter=0.5, tokens_per_second=None, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, prompt_cache_ratio=0.0, seed=None):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"未知的延迟分布: {latency}")
+        self.host = host
+        self.port = port
+        self.first_token_delay = first_token_delay
+        self.token_delay = 1 / tokens_per_second if tokens_per_second else token_delay
+        self.tokens = tokens
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.prompt_cache_ratio = prompt_cache_ratio
+        self.random = random.Random(seed)
+        self.server = None
+        self.connections = set()
+        self.requests_served = 0
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0}
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def completions_url(self):
+        return f"{self.base_url}/v1/chat/completions"
+
+    @property
+    def gemini_base_url(self):
+        return f"{self.base_url}/v1beta/models"
+
+    async def start(self):
+        """启动服务，port为0时自动分配端口"""
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # 关闭客户端连接池中保持的keep-alive连接
+            for task in list(self.connections):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+            await self.server.wait_closed()
+
+    def sample_first_token_delay(self) -> float:
+        """按配置的分布取样首token延迟"""
+        mean = self.first_token_delay
+        if self.latency == 'uniform':
+            return max(0.0, self.random.uniform(mean * (1 - self.jitter), mean * (1 + self.jitter)))
+        if self.latency == 'lognormal':
+            # 取样均值等于mean，sigma越大长尾越重
+            sigma = self.jitter
+            return self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0.0
+        if self.latency == 'exponential':
+            return self.random.expovariate(1 / mean) if mean > 0 else 0.0
+        return mean
+
+    async def _read_request(self, reader):
+        """读取一个HTTP请求，连接关闭时返回None，否则返回(path, payload)"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else '/'
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return path, json.loads(body or b'{}')
+
+    async def _write_chunk(self, writer, data: bytes):
+        writer.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        await writer.drain()
+
+    async def _send_json(self, writer, data, status=200, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        extra = ''.join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\nContent-Type: application/json\r\n{extra}"
+            f"Content-Length: {len(body)}\r\n\r\n".encode('ascii') + body
+        )
+        await writer.drain()
+
+    async def _handle_connection(self, reader, writer):
+        """处理一个keep-alive连接上的所有请求"""
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                path, payload = request
+                self.requests_served += 1
+                self.stats['requests'] += 1
+                if await self._inject_failure(writer):
+                    continue
+                gemini = ':generateContent' in path or ':streamGenerateContent' in path
+                stream = ':streamGenerateContent' in path if gemini else bool(payload.get('stream'))
+                if stream:
+                    self.stats['streams'] += 1
+                model = urlsplit(path).path.rsplit('/', 1)[-1].split(':')[0] if gemini else payload.get('model')
+                if gemini and stream:
+                    await self._gemini_stream_response(writer, payload, model)
+                elif gemini:
+                    await self._gemini_json_response(writer, payload, model)
+                elif stream:
+                    await self._stream_response(writer, payload)
+                else:
+                    await self._json_response(writer, payload)
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _inject_failure(self, writer) -> bool:
+        """按配置的比例返回500或429，返回是否已注入"""
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.stats['rate_limited'] += 1
+            await self._send_json(
+                writer, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}},
+                status=429, headers={'Retry-After': self.retry_after}
+            )
+            return True
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.stats['errors'] += 1
+            await self._send_json(writer, {'error': {'message': 'Injected failure', 'type': 'server_error'}}, status=500)
+            return True
+        return False
+
+    def _token_text(self, index):
+        return f"词{index} "
+
+    def _prompt_tokens(self, payload) -> int:
+        """按消息内容长度粗略估算提示词token数"""
+        texts = [json.dumps(message.get('content'), ensure_ascii=False) for message in payload.get('messages', [])]
+        texts += [json.dumps(content.get('parts'), ensure_ascii=False) for content in payload.get('contents', [])]
+        return max(1, sum(len(text) for text in texts) // 2)
+
+    def _usage(self, payload) -> dict:
+        prompt_tokens = self._prompt_tokens(payload)
+        hit = int(prompt_tokens * self.prompt_cache_ratio)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self.tokens,
+            'total_tokens': prompt_tokens + self.tokens,
+            'prompt_cache_hit_tokens': hit,
+            'prompt_cache_miss_tokens': prompt_tokens - hit,
+        }
+
+    def _gemini_usage(self, payload) -> dict:
+        prompt_tokens = self._prompt_tokens(payload)
+        return {
+            'promptTokenCount': prompt_tokens,
+            'candidatesTokenCount': self.tokens,
+            'totalTokenCount': prompt_tokens + self.tokens,
+            'cachedContentTokenCount': int(prompt_tokens * self.prompt_cache_ratio),
+        }
+
+    def _full_text(self):
+        return ''.join(self._token_text(i) for i in range(self.tokens))
+
+    async def _json_response(self, writer, payload):
+        await asyncio.sleep(self.sample_first_token_delay() + self.token_delay * self.tokens)
+        await self._send_json(writer, {
+            'id': f"chatcmpl-{self.requests_served}",
+            'model': payload.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self._full_text()}, 'finish_reason': 'stop'}],
+            'usage': self._usage(payload),
+        })
+
+    async def _stream_response(self, writer, payload):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self.sample_first_token_delay())
+        for index in range(self.tokens):
+            chunk = {
+                'id': f"chatcmpl-{self.requests_served}",
+                'model': payload.get('model'),
+                'created': int(time.time()),
+                'choices': [{'index': 0, 'delta': {'content': self._token_text(index)}}],
+            }
+            await self._write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(self.token_delay)
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            chunk = {'id': f"chatcmpl-{self.requests_served}", 'choices': [], 'usage': self._usage(payload)}
+            await self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        await self._write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _gemini_json_response(self, writer, payload, model):
+        await asyncio.sleep(self.sample_first_token_delay() + self.token_delay * self.tokens)
+        await self._send_json(writer, {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': self._full_text()}]}, 'finishReason': 'STOP'}],
+            'usageMetadata': self._gemini_usage(payload),
+            'modelVersion': model,
+        })
+
+    async def _gemini_stream_response(self, writer, payload, model):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await asyncio.sleep(self.sample_first_token_delay())
+        for index in range(self.tokens):
+            chunk = {
+                'candidates': [{'content': {'role': 'model', 'parts': [{'text': self._token_text(index)}]}}],
+                'modelVersion': model,
+            }
+            if index == self.tokens - 1:
+                chunk['candidates'][0]['finishReason'] = 'STOP'
+                chunk['usageMetadata'] = self._gemini_usage(payload)
+            await self._write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode('utf-8'))
+            await asyncio.sleep(self.token_delay)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def add_provider_arguments(parser):
+    """添加模拟提供商的命令行参数，压测脚本共用"""
+    parser.add_argument('--tokens', type=int, default=50, help='每次回复的token数量')
+    parser.add_argument('--first-token-delay', type=float, default=200, help='首token延迟均值（毫秒）')
+    parser.add_argument('--token-delay', type=float, default=20, help='token间隔（毫秒）')
+    parser.add_argument('--tokens-per-second', type=float, help='生成速率，覆盖--token-delay')
+    parser.add_argument('--latency', choices=LATENCY_DISTRIBUTIONS, default='fixed', help='首token延迟分布')
+    parser.add_argument('--jitter', type=float, default=0.5, help='uniform的相对波动范围 / lognormal的sigma')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500错误的比例')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回429的比例')
+    parser.add_argument('--prompt-cache-ratio', type=float, default=0.0, help='usage中命中前缀缓存的提示词比例')
+    parser.add_argument('--seed', type=int, help='随机数种子')
+
+
+def provider_from_args(args, host='127.0.0.1', port=0) -> FakeLLMProvider:
+    return FakeLLMProvider(
+        host=host, port=port,
+        first_token_delay=args.first_token_delay / 1000,
+        token_delay=args.token_delay / 1000,
+        tokens=args.tokens,
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        prompt_cache_ratio=args.prompt_cache_ratio,
+        seed=args.seed,
+    )
+
+
+async def _serve(args):
+    provider = provider_from_args(args, args.host, args.port)
+    await provider.start()
+    print(f"模拟提供商已启动: {provider.completions_url}")
+    print(f"Gemini兼容接口: {provider.gemini_base_url}")
+    await provider.server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='离线大模型提供商模拟器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8808)
+    add_provider_arguments(parser)
+    asyncio.run(_serve(parser.parse_args()))
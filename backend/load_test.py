@@ -0,0 +1,320 @@
+"""
+离线压测脚本
+启动内置的模拟提供商（llm_simulator），以目标RPS对 chat（/api/v1/messages/chat/）、stream_chat、function_router 和知识库搜索发起开环负载，
+统计吞吐量、延迟p50/p95/p99、流式首token时间（TTFT）和每个请求的数据库查询数
+可设置阈值，超出时以非零状态码退出，用于在CI中拦截性能回退：
+    python load_test.py --rps 20 --duration 30 --max-p95-ms 800 --max-error-rate 0.01
+"""
+import os
+import sys
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+# 设置Django环境
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from llm_simulator import add_provider_arguments, provider_from_args
+
+SCENARIOS = ('chat', 'stream_chat', 'function_router', 'knowledge_base')
+
+
+def percentile(values, pct):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def parse_mix(value):
+    """解析场景权重，如 chat=4,stream_chat=4,function_router=1,knowledge_base=1"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"未知的场景: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("至少需要一个权重大于0的场景")
+    return mix
+
+
+class ProviderThread:
+    """在后台线程的事件循环中运行模拟提供商，Django视图在压测线程中同步调用"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.provider.start(), self.loop).result()
+        return self.provider
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.provider.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class LoadRunner:
+    """按场景发起请求，每个压测线程使用自己的测试客户端和数据库连接"""
+
+    def __init__(self, args, token):
+        self.args = args
+        self.token = token
+        self.local = threading.local()
+
+    def _client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client()
+        return self.local.client
+
+    def _headers(self, index):
+        return {
+            'Authorization': f'Bearer {self.token}',
+            # 每个请求使用不同的来源IP，避免触发接口限流
+            'X-Forwarded-For': f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+        }
+
+    def run(self, scenario, index, scheduled):
+        """执行一个请求，延迟从计划发送时间算起，包含在线程池中排队的时间"""
+        client = self._client()
+        result = {'scenario': scenario}
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                getattr(self, f'_{scenario}')(client, index, scheduled, result)
+            result['queries'] = len(queries)
+        except Exception as e:
+            result['error'] = str(e)
+        result['latency'] = time.perf_counter() - scheduled
+        return result
+
+    def _post(self, client, path, data, index, **kwargs):
+        return client.post(path, data, content_type='application/json', headers=self._headers(index), **kwargs)
+
+    def _chat(self, client, index, scheduled, result):
+        response = self._post(client, '/api/v1/messages/chat/', {'message': f'压测消息 {index}', 'model': self.args.model}, index)
+        if response.status_code not in (200, 201):
+            result['error'] = f'HTTP {response.status_code}'
+
+    def _stream_chat(self, client, index, scheduled, result):
+        response = self._post(client, '/api/v1/stream-chat/', {'message': f'压测消息 {index}', 'model': self.args.model}, index)
+        if response.status_code != 200:
+            result['error'] = f'HTTP {response.status_code}'
+            return
+        for chunk in response.streaming_content:
+            for line in chunk.decode('utf-8').split('\n\n'):
+                if not line.startswith('data: '):
+                    continue
+                event = json.loads(line[len('data: '):])
+                if event['type'] == 'token' and 'ttft' not in result:
+                    result['ttft'] = time.perf_counter() - scheduled
+                elif event['type'] == 'error':
+                    result['error'] = event['message']
+
+    def _function_router(self, client, index, scheduled, result):
+        response = self._post(client, '/api/v1/function-router/', {'input': f'帮我写一首关于第{index}颗星星的诗', 'model': self.args.model}, index)
+        if response.status_code != 200:
+            result['error'] = f'HTTP {response.status_code}'
+
+    def _knowledge_base(self, client, index, scheduled, result):
+        response = self._post(client, '/api/v1/knowledge-base/search/', {'query': f'压测查询 {index % 50}', 'top_k': 5}, index)
+        if response.status_code != 200:
+            result['error'] = f'HTTP {response.status_code}'
+
+
+def run_load(args, token):
+    """按目标RPS均匀发送请求（开环：不等待前一个请求完成），返回所有结果和总耗时"""
+    runner = LoadRunner(args, token)
+    rng = random.Random(args.seed)
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    total = int(args.rps * args.duration)
+
+    # 预热导入、连接池和各场景的首次调用，不计入结果
+    for index, name in enumerate(names):
+        runner.run(name, 60000 + index, time.perf_counter())
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        start = time.perf_counter()
+        for index in range(total):
+            scheduled = start + index / args.rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            scenario = rng.choices(names, weights)[0]
+            futures.append(executor.submit(runner.run, scenario, index + 1, scheduled))
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summarize(results, elapsed):
+    """汇总整体和各场景的指标，延迟单位为毫秒"""
+    def stats(items):
+        ok = [r for r in items if 'error' not in r]
+        latencies = [r['latency'] * 1000 for r in ok]
+        ttfts = [r['ttft'] * 1000 for r in ok if 'ttft' in r]
+        queries = [r['queries'] for r in items if 'queries' in r]
+        summary = {
+            'requests': len(items),
+            'errors': len(items) - len(ok),
+            'error_rate': round((len(items) - len(ok)) / len(items), 4) if items else 0.0,
+            'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+            'latency_p50_ms': round(percentile(latencies, 50), 1),
+            'latency_p95_ms': round(percentile(latencies, 95), 1),
+            'latency_p99_ms': round(percentile(latencies, 99), 1),
+            'queries_avg': round(sum(queries) / len(queries), 2) if queries else 0.0,
+            'queries_max': max(queries) if queries else 0,
+        }
+        if ttfts:
+            summary.update({
+                'ttft_p50_ms': round(percentile(ttfts, 50), 1),
+                'ttft_p95_ms': round(percentile(ttfts, 95), 1),
+                'ttft_p99_ms': round(percentile(ttfts, 99), 1),
+            })
+        errors = [r['error'] for r in items if 'error' in r]
+        if errors:
+            summary['error_sample'] = errors[0]
+        return summary
+
+    scenarios = {}
+    for result in results:
+        scenarios.setdefault(result['scenario'], []).append(result)
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'overall': stats(results),
+        'scenarios': {name: stats(items) for name, items in sorted(scenarios.items())},
+    }
+
+
+def check_thresholds(args, summary):
+    """检查性能阈值，返回未通过的项"""
+    overall = summary['overall']
+    checks = [
+        (args.max_p95_ms, 'latency_p95_ms', '>'),
+        (args.max_p99_ms, 'latency_p99_ms', '>'),
+        (args.max_error_rate, 'error_rate', '>'),
+        (args.max_queries, 'queries_avg', '>'),
+        (args.min_throughput, 'throughput_rps', '<'),
+    ]
+    failures = []
+    for limit, key, op in checks:
+        if limit is None:
+            continue
+        value = overall[key]
+        if (op == '>' and value > limit) or (op == '<' and value < limit):
+            failures.append(f"{key}={value} {op} {limit}")
+    if args.max_ttft_p95_ms is not None:
+        stream = summary['scenarios'].get('stream_chat', {})
+        if stream.get('ttft_p95_ms', 0) > args.max_ttft_p95_ms:
+            failures.append(f"ttft_p95_ms={stream['ttft_p95_ms']} > {args.max_ttft_p95_ms}")
+    return failures
+
+
+def report(args, summary, provider_stats):
+    print("=" * 70)
+    print(f"目标RPS: {args.rps}  时长: {args.duration}秒  线程数: {args.workers}  模型: {args.model}")
+    print(f"模拟提供商: {args.latency}分布 首token {args.first_token_delay:.0f}ms, {args.tokens} tokens, "
+          f"500比例 {args.error_rate}, 429比例 {args.rate_limit_rate}")
+    print(f"提供商收到请求: {provider_stats['requests']}  注入500: {provider_stats['errors']}  注入429: {provider_stats['rate_limited']}")
+    print("-" * 70)
+    rows = [('overall', summary['overall'])] + list(summary['scenarios'].items())
+    for name, item in rows:
+        print(f"{name:<16} 请求 {item['requests']:<6} 失败 {item['errors']:<4} 吞吐 {item['throughput_rps']:.2f}/s  "
+              f"p50 {item['latency_p50_ms']:.1f}ms  p95 {item['latency_p95_ms']:.1f}ms  p99 {item['latency_p99_ms']:.1f}ms  "
+              f"查询 {item['queries_avg']:.1f}/{item['queries_max']}")
+        if 'ttft_p50_ms' in item:
+            print(f"{'':<16} TTFT p50 {item['ttft_p50_ms']:.1f}ms  p95 {item['ttft_p95_ms']:.1f}ms  p99 {item['ttft_p99_ms']:.1f}ms")
+        if 'error_sample' in item:
+            print(f"{'':<16} 错误示例: {item['error_sample']}")
+    print("=" * 70)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线压测：模拟提供商 + 开环负载生成')
+    parser.add_argument('--rps', type=float, default=10, help='目标每秒请求数')
+    parser.add_argument('--duration', type=float, default=10, help='压测时长（秒）')
+    parser.add_argument('--workers', type=int, default=32, help='并发线程数')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=4,stream_chat=4,function_router=1,knowledge_base=1'),
+                        help='场景权重，如 chat=4,stream_chat=4,function_router=1,knowledge_base=1')
+    parser.add_argument('--model', default='deepseek-chat', help='压测的模型，gemini开头的模型走Gemini兼容接口')
+    parser.add_argument('--with-cache', action='store_true', help='保留响应缓存和语义缓存（默认关闭，每个请求都访问提供商）')
+    parser.add_argument('--json', action='store_true', help='以JSON格式输出')
+    parser.add_argument('--output', help='把JSON结果写入文件，便于CI比较')
+    parser.add_argument('--max-p95-ms', type=float, help='整体p95延迟上限')
+    parser.add_argument('--max-p99-ms', type=float, help='整体p99延迟上限')
+    parser.add_argument('--max-ttft-p95-ms', type=float, help='stream_chat的TTFT p95上限')
+    parser.add_argument('--max-error-rate', type=float, help='整体错误率上限')
+    parser.add_argument('--max-queries', type=float, help='每个请求平均数据库查询数上限')
+    parser.add_argument('--min-throughput', type=float, help='整体吞吐量下限（每秒成功请求数）')
+    add_provider_arguments(parser)
+    args = parser.parse_args()
+
+    # 使用独立的测试数据库，不影响开发数据；SQLite使用临时文件，多线程写入时可以等待锁
+    if connection.vendor == 'sqlite':
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tempfile.mkdtemp(), 'load_test.sqlite3')
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        user = User.objects.create_user(username='loadtest', password='loadtest123')
+        token = str(RefreshToken.for_user(user).access_token)
+
+        provider = provider_from_args(args)
+        with ProviderThread(provider):
+            overrides = {
+                'LLM_CONFIG': dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='loadtest', GEMINI_API_KEY='loadtest'),
+                'DEEPSEEK_API_KEY': 'loadtest',
+                'GEMINI_API_KEY': 'loadtest',
+                'DEEPSEEK_API_BASE_URL': provider.completions_url,
+                'GEMINI_API_BASE_URL': provider.gemini_base_url,
+            }
+            if not args.with_cache:
+                overrides['LLM_RESPONSE_CACHE_CONFIG'] = dict(settings.LLM_RESPONSE_CACHE_CONFIG, ENABLED=False)
+                overrides['LLM_SEMANTIC_CACHE_CONFIG'] = dict(settings.LLM_SEMANTIC_CACHE_CONFIG, ENABLED=False)
+            with override_settings(**overrides):
+                results, elapsed = run_load(args, token)
+            provider_stats = dict(provider.stats)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    summary = summarize(results, elapsed)
+    summary['provider'] = provider_stats
+    failures = check_thresholds(args, summary)
+    summary['failures'] = failures
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        report(args, summary, provider_stats)
+        for failure in failures:
+            print(f"未通过: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
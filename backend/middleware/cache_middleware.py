@@ -35,7 +35,8 @@ class APICacheMiddleware(MiddlewareMixin):
         cached_response = cache.get(cache_key)
         if cached_response:
             logger.info(f"Cache hit for {request.path}")
-            return JsonResponse(cached_response)
+            # 列表类型的响应（如模型列表）需要safe=False
+            return JsonResponse(cached_response, safe=False)
         
         return None
 
@@ -87,6 +88,8 @@ class APICacheMiddleware(MiddlewareMixin):
             '/api/v1/chat/stream/',  # 流式聊天API
             '/api/v1/user/profile/',  # 实时用户资料
             '/api/v1/realtime/',     # 实时API
+            '/api/v1/models/',       # 模型列表包含实时的熔断状态
+            '/api/v1/health/',       # 健康检查
         ]
         
         return any(request.path.startswith(path) for path in no_cache_paths)
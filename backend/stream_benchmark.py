@@ -0,0 +1,144 @@
+"""
+异步流式聊天基准测试
+在本地模拟提供商上同时打开N个流，统计首token时间（TTFT）的p50/p99和每个流的内存占用
+"""
+import os
+import sys
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+import django
+
+# 设置Django环境
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import AsyncClient, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chatbot.models import Message
+from chatbot.utils.http_pool import close_async_clients
+from llm_simulator import FakeLLMProvider
+
+
+def percentile(values, pct):
+    """计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def open_stream(client, token, index, model):
+    """打开一个流并记录首token时间和总耗时"""
+    start = time.perf_counter()
+    response = await client.post(
+        '/api/v1/stream-chat/async/',
+        {'message': f'基准测试消息 {index}', 'model': model},
+        content_type='application/json',
+        headers={
+            'Authorization': f'Bearer {token}',
+            # 每个流使用不同的来源IP，避免触发接口限流
+            'X-Forwarded-For': f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+        },
+    )
+    if response.status_code != 200:
+        return {'error': f'HTTP {response.status_code}'}
+
+    ttft = None
+    tokens = 0
+    async for chunk in response.streaming_content:
+        for line in chunk.decode('utf-8').split('\n\n'):
+            if not line.startswith('data: '):
+                continue
+            event = json.loads(line[len('data: '):])
+            if event['type'] == 'token':
+                tokens += 1
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+            elif event['type'] == 'error':
+                return {'error': event['message']}
+    return {'ttft': ttft, 'total': time.perf_counter() - start, 'tokens': tokens}
+
+
+async def run_benchmark(args, token):
+    provider = await FakeLLMProvider(
+        first_token_delay=args.first_token_delay / 1000,
+        token_delay=args.token_delay / 1000,
+        tokens=args.tokens,
+    ).start()
+
+    llm_config = dict(settings.LLM_CONFIG, DEEPSEEK_API_KEY='benchmark')
+    client = AsyncClient()
+    try:
+        with override_settings(LLM_CONFIG=llm_config, DEEPSEEK_API_BASE_URL=provider.completions_url):
+            # 预热连接池和导入，避免计入首个流
+            await open_stream(client, token, 0, args.model)
+
+            tracemalloc.start()
+            baseline, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                open_stream(client, token, index + 1, args.model) for index in range(args.streams)
+            ])
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        await close_async_clients()
+        await provider.stop()
+
+    return results, elapsed, (peak - baseline) / max(args.streams, 1)
+
+
+def report(args, results, elapsed, memory_per_stream):
+    errors = [r['error'] for r in results if 'error' in r]
+    ok = [r for r in results if 'error' not in r]
+    ttfts = [r['ttft'] * 1000 for r in ok if r['ttft'] is not None]
+    totals = [r['total'] * 1000 for r in ok]
+
+    print("=" * 50)
+    print(f"并发流数量: {args.streams}  模型: {args.model}")
+    print(f"模拟提供商: 首token {args.first_token_delay:.0f}ms, token间隔 {args.token_delay:.0f}ms, {args.tokens} tokens")
+    print(f"成功: {len(ok)}  失败: {len(errors)}  总耗时: {elapsed:.2f}秒")
+    print(f"TTFT p50: {percentile(ttfts, 50):.1f}ms  p99: {percentile(ttfts, 99):.1f}ms")
+    print(f"总时长 p50: {percentile(totals, 50):.1f}ms  p99: {percentile(totals, 99):.1f}ms")
+    print(f"每个流的Python堆内存峰值: {memory_per_stream / 1024:.1f} KB")
+    if errors:
+        print(f"错误示例: {errors[0]}")
+    print("=" * 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='异步流式聊天基准测试')
+    parser.add_argument('--streams', type=int, default=100, help='并发流数量')
+    parser.add_argument('--tokens', type=int, default=50, help='每个回复的token数量')
+    parser.add_argument('--first-token-delay', type=float, default=200, help='模拟首token延迟（毫秒）')
+    parser.add_argument('--token-delay', type=float, default=20, help='模拟token间隔（毫秒）')
+    parser.add_argument('--model', default='deepseek-chat')
+    args = parser.parse_args()
+
+    # 使用独立的测试数据库，不影响开发数据
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        user = User.objects.create_user(username='benchmark', password='benchmark123')
+        token = str(RefreshToken.for_user(user).access_token)
+        results, elapsed, memory_per_stream = asyncio.run(run_benchmark(args, token))
+        report(args, results, elapsed, memory_per_stream)
+        print(f"保存的AI回复数: {Message.objects.filter(role='assistant').count()}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == "__main__":
+    sys.exit(main())